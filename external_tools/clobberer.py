@@ -1,19 +1,13 @@
 #!/usr/bin/python
 # vim:sts=2 sw=2
 import sys
-import shutil
 import urllib2
 import urllib
 import os
 import traceback
 import time
-if os.name == 'nt':
-    from win32file import RemoveDirectory, DeleteFile, \
-        GetFileAttributesW, SetFileAttributesW, \
-        FILE_ATTRIBUTE_NORMAL, FILE_ATTRIBUTE_DIRECTORY
-    from win32api import FindFiles
 
-clobber_suffix = '.deleteme'
+from reaper import clobber_suffix, delete_later, schedule_delete
 
 
 def ts_to_str(ts):
@@ -39,100 +33,29 @@ def read_file(fn):
     except ValueError:
         return None
 
-def rmdirRecursiveWindows(dir):
-    """Windows-specific version of rmdirRecursive that handles
-    path lengths longer than MAX_PATH.
-    """
-
-    dir = os.path.realpath(dir)
-    # Make sure directory is writable
-    SetFileAttributesW('\\\\?\\' + dir, FILE_ATTRIBUTE_NORMAL)
-
-    for ffrec in FindFiles('\\\\?\\' + dir + '\\*.*'):
-        file_attr = ffrec[0]
-        name = ffrec[8]
-        if name == '.' or name == '..':
-            continue
-        full_name = os.path.join(dir, name)
-
-        if file_attr & FILE_ATTRIBUTE_DIRECTORY:
-            rmdirRecursiveWindows(full_name)
-        else:
-            SetFileAttributesW('\\\\?\\' + full_name, FILE_ATTRIBUTE_NORMAL)
-            DeleteFile('\\\\?\\' + full_name)
-    RemoveDirectory('\\\\?\\' + dir)
-
-def rmdirRecursive(dir):
-    """This is a replacement for shutil.rmtree that works better under
-    windows. Thanks to Bear at the OSAF for the code.
-    (Borrowed from buildbot.slave.commands)"""
-    if os.name == 'nt':
-        rmdirRecursiveWindows(dir)
-        return
-
-    if not os.path.exists(dir):
-        # This handles broken links
-        if os.path.islink(dir):
-            os.remove(dir)
-        return
 
-    if os.path.islink(dir):
-        os.remove(dir)
-        return
-
-    # Verify the directory is read/write/execute for the current user
-    os.chmod(dir, 0700)
-
-    for name in os.listdir(dir):
-        full_name = os.path.join(dir, name)
-        # on Windows, if we don't have write permission we can't remove
-        # the file/directory either, so turn that on
-        if os.name == 'nt':
-            if not os.access(full_name, os.W_OK):
-                # I think this is now redundant, but I don't have an NT
-                # machine to test on, so I'm going to leave it in place
-                # -warner
-                os.chmod(full_name, 0600)
-
-        if os.path.isdir(full_name):
-            rmdirRecursive(full_name)
-        else:
-            # Don't try to chmod links
-            if not os.path.islink(full_name):
-                os.chmod(full_name, 0700)
-            os.remove(full_name)
-    os.rmdir(dir)
-
-
-def do_clobber(dir, dryrun=False, skip=None):
+def do_clobber(dir, dryrun=False, skip=None, background=True):
+    """Remove everything in dir but skip.  Directories are renamed to
+    *.deleteme and deleted by a background reaper (see reaper.py),
+    along with any left over from before, unless background is False.
+    """
+    trees = []
     try:
         for f in os.listdir(dir):
             if skip is not None and f in skip:
                 print "Skipping", f
                 continue
-            clobber_path = f + clobber_suffix
-            if os.path.isfile(f):
+            path = os.path.join(dir, f)
+            if os.path.isfile(path) or os.path.islink(path):
                 print "Removing", f
                 if not dryrun:
-                    if os.path.exists(clobber_path):
-                        os.unlink(clobber_path)
-                    # Prevent repeated moving.
-                    if f.endswith(clobber_suffix):
-                        os.unlink(f)
-                    else:
-                        shutil.move(f, clobber_path)
-                        os.unlink(clobber_path)
-            elif os.path.isdir(f):
+                    os.unlink(path)
+            elif os.path.isdir(path):
                 print "Removing %s/" % f
-                if not dryrun:
-                    if os.path.exists(clobber_path):
-                        rmdirRecursive(clobber_path)
-                    # Prevent repeated moving.
-                    if f.endswith(clobber_suffix):
-                        rmdirRecursive(f)
-                    else:
-                        shutil.move(f, clobber_path)
-                        rmdirRecursive(clobber_path)
+                if not dryrun and not f.endswith(clobber_suffix):
+                    trees.append(schedule_delete(path))
+        if not dryrun:
+            delete_later(trees, [dir], background=background)
     except:
         print "Couldn't clobber properly, bailing out."
         sys.exit(1)
@@ -179,6 +102,10 @@ if __name__ == "__main__":
                       dest='dir', default='.', type='string')
     parser.add_option('-v', '--verbose', help='be more verbose',
                       dest='verbose', action='store_true', default=False)
+    parser.add_option('--foreground', action='store_false',
+                      dest='background', default=True,
+                      help='delete directories before exiting, rather than '
+                      'in a background reaper')
 
     options, args = parser.parse_args()
     if len(args) != 6:
@@ -270,7 +197,8 @@ if __name__ == "__main__":
         if clobber:
             # Finally, perform a clobber if we're supposed to
             print "%s:Clobbering..." % builddir
-            do_clobber(builder_dir, options.dryrun, options.skip)
+            do_clobber(builder_dir, options.dryrun, options.skip,
+                       options.background)
             write_file(our_clobber_date, "last-clobber")
 
         # If this is the build dir for the current job, display the clobber type in TBPL.
@@ -15,26 +15,28 @@ are provided, subdirectories within those dirs will also be purged. This will
 obviously only increase the available space if the other base_dirs are on the
 same mountpoint, but this can be useful for, e.g., cleaning up scratchbox.
 
+Directories are renamed to *.deleteme and deleted by a background reaper
+(see reaper.py), unless --foreground is given.  The space they take counts
+as free already.
+
 example:
     python %prog -s 6 /builds/moz2_slave /scratchbox/users/cltbld/home/cltbld/build
 """
 
 import os
-import shutil
 import sys
+import time
 from fnmatch import fnmatch
 import re
 
-DEFAULT_BASE_DIRS = [".."]
+from reaper import clobber_suffix, delete_later, find_pending, \
+    schedule_delete, tree_size
 
-clobber_suffix = '.deleteme'
+DEFAULT_BASE_DIRS = [".."]
 
 if sys.platform == 'win32':
     # os.statvfs doesn't work on Windows
-    from win32file import RemoveDirectory, DeleteFile, \
-        GetFileAttributesW, SetFileAttributesW, GetDiskFreeSpace, \
-        FILE_ATTRIBUTE_NORMAL, FILE_ATTRIBUTE_DIRECTORY
-    from win32api import FindFiles
+    from win32file import GetDiskFreeSpace
 
     def freespace(p):
         secsPerClus, bytesPerSec, nFreeClus, totClus = GetDiskFreeSpace(p)
@@ -51,70 +53,48 @@ def mtime_sort(p1, p2):
     return cmp(os.path.getmtime(p1), os.path.getmtime(p2))
 
 
-def rmdirRecursiveWindows(dir):
-    """Windows-specific version of rmdirRecursive that handles
-    path lengths longer than MAX_PATH.
-    """
+class PendingDeletes(object):
+    """Trees renamed for the reaper, and the space they will free on
+    base_dir's filesystem once it has deleted them.
+
+    Measuring a tree means walking it, so trees added without a size
+    are only measured when freespace() needs them to be."""
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.device = os.stat(base_dir).st_dev
+        self.start_free = freespace(base_dir)
+        self.trees = []
+        self.scan_dirs = []
+        self.bytes = 0
+        self.unmeasured = []
+
+    def add(self, tree, size=None):
+        if tree in self.trees:
+            return
+        self.trees.append(tree)
+        if os.lstat(tree).st_dev != self.device:
+            return
+        if size is None:
+            self.unmeasured.append(tree)
+        else:
+            self.bytes += size
 
-    dir = os.path.realpath(dir)
-    # Make sure directory is writable
-    SetFileAttributesW('\\\\?\\' + dir, FILE_ATTRIBUTE_NORMAL)
+    def freespace(self, wanted=None):
+        """Free space as it will be when the reaper is done.  While it
+        runs, the space it has freed already is in freespace() as well
+        as in self.bytes, hence max() rather than a sum.
 
-    for ffrec in FindFiles('\\\\?\\' + dir + '\*.*'):
-        file_attr = ffrec[0]
-        name = ffrec[8]
-        if name == '.' or name == '..':
-            continue
-        full_name = os.path.join(dir, name)
+        Unmeasured trees are measured, oldest first, until wanted bytes
+        are known to be free; so with wanted, the result may be an
+        underestimate, but it's >= wanted if that much will be free."""
+        free = max(freespace(self.base_dir), self.start_free + self.bytes)
+        while self.unmeasured and (wanted is None or free < wanted):
+            self.bytes += tree_size(self.unmeasured.pop(0))
+            free = max(freespace(self.base_dir), self.start_free + self.bytes)
+        return free
 
-        if file_attr & FILE_ATTRIBUTE_DIRECTORY:
-            rmdirRecursiveWindows(full_name)
-        else:
-            SetFileAttributesW('\\\\?\\' + full_name, FILE_ATTRIBUTE_NORMAL)
-            DeleteFile('\\\\?\\' + full_name)
-    RemoveDirectory('\\\\?\\' + dir)
-
-
-def rmdirRecursive(dir):
-    """This is a replacement for shutil.rmtree that works better under
-    windows. Thanks to Bear at the OSAF for the code.
-    (Borrowed from buildbot.slave.commands)"""
-    if os.name == 'nt':
-        rmdirRecursiveWindows(dir)
-        return
-
-    if not os.path.exists(dir):
-        # This handles broken links
-        if os.path.islink(dir):
-            os.remove(dir)
-        return
-
-    if os.path.islink(dir):
-        os.remove(dir)
-        return
-
-    # Verify the directory is read/write/execute for the current user
-    os.chmod(dir, 0700)
-
-    for name in os.listdir(dir):
-        full_name = os.path.join(dir, name)
-        # on Windows, if we don't have write permission we can't remove
-        # the file/directory either, so turn that on
-        if os.name == 'nt':
-            if not os.access(full_name, os.W_OK):
-                # I think this is now redundant, but I don't have an NT
-                # machine to test on, so I'm going to leave it in place
-                # -warner
-                os.chmod(full_name, 0600)
-
-        if os.path.isdir(full_name):
-            rmdirRecursive(full_name)
-        else:
-            # Don't try to chmod links
-            if not os.path.islink(full_name):
-                os.chmod(full_name, 0700)
-            os.remove(full_name)
-    os.rmdir(dir)
+    def delete(self, background=True):
+        delete_later(self.trees, self.scan_dirs, background=background)
 
 
 def str2seconds(s):
@@ -133,7 +113,7 @@ def str2seconds(s):
         raise ValueError("Unhandled time format '%s'" % s)
 
 
-def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
+def purge(base_dirs, gigs, ignore, max_age, dry_run=False, pending=None):
     """Delete directories under `base_dirs` until `gigs` GB are free.
 
     Delete any directories older than max_age.
@@ -144,8 +124,15 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
       rel-*:40d
 
     Will not delete rel-* directories until they are over 40 days old.
+
+    Directories are only renamed for the reaper, and added to pending
+    (a PendingDeletes for base_dirs[0] by default), which is returned;
+    call its delete() to have them deleted.  *.deleteme directories
+    left in base_dirs are added too.
     """
     gigs *= 1024 * 1024 * 1024
+    if pending is None:
+        pending = PendingDeletes(base_dirs[0])
 
     # convert 'ignore' to a dict resembling { directory: cutoff_time }
     # where a cutoff time of -1 means 'never expire'.
@@ -155,9 +142,13 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
     dirs = []
     for base_dir in base_dirs:
         if os.path.exists(base_dir):
+            if not dry_run:
+                pending.scan_dirs.append(base_dir)
+                for p in find_pending([base_dir]):
+                    pending.add(p)
             for d in os.listdir(base_dir):
                 p = os.path.join(base_dir, d)
-                if not os.path.isdir(p):
+                if not os.path.isdir(p) or d.endswith(clobber_suffix):
                     continue
                 mtime = os.path.getmtime(p)
                 skip = False
@@ -180,27 +171,21 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
         # If we're newer than max_age, and don't need any more free space,
         # we're all done here
         if (not max_age) or (mtime > max_age):
-            if freespace(base_dirs[0]) >= gigs:
+            if pending.freespace(gigs) >= gigs:
                 break
 
         print "Deleting", d
         if not dry_run:
             try:
-                clobber_path = d + clobber_suffix
-                if os.path.exists(clobber_path):
-                    rmdirRecursive(clobber_path)
-                # Prevent repeated moving.
-                if d.endswith(clobber_suffix):
-                    rmdirRecursive(d)
-                else:
-                    shutil.move(d, clobber_path)
-                    rmdirRecursive(clobber_path)
+                pending.add(schedule_delete(d))
             except:
                 print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+    return pending
 
 
-def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
-    """Deletes old hg directories under share_dir"""
+def purge_hg_shares(share_dir, gigs, max_age, dry_run=False, pending=None):
+    """Deletes old hg directories under share_dir; see purge() for
+    pending, which is returned."""
     # Find hg directories
     hg_dirs = []
     for root, dirs, files in os.walk(share_dir):
@@ -212,17 +197,20 @@ def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
                 dirs.remove(d)
 
     # Now we have a list of hg directories, call purge on them
-    purge(hg_dirs, gigs, [], max_age, dry_run)
+    if not hg_dirs:
+        return pending
+    pending = purge(hg_dirs, gigs, [], max_age, dry_run, pending)
 
     # Clean up empty directories
     for d in hg_dirs:
         if not os.path.exists(os.path.join(d, '.hg')):
             print "Cleaning up", d
             if not dry_run:
-                rmdirRecursive(d)
+                # what's left is the checkout; its .hg is counted already
+                pending.add(schedule_delete(d), size=0)
+    return pending
 
 if __name__ == '__main__':
-    import time
     from optparse import OptionParser
     from ConfigParser import ConfigParser, NoOptionError
 
@@ -261,6 +249,11 @@ will be listed in the order in which they would be deleted.''')
             has an mtime older than this, it will be deleted, regardless of how
             much free space is required.  Set to 0 to disable.''')
 
+    parser.add_option('', '--foreground', action='store_false',
+                      dest='background', default=True,
+                      help='delete directories before exiting, rather than '
+                      'in a background reaper')
+
     options, base_dirs = parser.parse_args()
 
     if len(base_dirs) < 1:
@@ -277,22 +270,33 @@ will be listed in the order in which they would be deleted.''')
     else:
         cutoff_time = None
 
-    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run)
+    pending = purge(base_dirs, options.size, options.skip, cutoff_time,
+                    options.dry_run)
 
     # Try to cleanup shared hg repos. We run here even if we've freed enough
     # space so we can be sure and delete repositories older than max_age
+    share_pending = None
     if 'HG_SHARE_BASE_DIR' in os.environ:
-        purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'],
-                        options.share_size, cutoff_time, options.dry_run)
+        share_pending = purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'],
+                                        options.share_size, cutoff_time,
+                                        options.dry_run)
 
-    after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+    wanted = options.size * 1024 * 1024 * 1024
+    after = pending.freespace(wanted) / (1024 * 1024 * 1024.0)
 
     # Try to cleanup the current dir if we still need space and it will
     # actually help.
     if after < options.size:
         # We skip the tools dir here because we've usually just cloned it.
-        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run)
-        after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run,
+              pending)
+        wanted = options.size * 1024 * 1024 * 1024
+    after = pending.freespace(wanted) / (1024 * 1024 * 1024.0)
+
+    if not options.dry_run:
+        pending.delete(options.background)
+        if share_pending:
+            share_pending.delete(options.background)
 
     if after < options.size:
         print "Error: unable to free %1.2f GB of space. " % options.size + \
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Delete directory trees in the background.
+
+%prog [--workers N] [--scan dir ...] [tree ...]
+
+schedule_delete() renames a tree to <tree>.deleteme, which is quick and
+atomic; start_reaper() then runs this script, detached from the caller,
+to delete the trees on a pool of threads.  The reaper also deletes any
+*.deleteme trees it finds in the --scan directories, so the ones left
+behind by a crashed or killed reaper go the next time one starts.
+
+Each tree is flock()ed while it's deleted, so two reapers don't work
+on the same one.  Used by purge_builds.py and clobberer.py.
+"""
+
+import errno
+import multiprocessing
+import os
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+clobber_suffix = '.deleteme'
+
+try:
+    DEFAULT_WORKERS = min(multiprocessing.cpu_count(), 8)
+except NotImplementedError:
+    DEFAULT_WORKERS = 1
+
+if os.name == 'nt':
+    from win32file import RemoveDirectory, DeleteFile, \
+        SetFileAttributesW, FILE_ATTRIBUTE_NORMAL, FILE_ATTRIBUTE_DIRECTORY
+    from win32api import FindFiles
+
+
+def rmdirRecursiveWindows(dir):
+    """Windows-specific version of rmdirRecursive that handles
+    path lengths longer than MAX_PATH.
+    """
+
+    dir = os.path.realpath(dir)
+    # Make sure directory is writable
+    SetFileAttributesW('\\\\?\\' + dir, FILE_ATTRIBUTE_NORMAL)
+
+    for ffrec in FindFiles('\\\\?\\' + dir + '\\*.*'):
+        file_attr = ffrec[0]
+        name = ffrec[8]
+        if name == '.' or name == '..':
+            continue
+        full_name = os.path.join(dir, name)
+
+        if file_attr & FILE_ATTRIBUTE_DIRECTORY:
+            rmdirRecursiveWindows(full_name)
+        else:
+            SetFileAttributesW('\\\\?\\' + full_name, FILE_ATTRIBUTE_NORMAL)
+            DeleteFile('\\\\?\\' + full_name)
+    RemoveDirectory('\\\\?\\' + dir)
+
+
+def rmdirRecursive(dir):
+    """This is a replacement for shutil.rmtree that works better under
+    windows. Thanks to Bear at the OSAF for the code.
+    (Borrowed from buildbot.slave.commands)"""
+    if os.name == 'nt':
+        rmdirRecursiveWindows(dir)
+        return
+
+    if not os.path.exists(dir):
+        # This handles broken links
+        if os.path.islink(dir):
+            os.remove(dir)
+        return
+
+    if os.path.islink(dir):
+        os.remove(dir)
+        return
+
+    # Verify the directory is read/write/execute for the current user
+    os.chmod(dir, 0700)
+
+    for name in os.listdir(dir):
+        full_name = os.path.join(dir, name)
+        # on Windows, if we don't have write permission we can't remove
+        # the file/directory either, so turn that on
+        if os.name == 'nt':
+            if not os.access(full_name, os.W_OK):
+                # I think this is now redundant, but I don't have an NT
+                # machine to test on, so I'm going to leave it in place
+                # -warner
+                os.chmod(full_name, 0600)
+
+        if os.path.isdir(full_name):
+            rmdirRecursive(full_name)
+        else:
+            # Don't try to chmod links
+            if not os.path.islink(full_name):
+                os.chmod(full_name, 0700)
+            os.remove(full_name)
+    os.rmdir(dir)
+
+
+def tree_size(path):
+    """Bytes of disk used by the files under path."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+    return total
+
+
+def schedule_delete(path):
+    """Rename path to <path>.deleteme (or <path>-N.deleteme, if that's
+    taken) for the reaper to delete, and return the new name.  A path
+    that's already called *.deleteme is left where it is.
+    """
+    if path.endswith(clobber_suffix):
+        return path
+    dest = path + clobber_suffix
+    n = 0
+    while os.path.lexists(dest):
+        n += 1
+        dest = '%s-%d%s' % (path, n, clobber_suffix)
+    os.rename(path, dest)
+    return dest
+
+
+def find_pending(dirs):
+    """The *.deleteme entries in dirs."""
+    pending = []
+    for d in dirs:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in sorted(names):
+            if name.endswith(clobber_suffix):
+                pending.append(os.path.join(d, name))
+    return pending
+
+
+def _ignore_missing(func, *args):
+    try:
+        func(*args)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _remove_files(job):
+    dirpath, filenames = job
+    try:
+        # we need write permission on the directory to remove from it
+        os.chmod(dirpath, 0700)
+    except OSError:
+        pass
+    for name in filenames:
+        try:
+            _ignore_missing(os.remove, os.path.join(dirpath, name))
+        except OSError:
+            # rmdirRecursive() will have another go
+            pass
+
+
+def delete_tree(path, workers=DEFAULT_WORKERS):
+    """Delete the tree at path, removing the files in different
+    directories on different threads; unlink() releases the GIL."""
+    if os.name == 'nt' or workers <= 1 or \
+            os.path.islink(path) or not os.path.isdir(path):
+        if os.path.lexists(path):
+            if os.path.isdir(path) and not os.path.islink(path):
+                rmdirRecursive(path)
+            else:
+                os.remove(path)
+        return
+    jobs = []
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        # links to directories are listed in dirnames, but are files
+        links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+        if filenames or links:
+            jobs.append((dirpath, filenames + links))
+        dirs.append(dirpath)
+    pool = ThreadPool(workers)
+    try:
+        pool.map(_remove_files, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    try:
+        for d in dirs:
+            _ignore_missing(os.rmdir, d)
+    except OSError:
+        # e.g. something we couldn't list; the slow way copes with that
+        rmdirRecursive(path)
+
+
+def _lock_tree(path):
+    """Returns a locked fd for path, None if it's locked already, or
+    -1 if it can't be locked (not a directory, or no flock())."""
+    if fcntl is None:
+        return -1
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return -1
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def reap(trees, workers=DEFAULT_WORKERS):
+    """Delete trees, skipping those another reaper is deleting.
+    Returns the number of trees that couldn't be deleted."""
+    failures = 0
+    for tree in trees:
+        if not os.path.lexists(tree):
+            continue
+        fd = _lock_tree(tree)
+        if fd is None:
+            print "%s is being deleted by another reaper" % tree
+            continue
+        try:
+            delete_tree(tree, workers)
+        except Exception, e:
+            print >>sys.stderr, "Couldn't delete %s: %s" % (tree, e)
+            failures += 1
+        finally:
+            if fd >= 0:
+                os.close(fd)
+    return failures
+
+
+def start_reaper(trees=(), scan_dirs=(), workers=None):
+    """Run this script in the background to delete trees and the
+    *.deleteme entries in scan_dirs.  It's detached from us: it keeps
+    going after we exit, and doesn't hold on to our stdout.
+    Returns the Popen object.
+    """
+    cmd = [sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + '.py']
+    if workers:
+        cmd.extend(['--workers', str(workers)])
+    for d in scan_dirs:
+        cmd.extend(['--scan', os.path.abspath(d)])
+    cmd.extend([os.path.abspath(t) for t in trees])
+    devnull = open(os.devnull, 'r+')
+    kwargs = {}
+    if os.name == 'nt':
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        kwargs['creationflags'] = 0x00000008 | 0x00000200
+    else:
+        kwargs['close_fds'] = True
+        # its own session, so it outlives our process group
+        kwargs['preexec_fn'] = os.setsid
+    try:
+        return subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                                stderr=devnull, cwd='/' if os.name != 'nt' else None,
+                                **kwargs)
+    finally:
+        devnull.close()
+
+
+def delete_later(trees, scan_dirs=(), background=True, workers=None):
+    """Delete trees, already renamed by schedule_delete(), and any
+    leftovers in scan_dirs: in a background reaper, or right now if
+    background is False."""
+    if background:
+        start_reaper(trees, scan_dirs, workers)
+    else:
+        pending = list(trees) + [t for t in find_pending(scan_dirs)
+                                 if t not in trees]
+        reap(pending, workers or DEFAULT_WORKERS)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('-j', '--workers', dest='workers', type='int',
+                      default=DEFAULT_WORKERS,
+                      help='delete with this many threads (default %default)')
+    parser.add_option('--scan', dest='scan', action='append', default=[],
+                      help='also delete the *%s entries in this directory' % clobber_suffix)
+    options, trees = parser.parse_args()
+    trees += [t for t in find_pending(options.scan) if t not in trees]
+    sys.exit(reap(trees, options.workers) and 1 or 0)
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""In-process archive extraction.
+
+These extend mozfile.extract_zip() / mozfile.extract_tarball(), which
+unpack everything, one member at a time, with:
+
+  * patterns: unzip-style globs ('bin/*', 'mochitest/*'); only matching
+    members are extracted.
+  * parallel zip extraction on a thread pool; zlib and file I/O release
+    the GIL.
+  * skip_unchanged: a file that already has the member's size and CRC is
+    left alone, so re-running download-and-extract is cheap.
+  * extract_zip_stream(): extract from a file object read front to back,
+    such as a download in progress.
+  * members that would end up outside dest ('../foo', '/etc/foo') are
+    refused, as the unzip and tar commands these replace refuse them.
+
+rewrite_zip() adds, replaces and removes zip members without
+recompressing the others.
+"""
+
+import fnmatch
+import multiprocessing
+import os
+import shutil
+import stat
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from mozharness.base.errors import ExtractError
+
+try:
+    DEFAULT_WORKERS = min(multiprocessing.cpu_count(), 8)
+except NotImplementedError:
+    DEFAULT_WORKERS = 1
+BLOCK_SIZE = 1024 * 1024
+
+LOCAL_HEADER_SIG = 'PK\x03\x04'
+DATA_DESCRIPTOR_SIG = 'PK\x07\x08'
+LOCAL_HEADER = struct.Struct('<HHHHHIIIHH')
+
+
+def match_member(name, patterns):
+    """Does archive member name match any of patterns?  Like unzip,
+    '*' matches across directories, so 'bin/*' matches 'bin/a/b'.
+    """
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def _dest_path(dest, name):
+    """Return where member name goes under dest, refusing anything that
+    would end up outside it ('../foo', '/etc/foo').
+    """
+    root = os.path.realpath(dest)
+    # Resolve the directory but not the member itself, which may be a
+    # symlink we're about to replace.
+    path = os.path.join(root, name.rstrip('/'))
+    path = os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path))
+    if path != root and not path.startswith(root + os.sep):
+        raise ExtractError("%s would be extracted outside %s" % (name, dest))
+    return path
+
+
+def _file_crc(path):
+    crc = 0
+    fh = open(path, 'rb')
+    try:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), ''):
+            crc = zlib.crc32(block, crc)
+    finally:
+        fh.close()
+    return crc & 0xffffffff
+
+
+def _is_unchanged(path, size, crc):
+    return (os.path.isfile(path) and not os.path.islink(path) and
+            os.path.getsize(path) == size and _file_crc(path) == crc)
+
+
+def _remove(path):
+    # Replace rather than overwrite, so we never write through a
+    # hardlink or into a read-only file.
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def _set_mode(path, mode):
+    # Zips made on Windows carry no unix mode; keep the default then.
+    if mode & 0777:
+        os.chmod(path, mode & 0777)
+
+
+def _extract_zip_member(bundle, info, path, skip_unchanged):
+    mode = info.external_attr >> 16
+    if stat.S_ISLNK(mode):
+        target = bundle.read(info)
+        if os.path.islink(path) and os.readlink(path) == target:
+            return False
+        _remove(path)
+        os.symlink(target, path)
+        return True
+    if skip_unchanged and _is_unchanged(path, info.file_size, info.CRC):
+        _set_mode(path, mode)
+        return False
+    _remove(path)
+    member = bundle.open(info)
+    out = open(path, 'wb')
+    try:
+        shutil.copyfileobj(member, out, BLOCK_SIZE)
+    finally:
+        out.close()
+        member.close()
+    _set_mode(path, mode)
+    return True
+
+
+def extract_zip(src, dest, patterns=None, workers=DEFAULT_WORKERS,
+                skip_unchanged=True):
+    """Extract zip file src into dest.
+
+    Returns (names, extracted): the matching member names, and how many
+    files were actually written.
+    """
+    bundle = zipfile.ZipFile(src)
+    try:
+        infos = [info for info in bundle.infolist()
+                 if not patterns or match_member(info.filename, patterns)]
+    finally:
+        bundle.close()
+    files = []
+    dirs = set()
+    for info in infos:
+        path = _dest_path(dest, info.filename)
+        if info.filename.endswith('/'):
+            dirs.add(path)
+        else:
+            dirs.add(os.path.dirname(path))
+            files.append((info, path))
+    # Directories first, so the workers don't race to create them.
+    for path in sorted(dirs):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    # ZipFile objects aren't thread-safe; give each worker its own.
+    local = threading.local()
+    bundles = []
+
+    def extract_member(args):
+        if not hasattr(local, 'bundle'):
+            local.bundle = zipfile.ZipFile(src)
+            bundles.append(local.bundle)
+        return _extract_zip_member(local.bundle, args[0], args[1],
+                                   skip_unchanged)
+
+    if workers <= 1:
+        pool = None
+        map_ = map
+    else:
+        pool = ThreadPool(workers)
+        map_ = pool.map
+    try:
+        written = map_(extract_member, files)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        for b in bundles:
+            b.close()
+    return [info.filename for info in infos], sum(written)
+
+
+def apply_zip_modes(src, dest, patterns=None):
+    """Set unix modes and create symlinks for zip file src, extracted
+    into dest by extract_zip_stream().  Those live in the central
+    directory at the end of the archive, so streaming can't see them.
+    """
+    bundle = zipfile.ZipFile(src)
+    try:
+        for info in bundle.infolist():
+            if info.filename.endswith('/') or \
+                    (patterns and not match_member(info.filename, patterns)):
+                continue
+            path = _dest_path(dest, info.filename)
+            mode = info.external_attr >> 16
+            if stat.S_ISLNK(mode):
+                _remove(path)
+                os.symlink(bundle.read(info), path)
+            else:
+                _set_mode(path, mode)
+    finally:
+        bundle.close()
+
+
+class _PushbackReader(object):
+    """Just enough buffering over a file object to read exact byte
+    counts and push back what a decompressor didn't use.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.buf = ''
+
+    def read(self, size):
+        while len(self.buf) < size:
+            block = self.fileobj.read(max(size - len(self.buf), 64 * 1024))
+            if not block:
+                break
+            self.buf += block
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def read_block(self):
+        if self.buf:
+            data, self.buf = self.buf, ''
+            return data
+        return self.fileobj.read(64 * 1024)
+
+    def unread(self, data):
+        self.buf = data + self.buf
+
+
+def _zip64_sizes(extra, csize, usize):
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag == 1:
+            values = list(struct.unpack('<%dQ' % (length // 8), extra[4:4 + length]))
+            if usize == 0xffffffff:
+                usize = values.pop(0)
+            if csize == 0xffffffff:
+                csize = values.pop(0)
+            return csize, usize, True
+        extra = extra[4 + length:]
+    return csize, usize, False
+
+
+def extract_zip_stream(fileobj, dest, patterns=None):
+    """Extract a zip archive from fileobj, reading it once from front to
+    back by its local file headers.
+
+    Unix modes and symlinks aren't in the local headers; call
+    apply_zip_modes() on the complete archive afterwards.  Returns the
+    extracted member names.
+    """
+    reader = _PushbackReader(fileobj)
+    names = []
+    while reader.read(4) == LOCAL_HEADER_SIG:
+        (version, flags, method, mtime, mdate, crc, csize, usize,
+         name_length, extra_length) = LOCAL_HEADER.unpack(reader.read(LOCAL_HEADER.size))
+        name = reader.read(name_length)
+        csize, usize, zip64 = _zip64_sizes(reader.read(extra_length), csize, usize)
+        if flags & 0x1:
+            raise ExtractError("%s is encrypted" % name)
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ExtractError("%s: unsupported compression method %d" % (name, method))
+        if flags & 0x8 and method == zipfile.ZIP_STORED:
+            raise ExtractError("%s: can't stream a stored member of unknown size" % name)
+        path = _dest_path(dest, name)
+        out = None
+        if name.endswith('/'):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        elif not patterns or match_member(name, patterns):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            _remove(path)
+            out = open(path, 'wb')
+            names.append(name)
+        got_crc = 0
+        try:
+            if method == zipfile.ZIP_STORED:
+                remaining = csize
+                while remaining:
+                    data = reader.read(min(remaining, BLOCK_SIZE))
+                    if not data:
+                        raise ExtractError("%s is truncated" % name)
+                    remaining -= len(data)
+                    if out:
+                        got_crc = zlib.crc32(data, got_crc)
+                        out.write(data)
+            else:
+                decompressor = zlib.decompressobj(-15)
+                remaining = csize
+                while not decompressor.unused_data:
+                    if flags & 0x8:
+                        block = reader.read_block()
+                    elif remaining:
+                        block = reader.read(min(remaining, BLOCK_SIZE))
+                        remaining -= len(block)
+                    else:
+                        break
+                    if not block:
+                        raise ExtractError("%s is truncated" % name)
+                    data = decompressor.decompress(block)
+                    if out:
+                        got_crc = zlib.crc32(data, got_crc)
+                        out.write(data)
+                reader.unread(decompressor.unused_data)
+                data = decompressor.flush()
+                if out:
+                    got_crc = zlib.crc32(data, got_crc)
+                    out.write(data)
+        finally:
+            if out:
+                out.close()
+        if flags & 0x8:
+            descriptor = reader.read(4)
+            if descriptor == DATA_DESCRIPTOR_SIG:
+                descriptor = reader.read(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            reader.read(16 if zip64 else 8)
+        if out and got_crc & 0xffffffff != crc:
+            raise ExtractError("%s: CRC mismatch" % name)
+    return names
+
+
+def _copy_raw_member(src_fh, info, out):
+    """Append member info of the zip open as src_fh to ZipFile out,
+    copying its compressed bytes as they are."""
+    src_fh.seek(info.header_offset)
+    if src_fh.read(4) != LOCAL_HEADER_SIG:
+        raise ExtractError("%s: bad local header" % info.filename)
+    header = LOCAL_HEADER.unpack(src_fh.read(LOCAL_HEADER.size))
+    src_fh.seek(header[-2] + header[-1], os.SEEK_CUR)
+    new_info = _copy_info(info)
+    # The sizes and CRC go in the local header, so no data descriptor.
+    new_info.flag_bits &= ~0x08
+    _write_member(out, new_info, _read_exactly(src_fh, info.compress_size))
+
+
+def _read_exactly(fh, size):
+    while size:
+        data = fh.read(min(size, BLOCK_SIZE))
+        if not data:
+            raise ExtractError("unexpected end of zip data")
+        size -= len(data)
+        yield data
+
+
+def _copy_info(info):
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    for attr in ('compress_type', 'comment', 'extra', 'create_system',
+                 'create_version', 'extract_version', 'flag_bits',
+                 'internal_attr', 'external_attr', 'CRC', 'compress_size',
+                 'file_size'):
+        setattr(new_info, attr, getattr(info, attr))
+    # ZipFile writes its own zip64 extra field when it's needed.
+    new_info.extra = _strip_zip64_extra(info.extra)
+    return new_info
+
+
+def _strip_zip64_extra(extra):
+    kept = []
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag != 1:
+            kept.append(extra[:4 + length])
+        extra = extra[4 + length:]
+    return ''.join(kept)
+
+
+def _write_member(out, info, blocks):
+    """Write a member whose compress_size and CRC are already set, and
+    whose compressed data is the iterable blocks, to ZipFile out."""
+    info.header_offset = out.fp.tell()
+    out.fp.write(info.FileHeader())
+    for block in blocks:
+        out.fp.write(block)
+    out.filelist.append(info)
+    out.NameToInfo[info.filename] = info
+    out._didModify = True
+
+
+def _new_member(info, data, compresslevel):
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data) & 0xffffffff
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return [data]
+
+
+def rewrite_zip(src, dest, add=None, remove=None, compresslevel=9):
+    """Copy zip file src to dest, with the members in add ({name: data})
+    added or replaced and the ones matching the unzip-style globs in
+    remove left out.  src and dest are paths or file objects.
+
+    The compressed bytes of every other member are copied as they are;
+    only the members in add are compressed.  A replaced member keeps its
+    place, compression method and attributes; new ones are deflated and
+    go at the end.
+
+    Returns {'copied': n, 'added': n, 'replaced': n, 'removed': n}.
+    """
+    add = dict(add or {})
+    counts = {'copied': 0, 'added': 0, 'replaced': 0, 'removed': 0}
+    bundle = zipfile.ZipFile(src)
+    try:
+        out = zipfile.ZipFile(dest, 'w', allowZip64=True)
+        try:
+            for info in bundle.infolist():
+                if info.filename in add:
+                    new_info = _copy_info(info)
+                    new_info.flag_bits &= ~0x08
+                    new_info.extra = ''
+                    _write_member(out, new_info,
+                                  _new_member(new_info, add.pop(info.filename),
+                                              compresslevel))
+                    counts['replaced'] += 1
+                elif remove and match_member(info.filename, remove):
+                    counts['removed'] += 1
+                elif info.flag_bits & 0x1:
+                    raise ExtractError("%s is encrypted" % info.filename)
+                else:
+                    _copy_raw_member(bundle.fp, info, out)
+                    counts['copied'] += 1
+            for name in sorted(add):
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0644 << 16
+                _write_member(out, info, _new_member(info, add[name], compresslevel))
+                counts['added'] += 1
+        finally:
+            out.close()
+    finally:
+        bundle.close()
+    return counts
+
+
+class TeeReader(object):
+    """Wrap file object src, copying everything read from it to out.
+    self.length counts the bytes read so far."""
+    def __init__(self, src, out):
+        self.src = src
+        self.out = out
+        self.length = 0
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.out.write(data)
+        self.length += len(data)
+        return data
+
+    def drain(self):
+        """Copy whatever hasn't been read yet."""
+        while self.read(BLOCK_SIZE):
+            pass
+
+
+def extract_tarball(src, dest, patterns=None):
+    """Extract tarball src into dest; returns the extracted member names.
+
+    Like extract_tarball_stream(), each member is checked just before
+    it's extracted, so nothing ends up outside dest, even by way of a
+    symlink extracted earlier.
+    """
+    bundle = tarfile.open(src)
+    try:
+        members = [m for m in bundle.getmembers()
+                   if not patterns or match_member(m.name, patterns)]
+        for member in members:
+            _dest_path(dest, member.name)
+            bundle.extract(member, dest)
+    finally:
+        bundle.close()
+    return [m.name for m in members]
+
+
+def extract_tarball_stream(fileobj, dest, patterns=None):
+    """Extract a (possibly compressed) tarball from fileobj in a single
+    pass; returns the extracted member names.
+    """
+    names = []
+    bundle = tarfile.open(fileobj=fileobj, mode='r|*')
+    try:
+        for member in bundle:
+            if patterns and not match_member(member.name, patterns):
+                continue
+            _dest_path(dest, member.name)
+            bundle.extract(member, dest)
+            names.append(member.name)
+    finally:
+        bundle.close()
+    return names
@@ -26,8 +26,12 @@ TODO:
 
 from copy import deepcopy
 from optparse import OptionParser, Option, OptionGroup
+import hashlib
+import marshal
 import os
+import platform
 import sys
+import tempfile
 import urllib2
 import socket
 import time
@@ -65,7 +69,11 @@ class ExtendOption(Option):
 
 
 def make_immutable(item):
-    if isinstance(item, list) or isinstance(item, tuple):
+    if isinstance(item, LockedTuple) or \
+            (isinstance(item, ReadOnlyDict) and item._lock):
+        # Already frozen; share it rather than copying it again.
+        result = item
+    elif isinstance(item, list) or isinstance(item, tuple):
         result = LockedTuple(item)
     elif isinstance(item, dict):
         result = ReadOnlyDict(item)
@@ -83,7 +91,39 @@ class LockedTuple(tuple):
 
 
 # ReadOnlyDict {{{1
+# frozen values, by their marshal.dumps()
+_frozen_values = {}
+
+
+def _make_immutable_cached(item):
+    """make_immutable(), reusing the frozen copy of an equal value if
+    one was made before.
+
+    Parsed configs come out of marshal snapshots, so the same values
+    are locked again and again; marshal.dumps() walks them far faster
+    than make_immutable() does.  Values marshal can't handle (including
+    ones that are already frozen) go straight to make_immutable().
+    """
+    if not isinstance(item, (dict, list, tuple)):
+        return item
+    try:
+        key = marshal.dumps(item)
+    except ValueError:
+        return make_immutable(item)
+    frozen = _frozen_values.get(key)
+    if frozen is None:
+        frozen = _frozen_values[key] = make_immutable(item)
+    return frozen
+
+
 class ReadOnlyDict(dict):
+    """A dict that can be locked against changes.
+
+    lock() replaces every nested dict and list with its make_immutable()
+    copy, so nothing done to the dict this one was made from shows up in
+    it afterwards.  Values that are already frozen, or equal to one
+    frozen before, are shared rather than copied again.
+    """
     def __init__(self, dictionary):
         self._lock = False
         self.update(dictionary.copy())
@@ -92,8 +132,8 @@ class ReadOnlyDict(dict):
         assert not self._lock, "ReadOnlyDict is locked!"
 
     def lock(self):
-        for (k, v) in self.items():
-            self[k] = make_immutable(v)
+        for (k, v) in dict.items(self):
+            dict.__setitem__(self, k, _make_immutable_cached(v))
         self._lock = True
 
     def __setitem__(self, *args):
@@ -131,10 +171,80 @@ class ReadOnlyDict(dict):
         for k, v in self.__dict__.items():
             setattr(result, k, deepcopy(v, memo))
         result._lock = False
-        for k, v in self.items():
+        for k, v in dict.items(self):
             result[k] = deepcopy(v, memo)
         return result
 
+
+# parse_config_file {{{1
+# marshalled configs, by _config_cache_key()
+_config_snapshots = {}
+
+
+def _config_cache_key(file_path, contents, config_dict_name):
+    """Key a .py config's parsed contents.
+
+    Besides the file itself, this covers what configs read from their
+    surroundings: cwd, sys.executable, os.environ, hostname, platform.
+    """
+    st = os.stat(file_path)
+    key = [os.path.abspath(file_path), st.st_mtime, st.st_size,
+           config_dict_name, sys.version, sys.executable, sys.path[0],
+           os.getcwd(), socket.gethostname(), platform.system(),
+           platform.machine(), sorted(os.environ.items())]
+    return hashlib.sha1(contents + repr(key)).hexdigest()
+
+
+def _exec_config_file(file_path, config_dict_name):
+    """execfile() a .py config, caching the result.
+
+    Configs are kept as marshal snapshots, so each caller gets a fresh
+    copy, in memory and, if $MOZHARNESS_CONFIG_CACHE names a directory,
+    on disk for later runs.  Configs holding anything marshal can't
+    handle (compiled regexes, class instances) aren't cached.
+    """
+    fh = open(file_path, 'rb')
+    contents = fh.read()
+    fh.close()
+    key = _config_cache_key(file_path, contents, config_dict_name)
+    cache_dir = os.environ.get('MOZHARNESS_CONFIG_CACHE')
+    snapshot_path = None
+    if cache_dir:
+        snapshot_path = os.path.join(cache_dir, '%s.marshal' % key)
+    snapshot = _config_snapshots.get(key)
+    if snapshot is None and snapshot_path and os.path.exists(snapshot_path):
+        fh = open(snapshot_path, 'rb')
+        snapshot = fh.read()
+        fh.close()
+    if snapshot:
+        try:
+            config = marshal.loads(snapshot)
+            _config_snapshots[key] = snapshot
+            return config
+        except (EOFError, ValueError, TypeError):
+            pass
+    global_dict = {}
+    local_dict = {}
+    execfile(file_path, global_dict, local_dict)
+    config = local_dict[config_dict_name]
+    try:
+        snapshot = marshal.dumps(config)
+    except ValueError:
+        return config
+    _config_snapshots[key] = snapshot
+    if snapshot_path:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            os.write(fd, snapshot)
+            os.close(fd)
+            os.rename(tmp_path, snapshot_path)
+        except (IOError, OSError):
+            pass
+    return config
+
+
 # parse_config_file {{{1
 def parse_config_file(file_name, quiet=False, search_path=None,
                       config_dict_name="config"):
@@ -154,10 +264,7 @@ def parse_config_file(file_name, quiet=False, search_path=None,
         else:
             raise IOError("Can't find %s in %s!" % (file_name, search_path))
     if file_name.endswith('.py'):
-        global_dict = {}
-        local_dict = {}
-        execfile(file_path, global_dict, local_dict)
-        config = local_dict[config_dict_name]
+        config = _exec_config_file(file_path, config_dict_name)
     elif file_name.endswith('.json'):
         fh = open(file_path)
         config = {}
@@ -335,6 +442,11 @@ class BaseConfig(object):
             dest="no_actions", metavar="ACTIONS",
             help="Don't perform action"
         )
+        action_option_group.add_option(
+            "--parallel-actions", action="store", type="int",
+            dest="parallel_actions", metavar="N",
+            help="Run up to N independent actions at once"
+        )
         for action in self.all_actions:
             action_option_group.add_option(
                 "--%s" % action, action="append_const",
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""A persistent, content-addressed cache for downloaded files.
+
+Consecutive jobs on the same machine keep downloading the same
+installers, tests.zip, symbols, etc.  DownloadCache keeps one copy of each
+file under self.config['download_cache_dir']:
+
+    blobs/<sha512[:2]>/<sha512>   the file contents, read-only
+    urls/<sha1(url)>.json         url, sha512, size, ETag, Last-Modified
+    locks/                        per-url and global lock files
+
+A cached url is revalidated with a conditional HEAD request before use;
+if the caller knows the sha512 it wants, no request is needed at all.
+Hits are reflinked or, failing that, copied into place.  Callers that
+won't change the file can ask for a hardlink to the read-only blob
+instead (fetch(..., read_only=True)).
+
+The cache is capped at self.config['download_cache_max_size'] bytes
+(default 10 GiB), evicting least recently used blobs first.  Several
+mozharness processes may share one cache; all changes are made under
+flock() and files are moved into place atomically.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import urllib2
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from mozharness.base.log import LogMixin
+from mozharness.base.script import ScriptMixin
+from mozharness.base.signing import BaseSigningMixin
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+# DownloadCache {{{1
+class DownloadCache(ScriptMixin, LogMixin, BaseSigningMixin):
+    """Content-addressed download cache.
+
+    Usage:
+
+        cache = DownloadCache(self.config, self.log_obj, self._urlopen)
+        cache.fetch(url, file_name,
+                    lambda path: self._retry_download_file(url, path, ERROR))
+    """
+    default_max_size = 10 * 1024 ** 3
+
+    def __init__(self, config, log_obj, urlopen=None, hash_cache=None):
+        self.config = config
+        self.log_obj = log_obj
+        if urlopen:
+            # e.g. TestingMixin._urlopen, which knows about credentials
+            self._urlopen = urlopen
+        if hash_cache:
+            # share the script's, so files are only hashed once
+            self._hash_cache = hash_cache
+        self.cache_dir = os.path.abspath(config['download_cache_dir'])
+        self.max_size = config.get('download_cache_max_size',
+                                   self.default_max_size)
+        self.use_hardlinks = config.get('download_cache_hardlinks', True)
+        for subdir in ('blobs', 'urls', 'locks', 'tmp'):
+            self.mkdir_p(os.path.join(self.cache_dir, subdir))
+
+    @contextmanager
+    def lock(self, name):
+        """flock() locks/<name> for the duration of a with block.
+        Without fcntl (Windows) this is a no-op.
+        """
+        fh = open(os.path.join(self.cache_dir, 'locks', name), 'a')
+        try:
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing releases the lock
+            fh.close()
+
+    def _url_key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _blob_path(self, sha512):
+        return os.path.join(self.cache_dir, 'blobs', sha512[:2], sha512)
+
+    def _entry_path(self, url):
+        return os.path.join(self.cache_dir, 'urls', '%s.json' % self._url_key(url))
+
+    def query_entry(self, url):
+        """Return the cache entry dict for url, or None."""
+        try:
+            fh = open(self._entry_path(url))
+            try:
+                return json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+
+    def _write_entry(self, url, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.cache_dir, 'tmp'))
+        fh = os.fdopen(fd, 'w')
+        json.dump(entry, fh)
+        fh.close()
+        os.rename(tmp_path, self._entry_path(url))
+
+    def _query_headers(self, url, entry=None):
+        """Send a HEAD request for url, conditional on entry's validators.
+
+        Returns (headers, not_modified); headers is None if the request
+        failed.
+        """
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        if entry:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            response = self._urlopen(request, timeout=30)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return e.info(), True
+            self.info("Can't validate cache entry for %s: %s" % (url, str(e)))
+            return None, False
+        except Exception, e:
+            self.info("Can't validate cache entry for %s: %s" % (url, str(e)))
+            return None, False
+        headers = response.info()
+        response.close()
+        not_modified = False
+        if entry and (entry.get('etag') or entry.get('last_modified')):
+            # Servers that ignore conditional requests; compare ourselves.
+            not_modified = (
+                headers.get('etag') == entry.get('etag') and
+                headers.get('last-modified') == entry.get('last_modified') and
+                headers.get('content-length') in (None, str(entry['size']))
+            )
+        return headers, not_modified
+
+    def _link(self, src, dest, read_only=False):
+        """Put a copy of blob src at dest: a reflink where the filesystem
+        supports it, else a plain copy.
+
+        If read_only, a hardlink will do instead of the copy.  dest then
+        shares the blob's inode: it can't be written, and its mtime moves
+        whenever the blob is used.
+        """
+        if os.path.exists(dest):
+            os.remove(dest)
+        if fcntl:
+            try:
+                src_fh = open(src, 'rb')
+                try:
+                    dest_fh = open(dest, 'wb')
+                    try:
+                        fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+                        return 'reflink'
+                    finally:
+                        dest_fh.close()
+                finally:
+                    src_fh.close()
+            except (IOError, OSError):
+                os.remove(dest)
+        if read_only and self.use_hardlinks and hasattr(os, 'link'):
+            try:
+                os.link(src, dest)
+                return 'hardlink'
+            except OSError:
+                pass
+        shutil.copyfile(src, dest)
+        return 'copy'
+
+    def _use_blob(self, sha512, file_name, read_only=False):
+        """Link blob sha512 to file_name and mark it recently used.
+        Returns False if the blob has gone away (e.g. evicted).
+        """
+        blob_path = self._blob_path(sha512)
+        try:
+            how = self._link(blob_path, file_name, read_only)
+            os.utime(blob_path, None)
+        except (IOError, OSError):
+            return False
+        self.info("Using cached %s (%s) for %s." % (sha512[:12], how, file_name))
+        return True
+
+    def add(self, url, file_name, headers=None):
+        """Copy file_name into the cache as the contents of url."""
+        sha512 = self.query_sha512sum(file_name)
+        blob_path = self._blob_path(sha512)
+        self.mkdir_p(os.path.dirname(blob_path))
+        if not os.path.exists(blob_path):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.cache_dir, 'tmp'))
+            os.close(fd)
+            shutil.copyfile(file_name, tmp_path)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp_path, blob_path)
+        headers = headers or {}
+        with self.lock('global'):
+            self._write_entry(url, {
+                'url': url,
+                'sha512': sha512,
+                'size': os.path.getsize(blob_path),
+                'etag': headers.get('etag'),
+                'last_modified': headers.get('last-modified'),
+            })
+            self.evict()
+        return sha512
+
+    def fetch(self, url, file_name, download, expected_hash=None,
+              read_only=False):
+        """Put the contents of url at file_name, from the cache if we can.
+
+        download(file_name) is called on a miss; it must return file_name
+        on success, like ScriptMixin.download_file().  expected_hash is
+        the sha512 the caller wants, if known.  read_only lets a hit be
+        hardlinked to the cached blob; see _link().
+        """
+        if expected_hash and \
+                self._use_blob(expected_hash.lower(), file_name, read_only):
+            return file_name
+        if not url.startswith('http'):
+            return download(file_name)
+        with self.lock(self._url_key(url)):
+            entry = self.query_entry(url)
+            headers, not_modified = self._query_headers(url, entry)
+            if entry and not_modified and \
+                    (not expected_hash or entry['sha512'] == expected_hash.lower()) and \
+                    self._use_blob(entry['sha512'], file_name, read_only):
+                return file_name
+            self.info("Download cache miss for %s." % url)
+            status = download(file_name)
+            if status == file_name and headers is not None:
+                try:
+                    self.add(url, file_name, headers)
+                except (IOError, OSError), e:
+                    self.warning("Can't add %s to the download cache: %s" %
+                                 (file_name, str(e)))
+            return status
+
+    def evict(self):
+        """Remove least recently used blobs until the cache fits in
+        self.max_size.  Call with the global lock held.
+        """
+        blobs = []
+        total = 0
+        blob_dir = os.path.join(self.cache_dir, 'blobs')
+        for root, dirs, files in os.walk(blob_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                blobs.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        blobs.sort()
+        evicted = set()
+        while total > self.max_size and blobs:
+            mtime, size, path = blobs.pop(0)
+            self.info("Evicting %s from the download cache." % path)
+            os.remove(path)
+            evicted.add(os.path.basename(path))
+            total -= size
+        if not evicted:
+            return
+        url_dir = os.path.join(self.cache_dir, 'urls')
+        for name in os.listdir(url_dir):
+            path = os.path.join(url_dir, name)
+            try:
+                entry = json.load(open(path))
+            except (IOError, ValueError):
+                continue
+            if entry.get('sha512') in evicted:
+                os.remove(path)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Hash files once, for every digest we need.
+
+hash_file() reads a file a single time, through mmap where it can, and
+feeds each block to several hashlib digests (sha1, sha256, sha512 and
+md5 by default).  It also returns the size.
+
+HashCache remembers the results for as long as a file stays unchanged,
+by (st_dev, st_ino, st_size, mtime in ns), so an installer that is
+hashed for the build properties, signing, Balrog and upload is only
+read once per job.  hash_files() hashes batches on a thread pool;
+hashlib releases the GIL for large updates.
+
+ScriptMixin.query_file_hashes() and file_hash() use a HashCache that
+lives as long as the script.
+"""
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    DEFAULT_WORKERS = min(multiprocessing.cpu_count(), 8)
+except NotImplementedError:
+    DEFAULT_WORKERS = 1
+DEFAULT_HASH_TYPES = ('sha1', 'sha256', 'sha512', 'md5')
+BLOCK_SIZE = 1024 * 1024
+
+
+def _blocks(fh):
+    """Yield the contents of the open file fh in BLOCK_SIZE pieces,
+    from a memory map if possible."""
+    try:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, OverflowError, EnvironmentError):
+        # empty files can't be mapped, nor can some special files; and
+        # 32bit processes run out of address space.
+        mapped = None
+    if mapped is None:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), ''):
+            yield block
+        return
+    try:
+        for offset in xrange(0, len(mapped), BLOCK_SIZE):
+            # buffer() doesn't copy
+            yield buffer(mapped, offset, BLOCK_SIZE)
+    finally:
+        mapped.close()
+
+
+def hash_file(path, hash_types=DEFAULT_HASH_TYPES):
+    """Read path once and return {hash_type: hexdigest, 'size': size}.
+    hash_types are hashlib.new() names.
+    """
+    hashers = [(hash_type, hashlib.new(hash_type)) for hash_type in hash_types]
+    size = 0
+    fh = open(path, 'rb')
+    try:
+        for block in _blocks(fh):
+            size += len(block)
+            for hash_type, hasher in hashers:
+                hasher.update(block)
+    finally:
+        fh.close()
+    result = dict((hash_type, hasher.hexdigest()) for hash_type, hasher in hashers)
+    result['size'] = size
+    return result
+
+
+def file_key(path):
+    """(st_dev, st_ino, st_size, mtime in ns) of path; if it changes,
+    the contents may have."""
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10 ** 9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+# HashCache {{{1
+class HashCache(object):
+    """Digests of the files hashed so far.  Thread-safe.
+
+        cache = HashCache()
+        cache.query(path)['sha512']
+
+    hash_types is what query() computes on a miss; asking for a digest
+    that isn't among them hashes the file again, for all of them.
+    """
+    def __init__(self, hash_types=DEFAULT_HASH_TYPES):
+        self.hash_types = tuple(hash_types)
+        self.lock = threading.Lock()
+        # {file_key: {hash_type: hexdigest, 'size': size}}
+        self.entries = {}
+
+    def lookup(self, path, hash_types=()):
+        """Returns the cached result for path, if it has hash_types."""
+        key = file_key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and all(t in entry for t in hash_types):
+            return entry
+        return None
+
+    def query(self, path, hash_types=()):
+        """Returns {hash_type: hexdigest, 'size': size} for path, with at
+        least self.hash_types and hash_types in it.
+        """
+        entry = self.lookup(path, hash_types)
+        if entry is not None:
+            return dict(entry)
+        wanted = self.hash_types + tuple(t for t in hash_types
+                                         if t not in self.hash_types)
+        key = file_key(path)
+        entry = hash_file(path, wanted)
+        # Don't remember a file that changed while it was read.
+        if file_key(path) == key:
+            with self.lock:
+                self.entries[key] = entry
+        return dict(entry)
+
+
+def hash_files(paths, cache=None, hash_types=(), workers=DEFAULT_WORKERS):
+    """Hash paths on a pool of worker threads.
+    Returns {path: {hash_type: hexdigest, 'size': size}}.
+    """
+    if cache is None:
+        cache = HashCache()
+    paths = list(paths)
+
+    def query(path):
+        return cache.query(path, hash_types)
+
+    if workers <= 1 or len(paths) <= 1:
+        return dict(zip(paths, map(query, paths)))
+    pool = ThreadPool(min(workers, len(paths)))
+    try:
+        results = pool.map(query, paths)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(paths, results))
@@ -11,11 +11,21 @@ TODO:
 - log rotation config
 """
 
+import atexit
+from collections import deque
+import cPickle
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 import os
+import re
+import sre_constants
+import sre_parse
 import sys
+import tempfile
+import threading
 import traceback
+import weakref
 
 # Define our own FATAL_LEVEL
 FATAL_LEVEL = logging.CRITICAL + 10
@@ -68,6 +78,15 @@ class LogMixin(object):
                 self._print("FATAL: %s" % message, stderr=True)
             raise SystemExit(exit_code)
 
+    def query_log_level_enabled(self, level):
+        """Whether a message logged at level would be written anywhere,
+        so callers can skip building messages nobody will see."""
+        if level == IGNORE:
+            return False
+        if self.log_obj:
+            return self.log_obj.is_enabled_for(level)
+        return self._log_level_at_least(level)
+
     def worst_level(self, target_level, existing_level, levels=None):
         """returns either existing_level or target level.
         This depends on which is closest to levels[0]
@@ -120,6 +139,96 @@ class LogMixin(object):
         pass
 
 
+# ErrorListMatcher {{{1
+class ErrorListMatcher(object):
+    """Compiled form of an error_list.
+
+    Walking an error_list costs a few dict lookups per entry per line, plus
+    a full regex scan for every 'regex' entry.  Here each entry is turned
+    into a (literal, regex) pair once: 'substr' entries are just a literal,
+    and 'regex' entries get the longest literal run that any match must
+    contain (e.g. ': error:' for r':\\d+: error:').  A plain `in` test on
+    that literal rejects almost every line without running the regex.
+
+    match() returns the index of the first matching entry in list order,
+    exactly like walking the list would.  Entries with neither 'substr' nor
+    'regex' are listed in self.invalid.
+    """
+    def __init__(self, error_list):
+        self.length = len(error_list)
+        self.checks = []
+        self.invalid = []
+        for index, error_check in enumerate(error_list):
+            if 'substr' in error_check:
+                self.checks.append((error_check['substr'], None))
+            elif 'regex' in error_check:
+                regex = error_check['regex']
+                self.checks.append((self.required_literal(regex), regex))
+            else:
+                self.checks.append((None, self))
+                self.invalid.append(index)
+
+    def search(self, line):
+        """Stand-in regex for invalid entries; never matches."""
+        return None
+
+    @staticmethod
+    def required_literal(regex):
+        """Return the longest run of literal characters at the top level
+        of regex's pattern, or None if there isn't one we can trust.
+        """
+        if regex.flags & re.IGNORECASE:
+            return None
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+        except Exception:
+            return None
+        best = ''
+        run = []
+        for op, av in list(parsed) + [(None, None)]:
+            if op == sre_constants.LITERAL and av < 128:
+                run.append(chr(av))
+                continue
+            if len(run) > len(best):
+                best = ''.join(run)
+            run = []
+        return best or None
+
+    def match(self, line):
+        """Return the index of the first error_list entry matching line,
+        or None.
+        """
+        index = 0
+        for literal, regex in self.checks:
+            if literal is None or literal in line:
+                if regex is None or regex.search(line):
+                    return index
+            index += 1
+
+
+_error_list_matchers = {}
+
+
+def get_error_list_matcher(error_list):
+    """Return a cached ErrorListMatcher for error_list.
+
+    error_lists are mostly module-level constants shared by every
+    run_command() call, so compile each one once per process.  The key is
+    the identity of every entry, which also catches lists that were copied
+    and extended.
+    """
+    key = tuple([id(error_check) for error_check in error_list])
+    matcher = _error_list_matchers.get(key)
+    if matcher is None:
+        if len(_error_list_matchers) > 100:
+            _error_list_matchers.clear()
+        matcher = ErrorListMatcher(error_list)
+        # Hold on to the entries so their ids can't be reused.
+        matcher.error_list = list(error_list)
+        _error_list_matchers[key] = matcher
+    return matcher
+
+
 # OutputParser {{{1
 class OutputParser(LogMixin):
     """ Helper object to parse command output.
@@ -140,6 +249,9 @@ otherwise store a list of dictionaries in self.context_buffer that is
 buffered up to self.num_pre_context_lines (set to the largest
 pre-context-line setting in error_list.)
 """
+    _error_list_matcher = None
+    _matched_error_list = None
+
     def __init__(self, config=None, log_obj=None, error_list=None, log_output=True):
         self.config = config
         self.log_obj = log_obj
@@ -154,39 +266,45 @@ pre-context-line setting in error_list.)
         self.num_post_context_lines = 0
         self.worst_log_level = INFO
 
+    def query_error_list_matcher(self):
+        """Return the ErrorListMatcher for self.error_list, refreshing it
+        if self.error_list has been replaced or resized since.
+        """
+        if self._matched_error_list is not self.error_list or \
+                self._error_list_matcher.length != len(self.error_list):
+            self._error_list_matcher = get_error_list_matcher(self.error_list)
+            self._matched_error_list = self.error_list
+        return self._error_list_matcher
+
     def parse_single_line(self, line):
-        for error_check in self.error_list:
-            # TODO buffer for context_lines.
-            match = False
-            if 'substr' in error_check:
-                if error_check['substr'] in line:
-                    match = True
-            elif 'regex' in error_check:
-                if error_check['regex'].search(line):
-                    match = True
-            else:
-                self.warning("error_list: 'substr' and 'regex' not in %s" %
-                             error_check)
-            if match:
-                log_level = error_check.get('level', INFO)
-                if self.log_output:
-                    message = ' %s' % line
-                    if error_check.get('explanation'):
-                        message += '\n %s' % error_check['explanation']
-                    if error_check.get('summary'):
-                        self.add_summary(message, level=log_level)
-                    else:
-                        self.log(message, level=log_level)
-                if log_level in (ERROR, CRITICAL, FATAL):
-                    self.num_errors += 1
-                if log_level == WARNING:
-                    self.num_warnings += 1
-                self.worst_log_level = self.worst_level(log_level,
-                                                        self.worst_log_level)
+        # TODO buffer for context_lines.
+        matcher = self.query_error_list_matcher()
+        index = matcher.match(line)
+        for invalid_index in matcher.invalid:
+            if index is not None and invalid_index > index:
                 break
-        else:
+            self.warning("error_list: 'substr' and 'regex' not in %s" %
+                         self.error_list[invalid_index])
+        if index is None:
             if self.log_output:
                 self.info(' %s' % line)
+            return
+        error_check = self.error_list[index]
+        log_level = error_check.get('level', INFO)
+        if self.log_output:
+            message = ' %s' % line
+            if error_check.get('explanation'):
+                message += '\n %s' % error_check['explanation']
+            if error_check.get('summary'):
+                self.add_summary(message, level=log_level)
+            else:
+                self.log(message, level=log_level)
+        if log_level in (ERROR, CRITICAL, FATAL):
+            self.num_errors += 1
+        if log_level == WARNING:
+            self.num_warnings += 1
+        self.worst_log_level = self.worst_level(log_level,
+                                                self.worst_log_level)
 
     def add_lines(self, output):
         if isinstance(output, basestring):
@@ -198,6 +316,228 @@ pre-context-line setting in error_list.)
             self.parse_single_line(line)
 
 
+# FanOutFileHandler {{{1
+class FanOutFileHandler(logging.Handler):
+    """Write records to several log files from one background thread.
+
+    Each file has its own minimum level and formatter.  Logging a record
+    just queues it; the writer thread formats it once per distinct
+    formatter and appends it to every file whose level it meets, through
+    buffered files that are flushed every flush_interval seconds.
+    sync() waits until everything logged so far is on disk, and
+    close_files() closes the files once it is.
+
+    flush() and close() never wait for the writer: logging.shutdown()
+    calls them at exit, when the files are synced separately, and they
+    can be run by the garbage collector on any thread -- including a
+    writer.
+    """
+    def __init__(self, flush_interval=1.0, buffer_size=64 * 1024):
+        logging.Handler.__init__(self)
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.min_level = None
+        self.files = []
+        # deque.append() and popleft() are atomic, and much cheaper than
+        # a Queue; the writer is only woken up when it's idle.
+        self.pending = deque()
+        self.wakeup = threading.Event()
+        self.idle = False
+        self.writer = None
+        # Reentrant: the garbage collector can run BaseLogger.__del__,
+        # and so _queue(), on the writer while it holds the lock.
+        self.writer_lock = threading.RLock()
+        # .busy: this thread is in _wake() or waiting on self.wakeup
+        self._local = threading.local()
+        _fan_out_handlers.add(self)
+
+    def _ensure_writer(self):
+        """Start a writer unless one is running.  The check is made under
+        writer_lock, like the writer's decision to stop, so anything
+        queued before this call is written by one or the other."""
+        with self.writer_lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self._write_records,
+                                               name='log writer')
+                self.writer.daemon = True
+                self.writer.start()
+
+    def _queue(self, item):
+        self.pending.append(item)
+        self._wake(only_if_idle=True)
+
+    def _wake(self, only_if_idle=False):
+        """Start the writer if need be, and wake it up.
+
+        Does nothing on a thread that's already in here, or waiting on
+        self.wakeup: the garbage collector can run close_files() and
+        close() (from BaseLogger.__del__) at any point, and wakeup's lock
+        isn't reentrant.  The outer call wakes the writer, or sync()
+        does.
+        """
+        local = self._local
+        if getattr(local, 'busy', False):
+            return
+        local.busy = True
+        try:
+            self._ensure_writer()
+            if self.idle or not only_if_idle:
+                self.wakeup.set()
+        finally:
+            local.busy = False
+
+    def add_file(self, path, level=logging.NOTSET, formatter=None, append=False):
+        # Opened here, so errors show up in the caller; handed to the
+        # writer through the queue, so it applies from this point on.
+        fh = open(path, 'a' if append else 'w', self.buffer_size)
+        if self.min_level is None or level < self.min_level:
+            self.min_level = level
+        self._queue(('add', (level, formatter or self.formatter, fh)))
+
+    def handle(self, record):
+        # No filters, and no lock: queueing is all we do here.
+        if self.min_level is not None and record.levelno >= self.min_level:
+            self._queue(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    def _write_records(self):
+        pending = self.pending
+        # The writer can still be running while module globals are torn
+        # down at interpreter exit, so don't look logging up in there.
+        LogRecord = logging.LogRecord
+        dirty = False
+        while True:
+            try:
+                item = pending.popleft()
+            except IndexError:
+                self.idle = True
+                self._local.busy = True
+                try:
+                    # Re-check after announcing we're idle, so a record
+                    # queued in between isn't left waiting.
+                    if not pending:
+                        if not self.wakeup.wait(self.flush_interval if dirty else None) \
+                                and dirty:
+                            self._flush_files()
+                            dirty = False
+                    self.wakeup.clear()
+                finally:
+                    self._local.busy = False
+                self.idle = False
+                continue
+            if isinstance(item, LogRecord):
+                self._write_record(item)
+                dirty = True
+            elif item[0] == 'add':
+                self.files.append(item[1])
+            elif item[0] in ('flush', 'close_files'):
+                self._flush_files()
+                dirty = False
+                if item[0] == 'close_files':
+                    for level, formatter, fh in self.files:
+                        try:
+                            fh.close()
+                        except (IOError, OSError):
+                            pass
+                    self.files = []
+                if item[1] is not None:
+                    item[1].set()
+            elif item[0] == 'close':
+                self._flush_files()
+                # Anything queued before this check gets written; anything
+                # after it sees self.writer is None and starts a new writer.
+                with self.writer_lock:
+                    if not pending:
+                        self.writer = None
+                        return
+
+    def _write_record(self, record):
+        texts = {}
+        for level, formatter, fh in self.files:
+            if record.levelno < level:
+                continue
+            text = texts.get(id(formatter))
+            if text is None:
+                try:
+                    text = (formatter or logging._defaultFormatter).format(record)
+                    if isinstance(text, unicode):
+                        text = text.encode('utf-8')
+                    text += '\n'
+                except Exception:
+                    self.handleError(record)
+                    return
+                texts[id(formatter)] = text
+            try:
+                fh.write(text)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _flush_files(self):
+        for level, formatter, fh in self.files:
+            try:
+                fh.flush()
+            except (IOError, OSError, ValueError):
+                pass
+
+    def sync(self):
+        """Wait until everything logged so far is in the files."""
+        if self.writer is None and not self.pending:
+            return
+        self._wait_for('flush')
+
+    def close_files(self):
+        """Write out everything logged so far, then close the files.
+        Records logged after this aren't written anywhere."""
+        self._wait_for('close_files')
+
+    def _wait_for(self, name):
+        """Queue name for the writer, and wait until it's done."""
+        done = threading.Event()
+        self._queue((name, done))
+        if threading.current_thread() is self.writer or \
+                getattr(self._local, 'busy', False):
+            # can't wait for ourselves; the writer gets to it later
+            return
+        self._wake()
+        while not done.wait(1.0):
+            if self.pending:
+                # e.g. the writer died, or missed a wakeup; start another
+                # or wake this one, to drain the queue
+                self._wake()
+            else:
+                with self.writer_lock:
+                    writer = self.writer
+                if writer is None or not writer.is_alive():
+                    return
+
+    def flush(self):
+        if self.writer is not None or self.pending:
+            self._queue(('flush', None))
+
+    def close(self):
+        """Let the writer stop once it has written everything so far.
+        The files are left open, and the writer restarts with the next
+        record.
+        """
+        if self.writer is not None or self.pending:
+            self._queue(('close', None))
+        logging.Handler.close(self)
+
+
+_fan_out_handlers = weakref.WeakSet()
+
+
+def _sync_fan_out_handlers():
+    for handler in list(_fan_out_handlers):
+        handler.sync()
+
+# registered after logging's own atexit hook, so this runs before it
+atexit.register(_sync_fan_out_handlers)
+
+
 # BaseLogger {{{1
 class BaseLogger(object):
     """Create a base logging class.
@@ -225,6 +565,7 @@ class BaseLogger(object):
         log_to_raw=False,
         logger_name='',
         append_to_log=False,
+        async_writer=False,
     ):
         self.log_format = log_format
         self.log_date_format = log_date_format
@@ -234,6 +575,9 @@ class BaseLogger(object):
         self.log_name = log_name
         self.log_dir = log_dir
         self.append_to_log = append_to_log
+        # Write log files from a background thread; see FanOutFileHandler.
+        self.async_writer = async_writer
+        self.fan_out_handler = None
 
         # Not sure what I'm going to use this for; useless unless we
         # can have multiple logging objects that don't trample each other
@@ -242,6 +586,12 @@ class BaseLogger(object):
         self.all_handlers = []
         self.log_files = {}
 
+        # see block()
+        self._block_lock = threading.RLock()
+        self._local = threading.local()
+        self._blocks = []
+        self._live_block = None
+
         self.create_log_dir()
 
     def create_log_dir(self):
@@ -264,6 +614,9 @@ class BaseLogger(object):
             level = self.log_level
         return self.LEVELS.get(level, logging.NOTSET)
 
+    def is_enabled_for(self, level):
+        return self.logger.isEnabledFor(self.get_logger_level(level))
+
     def get_log_formatter(self, log_format=None, date_format=None):
         if not log_format:
             log_format = self.log_format
@@ -278,6 +631,10 @@ class BaseLogger(object):
         self.logger = logging.getLogger(logger_name)
         self.logger.setLevel(self.get_logger_level())
         self._clear_handlers()
+        if self.async_writer:
+            self.fan_out_handler = FanOutFileHandler()
+            self.logger.addHandler(self.fan_out_handler)
+            self.all_handlers.append(self.fan_out_handler)
         if self.log_to_console:
             self.add_console_handler()
         if self.log_to_raw:
@@ -294,12 +651,30 @@ class BaseLogger(object):
         if 'all_handlers' in attrs and 'logger' in attrs:
             for handler in self.all_handlers:
                 self.logger.removeHandler(handler)
+                if isinstance(handler, FanOutFileHandler):
+                    handler.close_files()
+                handler.close()
             self.all_handlers = []
 
+    def close(self):
+        """Write out what's been logged, then close this logger's files
+        and take its handlers off the logger, which is shared with any
+        other logger of the same name.  Done when the object goes away,
+        too.
+        """
+        self._clear_handlers()
+
     def __del__(self):
-        logging.shutdown()
         self._clear_handlers()
 
+    def flush(self):
+        """Make sure everything logged so far is in the log files."""
+        for handler in self.all_handlers:
+            if isinstance(handler, FanOutFileHandler):
+                handler.sync()
+            else:
+                handler.flush()
+
     def add_console_handler(self, log_level=None, log_format=None,
                             date_format=None):
         console_handler = logging.StreamHandler()
@@ -313,6 +688,14 @@ class BaseLogger(object):
                          date_format=None):
         if not self.append_to_log and os.path.exists(log_path):
             os.remove(log_path)
+        if self.fan_out_handler:
+            formatter = self.get_log_formatter(log_format=log_format,
+                                               date_format=date_format)
+            self.fan_out_handler.add_file(log_path,
+                                          level=self.get_logger_level(log_level),
+                                          formatter=formatter,
+                                          append=self.append_to_log)
+            return
         file_handler = logging.FileHandler(log_path)
         file_handler.setLevel(self.get_logger_level(log_level))
         file_handler.setFormatter(self.get_log_formatter(log_format=log_format,
@@ -320,6 +703,59 @@ class BaseLogger(object):
         self.logger.addHandler(file_handler)
         self.all_handlers.append(file_handler)
 
+    @contextmanager
+    def block(self):
+        """Keep this thread's log lines together while other threads log.
+
+        Blocks are written in the order they were started.  The oldest
+        unfinished block writes straight through; lines from the others
+        are held, with their original timestamps, until every block
+        before them has finished.  Lines from threads outside a block
+        are always written straight through.
+        """
+        block = _LogBlock()
+        with self._block_lock:
+            self._blocks.append(block)
+            self._local.block = block
+            self._promote_blocks()
+        try:
+            yield
+        finally:
+            with self._block_lock:
+                self._local.block = None
+                block.finished = True
+                self._promote_blocks()
+
+    def _promote_blocks(self):
+        """Write out held lines and pick the next live block.
+        Call with self._block_lock held.
+        """
+        while self._blocks:
+            head = self._blocks[0]
+            for record in head.release():
+                self.logger.handle(record)
+            if not head.finished:
+                self._live_block = head
+                return
+            self._blocks.pop(0)
+        self._live_block = None
+
+    def _log_line(self, level, line):
+        if not self.logger.isEnabledFor(level):
+            return
+        record = self.logger.makeRecord(self.logger.name, level, '(unknown file)',
+                                        0, line, None, None)
+        if getattr(self._local, 'block', None) is None:
+            # not in a block: nothing to hold back
+            self.logger.handle(record)
+            return
+        with self._block_lock:
+            block = self._local.block
+            if block is not self._live_block:
+                block.hold(record)
+            else:
+                self.logger.handle(record)
+
     def log_message(self, message, level=INFO, exit_code=-1, post_fatal_callback=None):
         """Generic log method.
         There should be more options here -- do or don't split by line,
@@ -331,15 +767,59 @@ class BaseLogger(object):
         if level == IGNORE:
             return
         for line in message.splitlines():
-            self.logger.log(self.get_logger_level(level), line)
+            self._log_line(self.get_logger_level(level), line)
         if level == FATAL:
             if callable(post_fatal_callback):
-                self.logger.log(FATAL_LEVEL, "Running post_fatal callback...")
+                self._log_line(FATAL_LEVEL, "Running post_fatal callback...")
                 post_fatal_callback(message=message, exit_code=exit_code)
-            self.logger.log(FATAL_LEVEL, 'Exiting %d' % exit_code)
+            self._log_line(FATAL_LEVEL, 'Exiting %d' % exit_code)
+            self.flush()
             raise SystemExit(exit_code)
 
 
+class _LogBlock(object):
+    """Lines held by BaseLogger.block().
+
+    Every max_records lines, the held lines are pickled to a temporary
+    file, so a block held for a long time (a test suite's whole log,
+    say) costs disk rather than memory.
+    """
+    max_records = 1000
+
+    def __init__(self):
+        self.records = []
+        self.spool = None
+        self.finished = False
+
+    def hold(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.max_records:
+            if self.spool is None:
+                self.spool = tempfile.TemporaryFile(prefix='mozharness_log_block')
+            cPickle.dump([r.__dict__ for r in self.records], self.spool,
+                         cPickle.HIGHEST_PROTOCOL)
+            self.records = []
+
+    def release(self):
+        """Yield the held records, oldest first, and forget them."""
+        if self.spool is not None:
+            spool, self.spool = self.spool, None
+            try:
+                spool.seek(0)
+                while True:
+                    try:
+                        batch = cPickle.load(spool)
+                    except EOFError:
+                        break
+                    for attrs in batch:
+                        yield logging.makeLogRecord(attrs)
+            finally:
+                spool.close()
+        records, self.records = self.records, []
+        for record in records:
+            yield record
+
+
 # SimpleFileLogger {{{1
 class SimpleFileLogger(BaseLogger):
     """Create one logFile.  Possibly also output to
@@ -364,14 +844,18 @@ class SimpleFileLogger(BaseLogger):
 class MultiFileLogger(BaseLogger):
     """Create a log per log level in log_dir.  Possibly also output to
     the terminal and a raw log (no prepending of level or date)
+
+    The log files are written by one background thread (see
+    FanOutFileHandler) unless async_writer is False; call flush() before
+    reading them.
     """
     def __init__(self, logger_name='Multi',
                  log_format='%(asctime)s %(levelname)8s - %(message)s',
-                 log_dir='logs', log_to_raw=True, **kwargs):
+                 log_dir='logs', log_to_raw=True, async_writer=True, **kwargs):
         BaseLogger.__init__(self, logger_name=logger_name,
                             log_format=log_format,
                             log_to_raw=log_to_raw, log_dir=log_dir,
-                            **kwargs)
+                            async_writer=async_writer, **kwargs)
 
         self.new_logger(self.logger_name)
         self.init_message()
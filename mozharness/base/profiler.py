@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Per-action timing and resource usage.
+
+BaseScript records a span for its own __init__, every action and its
+preflight/postflight, every listener and every run_command() /
+get_output_from_command().  Each span carries:
+
+  * wall time
+  * cpu_user / cpu_system: this process's CPU seconds
+  * children_user / children_system: CPU seconds of waited-for children
+  * maxrss_kb / children_maxrss_kb: RSS high-water marks at the end of
+    the span (these only ever go up, so they aren't deltas)
+  * read_bytes / write_bytes / rchar / wchar: IO bytes, from
+    /proc/self/io, which includes reaped children
+
+CPU and IO are counted for the whole process, so a span that ran while
+a span on another thread was open (parallel_actions, run_concurrently())
+also counts that thread's work.  Such spans get concurrent: true in
+their args; only the deltas of the others are the span's own.
+
+The result is written in the Chrome Trace Event Format, so it can be
+loaded in chrome://tracing or about:profiling, and summed across runs
+with a few lines of python.  Only the standard library is used; whatever
+a platform can't tell us (e.g. resource on Windows) is left out.
+"""
+
+from contextlib import contextmanager
+import functools
+import os
+import subprocess
+import sys
+import threading
+import time
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROC_IO = '/proc/self/io'
+IO_FIELDS = ('read_bytes', 'write_bytes', 'rchar', 'wchar')
+DELTA_FIELDS = ('cpu_user', 'cpu_system', 'children_user',
+                'children_system') + IO_FIELDS
+MAX_NAME_LENGTH = 120
+
+
+def _read_proc_io():
+    try:
+        fh = open(PROC_IO)
+    except IOError:
+        return {}
+    values = {}
+    try:
+        for line in fh:
+            key, _, value = line.partition(':')
+            if key in IO_FIELDS:
+                values[key] = int(value)
+    finally:
+        fh.close()
+    return values
+
+
+def _maxrss_kb(who):
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on mac, kilobytes everywhere else
+        maxrss //= 1024
+    return maxrss
+
+
+def snapshot():
+    """Return this process's resource usage so far, as a dict."""
+    times = os.times()
+    snap = {
+        'wall': time.time(),
+        'cpu_user': times[0],
+        'cpu_system': times[1],
+        'children_user': times[2],
+        'children_system': times[3],
+    }
+    if resource:
+        snap['maxrss_kb'] = _maxrss_kb(resource.RUSAGE_SELF)
+        snap['children_maxrss_kb'] = _maxrss_kb(resource.RUSAGE_CHILDREN)
+    snap.update(_read_proc_io())
+    return snap
+
+
+# Profiler {{{1
+class Profiler(object):
+    """Collects spans as trace events.
+
+        with self.profiler.span('download-and-extract', 'action') as args:
+            ...
+            args['success'] = True
+
+    Anything put in args ends up in the event's args, next to the
+    resource deltas.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+        # args of the spans open right now, by id(), with their thread
+        self.open_spans = {}
+
+    def add_event(self, name, cat, before, after=None, args=None):
+        """Record a span that started at snapshot before and ended at
+        snapshot after (default: now).
+        """
+        if after is None:
+            after = snapshot()
+        event_args = dict(args or {})
+        for field in DELTA_FIELDS:
+            if field in before and field in after:
+                delta = after[field] - before[field]
+                if isinstance(delta, float):
+                    delta = round(delta, 3)
+                event_args[field] = delta
+        for field in ('maxrss_kb', 'children_maxrss_kb'):
+            if field in after:
+                event_args[field] = after[field]
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': int((before['wall'] - self.start) * 1000000),
+            'dur': int((after['wall'] - before['wall']) * 1000000),
+            'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'args': event_args,
+        }
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        before = snapshot()
+        thread = threading.current_thread().ident
+        with self.lock:
+            for other_thread, other_args in self.open_spans.values():
+                if other_thread != thread:
+                    other_args['concurrent'] = True
+                    args['concurrent'] = True
+            self.open_spans[id(args)] = (thread, args)
+        try:
+            yield args
+        finally:
+            with self.lock:
+                del self.open_spans[id(args)]
+            self.add_event(name, cat, before, args=args)
+
+    def query_trace(self, **metadata):
+        """Return the events so far as a trace-event dict."""
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e['ts'])
+        other_data = {'start_time': self.start}
+        other_data.update(metadata)
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': other_data,
+        }
+
+    def write(self, path, **metadata):
+        tmp_path = path + '.tmp'
+        fh = open(tmp_path, 'w')
+        try:
+            json.dump(self.query_trace(**metadata), fh, indent=1)
+        finally:
+            fh.close()
+        os.rename(tmp_path, path)
+
+
+class NullProfiler(object):
+    """Stands in for Profiler on objects that don't profile, e.g. a
+    ScriptMixin outside a BaseScript.
+    """
+    events = ()
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        yield args
+
+
+def profiled_command(func):
+    """Decorator for ScriptMixin.run_command() and friends: record each
+    call as a 'command' span named after the command line.
+    """
+    @functools.wraps(func)
+    def wrapper(self, command, *args, **kwargs):
+        if isinstance(command, (list, tuple)):
+            command_line = subprocess.list2cmdline([str(c) for c in command])
+        else:
+            command_line = str(command)
+        with self.profiler.span(command_line[:MAX_NAME_LENGTH], 'command',
+                                command=command_line,
+                                cwd=kwargs.get('cwd')) as span_args:
+            result = func(self, command, *args, **kwargs)
+            if isinstance(result, int):
+                span_args['return'] = result
+            return result
+    return wrapper
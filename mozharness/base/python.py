@@ -7,9 +7,12 @@
 '''Python usage, esp. virtualenv.
 '''
 
+import hashlib
 import os
 import subprocess
 import sys
+import tarfile
+import tempfile
 import time
 import json
 import traceback
@@ -63,6 +66,11 @@ class VirtualenvMixin(object):
      * virtualenv_path points to the virtualenv location on disk.
      * virtualenv_modules lists the module names.
      * MODULE_url list points to the module URLs (optional)
+     * virtualenv_snapshot_dir (optional) keeps snapshots of finished
+       virtualenvs, by query_virtualenv_hash(); see create_virtualenv().
+     * virtualenv_snapshot_keep is how many snapshots to keep (default 3).
+     * virtualenv_wheelhouse (optional) is a local directory of wheels
+       and sdists for pip to look in.
     Requires virtualenv to be in PATH.
     Depends on ScriptMixin
     '''
@@ -186,6 +194,9 @@ class VirtualenvMixin(object):
         will be combined with the module_url (if any), like so:
 
         pip install -r requirements1.txt -r requirements2.txt module_url
+
+        module_url can also be a list of pip arguments, to install several
+        modules in one pip call.
         """
         c = self.config
         dirs = self.query_abs_dirs()
@@ -240,6 +251,8 @@ class VirtualenvMixin(object):
         proxxy = Proxxy(self.config, self.log_obj)
         for link in proxxy.get_proxies_and_urls(c.get('find_links', [])):
             command.extend(["--find-links", link])
+        if c.get('virtualenv_wheelhouse'):
+            command.extend(["--find-links", c['virtualenv_wheelhouse']])
 
         # module_url can be None if only specifying requirements files
         if module_url:
@@ -248,7 +261,10 @@ class VirtualenvMixin(object):
                     command += ['-e']
                 else:
                     self.fatal("editable installs not supported for install_method %s" % install_method)
-            command += [module_url]
+            if isinstance(module_url, (list, tuple)):
+                command += list(module_url)
+            else:
+                command += [module_url]
 
         # If we're only installing a single requirements file, use
         # the file's directory as cwd, so relative paths work correctly.
@@ -322,6 +338,11 @@ class VirtualenvMixin(object):
                 '/path/to/requirements1.txt',
                 '/path/to/requirements2.txt'
             ]
+
+        If c['virtualenv_snapshot_dir'] is set, a finished virtualenv is
+        saved there under query_virtualenv_hash(), and later runs with the
+        same hash restore it instead of running pip.  Building one, runs
+        of plain pip modules are installed in a single pip call.
         """
         c = self.config
         dirs = self.query_abs_dirs()
@@ -331,6 +352,7 @@ class VirtualenvMixin(object):
         if isinstance(virtualenv, str):
             # allow for [python, virtualenv] in config
             virtualenv = [virtualenv]
+        virtualenv = list(virtualenv)
 
         if not os.path.exists(virtualenv[0]) and not self.which(virtualenv[0]):
             self.add_summary("The executable '%s' is not found; not creating "
@@ -356,9 +378,23 @@ class VirtualenvMixin(object):
                 self.download_file(c['%s_url' % module],
                                    parent_dir=dirs['abs_work_dir'])
 
-        virtualenv_options = c.get('virtualenv_options',
-                                   ['--no-site-packages', '--distribute'])
+        virtualenv_options = list(c.get('virtualenv_options',
+                                        ['--no-site-packages', '--distribute']))
+
+        if not modules:
+            modules = c.get('virtualenv_modules', [])
+        if not requirements:
+            requirements = c.get('virtualenv_requirements', [])
+        module_list = self._query_virtualenv_module_list(modules, requirements)
+
+        venv_hash = None
+        if c.get('virtualenv_snapshot_dir'):
+            venv_hash = self.query_virtualenv_hash(
+                virtualenv + virtualenv_options, module_list)
+            if self._restore_virtualenv_snapshot(venv_hash):
+                return
 
+        created = False
         if os.path.exists(self.query_python_path()):
             self.info("Virtualenv %s appears to already exist; skipping virtualenv creation." % self.query_python_path())
         else:
@@ -366,13 +402,49 @@ class VirtualenvMixin(object):
                              cwd=dirs['abs_work_dir'],
                              error_list=VirtualenvErrorList,
                              halt_on_failure=True)
-        if not modules:
-            modules = c.get('virtualenv_modules', [])
-        if not requirements:
-            requirements = c.get('virtualenv_requirements', [])
+            created = True
+
+        if venv_hash:
+            # Install runs of plain pip modules in one pip call each.
+            batch = []
+            for module in module_list:
+                if self._can_batch_virtualenv_module(module) and \
+                        (not batch or batch[0]['requirements'] == module['requirements']):
+                    batch.append(module)
+                    continue
+                if batch:
+                    self._install_virtualenv_modules(batch)
+                    batch = []
+                if self._can_batch_virtualenv_module(module):
+                    batch.append(module)
+                else:
+                    self._install_virtualenv_module(module)
+            if batch:
+                self._install_virtualenv_modules(batch)
+        else:
+            for module in module_list:
+                self._install_virtualenv_module(module)
+
+        self.info("Done creating virtualenv %s." % venv_path)
+
+        pip_freeze_output = None
+        # Only snapshot what we built from scratch.
+        if venv_hash and created:
+            pip_freeze_output = self._save_virtualenv_snapshot(venv_hash)
+        self.package_versions(pip_freeze_output=pip_freeze_output,
+                              log_output=True)
+
+    def _query_virtualenv_module_list(self, modules, requirements):
+        """Resolve virtualenv_modules/requirements and the registered
+        modules into one ordered list of dicts of install_module() args.
+        """
+        requirements = tuple(requirements)
+        module_list = []
         if not modules and requirements:
-            self.install_module(requirements=requirements,
-                                install_method='pip')
+            module_list.append(dict(
+                name=None, url=None, method='pip', requirements=requirements,
+                global_options=[], optional=False, two_pass=False,
+                editable=False))
         for module in modules:
             module_url = module
             global_options = []
@@ -390,29 +462,205 @@ class VirtualenvMixin(object):
             install_method = 'pip'
             if module_name in ('pywin32',):
                 install_method = 'easy_install'
-            self.install_module(module=module_name,
-                                module_url=module_url,
-                                install_method=install_method,
-                                requirements=requirements,
-                                global_options=global_options)
-
+            module_list.append(dict(
+                name=module_name, url=module_url, method=install_method,
+                requirements=requirements, global_options=global_options,
+                optional=False, two_pass=False, editable=False))
         for module, url, method, requirements, optional, two_pass, editable in \
                 self._virtualenv_modules:
-            if two_pass:
-                self.install_module(
-                    module=module, module_url=url,
-                    install_method=method, requirements=requirements or (),
-                    optional=optional, no_deps=True, editable=editable
-                )
+            module_list.append(dict(
+                name=module, url=url, method=method,
+                requirements=tuple(requirements or ()), global_options=[],
+                optional=optional, two_pass=two_pass, editable=editable))
+        return module_list
+
+    def _install_virtualenv_module(self, module):
+        if module['two_pass']:
             self.install_module(
-                module=module, module_url=url,
-                install_method=method, requirements=requirements or (),
-                optional=optional, editable=editable
+                module=module['name'], module_url=module['url'],
+                install_method=module['method'],
+                requirements=module['requirements'],
+                optional=module['optional'], no_deps=True,
+                editable=module['editable']
             )
+        self.install_module(
+            module=module['name'], module_url=module['url'],
+            install_method=module['method'],
+            requirements=module['requirements'],
+            global_options=module['global_options'],
+            optional=module['optional'], editable=module['editable']
+        )
 
-        self.info("Done creating virtualenv %s." % venv_path)
-
-        self.package_versions(log_output=True)
+    def _can_batch_virtualenv_module(self, module):
+        # Installs from requirements files alone run in the file's
+        # directory so relative paths work; keep those separate.
+        return bool(module['method'] in (None, 'pip') and module['name'] and
+                    not module['optional'] and not module['global_options'])
+
+    def _install_virtualenv_modules(self, modules):
+        """Install modules in a single pip call (two, if any are two_pass)."""
+        if len(modules) == 1:
+            return self._install_virtualenv_module(modules[0])
+        names = ', '.join([m['name'] for m in modules])
+        targets = []
+        two_pass_targets = []
+        for m in modules:
+            target = [m['url'] or m['name']]
+            if m['editable']:
+                target = ['-e'] + target
+            targets += target
+            if m['two_pass']:
+                two_pass_targets += target
+        if two_pass_targets:
+            self.install_module(module=names, module_url=two_pass_targets,
+                                no_deps=True)
+        self.install_module(module=names, module_url=targets,
+                            requirements=modules[0]['requirements'])
+
+    def _hash_virtualenv_source(self, sha, path, base_dir):
+        """Add a local module path's contents to sha, if it exists."""
+        if not os.path.isabs(path):
+            path = os.path.join(base_dir, path)
+        if os.path.isfile(path):
+            sha.update(self.read_from_file(path, verbose=False, open_mode='rb'))
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                # Installing writes these into the source tree.
+                dirs[:] = sorted(d for d in dirs
+                                 if not d.endswith('.egg-info') and
+                                 d not in ('build', 'dist', '.hg', '.git'))
+                for name in sorted(files):
+                    if name.endswith(('.pyc', '.pyo')):
+                        continue
+                    file_path = os.path.join(root, name)
+                    sha.update(os.path.relpath(file_path, path))
+                    sha.update(self.read_from_file(file_path, verbose=False,
+                                                   open_mode='rb'))
+
+    def query_virtualenv_hash(self, virtualenv_command, module_list):
+        """Hash everything that goes into the virtualenv: its path (they
+        aren't relocatable), the virtualenv command, the resolved module
+        list, and the contents of requirements files and of any local
+        modules they or the module list point to.
+        """
+        c = self.config
+        dirs = self.query_abs_dirs()
+        sha = hashlib.sha1()
+        wheelhouse = c.get('virtualenv_wheelhouse')
+        sha.update(repr([
+            self.query_virtualenv_path(), virtualenv_command, sys.platform,
+            c.get('find_links'), c.get('pip_index'), c.get('distribute_url'),
+            c.get('pip_url'), wheelhouse,
+            sorted(os.listdir(wheelhouse)) if wheelhouse and os.path.isdir(wheelhouse) else None,
+            [sorted(m.items()) for m in module_list],
+        ]))
+        for module in module_list:
+            if module['url']:
+                self._hash_virtualenv_source(sha, module['url'],
+                                             dirs['abs_work_dir'])
+            for requirement in module['requirements']:
+                self._hash_virtualenv_source(sha, requirement,
+                                             dirs['abs_work_dir'])
+                if not os.path.isfile(requirement):
+                    continue
+                req_dir = os.path.dirname(os.path.abspath(requirement))
+                for line in self.read_from_file(requirement, verbose=False).splitlines():
+                    line = line.strip()
+                    if line.startswith('-e '):
+                        line = line[3:].strip()
+                    if line and not line.startswith(('#', '-')):
+                        self._hash_virtualenv_source(sha, line, req_dir)
+        return sha.hexdigest()
+
+    def _query_virtualenv_snapshot_paths(self, venv_hash):
+        snapshot_dir = self.config['virtualenv_snapshot_dir']
+        return (os.path.join(snapshot_dir, '%s.tar' % venv_hash),
+                os.path.join(snapshot_dir, '%s.freeze' % venv_hash))
+
+    def _restore_virtualenv_snapshot(self, venv_hash):
+        """Use the virtualenv snapshot for venv_hash, if we have one.
+        Returns True if the virtualenv is ready.
+        """
+        venv_path = self.query_virtualenv_path()
+        marker = os.path.join(venv_path, '.mozharness_venv_hash')
+        tar_path, freeze_path = self._query_virtualenv_snapshot_paths(venv_hash)
+        if os.path.exists(self.query_python_path()):
+            if os.path.exists(marker) and \
+                    self.read_from_file(marker, verbose=False) == venv_hash:
+                self.info("Virtualenv %s is up to date (%s)." % (venv_path, venv_hash))
+            else:
+                return False
+        elif os.path.exists(tar_path):
+            self.info("Restoring virtualenv %s from %s." % (venv_path, tar_path))
+            try:
+                bundle = tarfile.open(tar_path)
+                try:
+                    bundle.extractall(venv_path)
+                finally:
+                    bundle.close()
+                os.utime(tar_path, None)
+            except (tarfile.TarError, IOError, OSError), e:
+                self.warning("Can't restore virtualenv snapshot %s: %s" %
+                             (tar_path, str(e)))
+                self.rmtree(venv_path)
+                return False
+        else:
+            return False
+        pip_freeze_output = None
+        if os.path.exists(freeze_path):
+            pip_freeze_output = self.read_from_file(freeze_path, verbose=False)
+        self.package_versions(pip_freeze_output=pip_freeze_output,
+                              log_output=True)
+        return True
+
+    def _save_virtualenv_snapshot(self, venv_hash):
+        """Snapshot the virtualenv as venv_hash, pruning old snapshots.
+        Returns the `pip freeze` output, or None.
+        """
+        c = self.config
+        venv_path = self.query_virtualenv_path()
+        snapshot_dir = c['virtualenv_snapshot_dir']
+        tar_path, freeze_path = self._query_virtualenv_snapshot_paths(venv_hash)
+        pip_freeze_output = self.get_output_from_command(
+            [self.query_python_path('pip'), 'freeze'], silent=True)
+        if not isinstance(pip_freeze_output, basestring):
+            return None
+        self.write_to_file(os.path.join(venv_path, '.mozharness_venv_hash'),
+                           venv_hash, verbose=False)
+        # The pip download cache is usually inside the virtualenv.
+        download_cache = c.get("virtualenv_cache_dir", os.path.join(venv_path, "cache"))
+
+        def exclude_download_cache(tarinfo):
+            if download_cache and os.path.abspath(os.path.join(venv_path, tarinfo.name)) == \
+                    os.path.abspath(download_cache):
+                return None
+            return tarinfo
+
+        self.info("Saving virtualenv snapshot %s." % tar_path)
+        self.mkdir_p(snapshot_dir)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir)
+            os.close(fd)
+            bundle = tarfile.open(tmp_path, 'w')
+            try:
+                bundle.add(venv_path, arcname='.', filter=exclude_download_cache)
+            finally:
+                bundle.close()
+            self.write_to_file(freeze_path, pip_freeze_output, verbose=False)
+            os.rename(tmp_path, tar_path)
+        except (tarfile.TarError, IOError, OSError), e:
+            self.warning("Can't save virtualenv snapshot %s: %s" % (tar_path, str(e)))
+            return pip_freeze_output
+
+        snapshots = sorted((os.path.getmtime(os.path.join(snapshot_dir, f)), f)
+                           for f in os.listdir(snapshot_dir) if f.endswith('.tar'))
+        for mtime, name in snapshots[:-c.get('virtualenv_snapshot_keep', 3)]:
+            self.info("Removing old virtualenv snapshot %s." % name)
+            for path in (name, name[:-len('.tar')] + '.freeze'):
+                path = os.path.join(snapshot_dir, path)
+                if os.path.exists(path):
+                    os.remove(path)
+        return pip_freeze_output
 
     def activate_virtualenv(self):
         """Import the virtualenv's packages into this Python interpreter."""
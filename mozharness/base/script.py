@@ -23,12 +23,19 @@ import shutil
 import socket
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 import traceback
 import urllib2
 import httplib
 import urlparse
-import hashlib
+import Queue
+import zipfile
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
 if os.name == 'nt':
     try:
         import win32file
@@ -44,9 +51,173 @@ except ImportError:
     import json
 
 from mozprocess import ProcessHandler
+from mozharness.base import archive, hashing
 from mozharness.base.config import BaseConfig
+from mozharness.base.errors import ExtractError
 from mozharness.base.log import SimpleFileLogger, MultiFileLogger, \
     LogMixin, OutputParser, DEBUG, INFO, ERROR, FATAL
+from mozharness.base.profiler import Profiler, NullProfiler, \
+    profiled_command, snapshot
+
+
+# OutputPump {{{1
+class OutputPump(object):
+    """Drain a child process' output pipe on a dedicated reader thread.
+
+    The reader does large os.read()s, splits them into lines in bulk, and
+    hands lists of lines to the consumer through a bounded queue.  The
+    child never blocks on a full pipe while we're parsing or logging, and
+    the consumer pays the queue overhead once per batch rather than once
+    per line.  Lines keep their order; the trailing newline is stripped.
+
+        pump = OutputPump(p.stdout)
+        for lines in pump.batches():
+            parser.add_lines(lines)
+    """
+    def __init__(self, stream, chunk_size=64 * 1024, max_batches=64):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        fd = self.stream.fileno()
+        partial = ''
+        try:
+            while True:
+                chunk = os.read(fd, self.chunk_size)
+                if not chunk:
+                    break
+                lines = (partial + chunk).split('\n')
+                partial = lines.pop()
+                if lines:
+                    self.queue.put(lines)
+            if partial:
+                self.queue.put([partial])
+        except (IOError, OSError), e:
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+    def batches(self):
+        """Yield lists of lines until the pipe is closed."""
+        while True:
+            lines = self.queue.get()
+            if lines is None:
+                break
+            yield lines
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# OutputBuffer {{{1
+class OutputBuffer(object):
+    """Collect a child process' output in memory.
+
+    Once more than spill_size bytes have been collected, everything so far
+    and everything after goes to an anonymous temporary file instead, so
+    a runaway command can't eat all our memory.
+    """
+    def __init__(self, spill_size=None, chunk_size=64 * 1024):
+        self.spill_size = spill_size
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.size = 0
+        self.spill_file = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.spill_file is not None:
+            self.spill_file.write(data)
+            return
+        self.chunks.append(data)
+        if self.spill_size is not None and self.size > self.spill_size:
+            self.spill_file = tempfile.TemporaryFile()
+            self.spill_file.write(''.join(self.chunks))
+            self.chunks = []
+
+    def read_from(self, stream):
+        """Copy stream into the buffer until EOF.  Meant to be run on its
+        own thread, one per pipe, so stdout and stderr can't deadlock each
+        other.
+        """
+        fd = stream.fileno()
+        while True:
+            chunk = os.read(fd, self.chunk_size)
+            if not chunk:
+                break
+            self.write(chunk)
+        stream.close()
+
+    def getvalue(self):
+        if self.spill_file is None:
+            return ''.join(self.chunks)
+        self.spill_file.seek(0)
+        return self.spill_file.read()
+
+    def iter_lines(self):
+        """Iterate over the collected lines, without reading a spilled
+        buffer back into memory all at once.  Lines are split as by
+        str.splitlines() either way.
+        """
+        if self.spill_file is None:
+            for line in self.getvalue().splitlines():
+                yield line
+            return
+        self.spill_file.seek(0)
+        for line in self.spill_file:
+            # splitlines() turns a bare '\n' into no lines at all
+            for part in line.splitlines() or ['']:
+                yield part
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.chunks = []
+
+
+# run_concurrently {{{1
+def run_concurrently(func, items, workers, log_obj=None):
+    """Returns [func(item) for item in items], with up to workers calls
+    running at once on a pool of threads.  With a log_obj, each call
+    logs as one block (see BaseLogger.block()).
+
+    After an exception (e.g. a fatal()) no more items are started; the
+    first one is re-raised here, with its traceback, once the running
+    calls are done.  With workers <= 1, or a single item, the calls are
+    made in order on this thread.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    failures = []
+
+    def run_one(item):
+        if failures:
+            return None
+        try:
+            if log_obj is None:
+                return func(item)
+            with log_obj.block():
+                return func(item)
+        except BaseException:
+            failures.append(sys.exc_info())
+            return None
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        results = pool.map(run_one, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return results
 
 
 # ScriptMixin {{{1
@@ -62,6 +233,9 @@ class ScriptMixin(object):
 
     env = None
     script_obj = None
+    profiler = NullProfiler()
+    _hash_cache = None
+    _hash_cache_lock = threading.Lock()
 
     # Simple filesystem commands {{{2
     def mkdir_p(self, path, error_level=ERROR):
@@ -187,9 +361,32 @@ class ScriptMixin(object):
         """
         return urllib2.urlopen(url, **kwargs)
 
-    def _download_file(self, url, file_name):
+    _download_cache = None
+
+    def query_download_cache(self):
+        """ Return a DownloadCache if self.config['download_cache_dir']
+            is set, else None.
+            """
+        if self._download_cache is None and \
+                self.config.get('download_cache_dir'):
+            from mozharness.base.download_cache import DownloadCache
+            self._download_cache = DownloadCache(self.config, self.log_obj,
+                                                 self._urlopen,
+                                                 hash_cache=self.query_hash_cache())
+        return self._download_cache
+
+    def _download_file(self, url, file_name, expected_hash=None,
+                       hash_type='sha512'):
         """ Helper script for download_file()
-        """
+
+            http URLs are first asked for their first
+            download_min_segment_size bytes (default 16 MiB).  That is the
+            whole of most files, which are saved as is.  If the server
+            supports Range requests and the file is larger, the rest is
+            fetched by _download_file_ranges(), which can resume a partial
+            download.  A server that doesn't sends the whole file, which is
+            saved as usual.
+            """
         # If our URLs look like files, prefix them with file:// so they can
         # be loaded like URLs.
         if not (url.startswith("http") or url.startswith("file://")):
@@ -199,23 +396,32 @@ class ScriptMixin(object):
 
         try:
             f_length = None
-            f = self._urlopen(url, timeout=30)
-
-            if f.info().get('content-length') is not None:
-                f_length = int(f.info()['content-length'])
-                got_length = 0
-            local_file = open(file_name, 'wb')
-            while True:
-                block = f.read(1024 ** 2)
-                if not block:
-                    if f_length is not None and got_length != f_length:
-                        raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
-                    break
-                local_file.write(block)
-                if f_length is not None:
-                    got_length += len(block)
-            local_file.close()
-            return file_name
+            f = self._open_download(url)
+            content_range = self._query_content_range(f)
+            if content_range and content_range[1] + 1 < content_range[2]:
+                # Only the start of it; f is read as the first segment.
+                self._download_file_ranges(f.geturl(), file_name,
+                                           content_range[2], f.info(),
+                                           head=f, head_length=content_range[1] + 1)
+            else:
+                if f.getcode() == 206 and not content_range:
+                    # A part we can't place; get it whole.
+                    f.close()
+                    f = self._urlopen(url, timeout=30)
+                if f.info().get('content-length') is not None:
+                    f_length = int(f.info()['content-length'])
+                    got_length = 0
+                local_file = open(file_name, 'wb')
+                while True:
+                    block = f.read(1024 ** 2)
+                    if not block:
+                        if f_length is not None and got_length != f_length:
+                            raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
+                        break
+                    local_file.write(block)
+                    if f_length is not None:
+                        got_length += len(block)
+                local_file.close()
         except urllib2.HTTPError, e:
             self.warning("Server returned status %s %s for %s" % (str(e.code), str(e), url))
             raise
@@ -244,8 +450,174 @@ class ScriptMixin(object):
         except socket.error, e:
             self.warning("Socket error when accessing %s: %s" % (url, str(e)))
             raise
+        if expected_hash:
+            self._verify_download_hash(file_name, expected_hash, hash_type)
+        return file_name
+
+    def _open_download(self, url):
+        """ Helper method for _download_file(): open url, asking for only
+            its first download_min_segment_size bytes if it's an http URL.
+            """
+        if not url.startswith('http'):
+            return self._urlopen(url, timeout=30)
+        min_size = self.config.get('download_min_segment_size', 16 * 1024 ** 2)
+        request = urllib2.Request(url, headers={
+            'Range': 'bytes=0-%d' % (min_size - 1),
+        })
+        try:
+            return self._urlopen(request, timeout=30)
+        except urllib2.HTTPError, e:
+            # 416 Requested Range Not Satisfiable: an empty file.
+            if e.code != 416:
+                raise
+            e.close()
+            return self._urlopen(url, timeout=30)
+
+    def _query_content_range(self, f):
+        """ Helper method for _download_file(): f is the response to
+            _open_download().  Returns (first byte, last byte, file length)
+            if the server honoured the Range request from the start of the
+            file, else None.
+            """
+        if f.getcode() != 206:
+            return None
+        m = re.match(r'^bytes 0-(\d+)/(\d+)$', f.info().get('content-range', ''))
+        if not m:
+            return None
+        return 0, int(m.group(1)), int(m.group(2))
+
+    def _download_file_ranges(self, url, file_name, f_length, headers,
+                              head=None, head_length=0):
+        """ Helper method for _download_file(): fetch url in up to
+            self.config['download_segments'] (default 4) concurrent Range
+            requests, each writing its own part of file_name.
 
-    def _retry_download_file(self, url, file_name, error_level, retry_config=None):
+            head, if given, is an open response for the first head_length
+            bytes, which becomes the first segment.
+
+            Progress is kept in file_name + '.download_state', so when
+            this is called again (e.g. by retry()) for the same url, and
+            the server's ETag or Last-Modified and content-length haven't
+            changed, only the missing bytes are fetched.
+            """
+        state_file = '%s.download_state' % file_name
+        validator = headers.get('etag') or headers.get('last-modified')
+        state = None
+        if os.path.exists(state_file) and os.path.exists(file_name):
+            try:
+                state = json.load(open(state_file))
+            except ValueError:
+                state = None
+        if state and state.get('url') == url and \
+                state.get('length') == f_length and \
+                state.get('validator') == validator and \
+                os.path.getsize(file_name) == f_length:
+            segments = state['segments']
+            if head is not None:
+                head.close()
+                head = None
+            self.info("Resuming download of %s: %d of %d bytes already present." %
+                      (url, sum([s[2] for s in segments]), f_length))
+        else:
+            max_segments = self.config.get('download_segments', 4)
+            # [first byte, last byte, bytes done]
+            segments = []
+            if head is not None:
+                segments.append([0, head_length - 1, 0])
+                max_segments -= 1
+            rest = f_length - head_length
+            num_segments = max(1, min(
+                max_segments,
+                rest / self.config.get('download_min_segment_size', 16 * 1024 ** 2)
+            ))
+            segment_size = rest / num_segments
+            segments += [[head_length + i * segment_size,
+                          head_length + (i + 1) * segment_size - 1, 0]
+                         for i in range(num_segments)]
+            segments[-1][1] = f_length - 1
+            local_file = open(file_name, 'wb')
+            local_file.truncate(f_length)
+            local_file.close()
+        state = {'url': url, 'length': f_length, 'validator': validator,
+                 'segments': segments}
+        pending = [s for s in segments if s[0] + s[2] <= s[1]]
+        self.info("Downloading %d bytes in %d segments (%d remaining)." %
+                  (f_length, len(segments), len(pending)))
+        self._write_download_state(state_file, state)
+        first_exception = None
+        if pending:
+            pool = ThreadPool(len(pending))
+            results = [pool.apply_async(self._download_segment,
+                                        (url, file_name, segment))
+                       for segment in pending if segment[0] or head is None]
+            if head is not None:
+                results.append(pool.apply_async(self._download_segment,
+                                                (url, file_name, segments[0], head)))
+            pool.close()
+            pool.join()
+            for result in results:
+                try:
+                    result.get()
+                except Exception, e:
+                    first_exception = first_exception or e
+        if first_exception is not None:
+            self._write_download_state(state_file, state)
+            raise first_exception
+        got_length = sum([s[2] for s in segments])
+        if got_length != f_length:
+            self._write_download_state(state_file, state)
+            raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
+        os.remove(state_file)
+
+    def _download_segment(self, url, file_name, segment, f=None):
+        """ Helper method for _download_file_ranges(); runs on a worker
+            thread and updates segment's byte count as it goes.  f is
+            the already open response for the segment, if there is one.
+            """
+        first, last, done = segment
+        if f is None:
+            request = urllib2.Request(url, headers={
+                'Range': 'bytes=%d-%d' % (first + done, last),
+            })
+            f = self._urlopen(request, timeout=30)
+        try:
+            if f.getcode() != 206:
+                raise urllib2.URLError("Server ignored Range request for %s" % url)
+            local_file = open(file_name, 'r+b')
+            try:
+                local_file.seek(first + done)
+                while True:
+                    block = f.read(1024 ** 2)
+                    if not block:
+                        break
+                    local_file.write(block)
+                    segment[2] += len(block)
+            finally:
+                local_file.close()
+        finally:
+            f.close()
+        if first + segment[2] != last + 1:
+            raise urllib2.URLError("Download incomplete; range %d-%d stopped at %d" %
+                                   (first, last, first + segment[2] - 1))
+
+    def _write_download_state(self, state_file, state):
+        fh = open(state_file, 'w')
+        json.dump(state, fh)
+        fh.close()
+
+    def _verify_download_hash(self, file_name, expected_hash, hash_type='sha512'):
+        """ Helper method for _download_file(); a mismatch removes the file
+            and raises URLError so _retry_download_file() tries again.
+            """
+        got_hash = self.file_hash(file_name, hash_type=hash_type)
+        if got_hash != expected_hash.lower():
+            os.remove(file_name)
+            raise urllib2.URLError("%s of %s was %s, expected %s" %
+                                   (hash_type, file_name, got_hash, expected_hash))
+        self.info("Verified %s of %s." % (hash_type, file_name))
+
+    def _retry_download_file(self, url, file_name, error_level, retry_config=None,
+                             expected_hash=None, hash_type='sha512'):
         """ Helper method to retry _download_file().
 
             Split out so we can alter the retry logic in
@@ -266,6 +638,7 @@ class ScriptMixin(object):
         return self.retry(
             self._download_file,
             args=(url, file_name),
+            kwargs={'expected_hash': expected_hash, 'hash_type': hash_type},
             **retry_args
         )
 
@@ -273,8 +646,20 @@ class ScriptMixin(object):
     # TODO thinking about creating a transfer object.
     def download_file(self, url, file_name=None, parent_dir=None,
                       create_parent_dir=True, error_level=ERROR,
-                      exit_code=3, retry_config=None):
+                      exit_code=3, retry_config=None, expected_hash=None,
+                      hash_type='sha512', use_cache=True):
         """ Python wget.
+
+            Large files from servers that support Range requests are
+            downloaded in concurrent segments, and a failed attempt resumes
+            where it left off; see _download_file_ranges().
+
+            If expected_hash is given, the file's hash_type digest is
+            checked after download, and a mismatch is retried.
+
+            If self.config['download_cache_dir'] is set, the file comes
+            from the DownloadCache when it's there and still current,
+            unless use_cache is False.
         """
         if not file_name:
             try:
@@ -288,7 +673,19 @@ class ScriptMixin(object):
             if create_parent_dir:
                 self.mkdir_p(parent_dir, error_level=error_level)
         self.info("Downloading %s to %s" % (url, file_name))
-        status = self._retry_download_file(url, file_name, error_level, retry_config=retry_config)
+
+        def download(path):
+            return self._retry_download_file(url, path, error_level,
+                                             retry_config=retry_config,
+                                             expected_hash=expected_hash,
+                                             hash_type=hash_type)
+        cache = use_cache and self.query_download_cache()
+        if cache:
+            status = cache.fetch(
+                url, file_name, download,
+                expected_hash=expected_hash if hash_type == 'sha512' else None)
+        else:
+            status = download(file_name)
         if status == file_name:
             self.info("Downloaded %d bytes." % os.path.getsize(file_name))
         return status
@@ -398,7 +795,7 @@ class ScriptMixin(object):
 
     def write_to_file(self, file_path, contents, verbose=True,
                       open_mode='w', create_parent_dir=False,
-                      error_level=ERROR):
+                      error_level=ERROR, atomic=False):
         """
         Write contents to file_path.
 
@@ -406,6 +803,10 @@ class ScriptMixin(object):
         abs_path; that needs to be done beforehand, since ScriptMixin doesn't
         necessarily have access to query_abs_dirs().
 
+        With atomic=True the contents are written to file_path.tmp and
+        renamed over file_path, so readers never see a partial file.
+        Not for append modes.
+
         Returns file_path if successful, None if not.
         """
         self.info("Writing to file %s" % file_path)
@@ -416,12 +817,17 @@ class ScriptMixin(object):
         if create_parent_dir:
             parent_dir = os.path.dirname(file_path)
             self.mkdir_p(parent_dir, error_level=error_level)
+        write_path = file_path
+        if atomic:
+            write_path = file_path + '.tmp'
         try:
-            fh = open(file_path, open_mode)
+            fh = open(write_path, open_mode)
             fh.write(contents)
             fh.close()
+            if atomic:
+                os.rename(write_path, file_path)
             return file_path
-        except IOError:
+        except (IOError, OSError):
             self.log("%s can't be opened for writing!" % file_path,
                      level=error_level)
 
@@ -495,6 +901,40 @@ class ScriptMixin(object):
                     return exe_file
         return None
 
+    # File hashes {{{2
+    def query_hash_cache(self):
+        """Returns the HashCache for this script (see
+        mozharness.base.hashing).  It computes c['hash_types'] (sha1,
+        sha256, sha512 and md5 by default) in one read of each file.
+        """
+        with self._hash_cache_lock:
+            if self._hash_cache is None:
+                hash_types = self.config.get('hash_types',
+                                             hashing.DEFAULT_HASH_TYPES)
+                self._hash_cache = hashing.HashCache(hash_types)
+            return self._hash_cache
+
+    def query_file_hashes(self, file_path, hash_types=()):
+        """Returns {hash_type: hexdigest, 'size': size} for file_path.
+        Unchanged files are only read once.
+        """
+        return self.query_hash_cache().query(file_path, hash_types)
+
+    def query_files_hashes(self, file_paths, hash_types=()):
+        """query_file_hashes() for many files, in parallel on
+        c['hash_workers'] threads.  Returns {file_path: hashes}.
+        """
+        return hashing.hash_files(file_paths, cache=self.query_hash_cache(),
+                                  hash_types=hash_types,
+                                  workers=self.config.get('hash_workers',
+                                                          hashing.DEFAULT_WORKERS))
+
+    def file_hash(self, file_path, hash_type='sha512'):
+        """Returns the hex digest of file_path; hash_type is any name
+        hashlib.new() knows (sha1, sha512, md5...).
+        """
+        return self.query_file_hashes(file_path, (hash_type, ))[hash_type]
+
     # More complex commands {{{2
     def retry(self, action, attempts=None, sleeptime=60, max_sleeptime=5 * 60,
               retry_exceptions=(Exception, ), good_statuses=None, cleanup=None,
@@ -643,6 +1083,7 @@ class ScriptMixin(object):
             self.log("Unknown return_type type %s requested in query_exe!" % return_type, level=error_level)
         return exe
 
+    @profiled_command
     def run_command(self, command, cwd=None, error_list=None,
                     halt_on_failure=False, success_codes=None,
                     env=None, partial_env=None, return_type='status',
@@ -652,7 +1093,8 @@ class ScriptMixin(object):
         """Run a command, with logging and error parsing.
 
         output_timeout is the number of seconds without output before the process
-        is killed.
+        is killed; that's handled by mozprocess.ProcessHandler.  Otherwise
+        output is drained in batches by an OutputPump.
 
         TODO: context_lines
 
@@ -723,16 +1165,9 @@ class ScriptMixin(object):
             else:
                 p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
                                      cwd=cwd, stderr=subprocess.STDOUT, env=env)
-                loop = True
-                while loop:
-                    if p.poll() is not None:
-                        """Avoid losing the final lines of the log?"""
-                        loop = False
-                    while True:
-                        line = p.stdout.readline()
-                        if not line:
-                            break
-                        parser.add_lines(line)
+                for lines in OutputPump(p.stdout).batches():
+                    parser.add_lines(lines)
+                p.wait()
                 returncode = p.returncode
         except OSError, e:
             level = error_level
@@ -768,13 +1203,16 @@ class ScriptMixin(object):
             return parser.num_errors
         return returncode
 
+    @profiled_command
     def get_output_from_command(self, command, cwd=None,
                                 halt_on_failure=False, env=None,
                                 silent=False, log_level=INFO,
                                 tmpfile_base_path='tmpfile',
                                 return_type='output', save_tmpfiles=False,
                                 throw_exception=False, fatal_exit_code=2,
-                                ignore_errors=False, success_codes=None):
+                                ignore_errors=False, success_codes=None,
+                                head_lines=None, tail_lines=None,
+                                heartbeat_interval=None, spill_size=None):
         """Similar to run_command, but where run_command is an
         os.system(command) analog, get_output_from_command is a `command`
         analog.
@@ -782,11 +1220,21 @@ class ScriptMixin(object):
         Less error checking by design, though if we figure out how to
         do it without borking the output, great.
 
+        stdout and stderr are read concurrently into memory; temporary
+        files (tmpfile_base_path + '_stdout'/'_stderr') are only written
+        if save_tmpfiles is set or return_type isn't 'output', in which
+        case return_type != 'output' returns their filenames.
+
+        head_lines and tail_lines keep only the first and/or last N lines
+        of stdout in the log and the returned output.
+
+        heartbeat_interval logs a "still running" message every N seconds
+        until the command finishes.
+
+        spill_size is the number of bytes of stdout or stderr to hold in
+        memory before spilling the rest to an anonymous temporary file.
+
         TODO: binary mode? silent is kinda like that.
-        TODO: since p.wait() can take a long time, optionally log something
-        every N seconds?
-        TODO: optionally only keep the first or last (N) line(s) of output?
-        TODO: optionally only return the tmp_stdout_filename?
 
         ignore_errors=True is for the case where a command might produce standard
         error output, but you don't particularly care; setting to True will
@@ -805,73 +1253,104 @@ class ScriptMixin(object):
             self.info("Getting output from command: %s" % command)
         if isinstance(command, list):
             self.info("Copy/paste: %s" % subprocess.list2cmdline(command))
-        # This could potentially return something?
-        tmp_stdout = None
-        tmp_stderr = None
-        tmp_stdout_filename = '%s_stdout' % tmpfile_base_path
-        tmp_stderr_filename = '%s_stderr' % tmpfile_base_path
         if success_codes is None:
             success_codes = [0]
-
-        # TODO probably some more elegant solution than 2 similar passes
-        try:
-            tmp_stdout = open(tmp_stdout_filename, 'w')
-        except IOError:
-            level = ERROR
-            if halt_on_failure:
-                level = FATAL
-            self.log("Can't open %s for writing!" % tmp_stdout_filename +
-                     self.exception(), level=level)
-            return None
-        try:
-            tmp_stderr = open(tmp_stderr_filename, 'w')
-        except IOError:
-            level = ERROR
-            if halt_on_failure:
-                level = FATAL
-            self.log("Can't open %s for writing!" % tmp_stderr_filename +
-                     self.exception(), level=level)
-            return None
         shell = True
         if isinstance(command, list):
             shell = False
-        p = subprocess.Popen(command, shell=shell, stdout=tmp_stdout,
-                             cwd=cwd, stderr=tmp_stderr, env=env)
-        # XXX: changed from self.debug to self.log due to this error:
-        #      TypeError: debug() takes exactly 1 argument (2 given)
-        self.log("Temporary files: %s and %s" % (tmp_stdout_filename, tmp_stderr_filename), level=DEBUG)
-        p.wait()
-        tmp_stdout.close()
-        tmp_stderr.close()
+        use_tmpfiles = save_tmpfiles or return_type != 'output'
+        tmp_stdout_filename = '%s_stdout' % tmpfile_base_path
+        tmp_stderr_filename = '%s_stderr' % tmpfile_base_path
+        stdout_buffer = OutputBuffer(spill_size=spill_size)
+        stderr_buffer = OutputBuffer(spill_size=spill_size)
+
+        if use_tmpfiles:
+            tmp_stdout = None
+            tmp_stderr = None
+            # TODO probably some more elegant solution than 2 similar passes
+            try:
+                tmp_stdout = open(tmp_stdout_filename, 'w')
+            except IOError:
+                level = ERROR
+                if halt_on_failure:
+                    level = FATAL
+                self.log("Can't open %s for writing!" % tmp_stdout_filename +
+                         self.exception(), level=level)
+                return None
+            try:
+                tmp_stderr = open(tmp_stderr_filename, 'w')
+            except IOError:
+                level = ERROR
+                if halt_on_failure:
+                    level = FATAL
+                self.log("Can't open %s for writing!" % tmp_stderr_filename +
+                         self.exception(), level=level)
+                return None
+            p = subprocess.Popen(command, shell=shell, stdout=tmp_stdout,
+                                 cwd=cwd, stderr=tmp_stderr, env=env)
+            # XXX: changed from self.debug to self.log due to this error:
+            #      TypeError: debug() takes exactly 1 argument (2 given)
+            self.log("Temporary files: %s and %s" % (tmp_stdout_filename, tmp_stderr_filename), level=DEBUG)
+            self._wait_for_command(command, p, [], heartbeat_interval)
+            tmp_stdout.close()
+            tmp_stderr.close()
+            for filename, buf in ((tmp_stdout_filename, stdout_buffer),
+                                  (tmp_stderr_filename, stderr_buffer)):
+                if os.path.exists(filename) and os.path.getsize(filename):
+                    buf.write(self.read_from_file(filename, verbose=False))
+        else:
+            p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+                                 cwd=cwd, stderr=subprocess.PIPE, env=env)
+            readers = []
+            for stream, buf in ((p.stdout, stdout_buffer),
+                                (p.stderr, stderr_buffer)):
+                reader = threading.Thread(target=buf.read_from, args=(stream, ))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+            self._wait_for_command(command, p, readers, heartbeat_interval)
+
         return_level = DEBUG
         output = None
-        if os.path.exists(tmp_stdout_filename) and os.path.getsize(tmp_stdout_filename):
-            output = self.read_from_file(tmp_stdout_filename,
-                                         verbose=False)
-            if not silent:
-                self.log("Output received:", level=log_level)
-                output_lines = output.rstrip().splitlines()
+        if stdout_buffer.size:
+            capped = head_lines is not None or tail_lines is not None
+            output_lines = None
+            if capped:
+                output_lines = self._cap_output_lines(stdout_buffer.iter_lines(),
+                                                      head_lines, tail_lines)
+            elif not silent:
+                output_lines = stdout_buffer.iter_lines()
+            elif return_type == 'output':
+                output = stdout_buffer.getvalue()
+            if output_lines is not None:
+                kept_lines = []
+                if not silent:
+                    self.log("Output received:", level=log_level)
                 for line in output_lines:
-                    if not line or line.isspace():
+                    if return_type == 'output':
+                        kept_lines.append(line)
+                    if silent or not line or line.isspace():
                         continue
-                    line = line.decode("utf-8")
-                    self.log(' %s' % line, level=log_level)
-                output = '\n'.join(output_lines)
-        if os.path.exists(tmp_stderr_filename) and os.path.getsize(tmp_stderr_filename):
+                    self.log(' %s' % line.decode("utf-8"), level=log_level)
+                if return_type == 'output':
+                    output = '\n'.join(kept_lines)
+                    if not capped:
+                        output = output.rstrip()
+        if stderr_buffer.size:
             if not ignore_errors:
                 return_level = ERROR
             self.log("Errors received:", level=return_level)
-            errors = self.read_from_file(tmp_stderr_filename,
-                                         verbose=False)
-            for line in errors.rstrip().splitlines():
+            for line in stderr_buffer.iter_lines():
                 if not line or line.isspace():
                     continue
                 line = line.decode("utf-8")
                 self.log(' %s' % line, level=return_level)
         elif p.returncode not in success_codes and not ignore_errors:
             return_level = ERROR
+        stdout_buffer.close()
+        stderr_buffer.close()
         # Clean up.
-        if not save_tmpfiles:
+        if use_tmpfiles and not save_tmpfiles:
             self.rmtree(tmp_stderr_filename, log_level=DEBUG)
             self.rmtree(tmp_stdout_filename, log_level=DEBUG)
         if p.returncode and throw_exception:
@@ -888,6 +1367,51 @@ class ScriptMixin(object):
         else:
             return output
 
+    def _wait_for_command(self, command, p, readers, heartbeat_interval=None):
+        """Helper for get_output_from_command(): wait for the reader
+        threads to hit EOF and for p to exit, logging every
+        heartbeat_interval seconds while we wait.
+        """
+        if not heartbeat_interval:
+            for reader in readers:
+                reader.join()
+            p.wait()
+            return
+        start = time.time()
+        next_heartbeat = start + heartbeat_interval
+        while p.poll() is None or [r for r in readers if r.is_alive()]:
+            timeout = max(next_heartbeat - time.time(), 0)
+            alive = [r for r in readers if r.is_alive()]
+            if alive:
+                alive[0].join(timeout)
+            else:
+                time.sleep(min(timeout, 0.1))
+            if time.time() >= next_heartbeat:
+                self.info("Still running %s after %d seconds..." %
+                          (command, time.time() - start))
+                next_heartbeat += heartbeat_interval
+        p.wait()
+
+    def _cap_output_lines(self, lines, head_lines=None, tail_lines=None):
+        """Helper for get_output_from_command(): keep the first head_lines
+        and last tail_lines of lines, noting how many were dropped.
+        """
+        head = []
+        tail = deque(maxlen=tail_lines or 0)
+        dropped = 0
+        for line in lines:
+            if head_lines is not None and len(head) < head_lines:
+                head.append(line)
+            elif tail_lines:
+                if len(tail) == tail_lines:
+                    dropped += 1
+                tail.append(line)
+            else:
+                dropped += 1
+        if dropped:
+            self.info("Skipped %d lines of output." % dropped)
+        return head + list(tail)
+
     def _touch_file(self, file_name, times=None, error_level=FATAL):
         """touch a file; If times is None, then the file's access and modified
            times are set to the current time
@@ -903,22 +1427,123 @@ class ScriptMixin(object):
                 self.log(msg, error_level=error_level)
         os.utime(file_name, times)
 
-    def unpack(self, filename, extract_to):
+    def unpack(self, filename, extract_to, patterns=None):
         '''
         This method allows us to extract a file regardless of its extension
+
+        Zip files (including .apk, .jar, .xpi) and tarballs are extracted
+        in-process; see mozharness.base.archive.  patterns is an optional
+        list of unzip-style globs: only matching members are extracted.
+        Zip members that are already in place with the right size and CRC
+        are left alone.
+
+        Returns the list of matching member names; fatal on error.
         '''
-        # XXX: Make sure that filename has a extension of one of our supported file formats
-        m = re.search('\.tar\.(bz2|gz)$', filename)
-        if m:
-            command = self.query_exe('tar', return_type='list')
-            tar_cmd = "jxfv"
-            if m.group(1) == "gz":
-                tar_cmd = "zxfv"
-            command.extend([tar_cmd, filename, "-C", extract_to])
-            self.run_command(command, halt_on_failure=True)
-        else:
-            # XXX implement
-            pass
+        self.info("Extracting %s to %s" % (filename, extract_to))
+        self.mkdir_p(extract_to)
+        try:
+            if zipfile.is_zipfile(filename):
+                names, written = archive.extract_zip(
+                    filename, extract_to, patterns=patterns,
+                    workers=self.config.get('extract_workers',
+                                            archive.DEFAULT_WORKERS))
+                self.info("%d of %d files needed extracting." % (written, len(names)))
+            elif tarfile.is_tarfile(filename):
+                names = archive.extract_tarball(filename, extract_to,
+                                                patterns=patterns)
+            else:
+                self.fatal("Don't know how to extract %s!" % filename, exit_code=3)
+        except (ExtractError, zipfile.BadZipfile, tarfile.TarError,
+                zlib.error, IOError, OSError), e:
+            self.fatal("Can't extract %s: %s" % (filename, str(e)), exit_code=3)
+        if patterns and not names:
+            self.info("No files in %s matched %s." % (filename, patterns))
+        return names
+
+    def _download_unpack(self, url, file_name, extract_to, patterns=None,
+                         expected_hash=None, hash_type='sha512'):
+        """ Helper method for download_unpack().
+
+            A stream cut short between archive members looks like the end
+            of the archive, so the length is checked against
+            content-length, as _download_file() does, before going on.
+            """
+        is_tarball = re.search(r'\.(tar|tgz|tar\.gz|tar\.bz2)$', file_name)
+        f = self._urlopen(url, timeout=30)
+        out = open(file_name, 'wb')
+        try:
+            reader = archive.TeeReader(f, out)
+            if is_tarball:
+                names = archive.extract_tarball_stream(reader, extract_to, patterns)
+            else:
+                names = archive.extract_zip_stream(reader, extract_to, patterns)
+            reader.drain()
+            f_length = f.info().get('content-length')
+            if f_length is not None and reader.length != int(f_length):
+                raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (int(f_length), reader.length))
+        finally:
+            out.close()
+            f.close()
+        if expected_hash:
+            self._verify_download_hash(file_name, expected_hash, hash_type)
+        if not is_tarball:
+            archive.apply_zip_modes(file_name, extract_to, patterns)
+        self.info("Downloaded %d bytes; extracted %d files." %
+                  (os.path.getsize(file_name), len(names)))
+        return file_name
+
+    def download_unpack(self, url, extract_to, file_name=None, parent_dir=None,
+                        patterns=None, error_level=ERROR, retry_config=None,
+                        expected_hash=None, hash_type='sha512'):
+        """ Download a zip file or tarball and extract it into extract_to
+            as it arrives, instead of downloading it and then reading it
+            all again to unpack it.
+
+            The archive is also saved to file_name under parent_dir, as
+            download_file() would, and checked against expected_hash the
+            same way.  Returns file_name on success.
+            """
+        file_name = file_name or self.get_filename_from_url(url)
+        if parent_dir:
+            file_name = os.path.join(parent_dir, file_name)
+            self.mkdir_p(parent_dir, error_level=error_level)
+        self.mkdir_p(extract_to, error_level=error_level)
+        self.info("Downloading %s to %s and extracting to %s" %
+                  (url, file_name, extract_to))
+        retry_args = dict(
+            failure_status=None,
+            retry_exceptions=(urllib2.HTTPError, urllib2.URLError,
+                              httplib.BadStatusLine,
+                              socket.timeout, socket.error,
+                              ExtractError, zipfile.BadZipfile, zlib.error,
+                              tarfile.TarError),
+            error_message="Can't download and extract %s!" % url,
+            error_level=error_level,
+        )
+        if retry_config:
+            retry_args.update(retry_config)
+        return self.retry(
+            self._download_unpack,
+            args=(url, file_name, extract_to),
+            kwargs={'patterns': patterns, 'expected_hash': expected_hash,
+                    'hash_type': hash_type},
+            **retry_args
+        )
+
+    def run_concurrently(self, func, items, workers, name=None):
+        """Returns [func(item) for item in items], running up to workers
+        of them at once, each logging as one block; see the module-level
+        run_concurrently().  name describes func in the log.
+
+        Whatever func does mustn't depend on the cwd, since self.chdir()
+        is process-wide.
+        """
+        items = list(items)
+        if workers > 1 and len(items) > 1:
+            self.info("Running %s for %d items, %d at a time." %
+                      (name or func.__name__, len(items),
+                       min(workers, len(items))))
+        return run_concurrently(func, items, workers, log_obj=self.log_obj)
 
 
 def PreScriptRun(func):
@@ -1002,8 +1627,14 @@ def PostScriptAction(action=None):
 
 # BaseScript {{{1
 class BaseScript(ScriptMixin, LogMixin, object):
+    # {action: (actions it needs)}, for run_actions_in_parallel().
+    # Actions without an entry need every action before them.
+    action_dependencies = {}
+
     def __init__(self, config_options=None, ConfigClass=BaseConfig,
                  default_log_level="info", **kwargs):
+        self.profiler = Profiler()
+        init_start = snapshot()
         super(BaseScript, self).__init__()
 
         # Collect decorated methods. We simply iterate over the attributes of
@@ -1075,6 +1706,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             self._dump_config_hierarchy(rw_config.all_cfg_files_and_dicts)
         if self.config.get("dump_config"):
             self.dump_config(exit_on_finish=True)
+        self.profiler.add_event('__init__', 'script', init_start)
 
     def _dump_config_hierarchy(self, cfg_files):
         """ interpret each config file used.
@@ -1148,17 +1780,41 @@ class BaseScript(ScriptMixin, LogMixin, object):
         """This is here for run().
         """
         if hasattr(self, method_name) and callable(getattr(self, method_name)):
-            return getattr(self, method_name)()
+            with self.profiler.span(method_name, 'method'):
+                return getattr(self, method_name)()
         elif error_if_missing:
             self.error("No such method %s!" % method_name)
 
+    def _run_listener(self, fn, *args, **kwargs):
+        with self.profiler.span(fn, 'listener'):
+            return getattr(self, fn)(*args, **kwargs)
+
+    def write_profile(self):
+        """Write the profile of this run so far to
+        abs_log_dir/profile.json; see mozharness.base.profiler.
+        """
+        if not self.config.get("write_profile", True):
+            return
+        dirs = self.query_abs_dirs()
+        self.mkdir_p(dirs['abs_log_dir'])
+        path = os.path.join(dirs['abs_log_dir'], 'profile.json')
+        try:
+            self.profiler.write(path, script=sys.argv[0],
+                                actions=list(self.actions),
+                                return_code=self.return_code)
+        except (IOError, OSError, TypeError, ValueError):
+            self.warning("Can't write %s: %s" % (path, traceback.format_exc()))
+
     def copy_logs_to_upload_dir(self):
         """Copies logs to the upload directory"""
         self.info("Copying logs to upload dir...")
+        self.log_obj.flush()
         log_files = ['localconfig.json']
         for log_name in self.log_obj.log_files.keys():
             log_files.append(self.log_obj.log_files[log_name])
         dirs = self.query_abs_dirs()
+        if os.path.exists(os.path.join(dirs['abs_log_dir'], 'profile.json')):
+            log_files.append('profile.json')
         for log_file in log_files:
             self.copy_to_upload_dir(os.path.join(dirs['abs_log_dir'], log_file),
                                     dest=os.path.join('logs', log_file),
@@ -1171,6 +1827,10 @@ class BaseScript(ScriptMixin, LogMixin, object):
             self.action_message("Skipping %s step." % action)
             return
 
+        with self.profiler.span(action, 'action', success=False) as span_args:
+            span_args['success'] = self._run_action(action)
+
+    def _run_action(self, action):
         method_name = action.replace("-", "_")
         self.action_message("Running %s step." % action)
 
@@ -1181,8 +1841,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
             try:
                 self.info("Running pre-action listener: %s" % fn)
-                method = getattr(self, fn)
-                method(action)
+                self._run_listener(fn, action)
             except Exception:
                 self.error("Exception during pre-action for %s: %s" % (
                     action, traceback.format_exc()))
@@ -1193,8 +1852,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
                     try:
                         self.info("Running post-action listener: %s" % fn)
-                        method = getattr(self, fn)
-                        method(action, success=False)
+                        self._run_listener(fn, action, success=False)
                     except Exception:
                         self.error("An additional exception occurred during "
                                    "post-action for %s: %s" % (action,
@@ -1218,8 +1876,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
                 try:
                     self.info("Running post-action listener: %s" % fn)
-                    method = getattr(self, fn)
-                    method(action, success=success and self.return_code == 0)
+                    self._run_listener(fn, action,
+                                       success=success and self.return_code == 0)
                 except Exception:
                     post_success = False
                     self.error("Exception during post-action for %s: %s" % (
@@ -1227,6 +1885,90 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
             if not post_success:
                 self.fatal("Aborting due to failure in post-action listener.")
+        return success and self.return_code == 0
+
+    def query_action_dependencies(self):
+        """Return {action: set(actions it waits for)} for the enabled
+        actions, from self.action_dependencies and
+        self.config['action_dependencies'].
+
+        An action can only depend on actions before it in all_actions;
+        dependencies that aren't enabled this run are ignored.
+        """
+        declared = dict(self.action_dependencies)
+        declared.update(self.config.get('action_dependencies', {}))
+        dependencies = {}
+        previous = []
+        for action in self.all_actions:
+            if action not in self.actions:
+                continue
+            if action in declared:
+                for needed in declared[action]:
+                    if needed not in self.all_actions or \
+                            self.all_actions.index(needed) > self.all_actions.index(action):
+                        self.fatal("Action %s depends on %s, which doesn't come "
+                                   "before it in all_actions!" % (action, needed))
+                dependencies[action] = set(needed for needed in declared[action]
+                                           if needed in previous)
+            else:
+                dependencies[action] = set(previous)
+            previous.append(action)
+        return dependencies
+
+    def run_actions_in_parallel(self, workers):
+        """Run the enabled actions on a pool of worker threads, starting
+        each one as soon as the actions it depends on have succeeded
+        (see query_action_dependencies()).
+
+        Each action, with its listeners, runs in one thread and logs as
+        one block (see BaseLogger.block()).  After the first failure no
+        more actions are started; the running ones are waited for, then
+        the failure is raised here, as if the actions had run in order.
+
+        Actions that run at the same time mustn't depend on the cwd,
+        since self.chdir() is process-wide.
+        """
+        for action in self.all_actions:
+            if action not in self.actions:
+                self.run_action(action)
+        dependencies = self.query_action_dependencies()
+        pending = [a for a in self.all_actions if a in dependencies]
+        done = set()
+        running = set()
+        failure = None
+        finished = Queue.Queue()
+
+        def run_one(action):
+            try:
+                with self.log_obj.block():
+                    self.run_action(action)
+                finished.put((action, None))
+            except BaseException:
+                finished.put((action, sys.exc_info()))
+
+        self.info("Running up to %d actions at once." % workers)
+        pool = ThreadPool(workers)
+        try:
+            while True:
+                if failure is None:
+                    for action in list(pending):
+                        if dependencies[action] <= done:
+                            pending.remove(action)
+                            running.add(action)
+                            pool.apply_async(run_one, (action, ))
+                if not running:
+                    break
+                action, exc_info = finished.get()
+                running.remove(action)
+                if exc_info is None:
+                    done.add(action)
+                elif failure is None:
+                    failure = exc_info
+        finally:
+            pool.close()
+            pool.join()
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
 
     def run(self):
         """Default run method.
@@ -1242,30 +1984,38 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
         Postflight is quick testing for success after an action.
 
+        With self.config['parallel_actions'] > 1, independent actions
+        run at the same time; see run_actions_in_parallel().
+
+        A profile of the run is written to abs_log_dir/profile.json
+        (see write_profile()), even if an action fails.
         """
         for fn in self._listeners['pre_run']:
             try:
                 self.info("Running pre-run listener: %s" % fn)
-                method = getattr(self, fn)
-                method()
+                self._run_listener(fn)
             except Exception:
                 self.error("Exception during pre-run listener: %s" %
                            traceback.format_exc())
 
                 for fn in self._listeners['post_run']:
                     try:
-                        method = getattr(self, fn)
-                        method()
+                        self._run_listener(fn)
                     except Exception:
                         self.error("An additional exception occurred during a "
                                    "post-run listener: %s" % traceback.format_exc())
 
+                self.write_profile()
                 self.fatal("Aborting due to failure in pre-run listener.")
 
         self.dump_config()
         try:
-            for action in self.all_actions:
-                self.run_action(action)
+            workers = self.config.get('parallel_actions')
+            if workers and workers > 1:
+                self.run_actions_in_parallel(workers)
+            else:
+                for action in self.all_actions:
+                    self.run_action(action)
         except Exception:
             self.fatal("Uncaught exception: %s" % traceback.format_exc())
         finally:
@@ -1273,13 +2023,13 @@ class BaseScript(ScriptMixin, LogMixin, object):
             for fn in self._listeners['post_run']:
                 try:
                     self.info("Running post-run listener: %s" % fn)
-                    method = getattr(self, fn)
-                    method()
+                    self._run_listener(fn)
                 except Exception:
                     post_success = False
                     self.error("Exception during post-run listener: %s" %
                                traceback.format_exc())
 
+            self.write_profile()
             if not post_success:
                 self.fatal("Aborting due to failure in post-run listener.")
         if self.config.get("copy_logs_post_run", True):
@@ -1360,6 +2110,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             if value is not None:
                 log_config[key] = value
         if log_type == "multi":
+            log_config['async_writer'] = c.get('async_log_writer', True)
             self.log_obj = MultiFileLogger(**log_config)
         else:
             self.log_obj = SimpleFileLogger(**log_config)
@@ -1482,14 +2233,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             return None
 
     def file_sha512sum(self, file_path):
-        bs = 65536
-        hasher = hashlib.sha512()
-        with open(file_path, 'rb') as fh:
-            buf = fh.read(bs)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = fh.read(bs)
-        return hasher.hexdigest()
+        return self.file_hash(file_path, hash_type='sha512')
 
 
 # __main__ {{{1
@@ -8,13 +8,13 @@
 """
 
 import getpass
-import hashlib
 import os
 import re
 import subprocess
 
 from mozharness.base.errors import JarsignerErrorList, ZipErrorList, ZipalignErrorList
 from mozharness.base.log import OutputParser, IGNORE, DEBUG, INFO, ERROR, FATAL
+from mozharness.base.script import OutputPump
 
 UnsignApkErrorList = [{
     'regex': re.compile(r'''zip warning: name not matched: '?META-INF/'''),
@@ -41,14 +41,11 @@ class BaseSigningMixin(object):
         self.info(" %s" % str(length))
         return length
 
-    # TODO this should be parallelized with the to-be-written BaseHelper!
     def query_sha512sum(self, file_path):
+        """See ScriptMixin.file_hash(); the hashes of unchanged files are
+        cached."""
         self.info("Determining sha512sum for %s" % file_path)
-        m = hashlib.sha512()
-        contents = self.read_from_file(file_path, verbose=False,
-                                       open_mode='rb')
-        m.update(contents)
-        sha512 = m.hexdigest()
+        sha512 = self.file_hash(file_path, hash_type='sha512')
         self.info(" %s" % sha512)
         return sha512
 
@@ -128,13 +125,9 @@ class AndroidSigningMixin(object):
             return -3
         parser = OutputParser(config=self.config, log_obj=self.log_obj,
                               error_list=error_list)
-        loop = True
-        while loop:
-            if p.poll() is not None:
-                """Avoid losing the final lines of the log?"""
-                loop = False
-            for line in p.stdout:
-                parser.add_lines(line)
+        for lines in OutputPump(p.stdout).batches():
+            parser.add_lines(lines)
+        p.wait()
         if parser.num_errors:
             self.log("(failure)", level=error_level)
         else:
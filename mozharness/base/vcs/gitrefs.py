@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Resolve git ref names to revisions, with one `git ls-remote` per remote.
+
+`git ls-remote <url> <ref>` downloads the remote's whole ref advertisement
+and filters it locally, so GitRefResolver fetches each remote's refs once
+and resolves every ref wanted from it.  Resolved refs go into a
+GitRefCache, which can be saved between runs; entries older than its ttl
+are dropped when it's loaded.
+"""
+
+import subprocess
+import threading
+import time
+import urlparse
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.log import LogMixin
+from mozharness.base.script import run_concurrently
+
+
+def parse_ls_remote(output):
+    """Returns [(ref, revision), ...] from `git ls-remote` output, in order."""
+    refs = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            refs.append((parts[1], parts[0]))
+    return refs
+
+
+def match_ref(refs, pattern):
+    """Returns the revision `git ls-remote <url> <pattern>` would print
+    first: the ref named pattern, or else the first one ending in
+    /<pattern>.  refs is a list from parse_ls_remote().
+    """
+    first_match = None
+    for ref, revision in refs:
+        if ref == pattern:
+            return revision
+        if first_match is None and ref.endswith('/' + pattern):
+            first_match = revision
+    return first_match
+
+
+def query_host(url):
+    """The host part of a git url, including scp-style user@host:path."""
+    if '://' in url:
+        return urlparse.urlparse(url).hostname
+    if ':' in url:
+        return url.split(':', 1)[0].split('@')[-1]
+    return 'localhost'
+
+
+# GitRefCache {{{1
+class GitRefCache(object):
+    """Revisions keyed on "<remote url>:<ref>", each with the time it was
+    looked up.
+
+    Entries only expire in load(), so every lookup in one run gets the
+    same answer for the same ref.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.entries = {}
+
+    def _key(self, remote_url, ref):
+        return "%s:%s" % (remote_url, ref)
+
+    def get(self, remote_url, ref):
+        entry = self.entries.get(self._key(remote_url, ref))
+        if entry:
+            return entry['revision']
+
+    def set(self, remote_url, ref, revision, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.entries[self._key(remote_url, ref)] = {
+            'revision': revision,
+            'timestamp': timestamp,
+        }
+
+    def load(self, path, now=None):
+        """Add the entries saved in path that are younger than self.ttl.
+        Caches saved before entries had timestamps count as expired.
+        Returns the number of entries dropped.
+        """
+        if now is None:
+            now = time.time()
+        fh = open(path)
+        try:
+            entries = json.load(fh)
+        finally:
+            fh.close()
+        expired = 0
+        for key, entry in entries.items():
+            if not isinstance(entry, dict):
+                entry = {'revision': entry, 'timestamp': 0}
+            if self.ttl is not None and now - entry['timestamp'] > self.ttl:
+                expired += 1
+                continue
+            self.entries[key] = entry
+        return expired
+
+    def dumps(self):
+        return json.dumps(self.entries, sort_keys=True, indent=4) + "\n"
+
+
+# GitRefResolver {{{1
+class GitRefResolver(LogMixin):
+    """Resolve (remote url, ref) pairs with one `git ls-remote` per remote,
+    up to workers at a time and no more than per_host against one host.
+
+        resolver = GitRefResolver(log_obj=self.log_obj, cache=cache)
+        revisions = resolver.resolve([(url, 'refs/heads/master'), ...])
+
+    Each remote's refs are kept for the life of the resolver.
+    """
+    def __init__(self, log_obj=None, cache=None, workers=20, per_host=4,
+                 attempts=5, sleeptime=30, git='git'):
+        super(GitRefResolver, self).__init__()
+        self.log_obj = log_obj
+        if cache is None:
+            cache = GitRefCache()
+        self.cache = cache
+        self.workers = workers
+        self.per_host = per_host
+        self.attempts = attempts
+        self.sleeptime = sleeptime
+        self.git = git
+        self.remote_refs = {}
+        self.host_slots = {}
+
+    def ls_remote(self, remote_url):
+        """Returns parse_ls_remote() of `git ls-remote remote_url`, or None
+        if it fails self.attempts times.
+        """
+        cmd = [self.git, 'ls-remote', remote_url]
+        for attempt in range(1, self.attempts + 1):
+            self.info("Running %s" % cmd)
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, errors = proc.communicate()
+            if proc.returncode == 0:
+                refs = parse_ls_remote(output)
+                self.info("%s has %d refs" % (remote_url, len(refs)))
+                return refs
+            self.warning("%s returned %i - got output: %s" %
+                         (cmd, proc.returncode, errors))
+            if attempt < self.attempts:
+                self.warning("Sleeping %d and retrying" % self.sleeptime)
+                time.sleep(self.sleeptime)
+        return None
+
+    def query_remote_refs(self, remote_url):
+        if remote_url not in self.remote_refs:
+            host = query_host(remote_url)
+            with self.host_slots[host]:
+                self.remote_refs[remote_url] = self.ls_remote(remote_url)
+        return self.remote_refs[remote_url]
+
+    def resolve(self, wanted):
+        """Returns {(remote url, ref): revision} for each (remote url, ref)
+        in wanted.  The revision is None if the remote doesn't have the
+        ref, or can't be listed.
+        """
+        results = {}
+        pending = {}
+        for remote_url, ref in wanted:
+            revision = self.cache.get(remote_url, ref)
+            if revision:
+                self.info("Reusing previous lookup %s:%s -> %s" %
+                          (remote_url, ref, revision))
+                results[(remote_url, ref)] = revision
+            else:
+                pending.setdefault(remote_url, set()).add(ref)
+        if not pending:
+            return results
+        for remote_url in pending:
+            self.host_slots.setdefault(query_host(remote_url),
+                                       threading.BoundedSemaphore(self.per_host))
+        remote_urls = sorted(pending)
+        all_refs = run_concurrently(self.query_remote_refs, remote_urls,
+                                    self.workers)
+        for remote_url, refs in zip(remote_urls, all_refs):
+            for ref in sorted(pending[remote_url]):
+                revision = None
+                if refs is not None:
+                    revision = match_ref(refs, ref)
+                if revision:
+                    self.info("%s:%s -> %s" % (remote_url, ref, revision))
+                    self.cache.set(remote_url, ref, revision)
+                results[(remote_url, ref)] = revision
+        return results
@@ -8,11 +8,21 @@
 
 Largely copied/ported from
 https://hg.mozilla.org/build/tools/file/cf265ea8fb5e/lib/python/util/hg.py .
+
+With self.config['hg_command_server'] set, read-only queries against a
+local repo (parent, branch, branches, out) go to an
+`hg serve --cmdserver pipe` process kept per repo, instead of starting
+hg for every one; if the command server can't be used we fall back to
+running hg.  hg_ver() and query_can_share() are answered once per
+process.
 """
 
+import atexit
 import os
 import re
+import struct
 import subprocess
+import threading
 from urlparse import urlsplit
 
 import sys
@@ -24,6 +34,164 @@ from mozharness.base.script import ScriptMixin
 
 HG_OPTIONS = ['--config', 'ui.merge=internal:merge']
 
+# Per-process caches, keyed by the hg command line.
+_hg_versions = {}
+_can_share = {}
+
+
+# HgCommandServer {{{1
+class HgCommandServerError(Exception):
+    pass
+
+
+class HgCommandServer(object):
+    """A client for one `hg serve --cmdserver pipe` process, serving the
+    repository at path.  See
+    https://www.mercurial-scm.org/wiki/CommandServer for the protocol.
+    """
+    def __init__(self, hg, path):
+        self.path = path
+        self.repo_id = self.query_repo_id(path)
+        self.lock = threading.Lock()
+        devnull = open(os.devnull, 'w')
+        try:
+            self.proc = subprocess.Popen(
+                hg + ['serve', '--cmdserver', 'pipe',
+                      '--config', 'ui.interactive=False'],
+                cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull)
+        except OSError, e:
+            raise HgCommandServerError("Can't start hg command server: %s" % str(e))
+        finally:
+            devnull.close()
+        try:
+            channel, hello = self._read_channel()
+        except HgCommandServerError:
+            self.close()
+            raise
+        capabilities = []
+        for line in hello.splitlines():
+            if line.startswith('capabilities:'):
+                capabilities = line.split(':', 1)[1].split()
+        if channel != 'o' or 'runcommand' not in capabilities:
+            self.close()
+            raise HgCommandServerError("hg command server can't runcommand")
+
+    @staticmethod
+    def query_repo_id(path):
+        """Identifies the repo at path, so we notice when it has been
+        clobbered and recreated underneath a running server.
+        """
+        st = os.stat(os.path.join(path, '.hg'))
+        return (st.st_dev, st.st_ino)
+
+    def is_current(self):
+        try:
+            return self.proc.poll() is None and \
+                self.query_repo_id(self.path) == self.repo_id
+        except OSError:
+            return False
+
+    def _read_channel(self):
+        try:
+            header = self.proc.stdout.read(5)
+            if len(header) < 5:
+                raise HgCommandServerError("hg command server went away")
+            channel, length = struct.unpack('>cI', header)
+            if channel in 'IL':
+                # input requested; length is how much the server wants
+                return channel, length
+            return channel, self.proc.stdout.read(length)
+        except (IOError, OSError, struct.error), e:
+            raise HgCommandServerError(str(e))
+
+    def _write(self, data):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (IOError, OSError), e:
+            raise HgCommandServerError(str(e))
+
+    def runcommand(self, args):
+        """Run hg args in the server; returns (returncode, stdout, stderr)."""
+        data = '\0'.join(args)
+        output = []
+        errors = []
+        with self.lock:
+            self._write('runcommand\n' + struct.pack('>I', len(data)) + data)
+            while True:
+                channel, data = self._read_channel()
+                if channel == 'o':
+                    output.append(data)
+                elif channel == 'e':
+                    errors.append(data)
+                elif channel == 'r':
+                    return struct.unpack('>i', data)[0], ''.join(output), ''.join(errors)
+                elif channel in 'IL':
+                    # We never have input for hg; an empty block is EOF.
+                    self._write(struct.pack('>I', 0))
+                elif channel.isupper():
+                    raise HgCommandServerError("Unknown required channel %s" % channel)
+                # Lower case channels are optional; ignore them.
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+
+
+class HgCommandServerPool(object):
+    """The command servers of this process, one per (hg, repo)."""
+    def __init__(self):
+        self.servers = {}
+        self.unavailable = set()
+        self.lock = threading.Lock()
+
+    def query_server(self, hg, path):
+        """Return a running HgCommandServer for repo path, or None if
+        command servers don't work with this hg.
+        """
+        path = os.path.realpath(path)
+        key = (tuple(hg), path)
+        with self.lock:
+            if key[0] in self.unavailable:
+                return None
+            server = self.servers.get(key)
+            if server and server.is_current():
+                return server
+            if server:
+                server.close()
+            try:
+                server = HgCommandServer(hg, path)
+            except OSError:
+                # path isn't a repo (any more)
+                return None
+            except HgCommandServerError:
+                self.unavailable.add(key[0])
+                return None
+            self.servers[key] = server
+            return server
+
+    def discard(self, server):
+        with self.lock:
+            for key, value in self.servers.items():
+                if value is server:
+                    del self.servers[key]
+        server.close()
+
+    def close(self):
+        with self.lock:
+            servers = self.servers.values()
+            self.servers = {}
+        for server in servers:
+            server.close()
+
+
+command_servers = HgCommandServerPool()
+atexit.register(command_servers.close)
+
 # MercurialVCS {{{1
 # TODO Make the remaining functions more mozharness-friendly.
 # TODO Add the various tag functionality that are currently in
@@ -96,33 +264,65 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         else:
             return urlsplit(repo).path.lstrip("/")
 
+    def get_hg_output(self, args, cwd, silent=False, throw_exception=False):
+        """get_output_from_command(self.hg + args, cwd=cwd), through the
+        command server for repo cwd if self.config['hg_command_server']
+        is set and we can.
+        """
+        if self.config.get('hg_command_server') and \
+                os.path.isdir(os.path.join(cwd, '.hg')):
+            server = command_servers.query_server(self.hg, cwd)
+            if server:
+                command = self.hg + args
+                self.info("Getting output from hg command server: %s in %s" %
+                          (subprocess.list2cmdline(command), cwd))
+                try:
+                    returncode, output, errors = server.runcommand(args)
+                except HgCommandServerError, e:
+                    self.info("hg command server failed (%s); running hg instead." % str(e))
+                    command_servers.discard(server)
+                else:
+                    for line in errors.splitlines():
+                        if line and not line.isspace():
+                            self.error(' %s' % line.decode('utf-8'))
+                    if returncode and throw_exception:
+                        raise subprocess.CalledProcessError(returncode, command)
+                    if returncode:
+                        self.error("Return code: %d" % returncode)
+                    if not silent:
+                        output = '\n'.join(output.rstrip().splitlines())
+                    return output
+        return self.get_output_from_command(self.hg + args, cwd=cwd, silent=silent,
+                                            throw_exception=throw_exception)
+
     def get_revision_from_path(self, path):
         """Returns which revision directory `path` currently has checked out."""
-        return self.get_output_from_command(
-            self.hg + ['parent', '--template', '{node|short}'], cwd=path
-        )
+        return self.get_hg_output(['parent', '--template', '{node|short}'], cwd=path)
 
     def get_branch_from_path(self, path):
-        branch = self.get_output_from_command(self.hg + ['branch'], cwd=path)
+        branch = self.get_hg_output(['branch'], cwd=path)
         return str(branch).strip()
 
     def get_branches_from_path(self, path):
         branches = []
-        for line in self.get_output_from_command(self.hg + ['branches', '-c'],
-                                                 cwd=path).splitlines():
+        for line in self.get_hg_output(['branches', '-c'], cwd=path).splitlines():
             branches.append(line.split()[0])
         return branches
 
     def hg_ver(self):
         """Returns the current version of hg, as a tuple of
-        (major, minor, build)"""
+        (major, minor, build).  Only asks hg once per process."""
+        key = tuple(self.hg)
+        if key in _hg_versions:
+            return _hg_versions[key]
         ver_string = self.get_output_from_command(self.hg + ['-q', 'version'])
-        match = re.search("\(version ([0-9.]+)\)", ver_string)
+        match = re.search("\(version ([0-9.]+)\)", ver_string or '')
         if match:
             bits = match.group(1).split(".")
             if len(bits) < 3:
                 bits += (0,)
             ver = tuple(int(b) for b in bits)
+            _hg_versions[key] = ver
         else:
             ver = (0, 0, 0)
         self.debug("Running hg version %s" % str(ver))
@@ -270,7 +470,8 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         if os.path.exists(src):
             try:
                 revs = []
-                for line in self.get_output_from_command(cmd, cwd=src, throw_exception=True).rstrip().split("\n"):
+                for line in self.get_hg_output(cmd[len(self.hg):], cwd=src,
+                                               throw_exception=True).rstrip().split("\n"):
                     try:
                         rev, branch = line.split()
                     # Mercurial displays no branch at all if the revision
@@ -305,6 +506,8 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
 
     # hg share methods {{{2
     def query_can_share(self):
+        if self.can_share is None:
+            self.can_share = _can_share.get(tuple(self.hg))
         if self.can_share is not None:
             return self.can_share
         # Check that 'hg share' works
@@ -328,6 +531,7 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
             self.can_share = False
         if self.can_share:
             self.info("hg share works.")
+        _can_share[tuple(self.hg)] = self.can_share
         return self.can_share
 
     def _ensure_shared_repo_and_revision(self, share_base):
@@ -10,6 +10,8 @@
 from copy import deepcopy
 import os
 import sys
+import threading
+import urlparse
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(sys.path[0]))))
 
@@ -88,26 +90,77 @@ class VCSMixin(object):
     def vcs_checkout_repos(self, repo_list, parent_dir=None,
                            tag_override=None, **kwargs):
         """Check out a list of repos.
+
+        Relative dests are relative to parent_dir (default: the work
+        dir); the cwd isn't changed.  Repos are checked out one at a
+        time unless self.config['vcs_checkout_workers'] allows more; then
+        no more than self.config['vcs_checkout_per_host'] (default 4) of
+        them come from the same server at once.  Each repo is retried on
+        its own, and its output is logged as one block.
+
+        Returns {dest: {'repo': repo, 'revision': revision}}.
         """
-        orig_dir = os.getcwd()
         c = self.config
         if not parent_dir:
             parent_dir = os.path.join(c['base_work_dir'], c['work_dir'])
         self.mkdir_p(parent_dir)
-        self.chdir(parent_dir)
-        revision_dict = {}
-        kwargs_orig = deepcopy(kwargs)
+        checkouts = []
         for repo_dict in repo_list:
-            kwargs = deepcopy(kwargs_orig)
-            kwargs.update(repo_dict)
+            repo_kwargs = deepcopy(kwargs)
+            repo_kwargs.update(repo_dict)
             if tag_override:
-                kwargs['revision'] = tag_override
-            dest = self.query_dest(kwargs)
-            revision_dict[dest] = {'repo': kwargs['repo']}
-            revision_dict[dest]['revision'] = self.vcs_checkout(**kwargs)
-        self.chdir(orig_dir)
+                repo_kwargs['revision'] = tag_override
+            dest = self.query_dest(repo_kwargs)
+            repo_kwargs['dest'] = os.path.join(parent_dir, dest)
+            checkouts.append((dest, repo_kwargs))
+        workers = min(c.get('vcs_checkout_workers', 1), len(checkouts))
+        if workers <= 1:
+            revisions = [self.vcs_checkout(**repo_kwargs)
+                         for dest, repo_kwargs in checkouts]
+        else:
+            revisions = self._vcs_checkout_concurrently(
+                [repo_kwargs for dest, repo_kwargs in checkouts], workers,
+                c.get('vcs_checkout_per_host', 4))
+        revision_dict = {}
+        for (dest, repo_kwargs), revision in zip(checkouts, revisions):
+            revision_dict[dest] = {'repo': repo_kwargs['repo'],
+                                   'revision': revision}
         return revision_dict
 
+    def _vcs_checkout_concurrently(self, checkouts, workers, per_host):
+        """vcs_checkout(**kwargs) for each kwargs in checkouts, up to
+        workers at a time (see run_concurrently()) and no more than
+        per_host against one host.  Returns the revisions in order.
+
+        After a fatal error, or any exception, no more checkouts are
+        started; the first failure is re-raised here once the running
+        ones are done.
+        """
+        host_slots = {}
+        repo_locks = {}
+        for repo_kwargs in checkouts:
+            host = urlparse.urlparse(repo_kwargs['repo']).netloc
+            host_slots.setdefault(host, threading.BoundedSemaphore(per_host))
+            # Two dests of one repo would race on the same share.
+            repo_locks.setdefault(repo_kwargs['repo'], threading.Lock())
+        aborted = []
+
+        def checkout(repo_kwargs):
+            host = urlparse.urlparse(repo_kwargs['repo']).netloc
+            with host_slots[host]:
+                with repo_locks[repo_kwargs['repo']]:
+                    # another checkout may have failed while we waited
+                    if aborted:
+                        return None
+                    try:
+                        return self.vcs_checkout(**repo_kwargs)
+                    except BaseException:
+                        aborted.append(repo_kwargs['repo'])
+                        raise
+
+        return self.run_concurrently(checkout, checkouts, workers,
+                                     name='vcs_checkout')
+
 
 class VCSScript(VCSMixin, BaseScript):
     def __init__(self, **kwargs):
@@ -11,6 +11,7 @@ Ideally this will go away if and when we retire buildbot.
 import os
 import re
 import sys
+import threading
 
 try:
     import simplejson as json
@@ -22,6 +23,7 @@ sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozharness.base.config import parse_config_file
 from mozharness.base.log import INFO, WARNING, ERROR
+from mozharness.base.script import PreScriptAction, PostScriptAction
 
 # BuildbotMixin {{{1
 
@@ -49,9 +51,14 @@ TBPL_WORST_LEVEL_TUPLE = (TBPL_RETRY, TBPL_EXCEPTION, TBPL_FAILURE,
 
 
 class BuildbotMixin(object):
+    """Properties set with write_to_file=True are written out once per
+    action, when it finishes (see flush_buildbot_properties()), or right
+    away outside of an action.
+    """
     buildbot_config = None
     buildbot_properties = {}
     worst_buildbot_status = TBPL_SUCCESS
+    _buildbot_properties_lock = threading.RLock()
 
     def read_buildbot_config(self):
         c = self.config
@@ -79,6 +86,7 @@ class BuildbotMixin(object):
                     dirs['abs_log_dir'],
                     self.log_obj.log_files[self.log_obj.log_level]
                 )
+                self.log_obj.flush()
                 if os.path.exists(log_file):
                     file_size = os.path.getsize(log_file)
                     if file_size > self.config['buildbot_max_log_size']:
@@ -93,12 +101,79 @@ class BuildbotMixin(object):
             if set_return_code:
                 self.return_code = EXIT_STATUS_DICT[self.worst_buildbot_status]
 
+    def _query_property_transaction(self):
+        """Returns the {'actions', 'pending', 'written'} state of the
+        property writes, under _buildbot_properties_lock."""
+        if not hasattr(self, '_property_transaction'):
+            self._property_transaction = {
+                # how many actions are running
+                'actions': 0,
+                # names of properties set since the last flush
+                'pending': set(),
+                # names of every property written so far
+                'written': set(),
+            }
+        return self._property_transaction
+
+    @PreScriptAction
+    def _buildbot_properties_pre_action(self, action):
+        with self._buildbot_properties_lock:
+            self._query_property_transaction()['actions'] += 1
+
+    @PostScriptAction
+    def _buildbot_properties_post_action(self, action, success=None):
+        with self._buildbot_properties_lock:
+            transaction = self._query_property_transaction()
+            # an earlier pre-action listener may have failed before ours ran
+            transaction['actions'] = max(0, transaction['actions'] - 1)
+        self.flush_buildbot_properties()
+
     def set_buildbot_property(self, prop_name, prop_value, write_to_file=False):
         self.info("Setting buildbot property %s to %s" % (prop_name, prop_value))
-        self.buildbot_properties[prop_name] = prop_value
-        if write_to_file:
-            return self.dump_buildbot_properties(prop_list=[prop_name], file_name=prop_name)
-        return self.buildbot_properties[prop_name]
+        with self._buildbot_properties_lock:
+            self.buildbot_properties[prop_name] = prop_value
+            if write_to_file:
+                transaction = self._query_property_transaction()
+                transaction['pending'].add(prop_name)
+                if not transaction['actions']:
+                    self.flush_buildbot_properties()
+        return prop_value
+
+    def flush_buildbot_properties(self, error_level=ERROR):
+        """Write out the properties set with write_to_file=True since the
+        last flush: each one to <base_work_dir>/properties/<name>, as
+        buildbot reads them, and all of them so far to one json file,
+        c['buildbot_properties_json'] (<base_work_dir>/buildbot_properties.json
+        by default).  Every file is replaced atomically.
+
+        Returns the names of the properties written.
+        """
+        c = self.config
+        with self._buildbot_properties_lock:
+            transaction = self._query_property_transaction()
+            pending = sorted(transaction['pending'])
+            if not pending:
+                return []
+            transaction['pending'] = set()
+            transaction['written'].update(pending)
+            props_dir = os.path.join(c['base_work_dir'], "properties")
+            if not os.path.isdir(props_dir):
+                self.mkdir_p(props_dir)
+            self.info("Writing buildbot properties %s to %s" % (str(pending), props_dir))
+            for prop in pending:
+                self.write_to_file(os.path.join(props_dir, prop),
+                                   "%s:%s\n" % (prop, self.buildbot_properties.get(prop, "None")),
+                                   verbose=False, error_level=error_level,
+                                   atomic=True)
+            json_path = c.get('buildbot_properties_json',
+                              os.path.join(c['base_work_dir'], "buildbot_properties.json"))
+            written = dict((prop, self.buildbot_properties.get(prop))
+                           for prop in transaction['written'])
+            self.write_to_file(json_path,
+                               json.dumps(written, indent=2, sort_keys=True, default=str),
+                               verbose=False, error_level=error_level,
+                               create_parent_dir=True, atomic=True)
+        return pending
 
     def query_buildbot_property(self, prop_name):
         return self.buildbot_properties.get(prop_name)
@@ -137,7 +212,7 @@ class BuildbotMixin(object):
         contents = ""
         for prop in prop_list:
             contents += "%s:%s\n" % (prop, self.buildbot_properties.get(prop, "None"))
-        return self.write_to_file(file_name, contents)
+        return self.write_to_file(file_name, contents, atomic=True)
 
     def sendchange(self, downloadables=None, branch=None,
                    username="sendchange-unittest", sendchange_props=None):
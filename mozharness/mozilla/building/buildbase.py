@@ -10,6 +10,7 @@ provides a base class for fx desktop builds
 author: Jordan Lund
 
 """
+import ConfigParser
 import json
 
 import os
@@ -26,7 +27,8 @@ import sys
 from datetime import datetime
 import re
 from mozharness.base.config import BaseConfig, parse_config_file
-from mozharness.base.log import ERROR, OutputParser, FATAL, WARNING
+from mozharness.base.log import ERROR, OutputParser, FATAL, WARNING, \
+    get_error_list_matcher
 from mozharness.base.script import PostScriptRun
 from mozharness.base.vcs.vcsbase import MercurialScript
 from mozharness.mozilla.buildbot import BuildbotMixin, TBPL_STATUS_DICT, \
@@ -79,6 +81,8 @@ TBPL_UPLOAD_ERRORS = [
 
 class MakeUploadOutputParser(OutputParser):
     tbpl_error_list = TBPL_UPLOAD_ERRORS
+    package_url_regex = re.compile(
+        r'''^(https?://.*?\.(?:tar\.bz2|dmg|zip|apk|rpm|mar|tar\.gz))$''')
     # let's create a switch case using name-spaces/dict
     # rather than a long if/else with duplicate code
     property_conditions = [
@@ -98,11 +102,11 @@ class MakeUploadOutputParser(OutputParser):
         super(MakeUploadOutputParser, self).__init__(**kwargs)
         self.matches = {}
         self.tbpl_status = TBPL_SUCCESS
+        self.tbpl_error_matcher = get_error_list_matcher(self.tbpl_error_list)
 
     def parse_single_line(self, line):
         prop_assigned = False
-        pat = r'''^(https?://.*?\.(?:tar\.bz2|dmg|zip|apk|rpm|mar|tar\.gz))$'''
-        m = re.compile(pat).match(line)
+        m = self.package_url_regex.match(line)
         if m:
             m = m.group(1)
             for prop, condition in self.property_conditions:
@@ -117,15 +121,14 @@ class MakeUploadOutputParser(OutputParser):
 
         # now let's check for retry errors which will give log levels:
         # tbpl status as RETRY and mozharness status as WARNING
-        for error_check in self.tbpl_error_list:
-            if error_check['regex'].search(line):
-                self.num_warnings += 1
-                self.warning(line)
-                self.tbpl_status = self.worst_level(
-                    error_check['level'], self.tbpl_status,
-                    levels=TBPL_WORST_LEVEL_TUPLE
-                )
-                break
+        index = self.tbpl_error_matcher.match(line)
+        if index is not None:
+            self.num_warnings += 1
+            self.warning(line)
+            self.tbpl_status = self.worst_level(
+                self.tbpl_error_list[index]['level'], self.tbpl_status,
+                levels=TBPL_WORST_LEVEL_TUPLE
+            )
         else:
             self.info(line)
 
@@ -494,6 +497,13 @@ def generate_build_UID():
 
 class BuildScript(BuildbotMixin, PurgeMixin, MockMixin, BalrogMixin,
                   SigningMixin, MercurialScript):
+    # Cloning tools and setting up mock only share the clobber; with
+    # --parallel-actions they run side by side.
+    action_dependencies = {
+        'clone-tools': ('clobber', ),
+        'setup-mock': ('clobber', ),
+    }
+
     def __init__(self, **kwargs):
         # objdir is referenced in _query_abs_dirs() so let's make sure we
         # have that attribute before calling BaseScript.__init__
@@ -521,6 +531,8 @@ class BuildScript(BuildbotMixin, PurgeMixin, MockMixin, BalrogMixin,
         self.query_buildid()  # sets self.buildid
         self.query_builduid()  # sets self.builduid
         self.generated_build_props = False
+        # {app_ini_path: ((mtime, size), parser)}
+        self._app_ini_cache = {}
 
     def _pre_config_lock(self, rw_config):
         c = self.config
@@ -620,22 +632,42 @@ or run without that action (ie: --no-{action})"
         # otherwise:
         return  # all good
 
-    def _query_build_prop_from_app_ini(self, prop, app_ini_path=None):
-        dirs = self.query_abs_dirs()
-        print_conf_setting_path = os.path.join(dirs['abs_src_dir'],
-                                               'config',
-                                               'printconfigsetting.py')
+    def _query_app_ini(self, app_ini_path):
+        """Returns a RawConfigParser for the ini file at app_ini_path, or
+        None if it doesn't exist or can't be parsed.  Each version of the
+        file is only parsed once.
+        """
+        try:
+            st = os.stat(app_ini_path)
+        except OSError:
+            return None
+        version = (st.st_mtime, st.st_size)
+        cached = self._app_ini_cache.get(app_ini_path)
+        if cached and cached[0] == version:
+            return cached[1]
+        parser = ConfigParser.RawConfigParser()
+        # keys are case sensitive, like in printconfigsetting.py
+        parser.optionxform = str
+        try:
+            parser.read(app_ini_path)
+        except ConfigParser.Error, e:
+            self.error("Can't parse %s: %s" % (app_ini_path, str(e)))
+            return None
+        self._app_ini_cache[app_ini_path] = (version, parser)
+        return parser
+
+    def _query_build_prop_from_app_ini(self, prop, app_ini_path=None,
+                                       section='App'):
         if not app_ini_path:
             # set the default
-            app_ini_path = dirs['abs_app_ini_path']
-        if (os.path.exists(print_conf_setting_path) and
-                os.path.exists(app_ini_path)):
-            cmd = [
-                'python', print_conf_setting_path, app_ini_path,
-                'App', prop
-            ]
-            return self.get_output_from_command(cmd, cwd=dirs['base_work_dir'])
-        else:
+            app_ini_path = self.query_abs_dirs()['abs_app_ini_path']
+        parser = self._query_app_ini(app_ini_path)
+        if parser is None:
+            return None
+        try:
+            return parser.get(section, prop)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.warning("%s has no %s in [%s]" % (app_ini_path, prop, section))
             return None
 
     def query_builduid(self):
@@ -1201,32 +1233,24 @@ or run without that action (ie: --no-{action})"
                                       error_level=error_level)
 
         dirs = self.query_abs_dirs()
-        print_conf_setting_path = os.path.join(dirs['abs_src_dir'],
-                                               'config',
-                                               'printconfigsetting.py')
-        if (not os.path.exists(print_conf_setting_path) or
-                not os.path.exists(dirs['abs_app_ini_path'])):
+        if not os.path.exists(dirs['abs_app_ini_path']):
             self.log("Can't set the following properties: "
                      "buildid, sourcestamp, appVersion, and appName. "
-                     "Required paths missing. Verify both %s and %s "
-                     "exist. These paths require the 'build' action to be "
-                     "run prior to this" % (print_conf_setting_path,
-                                            dirs['abs_app_ini_path']),
+                     "Required path missing. Verify %s exists. This path "
+                     "requires the 'build' action to be run prior to "
+                     "this" % dirs['abs_app_ini_path'],
                      level=error_level)
         self.info("Setting properties found in: %s" % dirs['abs_app_ini_path'])
-        base_cmd = [
-            'python', print_conf_setting_path, dirs['abs_app_ini_path'], 'App'
-        ]
         properties_needed = [
             {'ini_name': 'SourceStamp', 'prop_name': 'sourcestamp'},
             {'ini_name': 'Version', 'prop_name': 'appVersion'},
             {'ini_name': 'Name', 'prop_name': 'appName'}
         ]
         for prop in properties_needed:
-            prop_val = self.get_output_from_command(
-                base_cmd + [prop['ini_name']], cwd=dirs['base_work_dir'],
-                halt_on_failure=halt_on_failure
-            )
+            prop_val = self._query_build_prop_from_app_ini(prop['ini_name'])
+            if prop_val is None:
+                self.log("Can't determine %s" % prop['prop_name'],
+                         level=error_level)
             self.set_buildbot_property(prop['prop_name'],
                                        prop_val,
                                        write_to_file=True)
@@ -1261,25 +1285,24 @@ or run without that action (ie: --no-{action})"
         c = self.config
         dirs = self.query_abs_dirs()
 
-        # windows fix. even bash -c loses two single slashes.
-        find_dir = find_dir.replace('\\', '\\\\\\\\')
-
         error_msg = "Not setting props: %s{Filename, Size, Hash}" % prop_type
-        cmd = ["bash", "-c",
-               "find %s -maxdepth 1 -type f -name %s" % (find_dir, file_name)]
-        file_path = self.get_output_from_command(cmd, dirs['abs_work_dir'])
-        if not file_path:
+        # find_dir is relative to abs_work_dir, file_name can be a pattern
+        pattern = os.path.join(dirs['abs_work_dir'], find_dir, file_name)
+        file_paths = sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+        if not file_paths:
             self.error(error_msg)
-            self.error("Can't determine filepath with cmd: %s" % (str(cmd),))
+            self.error("Can't find a file matching %s" % pattern)
             return
-
-        cmd = [
-            self.query_exe('openssl'), 'dgst',
-            '-%s' % (c.get("hash_type", "sha512"),), file_path
-        ]
-        hash_prop = self.get_output_from_command(cmd, dirs['abs_work_dir'])
-        if not hash_prop:
-            self.log("undetermined hash_prop with cmd: %s" % (str(cmd),),
+        file_path = file_paths[0]
+        if len(file_paths) > 1:
+            self.warning("%d files match %s; using %s" % (len(file_paths),
+                                                         pattern, file_path))
+
+        hash_type = c.get("hash_type", "sha512")
+        try:
+            hashes = self.query_file_hashes(file_path, (hash_type, ))
+        except (IOError, OSError, ValueError), e:
+            self.log("undetermined hash_prop for %s: %s" % (file_path, str(e)),
                      level=error_level)
             self.log(error_msg, level=error_level)
             return
@@ -1287,10 +1310,10 @@ or run without that action (ie: --no-{action})"
                                    os.path.split(file_path)[1],
                                    write_to_file=True)
         self.set_buildbot_property(prop_type + 'Size',
-                                   os.path.getsize(file_path),
+                                   hashes['size'],
                                    write_to_file=True)
         self.set_buildbot_property(prop_type + 'Hash',
-                                   hash_prop.strip().split(' ', 2)[1],
+                                   hashes[hash_type],
                                    write_to_file=True)
 
     def _query_previous_buildid(self):
@@ -1298,22 +1321,20 @@ or run without that action (ie: --no-{action})"
         previous_buildid = self.query_buildbot_property('previous_buildid')
         if previous_buildid:
             return previous_buildid
-        cmd = [
-            "bash", "-c", "find previous -maxdepth 4 -type f -name application.ini"
-        ]
         self.info("finding previous mar's inipath...")
-        prev_ini_path = self.get_output_from_command(cmd,
-                                                     cwd=dirs['abs_obj_dir'],
-                                                     halt_on_failure=True,
-                                                     fatal_exit_code=3)
-        print_conf_path = os.path.join(dirs['abs_src_dir'],
-                                       'config',
-                                       'printconfigsetting.py')
-        abs_prev_ini_path = os.path.join(dirs['abs_obj_dir'], prev_ini_path)
-        previous_buildid = self.get_output_from_command(['python',
-                                                         print_conf_path,
-                                                         abs_prev_ini_path,
-                                                         'App', 'BuildID'])
+        previous_dir = os.path.join(dirs['abs_obj_dir'], 'previous')
+        prev_ini_paths = []
+        for root, dir_names, file_names in os.walk(previous_dir):
+            if 'application.ini' in file_names:
+                prev_ini_paths.append(os.path.join(root, 'application.ini'))
+            # as deep as `find previous -maxdepth 4` looks
+            if os.path.relpath(root, previous_dir).count(os.sep) >= 2:
+                dir_names[:] = []
+        if not prev_ini_paths:
+            self.fatal("Can't find application.ini in %s" % previous_dir,
+                       exit_code=3)
+        previous_buildid = self._query_build_prop_from_app_ini(
+            'BuildID', app_ini_path=sorted(prev_ini_paths)[0])
         if not previous_buildid:
             self.fatal("Could not determine previous_buildid. This property"
                        "requires the upload action creating a partial mar.")
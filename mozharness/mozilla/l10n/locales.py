@@ -93,18 +93,20 @@ class LocalesMixin(ChunkingMixin):
             locales = self.read_from_file(locales_file).split()
         return locales
 
-    def run_compare_locales(self, locale, halt_on_failure=False):
+    def run_compare_locales(self, locale, halt_on_failure=False,
+                            merge_dir=None):
         dirs = self.query_abs_dirs()
+        merge_dir = merge_dir or dirs['abs_merge_dir']
         compare_locales_script = os.path.join(dirs['abs_compare_locales_dir'],
                                               'scripts', 'compare-locales')
         env = self.query_env(partial_env={'PYTHONPATH':
                              os.path.join(dirs['abs_compare_locales_dir'],
                                           'lib')})
         compare_locales_error_list = list(PythonErrorList)
-        self.rmtree(dirs['abs_merge_dir'])
-        self.mkdir_p(dirs['abs_merge_dir'])
+        self.rmtree(merge_dir)
+        self.mkdir_p(merge_dir)
         command = "python %s -m %s l10n.ini %s %s" % (compare_locales_script,
-                  dirs['abs_merge_dir'], dirs['abs_l10n_dir'], locale)
+                  merge_dir, dirs['abs_l10n_dir'], locale)
         self.info("*** BEGIN compare-locales %s" % locale)
         status = self.run_command(command, error_list=compare_locales_error_list,
                                   cwd=dirs['abs_locales_src_dir'], env=env,
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""An indexed store of git<->hg mappings.
+
+A mapfile, like the git-mapfile hg-git writes, has one "<git sha> <hg
+sha>" line per commit.  MapfileStore keeps them in a directory:
+
+  * mapfile: every mapping, in the order they were merged in.  It is
+    only ever appended to, so "everything after byte N" is the delta
+    since a consumer last looked (see query_delta()).
+  * hg-N, git-N: sorted index segments.  Each is a run of 40 byte
+    records, the binary sha being looked up followed by the binary sha
+    it maps to, so lookups are a binary search over an mmap.  Every
+    merge() adds one pair of segments; when there are more than
+    MAX_SEGMENTS, they are merged into one.
+  * state.json: the segments, how far into each source mapfile we have
+    read, and where each consumer is up to.
+
+hg-git only appends to git-mapfile, so merging it again only reads the
+lines added since the last merge.  A mapping is keyed on its hg sha:
+later mappings for an hg sha already in the store are ignored, like
+`sort --unique --key=2` did.  Mappings can't be taken out again; when a
+source is dropped or rewritten, clear() the store and merge the current
+sources from scratch.
+"""
+
+from binascii import hexlify, unhexlify
+import heapq
+import mmap
+import os
+import re
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+SHA_LENGTH = 20
+RECORD_LENGTH = 2 * SHA_LENGTH
+MAX_SEGMENTS = 8
+# New mappings are sorted in memory, this many at a time.
+BATCH_SIZE = 1000000
+MAPPING_RE = re.compile(r'^([0-9a-f]{40}) ([0-9a-f]{40})$')
+SHA_RE = re.compile(r'^[0-9a-f]{1,40}$')
+
+
+def _parse_mapping(line):
+    m = MAPPING_RE.match(line.strip())
+    if m:
+        return unhexlify(m.group(1)), unhexlify(m.group(2))
+
+
+# Segment {{{1
+class Segment(object):
+    """A sorted run of records, mmapped."""
+    def __init__(self, path):
+        self.path = path
+        self.length = os.path.getsize(path) // RECORD_LENGTH
+        self.map = None
+        if self.length:
+            fh = open(path, 'rb')
+            try:
+                self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fh.close()
+
+    def lookup(self, prefix):
+        """Binary search for the first record whose key starts with the
+        hex sha prefix; returns the sha it maps to, or None."""
+        low = unhexlify(prefix.ljust(2 * SHA_LENGTH, '0'))
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * RECORD_LENGTH
+            if self.map[offset:offset + SHA_LENGTH] < low:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.length:
+            offset = lo * RECORD_LENGTH
+            if hexlify(self.map[offset:offset + SHA_LENGTH]).startswith(prefix):
+                return self.map[offset + SHA_LENGTH:offset + RECORD_LENGTH]
+        return None
+
+    def __iter__(self):
+        for offset in xrange(0, self.length * RECORD_LENGTH, RECORD_LENGTH):
+            yield self.map[offset:offset + RECORD_LENGTH]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def _write_segment(path, records):
+    """Write the sorted iterable records to path, atomically."""
+    tmp_path = path + '.tmp'
+    fh = open(tmp_path, 'wb')
+    try:
+        for record in records:
+            fh.write(record)
+    finally:
+        fh.close()
+    os.rename(tmp_path, path)
+
+
+# MapfileStore {{{1
+class MapfileStore(object):
+    """Append-only git<->hg mappings, indexed in both directions.
+
+        store = MapfileStore('conversion/.hg/mapfile-store')
+        store.merge('conversion/.hg/git-mapfile')
+        git_sha = store.query_git_revision(hg_sha)
+
+    One process at a time may change a store.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.log_path = os.path.join(path, 'mapfile')
+        self.state_path = os.path.join(path, 'state.json')
+        self.state = {'segments': [], 'next_segment': 1, 'log_size': 0,
+                      'length': 0, 'sources': {}, 'consumers': {}}
+        if os.path.exists(self.state_path):
+            fh = open(self.state_path)
+            try:
+                self.state.update(json.load(fh))
+            finally:
+                fh.close()
+        # Drop anything a merge appended without getting to save the state.
+        if os.path.exists(self.log_path) and \
+                os.path.getsize(self.log_path) > self.state['log_size']:
+            fh = open(self.log_path, 'r+b')
+            try:
+                fh.truncate(self.state['log_size'])
+            finally:
+                fh.close()
+        self.segments = {'hg': [], 'git': []}
+        self._open_segments()
+
+    def _segment_path(self, kind, number):
+        return os.path.join(self.path, '%s-%d' % (kind, number))
+
+    def _open_segments(self):
+        for kind in ('hg', 'git'):
+            for segment in self.segments[kind]:
+                segment.close()
+            self.segments[kind] = [Segment(self._segment_path(kind, n))
+                                   for n in self.state['segments']]
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        fh = open(tmp_path, 'w')
+        try:
+            json.dump(self.state, fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+        os.rename(tmp_path, self.state_path)
+
+    def close(self):
+        for kind in ('hg', 'git'):
+            for segment in self.segments[kind]:
+                segment.close()
+            self.segments[kind] = []
+
+    def __len__(self):
+        return self.state['length']
+
+    # Lookups {{{2
+    def _lookup(self, kind, sha):
+        sha = sha.lower()
+        if not SHA_RE.match(sha):
+            return None
+        for segment in self.segments[kind]:
+            value = segment.lookup(sha)
+            if value is not None:
+                return hexlify(value)
+        return None
+
+    def query_git_revision(self, hg_revision):
+        """Returns the git sha for an hg sha, or a prefix of one (like
+        `hg id` prints), or None."""
+        return self._lookup('hg', hg_revision)
+
+    def query_hg_revision(self, git_revision):
+        """Returns the hg sha for a git sha, or a prefix of one, or None."""
+        return self._lookup('git', git_revision)
+
+    def iter_mappings(self):
+        """Yield every "<git sha> <hg sha>\\n" line, sorted by hg sha."""
+        for record in heapq.merge(*self.segments['hg']):
+            yield "%s %s\n" % (hexlify(record[SHA_LENGTH:]),
+                               hexlify(record[:SHA_LENGTH]))
+
+    def write_mapfile(self, path):
+        """Write all the mappings to path, sorted by hg sha, like
+        `sort --unique --key=2` of the mapfiles merged in."""
+        tmp_path = path + '.tmp'
+        fh = open(tmp_path, 'w')
+        try:
+            for line in self.iter_mappings():
+                fh.write(line)
+        finally:
+            fh.close()
+        os.rename(tmp_path, path)
+
+    # Merging {{{2
+    def query_sources(self):
+        """Returns the absolute paths of the mapfiles merged so far."""
+        return sorted(self.state['sources'])
+
+    def query_merged_offset(self, mapfile):
+        """Returns how much of mapfile has been merged: 0 if none of it,
+        or None if it no longer starts with what we read last time.
+        """
+        source = self.state['sources'].get(os.path.abspath(mapfile))
+        if not source:
+            return 0
+        tail = source['tail'].encode('ascii')
+        start = source['offset'] - len(tail)
+        if start < 0:
+            return None
+        fh = open(mapfile, 'rb')
+        try:
+            fh.seek(start)
+            if fh.read(len(tail)) != tail:
+                return None
+        finally:
+            fh.close()
+        return source['offset']
+
+    def _read_new_lines(self, mapfile):
+        """Yield the complete lines of mapfile that haven't been merged
+        yet, each with the offset just past it.  If mapfile no longer
+        starts with what we read last time, start over.
+        """
+        offset = self.query_merged_offset(mapfile) or 0
+        fh = open(mapfile, 'rb')
+        try:
+            fh.seek(offset)
+            for line in fh:
+                if not line.endswith('\n'):
+                    break
+                offset += len(line)
+                yield line, offset
+        finally:
+            fh.close()
+
+    def _add_segment(self, records):
+        """records are (hg, git) pairs."""
+        number = self.state['next_segment']
+        _write_segment(self._segment_path('hg', number),
+                       sorted([hg + git for hg, git in records]))
+        _write_segment(self._segment_path('git', number),
+                       sorted([git + hg for hg, git in records]))
+        self.state['next_segment'] = number + 1
+        self.state['segments'].insert(0, number)
+
+    def _compact(self):
+        number = self.state['next_segment']
+        for kind in ('hg', 'git'):
+            _write_segment(self._segment_path(kind, number),
+                           heapq.merge(*self.segments[kind]))
+        old = self.state['segments']
+        self.state['segments'] = [number]
+        self.state['next_segment'] = number + 1
+        self._save_state()
+        self._open_segments()
+        for n in old:
+            for kind in ('hg', 'git'):
+                os.remove(self._segment_path(kind, n))
+
+    def merge(self, mapfile):
+        """Add the mappings in mapfile that aren't in the store yet.
+        Returns how many were added.
+        """
+        added = 0
+        batch = {}
+        last_line = None
+        end = None
+        log = open(self.log_path, 'ab')
+        try:
+            for line, end in self._read_new_lines(mapfile):
+                last_line = line
+                mapping = _parse_mapping(line)
+                if mapping is None:
+                    continue
+                git, hg = mapping
+                if hg in batch or (len(self) and
+                                   self._lookup('hg', hexlify(hg))):
+                    continue
+                batch[hg] = git
+                log.write("%s %s\n" % (hexlify(git), hexlify(hg)))
+                if len(batch) >= BATCH_SIZE:
+                    self._add_segment(batch.items())
+                    added += len(batch)
+                    self.state['length'] += len(batch)
+                    batch = {}
+                    # look new mappings up in the new segment too
+                    self._open_segments()
+            if batch:
+                self._add_segment(batch.items())
+                added += len(batch)
+                self.state['length'] += len(batch)
+        finally:
+            log.close()
+        self.state['log_size'] = os.path.getsize(self.log_path)
+        if last_line is not None:
+            self.state['sources'][os.path.abspath(mapfile)] = {
+                'offset': end, 'tail': last_line}
+        self._save_state()
+        self._open_segments()
+        if len(self.state['segments']) > MAX_SEGMENTS:
+            self._compact()
+        return added
+
+    def clear(self):
+        """Forget every mapping, source and consumer, e.g. to merge the
+        current sources in again when one has been dropped or rewritten.
+        """
+        self.close()
+        for n in self.state['segments']:
+            for kind in ('hg', 'git'):
+                os.remove(self._segment_path(kind, n))
+        self.state.update({'segments': [], 'log_size': 0, 'length': 0,
+                           'sources': {}, 'consumers': {}})
+        self._save_state()
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    # Deltas {{{2
+    def query_delta(self, consumer):
+        """Returns (lines, end): the mapping lines added since
+        mark_consumed(consumer, ...) was last called, in the order they
+        were merged, and the end offset to pass to mark_consumed() once
+        they've been dealt with.  lines is an iterator, so the delta
+        doesn't need to fit in memory.
+        """
+        start = self.state['consumers'].get(consumer, 0)
+        end = self.state['log_size']
+
+        def lines():
+            fh = open(self.log_path, 'rb')
+            try:
+                fh.seek(start)
+                remaining = end - start
+                for line in fh:
+                    if remaining <= 0:
+                        break
+                    remaining -= len(line)
+                    yield line
+            finally:
+                fh.close()
+        return lines(), end
+
+    def query_consumed(self, consumer):
+        """Returns where consumer is up to, or None if it's new."""
+        return self.state['consumers'].get(consumer)
+
+    def mark_consumed(self, consumer, end):
+        self.state['consumers'][consumer] = end
+        self._save_state()
@@ -4,15 +4,43 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
-"""MarMixin, manages mar files"""
+"""MarMixin, manages mar files.
 
+With the native_mar config option, mars are unpacked in process (see
+marfile.py) into an UnpackedMarCache, and partials are made by
+generate_partial() instead of make_incremental_update.sh.
+"""
+
+import bz2
+import fnmatch
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import ConfigParser
 
 # load modules from parent dir
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
+from mozharness.base.errors import MarError
+from mozharness.base.hashing import hash_file
+from mozharness.mozilla.marfile import BLOCK_SIZE, MarReader, MarWriter
+
+try:
+    DEFAULT_WORKERS = min(multiprocessing.cpu_count(), 8)
+except NotImplementedError:
+    DEFAULT_WORKERS = 1
+MANIFESTS = ('updatev2.manifest', 'update.manifest')
+# Shipped whole in every partial, changed or not, as
+# make_incremental_update.sh does; so are *.chk files.
+FORCED_UPDATES = ('precomplete', 'Contents/Resources/precomplete',
+                  'removed-files')
+
 
 CONFIG = {
     "buildid_section": 'App',
@@ -33,6 +61,287 @@ def buildid_from_ini(ini_file):
                           CONFIG.get('buildid_option'))
 
 
+def file_sha1(path):
+    return hash_file(path, ('sha1', ))['sha1']
+
+
+# UnpackedMarCache {{{1
+def _tree_size(root):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            total += os.lstat(os.path.join(dirpath, filename)).st_size
+    return total
+
+
+class UnpackedMarCache(object):
+    """Unpacked, decompressed mars under cache_dir, keyed by the sha1 of
+    the mar.
+
+    The en-US mar that partials are made from is the same for every
+    locale, so it only gets unpacked once.  Each tree is unpacked into a
+    temporary directory and renamed into place, so other threads and
+    processes never see half of one.  The trees are shared: don't
+    change them.
+
+    The cache is capped at max_size bytes (default 4 GiB): after each
+    unpack, the least recently used trees are removed, except for those
+    this cache has handed out, which may still be in use.
+
+    hash_cache is an optional mozharness.base.hashing.HashCache to take
+    the sha1s from.
+    """
+    default_max_size = 4 * 1024 ** 3
+
+    def __init__(self, cache_dir, hash_cache=None, max_size=None):
+        self.cache_dir = cache_dir
+        self.hash_cache = hash_cache
+        self.max_size = max_size or self.default_max_size
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        # keys we've returned trees for
+        self.used = set()
+        # {key: bytes}, for the trees we've measured
+        self.sizes = {}
+
+    def unpack(self, mar_file):
+        """Returns the directory mar_file is unpacked in."""
+        if self.hash_cache:
+            key = self.hash_cache.query(mar_file, ('sha1', ))['sha1']
+        else:
+            key = file_sha1(mar_file)
+        path = os.path.join(self.cache_dir, key)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+            # from now on, evict() leaves it alone
+            self.used.add(key)
+        with key_lock:
+            if os.path.isdir(path):
+                # for evict(), which goes by mtime
+                os.utime(path, None)
+                return path
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_dir = tempfile.mkdtemp(prefix=key + '.', dir=self.cache_dir)
+            try:
+                with MarReader(mar_file) as mar:
+                    mar.extract_all(tmp_dir, decompress=True)
+                os.chmod(tmp_dir, 0755)
+                size = _tree_size(tmp_dir)
+                try:
+                    os.rename(tmp_dir, path)
+                except OSError:
+                    # another process got there first
+                    if not os.path.isdir(path):
+                        raise
+            finally:
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+        with self.lock:
+            self.sizes[key] = size
+            self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used trees, other than the ones in
+        self.used, until the cache fits in self.max_size.  Call with
+        self.lock held.
+        """
+        trees = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, key)
+            # skip the temporary key.XXXXXX directories
+            if '.' in key or not os.path.isdir(path):
+                continue
+            if key not in self.sizes:
+                self.sizes[key] = _tree_size(path)
+            trees.append((os.stat(path).st_mtime, self.sizes[key], key))
+            total += self.sizes[key]
+        trees.sort()
+        for mtime, size, key in trees:
+            if total <= self.max_size:
+                break
+            if key in self.used:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            del self.sizes[key]
+            total -= size
+
+
+# generate_partial {{{1
+def _list_files(root, ignore):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            if name in MANIFESTS or \
+                    [p for p in ignore if fnmatch.fnmatchcase(name, p)]:
+                continue
+            files[name] = path
+    return files
+
+
+def _bzip2(src, dest):
+    compressor = bz2.BZ2Compressor()
+    fh = open(src, 'rb')
+    out = open(dest, 'wb')
+    try:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), ''):
+            out.write(compressor.compress(block))
+        out.write(compressor.flush())
+    finally:
+        out.close()
+        fh.close()
+    return os.path.getsize(dest)
+
+
+def _is_forced(name):
+    return name in FORCED_UPDATES or name.endswith('.chk')
+
+
+def _extension_dir(name):
+    """The extension directory that name is in, if any: the updater only
+    adds or patches such a file if the directory is still there (the
+    user may have removed the extension)."""
+    match = re.match(r'(.*extensions/[^/]+)/', name)
+    if match:
+        return match.group(1)
+    return None
+
+
+def _partial_member(job):
+    """Returns (action, bzip2ed data file) for one file of a partial, or
+    None if it's unchanged."""
+    mbsdiff, from_path, to_path, work_path, forced = job
+    full = work_path + '.full'
+    if from_path is None or forced:
+        _bzip2(to_path, full)
+        return 'add', full
+    if os.path.getsize(from_path) == os.path.getsize(to_path) and \
+            file_sha1(from_path) == file_sha1(to_path):
+        return None
+    full_size = _bzip2(to_path, full)
+    raw_patch = work_path + '.raw'
+    patch = work_path + '.patch'
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call([mbsdiff, from_path, to_path, raw_patch],
+                              stdout=devnull, stderr=subprocess.STDOUT)
+    finally:
+        devnull.close()
+    patch_size = _bzip2(raw_patch, patch)
+    os.remove(raw_patch)
+    if patch_size < full_size:
+        os.remove(full)
+        return 'patch', patch
+    os.remove(patch)
+    return 'add', full
+
+
+def _removed_files_instructions(path):
+    """Instructions for the entries of a removed-files list, as
+    make_incremental_update.sh writes them."""
+    instructions = []
+    fh = open(path)
+    try:
+        for line in fh:
+            entry = line.strip()
+            if not entry or entry.startswith('#'):
+                continue
+            if entry.endswith('/*'):
+                instructions.append('rmrfdir "%s"' % entry[:-1])
+            elif entry.endswith('/'):
+                instructions.append('rmdir "%s"' % entry)
+            else:
+                instructions.append('remove "%s"' % entry)
+    finally:
+        fh.close()
+    return instructions
+
+
+def generate_partial(from_dir, to_dir, partial_path, mbsdiff,
+                     product_info=None, ignore=(), workers=DEFAULT_WORKERS):
+    """Write the partial update mar partial_path, which updates the
+    unpacked complete mar from_dir to to_dir.
+
+    Files are compared by size and sha1 first; mbsdiff only runs on the
+    ones that changed, on a pool of worker threads (mbsdiff is a separate
+    process, and bz2 and hashlib release the GIL).  A changed file is
+    shipped as a patch if its bzip2ed patch is smaller than the bzip2ed
+    file, and whole otherwise.  Files matching a glob in ignore are left
+    out.
+
+    As in make_incremental_update.sh, the FORCED_UPDATES files and *.chk
+    files are always added whole, and adds and patches of files inside
+    an extension directory become add-if/patch-if on that directory.
+    Returns a dict counting the files patched, added, removed and
+    unchanged.
+    """
+    from_files = _list_files(from_dir, ignore)
+    to_files = _list_files(to_dir, ignore)
+    names = sorted(to_files)
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(partial_path)))
+    tmp_path = partial_path + '.tmp'
+    try:
+        jobs = [(mbsdiff, from_files.get(name), to_files[name],
+                 os.path.join(work_dir, str(i)), _is_forced(name))
+                for i, name in enumerate(names)]
+        pool = ThreadPool(max(workers, 1))
+        try:
+            results = pool.map(_partial_member, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        counts = {'patch': 0, 'add': 0, 'remove': 0, 'unchanged': 0}
+        instructions = []
+        members = []
+        for name, result in zip(names, results):
+            if result is None:
+                counts['unchanged'] += 1
+                continue
+            action, data = result
+            counts[action] += 1
+            test_dir = _extension_dir(name)
+            if action == 'patch':
+                if test_dir:
+                    instructions.append('patch-if "%s" "%s.patch" "%s"' %
+                                        (test_dir, name, name))
+                else:
+                    instructions.append('patch "%s.patch" "%s"' % (name, name))
+                members.append((name + '.patch', data, to_files[name]))
+            else:
+                if test_dir:
+                    instructions.append('add-if "%s" "%s"' % (test_dir, name))
+                else:
+                    instructions.append('add "%s"' % name)
+                members.append((name, data, to_files[name]))
+        for name in sorted(set(from_files) - set(to_files)):
+            counts['remove'] += 1
+            instructions.append('remove "%s"' % name)
+        if 'removed-files' in to_files:
+            instructions.extend(
+                _removed_files_instructions(to_files['removed-files']))
+        v1_instructions = [i for i in instructions
+                           if i.split(' ', 1)[0] in ('add', 'add-if', 'patch',
+                                                     'patch-if', 'remove')]
+        with MarWriter(tmp_path, product_info=product_info) as mar:
+            mar.add_data('updatev2.manifest',
+                         '\n'.join(['type "partial"'] + instructions) + '\n',
+                         compress=True)
+            mar.add_data('update.manifest',
+                         '\n'.join(v1_instructions) + '\n', compress=True)
+            for name, data, to_path in members:
+                mar.add(name, data, flags=os.stat(to_path).st_mode & 0777)
+        os.rename(tmp_path, partial_path)
+    finally:
+        shutil.rmtree(work_dir)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return counts
+
+
 # MarMixin {{{1
 class MarMixin(object):
     def _mar_tool_dir(self):
@@ -76,6 +385,14 @@ class MarMixin(object):
 
     def _unpack_mar(self, mar_file, dst_dir):
         """unpacks a mar file into dst_dir"""
+        if self.config.get('native_mar'):
+            self.info("unpacking %s" % mar_file)
+            try:
+                with MarReader(mar_file) as mar:
+                    mar.extract_all(dst_dir, decompress=True)
+            except (MarError, IOError, OSError), e:
+                self.fatal("Can't unpack %s: %s" % (mar_file, str(e)))
+            return 0
         cmd = ['perl', self._unpack_script(), mar_file]
         env = self.query_repack_env()
         self.info("unpacking %s" % mar_file)
@@ -85,18 +402,71 @@ class MarMixin(object):
                                 env=env,
                                 halt_on_failure=True)
 
-    def do_incremental_update(self, previous_dir, current_dir, partial_filename):
+    def _unpacked_mar_cache(self):
+        """returns the UnpackedMarCache, in abs_objdir/unpacked_mar_cache_dir"""
+        if getattr(self, 'unpacked_mar_cache', None) is None:
+            dirs = self.query_abs_dirs()
+            cache_dir = os.path.join(dirs['abs_objdir'],
+                                     self.config.get('unpacked_mar_cache_dir',
+                                                     'unpacked-mars'))
+            self.unpacked_mar_cache = UnpackedMarCache(
+                cache_dir, hash_cache=self.query_hash_cache(),
+                max_size=self.config.get('unpacked_mar_cache_max_size'))
+        return self.unpacked_mar_cache
+
+    def query_unpacked_mar_dir(self, mar_file, dst_dir):
+        """returns a directory with mar_file unpacked in it: dst_dir, or
+           with native_mar, the mar's tree in the unpacked mar cache,
+           which is shared and must not be modified"""
+        if not self.config.get('native_mar'):
+            self._unpack_mar(mar_file, dst_dir)
+            return dst_dir
+        self.info("unpacking %s (cached)" % mar_file)
+        try:
+            return self._unpacked_mar_cache().unpack(mar_file)
+        except (MarError, IOError, OSError), e:
+            self.fatal("Can't unpack %s: %s" % (mar_file, str(e)))
+
+    def do_incremental_update(self, previous_dir, current_dir, partial_filename,
+                              ignore=()):
         """create an incremental update from src_mar to dst_src.
-           It stores the result in partial_filename"""
+           It stores the result in partial_filename.
+           ignore is a list of globs of files to leave out; only
+           native_mar uses it"""
+        cwd = self._mar_dir('update_mar_dir')
+        self.mkdir_p(cwd)
+        if self.config.get('native_mar'):
+            return self._generate_partial(current_dir, previous_dir,
+                                          os.path.join(cwd, partial_filename),
+                                          ignore)
         # Usage: make_incremental_update.sh [OPTIONS] ARCHIVE FROMDIR TODIR
         cmd = [self._incremental_update_script(), partial_filename,
                current_dir, previous_dir]
         env = self.query_repack_env()
-        cwd = self._mar_dir('update_mar_dir')
-        self.mkdir_p(cwd)
         result = self.run_command(cmd, cwd=cwd, env=env)
         return result
 
+    def _generate_partial(self, from_dir, to_dir, partial_path, ignore):
+        """generate_partial() with the mar tools and the product info
+           make_incremental_update.sh would use"""
+        env = self.query_repack_env()
+        product_info = None
+        if env.get('MAR_CHANNEL_ID') and env.get('MOZ_PRODUCT_VERSION'):
+            product_info = (env['MAR_CHANNEL_ID'], env['MOZ_PRODUCT_VERSION'])
+        mbsdiff = os.path.join(self._mar_tool_dir(), self.config['mbsdiff'])
+        self.info("generating %s from %s to %s" % (partial_path, from_dir, to_dir))
+        try:
+            counts = generate_partial(
+                from_dir, to_dir, partial_path, mbsdiff,
+                product_info=product_info, ignore=ignore,
+                workers=self.config.get('mbsdiff_workers', DEFAULT_WORKERS))
+        except (MarError, IOError, OSError, subprocess.CalledProcessError), e:
+            self.error("Can't generate %s: %s" % (partial_path, str(e)))
+            return -1
+        self.info("%(patch)d files patched, %(add)d added, %(remove)d removed, "
+                  "%(unchanged)d unchanged" % counts)
+        return 0
+
     def get_buildid_from_mar_dir(self, mar_unpack_dir):
         """returns the buildid of the current mar file"""
         config = self.config
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""In-process MAR (Mozilla ARchive) reading and writing.
+
+All integers are big-endian:
+
+  * 'MAR1', then the offset of the index (u32).
+  * The signature block, in MARs made by a signing-capable mar: the
+    total file size (u64), the number of signatures (u32) and each
+    signature's algorithm id (u32), size (u32) and data; then the
+    number of additional sections (u32) and each section's size,
+    counting this header (u32), id (u32) and data.  Section 1 is the
+    product info: the MAR channel id and product version, each
+    NUL-terminated.
+  * The members' data.
+  * The index: its size (u32), then each member's offset (u32), size
+    (u32), flags (u32; the unix mode) and NUL-terminated name.
+
+Older MARs have no signature block, so the first member's data starts
+right after 'MAR1' and the index offset.  Update MARs bzip2 every member
+on its own; that's what compress and decompress refer to below.
+"""
+
+import bz2
+from collections import namedtuple
+import os
+import struct
+
+from mozharness.base.archive import _dest_path
+from mozharness.base.errors import MarError
+
+MAR_MAGIC = 'MAR1'
+HEADER = struct.Struct('>4sI')
+SIGNATURE_HEADER = struct.Struct('>QI')
+SIGNATURE = struct.Struct('>II')
+SECTION = struct.Struct('>II')
+INDEX_ENTRY = struct.Struct('>III')
+UINT32 = struct.Struct('>I')
+MAX_OFFSET = 0xffffffff
+PRODUCT_INFO_ID = 1
+BLOCK_SIZE = 1024 * 1024
+
+MarMember = namedtuple('MarMember', ['name', 'offset', 'size', 'flags'])
+
+
+# MarReader {{{1
+class MarReader(object):
+    """Read a MAR's index, and stream its members.
+
+        with MarReader('firefox-37.0a1.en-US.linux-i686.complete.mar') as mar:
+            mar.extract_all('current', decompress=True)
+
+    A MarReader reads through one file object, so don't share it between
+    threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file_size = None
+        self.signatures = []
+        self.sections = {}
+        self.fh = open(path, 'rb')
+        try:
+            self._read_index()
+        except:
+            self.fh.close()
+            raise
+
+    def _read(self, offset, size):
+        self.fh.seek(offset)
+        data = self.fh.read(size)
+        if len(data) != size:
+            raise MarError("%s is truncated" % self.path)
+        return data
+
+    def _read_index(self):
+        magic, index_offset = HEADER.unpack(self._read(0, HEADER.size))
+        if magic != MAR_MAGIC:
+            raise MarError("%s isn't a MAR file" % self.path)
+        index_size = UINT32.unpack(self._read(index_offset, UINT32.size))[0]
+        index = self._read(index_offset + UINT32.size, index_size)
+        self.members = []
+        pos = 0
+        while pos < len(index):
+            if pos + INDEX_ENTRY.size > len(index):
+                raise MarError("%s has a corrupt index" % self.path)
+            offset, size, flags = INDEX_ENTRY.unpack_from(index, pos)
+            pos += INDEX_ENTRY.size
+            end = index.find('\0', pos)
+            if end == -1:
+                raise MarError("%s has a corrupt index" % self.path)
+            self.members.append(MarMember(index[pos:end], offset, size, flags))
+            pos = end + 1
+        data_start = min([m.offset for m in self.members] + [index_offset])
+        if data_start > HEADER.size:
+            self._read_signature_block(data_start)
+
+    def _read_signature_block(self, data_start):
+        pos = HEADER.size
+        self.file_size, count = SIGNATURE_HEADER.unpack(
+            self._read(pos, SIGNATURE_HEADER.size))
+        pos += SIGNATURE_HEADER.size
+        for _ in range(count):
+            algorithm, size = SIGNATURE.unpack(self._read(pos, SIGNATURE.size))
+            pos += SIGNATURE.size
+            self.signatures.append((algorithm, self._read(pos, size)))
+            pos += size
+        if pos + UINT32.size > data_start:
+            return
+        count = UINT32.unpack(self._read(pos, UINT32.size))[0]
+        pos += UINT32.size
+        for _ in range(count):
+            size, section_id = SECTION.unpack(self._read(pos, SECTION.size))
+            if size < SECTION.size:
+                raise MarError("%s has a corrupt additional section" % self.path)
+            self.sections[section_id] = self._read(pos + SECTION.size,
+                                                   size - SECTION.size)
+            pos += size
+
+    def query_product_info(self):
+        """Return (MAR channel id, product version), or None."""
+        data = self.sections.get(PRODUCT_INFO_ID)
+        if data is None:
+            return None
+        fields = data.split('\0')
+        if len(fields) < 2:
+            raise MarError("%s has a corrupt product info block" % self.path)
+        return fields[0], fields[1]
+
+    def iter_member(self, member, decompress=False):
+        """Yield member's data a block at a time."""
+        decompressor = None
+        if decompress:
+            decompressor = bz2.BZ2Decompressor()
+        offset = member.offset
+        remaining = member.size
+        while remaining:
+            block = self._read(offset, min(remaining, BLOCK_SIZE))
+            offset += len(block)
+            remaining -= len(block)
+            if decompressor:
+                try:
+                    block = decompressor.decompress(block)
+                except (IOError, EOFError), e:
+                    raise MarError("Can't decompress %s from %s: %s" %
+                                   (member.name, self.path, str(e)))
+            if block:
+                yield block
+
+    def read(self, member, decompress=False):
+        return ''.join(self.iter_member(member, decompress=decompress))
+
+    def extract(self, member, dest, decompress=False):
+        """Write member under the directory dest; returns its path."""
+        path = _dest_path(dest, member.name)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.lexists(path):
+            os.remove(path)
+        out = open(path, 'wb')
+        try:
+            for block in self.iter_member(member, decompress=decompress):
+                out.write(block)
+        finally:
+            out.close()
+        if member.flags & 0777:
+            os.chmod(path, member.flags & 0777)
+        return path
+
+    def extract_all(self, dest, decompress=False):
+        return [self.extract(m, dest, decompress=decompress)
+                for m in self.members]
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# MarWriter {{{1
+class MarWriter(object):
+    """Write a MAR with a signature block (with no signatures), one member
+    at a time.  Members are streamed into the file; close() writes the
+    index.
+
+        with MarWriter('partial.mar', ('firefox-mozilla-central', '37.0a1')) as mar:
+            mar.add('updatev2.manifest', manifest_path, compress=True)
+
+    If the with block raises, the half-written file is removed.
+    """
+    def __init__(self, path, product_info=None):
+        self.path = path
+        self.members = []
+        self.fh = open(path, 'wb')
+        self.fh.write(HEADER.pack(MAR_MAGIC, 0))
+        self.fh.write(SIGNATURE_HEADER.pack(0, 0))
+        if product_info:
+            data = '%s\0%s\0' % tuple(product_info)
+            self.fh.write(UINT32.pack(1))
+            self.fh.write(SECTION.pack(SECTION.size + len(data), PRODUCT_INFO_ID))
+            self.fh.write(data)
+        else:
+            self.fh.write(UINT32.pack(0))
+
+    def _add_member(self, name, offset, flags):
+        size = self.fh.tell() - offset
+        if self.fh.tell() > MAX_OFFSET:
+            raise MarError("%s is too big for a MAR" % self.path)
+        self.members.append(MarMember(name, offset, size, flags))
+
+    def add(self, name, src, flags=None, compress=False):
+        """Add the file src as member name.  flags defaults to src's
+        permissions.
+        """
+        if flags is None:
+            flags = os.stat(src).st_mode & 0777
+        offset = self.fh.tell()
+        compressor = None
+        if compress:
+            compressor = bz2.BZ2Compressor()
+        fh = open(src, 'rb')
+        try:
+            for block in iter(lambda: fh.read(BLOCK_SIZE), ''):
+                if compressor:
+                    block = compressor.compress(block)
+                self.fh.write(block)
+        finally:
+            fh.close()
+        if compressor:
+            self.fh.write(compressor.flush())
+        self._add_member(name, offset, flags)
+
+    def add_data(self, name, data, flags=0644, compress=False):
+        offset = self.fh.tell()
+        if compress:
+            data = bz2.compress(data)
+        self.fh.write(data)
+        self._add_member(name, offset, flags)
+
+    def close(self):
+        if self.fh is None:
+            return
+        index = ''.join([INDEX_ENTRY.pack(m.offset, m.size, m.flags) + m.name + '\0'
+                         for m in self.members])
+        index_offset = self.fh.tell()
+        self.fh.write(UINT32.pack(len(index)))
+        self.fh.write(index)
+        file_size = self.fh.tell()
+        self.fh.seek(0)
+        self.fh.write(HEADER.pack(MAR_MAGIC, index_offset))
+        self.fh.write(SIGNATURE_HEADER.pack(file_size, 0))
+        self.fh.close()
+        self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+            return
+        self.fh.close()
+        self.fh = None
+        os.remove(self.path)
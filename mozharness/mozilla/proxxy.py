@@ -125,7 +125,8 @@ class Proxxy(ScriptMixin, LogMixin):
 
     def download_proxied_file(self, url, file_name, parent_dir=None,
                               create_parent_dir=True, error_level=ERROR,
-                              exit_code=3):
+                              exit_code=3, expected_hash=None,
+                              hash_type='sha512', use_cache=True):
         """
         Wrapper around BaseScript.download_file that understands proxies
         retry dict is set to 3 attempts, sleeping time 30 seconds.
@@ -142,6 +143,12 @@ class Proxxy(ScriptMixin, LogMixin):
                     defaults to ERROR
                 exit_code (int, optional): return code to log if file_name
                     is not defined and it cannot be determined from the url
+                expected_hash (string, optional): hex digest the downloaded
+                    file must match; mismatches are retried
+                hash_type (string, optional): hashlib name of the digest in
+                    expected_hash. Defaults to 'sha512'
+                use_cache (bool, optional): if False, skip the download cache;
+                    for callers that go through it themselves. Defaults to True
             Returns:
                 string: file_name if the download has succeded, None in case of
                     error. In case of error, if error_level is set to FATAL,
@@ -159,7 +166,10 @@ class Proxxy(ScriptMixin, LogMixin):
                 retry_config=dict(
                     attempts=3,
                     sleeptime=30,
-                ))
+                ),
+                expected_hash=expected_hash,
+                hash_type=hash_type,
+                use_cache=use_cache)
             if retval:
                 return retval
 
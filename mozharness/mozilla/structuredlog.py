@@ -3,10 +3,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
-import json
+# Harnesses emit millions of these lines, so use the fastest decoder
+# available.  Both raise ValueError on anything that isn't JSON.
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from mozharness.base import log
-from mozharness.base.log import OutputParser, WARNING, INFO, ERROR
+from mozharness.base.log import OutputParser, DEBUG, WARNING, INFO, ERROR
 from mozharness.mozilla.buildbot import TBPL_WARNING, TBPL_FAILURE
 from mozharness.mozilla.buildbot import TBPL_SUCCESS, TBPL_WORST_LEVEL_TUPLE
 from mozharness.mozilla.testing.unittest import tbox_print_summary
@@ -37,6 +42,7 @@ class StructuredOutputParser(OutputParser):
 
         self.worst_log_level = INFO
         self.tbpl_status = TBPL_SUCCESS
+        self._level_enabled = {}
 
     def _get_mozlog_module(self):
         try:
@@ -54,36 +60,73 @@ class StructuredOutputParser(OutputParser):
             return
         super(StructuredOutputParser, self).parse_single_line(line)
 
+    def _parse_json(self, line):
+        """Returns the structured log message on line, or None.  Lines
+        that can't be JSON objects aren't handed to the decoder at all.
+        """
+        if line[:1] != '{' and line.lstrip()[:1] != '{':
+            return None
+        try:
+            data = json_loads(line)
+        except ValueError:
+            return None
+        if isinstance(data, dict) and data.get('action') in self.log_actions:
+            return data
+        return None
+
+    def _is_level_enabled(self, level):
+        enabled = self._level_enabled.get(level)
+        if enabled is None:
+            enabled = self._level_enabled[level] = self.query_log_level_enabled(level)
+        return enabled
+
+    def _log_message(self, data):
+        """Re-emit data in human-readable format, unless nothing would be
+        logged at its level."""
+        level = INFO
+        if data["action"] == "log":
+            level = getattr(log, data["level"].upper())
+        if self._is_level_enabled(level):
+            self.log(self.formatter(data), level=level)
+        # INFO and DEBUG can't make the status any worse.
+        if level not in (INFO, DEBUG):
+            self.update_levels(TBPL_SUCCESS, level)
 
     def parse_single_line(self, line):
         """Parses a line of log output from the child process and passes
         it to mozlog to update the overall status of the run.
         Re-emits the logged line in human-readable format.
         """
-        level = INFO
-        tbpl_level = TBPL_SUCCESS
-
-        data = None
-        try:
-            candidate_data = json.loads(line)
-            if (isinstance(candidate_data, dict) and
-                'action' in candidate_data and candidate_data['action'] in self.log_actions):
-                data = candidate_data
-        except ValueError:
-            pass
-
+        data = self._parse_json(line)
         if data is None:
             self._handle_unstructured_output(line)
             return
-
         self.handler(data)
+        self._log_message(data)
 
-        action = data["action"]
-        if action == "log":
-            level = getattr(log, data["level"].upper())
-
-        self.log(self.formatter(data), level=level)
-        self.update_levels(tbpl_level, level)
+    def add_lines(self, output):
+        """Like OutputParser.add_lines(), but structured messages go to the
+        JSON decoder without being decoded from utf-8 first, and the
+        handler is updated once per batch of lines.
+        """
+        if isinstance(output, basestring):
+            output = [output]
+        messages = []
+        try:
+            for raw_line in output:
+                if not raw_line or raw_line.isspace():
+                    continue
+                data = self._parse_json(raw_line.rstrip())
+                if data is None:
+                    self._handle_unstructured_output(
+                        raw_line.decode("utf-8", 'replace').rstrip())
+                    continue
+                messages.append(data)
+                self._log_message(data)
+        finally:
+            handler = self.handler
+            for data in messages:
+                handler(data)
 
     def evaluate_parser(self, return_code):
         summary = self.handler.summarize()
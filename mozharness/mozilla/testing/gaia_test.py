@@ -206,7 +206,8 @@ class GaiaTest(TestingMixin, TooltoolMixin, MercurialScript, TransferMixin,
             self.proxxy = proxxy
         return self.proxxy
 
-    def _retry_download_file(self, url, file_name, error_level=FATAL, retry_config=None):
+    def _retry_download_file(self, url, file_name, error_level=FATAL, retry_config=None,
+                             expected_hash=None, hash_type='sha512'):
         if self.config.get("bypass_download_cache"):
             n = 0
             # ignore retry_config in this case
@@ -218,7 +219,9 @@ class GaiaTest(TestingMixin, TooltoolMixin, MercurialScript, TransferMixin,
                 try:
                     _url = "%s?rand=%s" % (url, time.strftime("%Y%m%d%H%M%S"))
                     self.info("Trying %s..." % _url)
-                    status = self._download_file(_url, file_name)
+                    status = self._download_file(_url, file_name,
+                                                 expected_hash=expected_hash,
+                                                 hash_type=hash_type)
                     return status
                 except Exception:
                     if n >= max_attempts:
@@ -230,6 +233,7 @@ class GaiaTest(TestingMixin, TooltoolMixin, MercurialScript, TransferMixin,
         else:
             return super(GaiaTest, self)._retry_download_file(
                 url, file_name, error_level, retry_config=retry_config,
+                expected_hash=expected_hash, hash_type=hash_type,
             )
 
     def download_and_extract(self):
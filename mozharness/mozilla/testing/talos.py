@@ -19,6 +19,7 @@ from mozharness.base.log import OutputParser, DEBUG, ERROR, CRITICAL, FATAL
 from mozharness.base.log import INFO, WARNING
 from mozharness.mozilla.blob_upload import BlobUploadMixin, blobupload_config_options
 from mozharness.mozilla.testing.testbase import TestingMixin, testing_config_options, INSTALLER_SUFFIXES
+from mozharness.mozilla.testing.webroot import WebrootSync
 from mozharness.base.vcs.vcsbase import MercurialScript
 from mozharness.mozilla.testing.errors import TinderBoxPrintRe
 from mozharness.mozilla.buildbot import TBPL_SUCCESS, TBPL_WORST_LEVEL_TUPLE
@@ -468,8 +469,31 @@ class Talos(TestingMixin, MercurialScript, BlobUploadMixin):
             return conf
         return os.path.join(self.workdir, conf)
 
+    def _query_webroot_archive(self, webroot_sync, url):
+        """Download url and unpack it, once per distinct archive.
+        Returns (sha512, directory it's unpacked in).
+        """
+        dirs = self.query_abs_dirs()
+        archive = self.download_proxied_file(url, parent_dir=dirs['abs_work_dir'],
+                                             error_level=FATAL)
+        sha512 = self.file_sha512sum(archive)
+        path = webroot_sync.query_archive_path(sha512)
+        if os.path.isdir(path):
+            self.info("%s is already unpacked in %s" % (url, path))
+        else:
+            tmp_path = path + '.tmp'
+            self.rmtree(tmp_path, error_level=FATAL)
+            self.unpack(archive, tmp_path)
+            self.move(tmp_path, path, error_level=FATAL)
+        return sha512, path
+
     def _populate_webroot(self):
-        """Populate the production test slaves' webroots"""
+        """Populate the production test slaves' webroots.
+
+        <webroot>/talos is updated incrementally and swapped in whole;
+        see mozharness.mozilla.testing.webroot.  If neither the talos
+        revision nor any of the archives have changed, it's left alone.
+        """
         c = self.config
         talos_repo = self.query_talos_repo()
         talos_revision = self.query_talos_revision()
@@ -478,7 +502,7 @@ class Talos(TestingMixin, MercurialScript, BlobUploadMixin):
         self.info("Populating webroot %s..." % c['webroot'])
         talos_webdir = os.path.join(c['webroot'], 'talos')
         self.mkdir_p(c['webroot'], error_level=FATAL)
-        self.rmtree(talos_webdir, error_level=FATAL)
+        webroot_sync = WebrootSync(c['webroot'], log_obj=self.log_obj)
 
         # clone talos' repo
         repo = {
@@ -488,39 +512,55 @@ class Talos(TestingMixin, MercurialScript, BlobUploadMixin):
             'revision': talos_revision,
             'output_timeout': 1200,
         }
-        self.vcs_checkout(**repo)
+        got_revision = self.vcs_checkout(**repo)
         self.has_cloned_talos = True
 
         # the apache server needs the talos directory (talos/talos)
-        # to be in the webroot
-        src_talos_webdir = os.path.join(self.talos_path, 'talos')
-        self.copytree(src_talos_webdir, talos_webdir)
+        # to be in the webroot; archives are unpacked on top of it.
+        layers = [('', os.path.join(self.talos_path, 'talos'))]
+        wanted = {'talos_revision': got_revision, 'archives': []}
+
+        def add_archive(url, dest):
+            sha512, path = self._query_webroot_archive(webroot_sync, url)
+            layers.append((os.path.relpath(dest, talos_webdir), path))
+            wanted['archives'].append({'url': url, 'sha512': sha512,
+                                       'dest': layers[-1][0]})
 
         if c.get('use_talos_json'):
             if self.query_pagesets_url():
                 self.info("Downloading pageset...")
                 pagesets_path = os.path.join(c['webroot'], self.query_pagesets_parent_dir_path())
-                self._download_unzip(self.pagesets_url, pagesets_path)
-
-                # mkdir for the missing manifest directory in talos_repo/talos/page_load_test directory
-                abs_pagesets_paths = self.query_abs_pagesets_paths()
-                abs_manifest_parent_path = abs_pagesets_paths['pagesets_manifest_parent']
-                self.mkdir_p(abs_manifest_parent_path, error_level=FATAL)
-
-                # copy all the manifest file from unzipped zip file into the manifest dir
-                src_manifest_file = os.path.join(c['webroot'], self.query_pagesets_manifest_path())
-                dest_manifest_file = abs_pagesets_paths['pagesets_manifest']
-                self.copyfile(src_manifest_file, dest_manifest_file, error_level=FATAL)
+                if os.path.relpath(pagesets_path, talos_webdir).startswith(os.pardir):
+                    # not in the tree we swap in; unpack it in place
+                    self._download_unzip(self.pagesets_url, pagesets_path)
+                else:
+                    add_archive(self.pagesets_url, pagesets_path)
             plugins_url = self.talos_json_config['suites'][c['suite']].get('plugins', {}).get(c['system_bits'])
             if plugins_url:
                 self.info("Downloading plugin...")
                 # TODO add this path to talos.json ?
-                self._download_unzip(plugins_url, os.path.join(talos_webdir, 'base_profile'))
+                add_archive(plugins_url, os.path.join(talos_webdir, 'base_profile'))
             addons_urls = self.talos_json_config['suites'][c['suite']].get('talos_addons')
             if addons_urls:
                 self.info("Downloading addons...")
                 for addons_url in addons_urls:
-                    self._download_unzip(addons_url, talos_webdir)
+                    add_archive(addons_url, talos_webdir)
+
+        if got_revision and webroot_sync.is_current(wanted):
+            self.info("%s is up to date." % talos_webdir)
+        else:
+            webroot_sync.sync(wanted, layers)
+
+        if c.get('use_talos_json') and self.query_pagesets_url():
+            # mkdir for the missing manifest directory in talos_repo/talos/page_load_test directory
+            abs_pagesets_paths = self.query_abs_pagesets_paths()
+            abs_manifest_parent_path = abs_pagesets_paths['pagesets_manifest_parent']
+            self.mkdir_p(abs_manifest_parent_path, error_level=FATAL)
+
+            # copy all the manifest file from unzipped zip file into the manifest dir
+            src_manifest_file = os.path.join(c['webroot'], self.query_pagesets_manifest_path())
+            dest_manifest_file = abs_pagesets_paths['pagesets_manifest']
+            self.copyfile(src_manifest_file, dest_manifest_file, error_level=FATAL)
 
     def _is_metro_mode(self):
         c = self.config
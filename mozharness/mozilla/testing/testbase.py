@@ -8,7 +8,6 @@
 import copy
 import os
 import platform
-import re
 import urllib2
 import getpass
 
@@ -102,13 +101,37 @@ class TestingMixin(VirtualenvMixin, BuildbotMixin, ResourceMonitoringMixin):
 
     def download_proxied_file(self, url, file_name=None, parent_dir=None,
                               create_parent_dir=True, error_level=FATAL,
-                              exit_code=3):
+                              exit_code=3, expected_hash=None,
+                              hash_type='sha512'):
         proxxy = self._query_proxxy()
-        return proxxy.download_proxied_file(url=url, file_name=file_name,
-                                            parent_dir=parent_dir,
-                                            create_parent_dir=create_parent_dir,
-                                            error_level=error_level,
-                                            exit_code=exit_code)
+        cache = self.query_download_cache()
+        if not cache:
+            return proxxy.download_proxied_file(url=url, file_name=file_name,
+                                                parent_dir=parent_dir,
+                                                create_parent_dir=create_parent_dir,
+                                                error_level=error_level,
+                                                exit_code=exit_code,
+                                                expected_hash=expected_hash,
+                                                hash_type=hash_type)
+        # Cache by the original url, not whichever proxy served it.
+        file_name = file_name or self.get_filename_from_url(url)
+        if parent_dir:
+            file_name = os.path.join(parent_dir, file_name)
+            if create_parent_dir:
+                self.mkdir_p(parent_dir, error_level=error_level)
+
+        def download(path):
+            # cache.fetch() has already missed; don't look again under
+            # the proxied url.
+            return proxxy.download_proxied_file(url=url, file_name=path,
+                                                error_level=error_level,
+                                                exit_code=exit_code,
+                                                expected_hash=expected_hash,
+                                                hash_type=hash_type,
+                                                use_cache=False)
+        return cache.fetch(
+            url, file_name, download,
+            expected_hash=expected_hash if hash_type == 'sha512' else None)
 
     def query_value(self, key):
         """
@@ -214,12 +237,17 @@ class TestingMixin(VirtualenvMixin, BuildbotMixin, ResourceMonitoringMixin):
         '''
         # Code based on http://code.activestate.com/recipes/305288-http-basic-authentication
         def _urlopen_basic_auth(url, **kwargs):
-            self.info("We want to download this file %s" % url)
+            # url may be a urllib2.Request, e.g. for Range requests.
+            if isinstance(url, urllib2.Request):
+                uri = url.get_full_url()
+            else:
+                uri = url
+            self.info("We want to download this file %s" % uri)
             username, password = self._get_credentials()
             # This creates a password manager
             passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
             # Because we have put None at the start it will use this username/password combination from here on
-            passman.add_password(None, url, username, password)
+            passman.add_password(None, uri, username, password)
             authhandler = urllib2.HTTPBasicAuthHandler(passman)
 
             return urllib2.build_opener(authhandler).open(url, **kwargs)
@@ -316,17 +344,6 @@ You can set this by:
         if message:
             self.fatal(message + "Can't run download-and-extract... exiting")
 
-        if self.config.get("developer_mode") and self.is_darwin():
-            # Bug 1066700 only affects Mac users that try to run mozharness locally
-            version = self._query_binary_version(
-                    regex=re.compile("UnZip\ (\d+\.\d+)\ .*",re.MULTILINE),
-                    cmd=[self.query_exe('unzip'), '-v']
-            )
-            if not version >= 6:
-                self.fatal("We require a more recent version of unzip to unpack our tests.zip files.\n" \
-                        "You are currently using version %s. Please update to at least 6.0.\n" \
-                        "You can visit http://www.info-zip.org/UnZip.html" % version)
-
     def _download_test_zip(self):
         dirs = self.query_abs_dirs()
         file_name = None
@@ -344,30 +361,32 @@ You can set this by:
         This is hardcoded to halt on failure.
         We should probably change some other methods to call this."""
         dirs = self.query_abs_dirs()
-        zipfile = self.download_proxied_file(url, parent_dir=dirs['abs_work_dir'],
-                                             error_level=FATAL)
-        command = self.query_exe('unzip', return_type='list')
-        command.extend(['-q', '-o', zipfile])
-        self.run_command(command, cwd=parent_dir, halt_on_failure=True,
-                         fatal_exit_code=3, output_timeout=1760)
+        if self.query_download_cache():
+            # Cache hits don't touch the network; extract the local copy.
+            zipfile = self.download_proxied_file(url, parent_dir=dirs['abs_work_dir'],
+                                                 error_level=FATAL)
+            self.unpack(zipfile, parent_dir)
+            return
+        # Otherwise extract as we download.
+        proxxy = self._query_proxxy()
+        for proxied_url in proxxy.get_proxies_and_urls([url]):
+            self.info("trying %s" % proxied_url)
+            if self.download_unpack(proxied_url, parent_dir,
+                                    file_name=self.get_filename_from_url(url),
+                                    parent_dir=dirs['abs_work_dir'],
+                                    retry_config={'attempts': 3,
+                                                  'sleeptime': 30}):
+                return
+        self.fatal("Failed to download from all available URLs, aborting",
+                   exit_code=3)
 
     def _extract_test_zip(self, target_unzip_dirs=None):
         dirs = self.query_abs_dirs()
-        unzip = self.query_exe("unzip")
         test_install_dir = dirs.get('abs_test_install_dir',
                                     os.path.join(dirs['abs_work_dir'], 'tests'))
-        self.mkdir_p(test_install_dir)
-        # adding overwrite flag otherwise subprocess.Popen hangs on waiting for
-        # input in a hidden pipe whenever this action is run twice without
-        # clobber
-        unzip_cmd = [unzip, '-q', '-o', self.test_zip_path]
-        if target_unzip_dirs:
-            unzip_cmd.extend(target_unzip_dirs)
-        # TODO error_list
-        # unzip return code 11 is 'no matching files were found'
-        self.run_command(unzip_cmd, cwd=test_install_dir,
-                         halt_on_failure=True, success_codes=[0, 11],
-                         fatal_exit_code=3)
+        # Files left by a previous run are skipped if unchanged.
+        self.unpack(self.test_zip_path, test_install_dir,
+                    patterns=target_unzip_dirs)
 
     def _read_tree_config(self):
         """Reads an in-tree config file"""
@@ -443,8 +462,7 @@ You can set this by:
                                             error_level=FATAL)
         self.set_buildbot_property("symbols_url", self.symbols_url,
                                    write_to_file=True)
-        self.run_command(['unzip', '-q', source], cwd=self.symbols_path,
-                         halt_on_failure=True, fatal_exit_code=3)
+        self.unpack(source, self.symbols_path)
 
     def download_and_extract(self, target_unzip_dirs=None):
         """
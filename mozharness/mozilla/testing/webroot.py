@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Incremental, swap-in webroot updates.
+
+A webroot directory (e.g. <webroot>/talos) is built from layers: a
+source tree such as talos' talos/ directory, then archives unpacked on
+top of it.  WebrootSync keeps two copies of it side by side:
+
+  * <webroot>/talos: the live copy, the one being served.
+  * <webroot>/.talos-staging: the copy before last.  sync() brings it up
+    to date, copying only the files that differ and removing the ones
+    that shouldn't be there, and then swaps it with the live copy.
+
+The swap is two renames, so the live copy is never half-written; it only
+goes missing for the instant between them.
+
+<webroot>/.talos-webroot.json records what each copy was built from
+(the talos revision, and the url and sha512 of each archive), so when
+nothing has changed sync() isn't needed at all; see is_current().
+Archives are unpacked once per sha512, into <webroot>/.talos-archives.
+"""
+
+import filecmp
+import os
+import shutil
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.log import LogMixin
+
+
+def _join(rel, name):
+    if rel:
+        return os.path.join(rel, name)
+    return name
+
+
+def _relpath(path, root):
+    rel = os.path.relpath(path, root)
+    if rel == os.curdir:
+        return ''
+    return rel
+
+
+def collect_layers(layers):
+    """Returns (files, dirs) for the tree layers describe: files maps
+    each relative path to the source file it comes from, and dirs is the
+    set of relative directories.  layers is a list of (subdir, src_dir);
+    src_dir is laid over subdir, and later layers win.
+    """
+    files = {}
+    dirs = set()
+    for subdir, src_dir in layers:
+        subdir = os.path.normpath(subdir or os.curdir)
+        if subdir == os.curdir:
+            subdir = ''
+        parent = subdir
+        while parent:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            rel = _join(subdir, _relpath(dirpath, src_dir))
+            if rel:
+                dirs.add(rel)
+            for name in filenames:
+                files[_join(rel, name)] = os.path.join(dirpath, name)
+    return files, dirs
+
+
+def sync_tree(layers, dest):
+    """Make dest the tree described by layers (see collect_layers()),
+    only touching what differs.  Files are compared by size and mtime,
+    then by contents; they're copied with their mtimes, so next time
+    the first comparison is usually enough.
+
+    Returns {'copied': n, 'removed': n, 'unchanged': n}.
+    """
+    files, dirs = collect_layers(layers)
+    counts = {'copied': 0, 'removed': 0, 'unchanged': 0}
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    for dirpath, dirnames, filenames in os.walk(dest, topdown=False):
+        rel = _relpath(dirpath, dest)
+        for name in filenames:
+            if _join(rel, name) not in files:
+                os.remove(os.path.join(dirpath, name))
+                counts['removed'] += 1
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                # os.walk() doesn't descend into these
+                if _join(rel, name) not in files:
+                    os.remove(path)
+                    counts['removed'] += 1
+            elif _join(rel, name) not in dirs:
+                # everything in it has gone already
+                os.rmdir(path)
+    for rel in sorted(dirs):
+        path = os.path.join(dest, rel)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+    for rel, src in files.iteritems():
+        path = os.path.join(dest, rel)
+        if os.path.isfile(path) and not os.path.islink(path) and \
+                filecmp.cmp(src, path, shallow=True):
+            counts['unchanged'] += 1
+            continue
+        if os.path.lexists(path):
+            # don't write through a link or into a file shared with the
+            # other copy
+            os.remove(path)
+        shutil.copy2(src, path)
+        counts['copied'] += 1
+    return counts
+
+
+def swap_dirs(live, staging):
+    """Swap the directories live and staging; if live doesn't exist yet,
+    staging just becomes live."""
+    if not os.path.exists(live):
+        os.rename(staging, live)
+        return
+    swap = staging + '.swap'
+    os.rename(live, swap)
+    os.rename(staging, live)
+    os.rename(swap, staging)
+
+
+# WebrootSync {{{1
+class WebrootSync(LogMixin):
+    """Keep <webroot>/<name> up to date incrementally.
+
+        sync = WebrootSync(webroot, log_obj=self.log_obj)
+        wanted = {'talos_revision': revision, 'archives': [...]}
+        if not sync.is_current(wanted):
+            sync.sync(wanted, [('', talos_src), ('page_load_test', pageset_dir)])
+
+    wanted is any json-able description of the layers; it's compared
+    with what the live copy was built from.  One process at a time may
+    sync a webroot.
+    """
+    def __init__(self, webroot, name='talos', log_obj=None):
+        super(WebrootSync, self).__init__()
+        self.log_obj = log_obj
+        self.webroot = webroot
+        self.live = os.path.join(webroot, name)
+        self.staging = os.path.join(webroot, '.%s-staging' % name)
+        self.manifest_path = os.path.join(webroot, '.%s-webroot.json' % name)
+        self.archive_dir = os.path.join(webroot, '.%s-archives' % name)
+        self._recover()
+        self.manifest = self._load_manifest()
+
+    def _recover(self):
+        """Finish or undo a swap that was interrupted."""
+        swap = self.staging + '.swap'
+        if not os.path.exists(swap):
+            return
+        if os.path.exists(self.live):
+            self.warning("Removing %s, left over from an interrupted swap" % swap)
+            shutil.rmtree(swap)
+        else:
+            self.warning("Restoring %s from an interrupted swap" % self.live)
+            os.rename(swap, self.live)
+
+    def _load_manifest(self):
+        manifest = {'live': None, 'staging': None}
+        if os.path.exists(self.manifest_path):
+            fh = open(self.manifest_path)
+            try:
+                manifest.update(json.load(fh))
+            except ValueError:
+                self.warning("Ignoring unreadable %s" % self.manifest_path)
+            finally:
+                fh.close()
+        # The manifest can't vouch for a copy that isn't there.
+        if not os.path.isdir(self.live):
+            manifest['live'] = None
+        return manifest
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        fh = open(tmp_path, 'w')
+        try:
+            json.dump(self.manifest, fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+        os.rename(tmp_path, self.manifest_path)
+
+    def is_current(self, wanted):
+        """Is the live copy already built from wanted?"""
+        # Round trip through json, so tuples compare equal to the lists
+        # they are saved as.
+        return self.manifest['live'] == json.loads(json.dumps(wanted))
+
+    def query_archive_path(self, sha512):
+        """Where an archive with this sha512 is unpacked."""
+        return os.path.join(self.archive_dir, sha512[:32])
+
+    def sync(self, wanted, layers):
+        """Bring the staging copy up to date with layers, make it live,
+        and record that it was built from wanted.
+        Returns the counts from sync_tree().
+        """
+        self.info("Updating %s..." % self.staging)
+        counts = sync_tree(layers, self.staging)
+        self.info("%(copied)d files copied, %(removed)d removed, "
+                  "%(unchanged)d unchanged." % counts)
+        self.info("Swapping %s into %s" % (self.staging, self.live))
+        swap_dirs(self.live, self.staging)
+        self.manifest = {
+            'live': json.loads(json.dumps(wanted)),
+            'staging': self.manifest['live'],
+        }
+        self._save_manifest()
+        self.evict_archives(layers)
+        return counts
+
+    def evict_archives(self, layers):
+        """Remove unpacked archives that aren't among layers."""
+        if not os.path.isdir(self.archive_dir):
+            return
+        keep = set(os.path.abspath(src_dir) for subdir, src_dir in layers)
+        for name in os.listdir(self.archive_dir):
+            path = os.path.abspath(os.path.join(self.archive_dir, name))
+            if path not in keep:
+                self.info("Removing unused %s" % path)
+                shutil.rmtree(path)
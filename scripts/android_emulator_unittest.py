@@ -7,11 +7,13 @@
 
 import copy
 import os
+import Queue
 import sys
 import signal
 import socket
 import subprocess
 import telnetlib
+import threading
 import time
 import tempfile
 
@@ -19,7 +21,7 @@ import tempfile
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozharness.base.log import FATAL
-from mozharness.base.script import BaseScript
+from mozharness.base.script import BaseScript, OutputPump
 from mozharness.base.vcs.vcsbase import VCSMixin
 from mozharness.mozilla.blob_upload import BlobUploadMixin, blobupload_config_options
 from mozharness.mozilla.mozbase import MozbaseMixin
@@ -431,9 +433,9 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
 
         We return a dictionary with the following information:
          - subprocess object that is running the test on the emulator
-         - the filename where the stdout is going to
-         - the stdout where the output is going to
-         - the suite name that is associated
+         - an OutputPump draining its stdout and stderr
+         - the suite name and emulator index that are associated
+         - how many lines of output have been parsed, and the parser
         """
         dirs = self.query_abs_dirs()
         cmd = self._build_command(self.emulators[emulator_index], suite_name)
@@ -449,17 +451,51 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         env['MINIDUMP_SAVE_PATH'] = self.query_abs_dirs()['abs_blob_upload_dir']
 
         self.info("Running on %s the command %s" % (self.emulators[emulator_index]["name"], subprocess.list2cmdline(cmd)))
-        tmp_file = tempfile.NamedTemporaryFile(mode='w')
-        tmp_stdout = open(tmp_file.name, 'w')
-        self.info("Created temp file %s." % tmp_file.name)
+        process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
         return {
-            "process": subprocess.Popen(cmd, cwd=cwd, stdout=tmp_stdout, stderr=tmp_stdout, env=env),
-            "tmp_file": tmp_file,
-            "tmp_stdout": tmp_stdout,
+            "process": process,
+            "pump": OutputPump(process.stdout),
             "suite_name": suite_name,
-            "emulator_index": emulator_index
+            "emulator_index": emulator_index,
+            "lines": 0,
+            "parser": None,
         }
 
+    def _parse_suite_output(self, p, finished):
+        """
+        Parse a suite's output as it arrives, on its own thread, then
+        put p on the finished queue.
+
+        The suite's log is written as one block: the first suite to start
+        logs as it goes, the others' lines are held until the suites
+        before them are done.  Held lines are spooled to disk in batches
+        (see mozharness.base.log._LogBlock), so a suite waiting its turn
+        doesn't keep its whole log in memory.
+        """
+        suite_name = p["suite_name"]
+        try:
+            with self.log_obj.block():
+                self.info("##### %s log begins" % suite_name)
+                parser = self.get_test_output_parser(
+                    self.test_suite_definitions[suite_name]["category"],
+                    config=self.config,
+                    log_obj=self.log_obj,
+                    error_list=self.error_list)
+                p["parser"] = parser
+                for lines in p["pump"].batches():
+                    parser.add_lines(lines)
+                    p["lines"] += len(lines)
+                p["process"].wait()
+                # After parsing each line we should know what the summary for this suite should be
+                p["status"] = parser.evaluate_parser(0)
+                parser.append_tinderboxprint_line(suite_name)
+                self.info("##### %s log ends" % suite_name)
+                self._dump_emulator_log(p["emulator_index"])
+        except BaseException:
+            p["exc_info"] = sys.exc_info()
+        finally:
+            finished.put(p)
+
     ##########################################
     ### Actions for AndroidEmulatorTest ###
     ##########################################
@@ -641,7 +677,10 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
 
     def run_tests(self):
         """
-        Run the tests
+        Run the tests, all suites at once, parsing each suite's output as
+        it arrives.  Every suite_heartbeat_interval seconds (default 5
+        minutes) we log each running suite's progress, so buildbot won't
+        kill the job for lack of output.
         """
         procs = []
 
@@ -650,51 +689,36 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
             procs.append(self._trigger_test(suite_name, emulator_index))
             emulator_index += 1
 
+        finished = Queue.Queue()
+        for p in procs:
+            t = threading.Thread(target=self._parse_suite_output, args=(p, finished))
+            t.daemon = True
+            t.start()
+
+        heartbeat_interval = self.config.get('suite_heartbeat_interval', 5 * 60)
+        start_time = time.time()
+        running = list(procs)
+        while running:
+            try:
+                running.remove(finished.get(timeout=heartbeat_interval))
+            except Queue.Empty:
+                for p in running:
+                    num_errors = 0
+                    if p["parser"]:
+                        num_errors = p["parser"].num_errors
+                    self.info("##### %s still running after %d minutes: %d lines of output, %d errors so far" %
+                              (p["suite_name"], (time.time() - start_time) / 60, p["lines"], num_errors))
+
         joint_tbpl_status = None
         joint_log_level = None
-        start_time = int(time.time())
-        while True:
-            for p in procs:
-                emulator_index = p["emulator_index"]
-                return_code = p["process"].poll()
-                if return_code is not None:
-                    suite_name = p["suite_name"]
-                    # To make reading the log of the suite not mix with the previous line
-                    sys.stdout.write('\n')
-                    self.info("##### %s log begins" % p["suite_name"])
-                    # Let's close the stdout
-                    p["tmp_stdout"].close()
-                    # Let's read the file that now has the output
-                    output = self.read_from_file(p["tmp_file"].name, verbose=False)
-                    # Let's parse the output (which also prints it)
-                    # and determine what the results should be
-                    parser = self.get_test_output_parser(
-                        self.test_suite_definitions[p["suite_name"]]["category"],
-                        config=self.config,
-                        log_obj=self.log_obj,
-                        error_list=self.error_list)
-                    for line in output.splitlines():
-                        parser.parse_single_line(line)
-
-                    # After parsing each line we should know what the summary for this suite should be
-                    tbpl_status, log_level = parser.evaluate_parser(0)
-                    parser.append_tinderboxprint_line(p["suite_name"])
-                    # After running all jobs we will report the worst status of all emulator runs
-                    joint_tbpl_status = self.worst_level(tbpl_status, joint_tbpl_status, TBPL_WORST_LEVEL_TUPLE)
-                    joint_log_level = self.worst_level(log_level, joint_log_level)
-
-                    self.info("##### %s log ends" % p["suite_name"])
-                    self._dump_emulator_log(emulator_index)
-                    procs.remove(p)
-            if procs == []:
-                break
-            else:
-                # Every 5 minutes let's print something to stdout
-                # so buildbot won't kill the process due to lack of output
-                if int(time.time()) - start_time > 5 * 60:
-                    self.info('#')
-                    start_time = int(time.time())
-                time.sleep(30)
+        for p in procs:
+            if "exc_info" in p:
+                exc_info = p["exc_info"]
+                raise exc_info[0], exc_info[1], exc_info[2]
+            tbpl_status, log_level = p["status"]
+            # After running all jobs we will report the worst status of all emulator runs
+            joint_tbpl_status = self.worst_level(tbpl_status, joint_tbpl_status, TBPL_WORST_LEVEL_TUPLE)
+            joint_log_level = self.worst_level(log_level, joint_log_level)
 
         self.buildbot_status(joint_tbpl_status, level=joint_log_level)
 
@@ -17,8 +17,6 @@
 
 import os
 import sys
-from multiprocessing.pool import ThreadPool
-import subprocess
 import time
 from urlparse import urlparse
 try:
@@ -30,6 +28,7 @@ except ImportError:
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozharness.base.errors import HgErrorList
+from mozharness.base.vcs.gitrefs import GitRefCache, GitRefResolver
 from mozharness.base.vcs.vcsbase import VCSScript
 from mozharness.mozilla import repo_manifest
 from mozharness.base.log import ERROR
@@ -82,8 +81,12 @@ class B2GBumper(VCSScript, MapperMixin):
         # Mapping of device name to manifest
         self.device_manifests = {}
 
-        # Cache of "%s:%s" % (remote url, refname) to revision hashes
-        self._git_ref_cache = {}
+        # Cache of "%s:%s" % (remote url, refname) to revision hashes.
+        # Entries older than git_ref_cache_ttl seconds are dropped when
+        # it's imported.
+        self._git_ref_cache = GitRefCache(
+            ttl=self.config.get('git_ref_cache_ttl', 30 * 60))
+        self._git_ref_resolver = None
 
         # File location for persisting _git_ref_cache dictionary above as a json file
         self.git_ref_cache_file = self.config.get('git_ref_cache', os.path.join(self.query_abs_dirs()['abs_work_dir'], 'git_ref_cache.json'))
@@ -148,113 +151,77 @@ class B2GBumper(VCSScript, MapperMixin):
             return m
         repo_manifest.rewrite_remotes(manifest, mapping_func)
 
-    def resolve_git_ref(self, remote_url, revision):
-        cache_key = "%s:%s" % (remote_url, revision)
-        cmd = ['git', 'ls-remote', remote_url, revision]
-        self.info("Running %s" % cmd)
-        # Retry this a few times, in case there are network errors or somesuch
-        max_retries = 5
-        for _ in range(max_retries):
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT)
-            if proc.wait() != 0:
-                self.warning("Returned %i - sleeping and retrying" %
-                             proc.returncode)
-                self.warning("%s - got output: %s" % (cache_key, proc.stdout.read()))
-                time.sleep(30)
-                continue
-            output = proc.stdout.read()
-            self.info("%s - got output: %s" % (cache_key, output))
-            try:
-                abs_revision = output.split()[0].strip()
-                self._git_ref_cache[cache_key] = abs_revision
-                return abs_revision
-            except IndexError:
-                # Couldn't split the output properly
-                self.warning("no output from: git ls-remote %s %s" % (remote_url, revision))
-                return None
-        return None
-
-    def resolve_refs(self, manifest):
-        worker_pool = ThreadPool(20)
-        lookup_threads_by_project = {}
-        lookup_threads_by_parameters = {}
-
-        # Resolve refnames
-        for p in manifest.getElementsByTagName('project'):
-            name = p.getAttribute('name')
-            remote_url = repo_manifest.get_project_remote_url(manifest, p)
-            revision = repo_manifest.get_project_revision(manifest, p)
-
-            # commit ids are already done
-            if repo_manifest.is_commitid(revision):
-                self.debug("%s is already locked to %s; skipping" %
-                           (name, revision))
-                continue
-
-            # gaia is special - make sure we're using the same revision we used
-            # for gaia.json
-            if self.gaia_hg_revision and p.getAttribute('path') == 'gaia' and revision == self.config['gaia_git_branch']:
-                if not self.gaia_git_rev:
-                    self.gaia_git_rev = self.query_mapper_git_revision(
-                        self.config['mapper_url'],
-                        self.config['gaia_mapper_project'],
-                        self.gaia_hg_revision,
-                    )
-                self.info("Using %s for gaia to match %s in gaia.json" % (self.gaia_git_rev, self.gaia_hg_revision))
-                p.setAttribute('revision', self.gaia_git_rev)
-                continue
+    def query_git_ref_resolver(self):
+        """ The resolver runs `git ls-remote` once per remote url, up to
+            git_ls_remote_workers (default 20) at a time and no more than
+            git_ls_remote_per_host (default 4) against one host.
+            """
+        if self._git_ref_resolver is None:
+            self._git_ref_resolver = GitRefResolver(
+                log_obj=self.log_obj,
+                cache=self._git_ref_cache,
+                workers=self.config.get('git_ls_remote_workers', 20),
+                per_host=self.config.get('git_ls_remote_per_host', 4),
+            )
+        return self._git_ref_resolver
 
-            # If there's no '/' in the revision, assume it's a head
-            if '/' not in revision:
-                revision = 'refs/heads/%s' % revision
-
-            cache_key = "%s:%s" % (remote_url, revision)
-
-            # Check to see if we've looked up this revision on this remote
-            # before. If we have, reuse the previous value rather than looking
-            # it up again. This will make sure revisions for the same ref name
-            # are consistent between devices, as long as they use the same
-            # remote/refname.
-            if cache_key in self._git_ref_cache:
-                abs_revision = self._git_ref_cache[cache_key]
-                self.info(
-                    "Reusing previous lookup %s -> %s" %
-                    (cache_key, abs_revision))
-                p.setAttribute('revision', abs_revision)
-                continue
+    def resolve_refs(self, manifests):
+        """ Lock every project in manifests to an absolute revision.
+            Refs are resolved for all the manifests at once, so each remote
+            is only listed once, and the same remote/refname resolves to
+            the same revision for every device.
+            """
+        # [(manifest, project, remote_url, revision), ...]
+        lookups = []
 
-            # Maybe a thread already exists for this lookup, even if the result has not
-            # yet been retrieved and placed in _git_ref_cache...
-            # Please note result.get() can be called multiple times without problems;
-            # the git command will only be executed once. Therefore we can associate many
-            # projects to the same thread result, without problems later when we call
-            # get() multiple times against the same thread result.
-            if cache_key in lookup_threads_by_parameters:
-                self.info("Reusing currently running thread to look up %s" % cache_key)
-                lookup_threads_by_project[p] = lookup_threads_by_parameters.get(cache_key)
-            else:
-                async_result = worker_pool.apply_async(self.resolve_git_ref,
-                                                   (remote_url, revision))
-                lookup_threads_by_parameters[cache_key] = async_result
-                lookup_threads_by_project[p] = async_result
+        # Resolve refnames
+        for manifest in manifests:
+            for p in manifest.getElementsByTagName('project'):
+                name = p.getAttribute('name')
+                remote_url = repo_manifest.get_project_remote_url(manifest, p)
+                revision = repo_manifest.get_project_revision(manifest, p)
+
+                # commit ids are already done
+                if repo_manifest.is_commitid(revision):
+                    self.debug("%s is already locked to %s; skipping" %
+                               (name, revision))
+                    continue
+
+                # gaia is special - make sure we're using the same revision we used
+                # for gaia.json
+                if self.gaia_hg_revision and p.getAttribute('path') == 'gaia' and revision == self.config['gaia_git_branch']:
+                    if not self.gaia_git_rev:
+                        self.gaia_git_rev = self.query_mapper_git_revision(
+                            self.config['mapper_url'],
+                            self.config['gaia_mapper_project'],
+                            self.gaia_hg_revision,
+                        )
+                    self.info("Using %s for gaia to match %s in gaia.json" % (self.gaia_git_rev, self.gaia_hg_revision))
+                    p.setAttribute('revision', self.gaia_git_rev)
+                    continue
+
+                # If there's no '/' in the revision, assume it's a head
+                if '/' not in revision:
+                    revision = 'refs/heads/%s' % revision
+
+                lookups.append((manifest, p, remote_url, revision))
+
+        abs_revisions = self.query_git_ref_resolver().resolve(
+            set([(remote_url, revision) for (manifest, p, remote_url, revision) in lookups]))
 
         # TODO: alert/notify on missing repositories
-        abort = False
         failed = []
-        for p, result in lookup_threads_by_project.iteritems():
-            abs_revision = result.get(timeout=300)
-            remote_url = repo_manifest.get_project_remote_url(manifest, p)
-            revision = repo_manifest.get_project_revision(manifest, p)
+        for (manifest, p, remote_url, revision) in lookups:
+            abs_revision = abs_revisions[(remote_url, revision)]
             if not abs_revision:
-                abort = True
                 self.error("Couldn't resolve reference %s %s" % (remote_url, revision))
-                failed.append(p)
+                failed.append((manifest, p))
+                continue
             p.setAttribute('revision', abs_revision)
-        if abort:
+        if failed:
             # Write message about how to set up syncing
-            default = repo_manifest.get_default(manifest)
-            for p in failed:
+            for (manifest, p) in failed:
+                default = repo_manifest.get_default(manifest)
                 if p.hasAttribute('remote'):
                     remote = repo_manifest.get_remote(manifest, p.getAttribute('remote'))
                 else:
@@ -496,13 +463,18 @@ class B2GBumper(VCSScript, MapperMixin):
         Finally, we'll resolve absolute refs for projects that aren't fully
         specified.
         """
+        manifests = {}
         for device, device_config in self.query_devices().items():
             self.info("Massaging manifests for %s" % device)
             manifest = self.query_manifest(device)
             self.filter_projects(device_config, manifest)
             self.filter_groups(device_config, manifest)
             self.map_remotes(manifest)
-            self.resolve_refs(manifest)
+            manifests[device] = manifest
+
+        self.resolve_refs(manifests.values())
+
+        for device, manifest in manifests.items():
             repo_manifest.cleanup(manifest)
             self.device_manifests[device] = manifest
 
@@ -610,15 +582,23 @@ class B2GBumper(VCSScript, MapperMixin):
     def import_git_ref_cache(self):
         """ This action imports the git ref cache created during a previous run. This is
         useful for sharing the cache across multiple branches (for example).
+        Entries older than git_ref_cache_ttl seconds (default 30 minutes; None
+        to keep them forever) are dropped, so that new refs get fetched.
         """
         if os.path.exists(self.git_ref_cache_file):
-            self._git_ref_cache = self._read_json(self.git_ref_cache_file)
+            try:
+                expired = self._git_ref_cache.load(self.git_ref_cache_file)
+            except ValueError:
+                self.warning("%s is invalid json; ignoring it." % self.git_ref_cache_file)
+                return
+            self.info("Imported %d git refs from %s; %d had expired." %
+                      (len(self._git_ref_cache.entries), self.git_ref_cache_file, expired))
 
     def export_git_ref_cache(self):
         """ This action exports the git ref cache created during this run. This is useful
         for sharing the cache across multiple branches (for example).
         """
-        if self.write_to_file(self.git_ref_cache_file, json.dumps(self._git_ref_cache, sort_keys=True, indent=4) + "\n") != self.git_ref_cache_file:
+        if self.write_to_file(self.git_ref_cache_file, self._git_ref_cache.dumps()) != self.git_ref_cache_file:
             self.add_summary(
                 "Unable to update %s with git ref cache" % self.git_ref_cache_file,
                 level=ERROR,
@@ -628,12 +608,13 @@ class B2GBumper(VCSScript, MapperMixin):
     def delete_git_ref_cache(self):
         """ Used to delete the git ref cache from the file system. The cache can be used
         to persist git ls-remote lookup results, for example to reuse them between b2g bumper
-        runs. Since the results are stale and do not get updated, the cache should be
-        periodically deleted, so that the new refs can be fetched. The cache can also be used
+        runs. import-git-ref-cache drops entries older than git_ref_cache_ttl, so this
+        is only needed to throw away fresh results too. The cache can also be used
         across branches/devices.
         """
-        self.log("Deleting git ls-remote look-up cache file ('%s')...")
-        os.remove(self.git_ref_cache_file)
+        self.log("Deleting git ls-remote look-up cache file ('%s')..." % self.git_ref_cache_file)
+        if os.path.exists(self.git_ref_cache_file):
+            os.remove(self.git_ref_cache_file)
 
 # __main__ {{{1
 if __name__ == '__main__':
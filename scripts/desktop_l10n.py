@@ -9,9 +9,12 @@
 This script manages Desktop repacks for nightly builds.
 In this version, a single partial is supported.
 """
+from contextlib import contextmanager
+from itertools import izip
 import os
 import re
 import sys
+import threading
 
 import subprocess
 
@@ -63,6 +66,10 @@ configuration_tokens = ('branch',
 runtime_config_tokens = ('buildid', 'version', 'locale', 'from_buildid',
                          'abs_objdir', 'abs_merge_dir', 'version', 'to_buildid')
 
+# mar directories that get their own copy in each repack workspace
+workspace_mar_dirs = ('previous_mar_dir', 'current_mar_dir',
+                      'current_work_mar_dir')
+
 
 # DesktopSingleLocale {{{1
 class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
@@ -141,6 +148,17 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
          "dest": "total_locale_chunks",
          "type": "int",
          "help": "Specify the total number of chunks of locales"}
+    ], [
+        ['--repack-workers', ],
+        {"action": "store",
+         "dest": "repack_workers",
+         "type": "int",
+         "help": "Specify how many locales to repack at once"}
+    ], [
+        ['--native-mar', ],
+        {"action": "store_true",
+         "dest": "native_mar",
+         "help": "Unpack mars and generate partials in process"}
     ]]
 
     def __init__(self, require_config_file=True):
@@ -165,6 +183,7 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
                 "update_mar_dir": "dist/update",
                 "previous_mar_filename": "previous.mar",
                 "current_work_mar_dir": "current.work",
+                "shared_mar_dir": "shared-mars",
                 "buildid_section": "App",
                 "buildid_option": "BuildID",
                 "application_ini": "application.ini",
@@ -173,6 +192,8 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
                 "clobber_file": 'CLOBBER',
                 "appName": "Firefox",
                 "hashType": "sha512",
+                "repack_workers": 1,
+                "repack_workspace_dir": "repacks",
             },
         }
         #
@@ -196,6 +217,11 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
         self.l10n_dir = None
         self.package_urls = {}
         self.partials = {}
+        # see repack_workspace()
+        self.workspace = threading.local()
+        self.current_mar_lock = threading.Lock()
+        # see _repack_locale()
+        self.staging_lock = threading.Lock()
         if 'mock_target' in self.config:
             self.enable_mock()
 
@@ -452,15 +478,21 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
         """iterates through the list of locales and calls make upload"""
         self.summarize(self.make_upload, self.query_locales())
 
-    def summarize(self, func, items):
+    def summarize(self, func, items, workers=1):
         """runs func for any item in items, calls the add_failure() for each
            error. It assumes that function returns 0 when successful.
+           With workers > 1, runs func for up to workers items at once
+           (see run_concurrently()); failures are still added in order.
            returns a two element tuple with (success_count, total_count)"""
         success_count = 0
         total_count = len(items)
         name = func.__name__
-        for item in items:
-            result = func(item)
+        if workers > 1:
+            results = self.run_concurrently(func, items, workers)
+        else:
+            # lazily, so each failure is added before the next call
+            results = (func(item) for item in items)
+        for item, result in izip(items, results):
             if result == SUCCESS:
                 #  success!
                 success_count += 1
@@ -700,8 +732,7 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
 
     def make_installers(self, locale):
         """wrapper for make installers-(locale)"""
-        env = self.query_repack_env()
-        self._copy_mozconfig()
+        env = self._query_locale_repack_env()
         env['L10NBASEDIR'] = self.l10n_dir
         dirs = self.query_abs_dirs()
         cwd = os.path.join(dirs['abs_locales_dir'])
@@ -727,19 +758,29 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
     def repack_locale(self, locale):
         """wraps the logic for comapare locale, make installers and generate
            partials"""
-        if self.run_compare_locales(locale) != 0:
+        with self.repack_workspace(locale):
+            return self._repack_locale(locale)
+
+    def _repack_locale(self, locale):
+        if self.run_compare_locales(locale,
+                                    merge_dir=self._query_merge_dir()) != 0:
             self.error("compare locale %s failed" % (locale))
             return FAILURE
 
-        # compare locale succeded, let's run make installers
-        if self.make_installers(locale) != 0:
-            self.error("make installers-%s failed" % (locale))
-            return FAILURE
+        # make installers-<locale> and full-update stage the package in
+        # the objdir's dist/, which every repack shares: with
+        # repack_workers > 1, they run for one locale at a time, and only
+        # compare-locales and the partials run concurrently.
+        with self.staging_lock:
+            # compare locale succeded, let's run make installers
+            if self.make_installers(locale) != 0:
+                self.error("make installers-%s failed" % (locale))
+                return FAILURE
 
-        # installer succeded, generate complete mar
-        if self.generate_complete_mar(locale) != 0:
-            self.error("generate complete %s mar failed" % (locale))
-            return FAILURE
+            # installer succeded, generate complete mar
+            if self.generate_complete_mar(locale) != 0:
+                self.error("generate complete %s mar failed" % (locale))
+                return FAILURE
 
         # do we need to generate partials?
         if self.has_partials():
@@ -758,7 +799,69 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
 
     def repack(self):
         """creates the repacks and udpates"""
-        self.summarize(self.repack_locale, self.query_locales())
+        locales = self.query_locales()
+        workers = self.config.get('repack_workers', 1)
+        self._copy_mozconfig()
+        # may be left over from a previous run, for another version
+        self.rmtree(self._shared_mar_dir())
+        if workers > 1:
+            self.rmtree(self._repack_workspaces_dir())
+            # shared by all the locales: get them before the workers race
+            # for them
+            self.query_repack_env()
+            self.download_mar_tools()
+            if self.has_partials():
+                self.query_version()
+                self._query_buildid()
+        self.summarize(self.repack_locale, locales, workers=workers)
+
+    @contextmanager
+    def repack_workspace(self, locale):
+        """with repack_workers > 1, locales are repacked at the same time
+           (but see _repack_locale()), so each one gets its own merge dir
+           and previous/ current/ current.work/ mar dirs, under
+           abs_objdir/repack_workspace_dir/locale, for the calling thread.
+           The workspace is removed afterwards: the complete and partial
+           mars end up in update_mar_dir as usual"""
+        if self.config.get('repack_workers', 1) <= 1:
+            yield None
+            return
+        workspace = os.path.join(self._repack_workspaces_dir(), locale)
+        self.rmtree(workspace)
+        self.mkdir_p(workspace)
+        self.workspace.path = workspace
+        try:
+            yield workspace
+        finally:
+            self.workspace.path = None
+            self.rmtree(workspace)
+
+    def _query_workspace(self):
+        """returns the calling thread's repack workspace, or None"""
+        return getattr(self.workspace, 'path', None)
+
+    def _repack_workspaces_dir(self):
+        """returns the full path of the directory with the repack workspaces"""
+        return os.path.join(self._get_objdir(),
+                            self.config['repack_workspace_dir'])
+
+    def _query_merge_dir(self):
+        """returns the compare-locales merge dir for the current repack"""
+        workspace = self._query_workspace()
+        if workspace:
+            return os.path.join(workspace, 'merged')
+        return self.query_abs_dirs()['abs_merge_dir']
+
+    def _query_locale_repack_env(self):
+        """returns a copy of the repack env, pointing LOCALE_MERGEDIR at
+           the merge dir of the current repack"""
+        env = dict(self.query_repack_env())
+        merge_dir = self._query_merge_dir()
+        abs_merge_dir = self.query_abs_dirs()['abs_merge_dir']
+        if 'LOCALE_MERGEDIR' in env and merge_dir != abs_merge_dir:
+            env['LOCALE_MERGEDIR'] = env['LOCALE_MERGEDIR'].replace(abs_merge_dir,
+                                                                    merge_dir)
+        return env
 
     def localized_marfile(self, locale):
         """returns the localized mar file name"""
@@ -781,21 +884,13 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
         self.download_mar_tools()
         # get the previous mar file
         previous_marfile = self._get_previous_mar(locale)
-        # and unpack it
-        previous_mar_dir = self._previous_mar_dir()
-        result = self._unpack_mar(previous_marfile, previous_mar_dir)
-        if result != 0:
-            self.error('failed to unpack %s to %s' % (previous_marfile,
-                                                      previous_mar_dir))
-            return result
-
+        # and unpack it (halts on failure); with native_mar, the unpacked
+        # mars come from the unpacked mar cache and are shared
+        previous_mar_dir = self.query_unpacked_mar_dir(previous_marfile,
+                                                       self._previous_mar_dir())
         current_marfile = self._get_current_mar()
-        current_mar_dir = self._current_mar_dir()
-        result = self._unpack_mar(current_marfile, current_mar_dir)
-        if result != 0:
-            self.error('failed to unpack %s to %s' % (current_marfile,
-                                                      current_mar_dir))
-            return result
+        current_mar_dir = self.query_unpacked_mar_dir(current_marfile,
+                                                      self._current_mar_dir())
         # partial filename
         config = self.config
         version = self.query_version()
@@ -809,9 +904,10 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
             self.package_urls[locale] = {}
         self.package_urls[locale]['partial_filename'] = partial_filename
         self.package_urls[locale]['previous_buildid'] = previous_mar_buildid
-        self._delete_pgc_files()
+        if not self.config.get('native_mar'):
+            self._delete_pgc_files()
         result = self.do_incremental_update(previous_mar_dir, current_mar_dir,
-                                            partial_filename)
+                                            partial_filename, ignore=('*.pgc', ))
         if result == 0:
             # incremental updates succeded
             # prepare partialInfo for balrog submission
@@ -874,6 +970,12 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
         self.set_buildbot_property("buildid", self._query_buildid())
         self.set_buildbot_property("appVersion", self.query_version())
 
+        # hash all the complete mars at once, in parallel;
+        # submit_repack_to_balrog() finds them in the hash cache
+        complete_mars = [self._query_complete_mar_filename(locale)
+                         for locale in self.query_locales()]
+        self.query_files_hashes([m for m in complete_mars if os.path.exists(m)])
+
         # submit complete mar to balrog
         # clean up buildbot_properties
         self.summarize(self.submit_repack_to_balrog, self.query_locales())
@@ -994,11 +1096,14 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
     def _get_current_mar(self):
         """downloads the current mar file"""
         self.mkdir_p(self._previous_mar_dir())
-        if not os.path.exists(self._current_mar_filename()):
-            self.download_file(self._current_mar_url(),
-                               self._current_mar_filename())
-        else:
-            self.info('%s already exists, skipping download' % (self._current_mar_filename()))
+        self.mkdir_p(os.path.dirname(self._current_mar_filename()))
+        # repack workspaces share one current mar
+        with self.current_mar_lock:
+            if not os.path.exists(self._current_mar_filename()):
+                self.download_file(self._current_mar_url(),
+                                   self._current_mar_filename())
+            else:
+                self.info('%s already exists, skipping download' % (self._current_mar_filename()))
         return self._current_mar_filename()
 
     def _get_previous_mar(self, locale):
@@ -1027,9 +1132,19 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
                             config['previous_mar_filename'])
 
     def _current_mar_filename(self):
-        """returns the complete path to current.mar"""
+        """returns the complete path to current.mar. Repack workspaces
+           and native_mar keep a single one for all the locales, out of
+           the per locale mar dirs"""
+        if self._query_workspace() or self.config.get('native_mar'):
+            return os.path.join(self._shared_mar_dir(),
+                                self._current_mar_name())
         return os.path.join(self._current_mar_dir(), self._current_mar_name())
 
+    def _shared_mar_dir(self):
+        """returns the full path of the directory for mars shared by all
+           the locales"""
+        return self._mar_dir('shared_mar_dir')
+
     def _create_mar_dirs(self):
         """creates mar directories: previous/ current/"""
         for directory in (self._previous_mar_dir(),
@@ -1082,6 +1197,9 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MockMixin, PurgeMixin,
         """returns the full path of dirname;
             dirname is an entry in configuration"""
         config = self.config
+        workspace = self._query_workspace()
+        if workspace and dirname in workspace_mar_dirs:
+            return os.path.join(workspace, config.get(dirname))
         return os.path.join(self._get_objdir(), config.get(dirname))
 
     def _get_objdir(self):
@@ -11,11 +11,14 @@
 from copy import deepcopy
 import os
 import sys
+import zipfile
+from cStringIO import StringIO
 
 # load modules from parent dir
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
-from mozharness.base.errors import ZipErrorList
+from mozharness.base.archive import DEFAULT_WORKERS, rewrite_zip
+from mozharness.base.errors import ExtractError
 from mozharness.base.log import FATAL
 from mozharness.base.transfer import TransferMixin
 from mozharness.base.vcs.vcsbase import MercurialScript
@@ -95,6 +98,14 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
          "metavar": "INT",
          "help": "Specify the current release build num (e.g. build1, build2)"
          }
+    ], [
+        ['--repack-workers', ],
+        {"action": "store",
+         "dest": "repack_workers",
+         "type": "int",
+         "metavar": "INT",
+         "help": "Repack up to INT apks at once (default: %d)" % DEFAULT_WORKERS
+         }
     ]]
 
     def __init__(self, require_config_file=True):
@@ -179,54 +190,44 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
         self.summarize_success_count(success_count, total_count,
                                      message="Downloaded %d of %d installers successfully.")
 
-    def _repack_apk(self, partner, orig_path, repack_path):
-        """ Repack the apk with a partner update channel.
+    def _repack_apk(self, partner, orig_path, repack_path, scratch_dir):
+        """ Repack the apk with a partner update channel: add
+        defaults/pref/partner.js to its omni.ja, and drop its signature.
+        Both zips are rewritten in process, copying the members that
+        don't change without recompressing them.  scratch_dir is this
+        repack's own.
         Returns True for success, None for failure
         """
-        dirs = self.query_abs_dirs()
-        zip_bin = self.query_exe("zip")
-        unzip_bin = self.query_exe("unzip")
-        file_name = os.path.basename(orig_path)
-        tmp_dir = os.path.join(dirs['abs_work_dir'], 'tmp')
-        tmp_file = os.path.join(tmp_dir, file_name)
-        tmp_prefs_dir = os.path.join(tmp_dir, 'defaults', 'pref')
-        # Error checking for each step.
-        # Ignoring the mkdir_p()s since the subsequent copyfile()s will
-        # error out if unsuccessful.
-        if self.rmtree(tmp_dir):
+        tmp_file = os.path.join(scratch_dir, os.path.basename(orig_path))
+        if self.rmtree(scratch_dir):
             return
-        self.mkdir_p(tmp_prefs_dir)
-        if self.copyfile(orig_path, tmp_file):
+        self.mkdir_p(scratch_dir)
+        prefs = 'pref("app.partner.%s", "%s");' % (partner, partner)
+        self.info("Adding partner.js for %s to %s" % (partner, orig_path))
+        try:
+            apk = zipfile.ZipFile(orig_path)
+            try:
+                omni_ja = apk.read('omni.ja')
+            finally:
+                apk.close()
+            new_omni_ja = StringIO()
+            rewrite_zip(StringIO(omni_ja), new_omni_ja,
+                        add={'defaults/pref/partner.js': prefs})
+            # Unsigning is dropping META-INF/*, like unsign_apk().
+            rewrite_zip(orig_path, tmp_file,
+                        add={'omni.ja': new_omni_ja.getvalue()},
+                        remove=['META-INF/*'])
+        except KeyError:
+            self.error("No omni.ja in %s!" % orig_path)
             return
-        if self.write_to_file(os.path.join(tmp_prefs_dir, 'partner.js'),
-                              'pref("app.partner.%s", "%s");' % (partner, partner)
-                              ) is None:
-            return
-        if self.run_command([unzip_bin, '-q', file_name, 'omni.ja'],
-                            error_list=ZipErrorList,
-                            return_type='num_errors',
-                            cwd=tmp_dir):
-            self.error("Can't extract omni.ja from %s!" % file_name)
-            return
-        if self.run_command([zip_bin, '-9r', 'omni.ja',
-                             'defaults/pref/partner.js'],
-                            error_list=ZipErrorList,
-                            return_type='num_errors',
-                            cwd=tmp_dir):
-            self.error("Can't add partner.js to omni.ja!")
-            return
-        if self.run_command([zip_bin, '-9r', file_name, 'omni.ja'],
-                            error_list=ZipErrorList,
-                            return_type='num_errors',
-                            cwd=tmp_dir):
-            self.error("Can't re-add omni.ja to %s!" % file_name)
-            return
-        if self.unsign_apk(tmp_file):
+        except (IOError, OSError, zipfile.BadZipfile, ExtractError), e:
+            self.error("Can't repack %s: %s" % (orig_path, str(e)))
             return
         repack_dir = os.path.dirname(repack_path)
         self.mkdir_p(repack_dir)
-        if self.copyfile(tmp_file, repack_path):
+        if self.move(tmp_file, repack_path):
             return
+        self.rmtree(scratch_dir)
         return True
 
     def repack(self):
@@ -235,6 +236,8 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
         dirs = self.query_abs_dirs()
         locales = self.query_locales()
         success_count = total_count = 0
+        repacks = []
+        jobs = []
         for platform in c['platforms']:
             for locale in locales:
                 installer_name = c['installer_base_names'][platform] % {'version': rc['version'], 'locale': locale}
@@ -244,12 +247,20 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
                 original_path = '%s/original/%s/%s/%s' % (dirs['abs_work_dir'], platform, locale, installer_name)
                 for partner in c['partner_config'].keys():
                     repack_path = '%s/unsigned/partner-repacks/%s/%s/%s/%s' % (dirs['abs_work_dir'], partner, platform, locale, installer_name)
-                    total_count += 1
-                    if self._repack_apk(partner, original_path, repack_path):
-                        success_count += 1
-                    else:
-                        self.add_failure(platform, locale,
-                                         message="Unable to repack %(platform)s:%(locale)s installer!")
+                    scratch_dir = os.path.join(dirs['abs_work_dir'], 'tmp', partner, platform, locale)
+                    repacks.append((platform, locale))
+                    jobs.append((partner, original_path, repack_path, scratch_dir))
+        workers = min(c.get('repack_workers') or DEFAULT_WORKERS, max(len(jobs), 1))
+        results = self.run_concurrently(lambda job: self._repack_apk(*job),
+                                        jobs, workers, name='_repack_apk')
+        # failures are added here, in order, rather than from the workers
+        for (platform, locale), result in zip(repacks, results):
+            total_count += 1
+            if result:
+                success_count += 1
+            else:
+                self.add_failure(platform, locale,
+                                 message="Unable to repack %(platform)s:%(locale)s installer!")
         self.summarize_success_count(success_count, total_count,
                                      message="Repacked %d of %d installers successfully.")
 
@@ -10,13 +10,16 @@ hg<->git conversions.  Needs to support both the monolithic beagle/gecko.git
 type conversions, as well as many-to-many (l10n, build repos, etc.)
 """
 
+from contextlib import contextmanager
 from copy import deepcopy
-import mmap
+from itertools import islice
 import os
 import pprint
 import re
 import sys
+import threading
 import time
+import urlparse
 
 try:
     import simplejson as json
@@ -35,8 +38,10 @@ external_tools_path = os.path.join(
 from mozharness.base.errors import HgErrorList, GitErrorList
 from mozharness.base.log import INFO, ERROR, FATAL
 from mozharness.base.python import VirtualenvMixin, virtualenv_config_options
+from mozharness.base.script import run_concurrently
 from mozharness.base.transfer import TransferMixin
 from mozharness.base.vcs.vcssync import VCSSyncScript
+from mozharness.mozilla.mapfile import MapfileStore
 from mozharness.mozilla.tooltool import TooltoolMixin
 
 
@@ -52,10 +57,25 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
         script with some changes.
         """
 
-    mapfile_binary_search = None
     all_repos = None
     successful_repos = []
+    # The per-repo actions, in order, and the method each runs for one repo.
+    repo_pipeline = [
+        ('update-stage-mirror', '_update_stage_repo'),
+        ('update-work-mirror', '_update_work_repo'),
+        ('create-git-notes', '_create_repo_git_notes'),
+        ('publish-to-mapper', '_publish_repo_to_mapper'),
+        ('push', '_push_repo_and_record_status'),
+    ]
     config_options = [
+        [["--workers", ], {
+            "action": "store",
+            "dest": "vcs_sync_workers",
+            "type": "int",
+            "default": 1,
+            "help": "Take this many repos through the per-repo actions at once "
+                    "(default 1: run each action over every repo in turn).",
+        }],
         [["--no-check-incoming", ], {
             "action": "store_false",
             "dest": "check_incoming",
@@ -106,6 +126,13 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             require_config_file=require_config_file
         )
         self.remote_targets = None
+        self.mapfile_stores = {}
+        self.repo_pipeline_done = False
+        self.push_slots = {}
+        # Guards self.failures, self.successful_repos and self.push_slots
+        # while the repo pipeline runs.
+        self.state_lock = threading.RLock()
+        self.repo_update_lock = threading.RLock()
 
     # Helper methods {{{1
     def query_abs_dirs(self):
@@ -315,15 +342,21 @@ intree=1
         return repo_map.get('repos', {}).get(repo_name, {}).get('previous_push_successful')
 
     def _update_repo_previous_status(self, repo_name, successful_flag, repo_map=None, write_update=False):
-        """ Set the repo_name to successful_flag (False for unsuccessful, True for successful)
+        """ Set the repo_name to successful_flag (False for unsuccessful, True for successful).
+            Without a repo_map, update repo_update.json.
             """
         if repo_map is None:
-            repo_map = self._read_repo_update_json()
+            with self._updating_repo_update_json() as repo_map:
+                return self._update_repo_previous_status(repo_name, successful_flag, repo_map=repo_map)
         repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
         if write_update:
             self._write_repo_update_json(repo_map)
         return repo_map
 
+    def add_failure(self, key, *args, **kwargs):
+        with self.state_lock:
+            super(HgGitScript, self).add_failure(key, *args, **kwargs)
+
     def _update_stage_repo(self, repo_config, retry=True, clobber=False):
         """ Update a stage repo.
             See update_stage_mirror() for a description of the stage repos.
@@ -423,6 +456,24 @@ intree=1
 #            else:
 #                self.fatal("Can't verify %s!" % source_dest)
 
+    def _query_push_slot(self, target_repo):
+        """ Return the semaphore that limits pushes to target_repo's host to
+            self.config['vcs_sync_pushes_per_host'] (default 4) at a time.
+            Test pushes to local directories share the 'localhost' slots.
+            """
+        if '://' in target_repo:
+            host = urlparse.urlparse(target_repo).hostname
+        elif ':' in target_repo:
+            # scp-style: user@host:path
+            host = target_repo.split(':', 1)[0].split('@')[-1]
+        else:
+            host = 'localhost'
+        with self.state_lock:
+            if host not in self.push_slots:
+                self.push_slots[host] = threading.BoundedSemaphore(
+                    self.config.get('vcs_sync_pushes_per_host', 4))
+            return self.push_slots[host]
+
     def _do_push_repo(self, base_command, refs_list=None, kwargs=None):
         """ Helper method for _push_repo() since it has to be able to break
             out of the target_repo list loop, and the commands loop borks that.
@@ -544,16 +595,18 @@ intree=1
                                     refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
                                     continue
                 error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_git_repo)
-                if self._do_push_repo(
-                    base_command,
-                    refs_list=refs_list,
-                    kwargs={
-                        'output_timeout': target_config.get("output_timeout", 30 * 60),
-                        'cwd': os.path.join(conversion_dir, '.git'),
-                        'error_list': GitErrorList,
-                        'partial_env': env,
-                    }
-                ):
+                with self._query_push_slot(target_git_repo):
+                    push_failed = self._do_push_repo(
+                        base_command,
+                        refs_list=refs_list,
+                        kwargs={
+                            'output_timeout': target_config.get("output_timeout", 30 * 60),
+                            'cwd': os.path.join(conversion_dir, '.git'),
+                            'error_list': GitErrorList,
+                            'partial_env': env,
+                        }
+                    )
+                if push_failed:
                     if target_config.get("test_push"):
                         error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
                     self.error(error_msg)
@@ -568,24 +621,53 @@ intree=1
                 return_status += error_msg
         return return_status
 
+    def _query_store(self, store_dir):
+        store = self.mapfile_stores.get(store_dir)
+        if store is None:
+            store = MapfileStore(store_dir)
+            self.mapfile_stores[store_dir] = store
+        return store
+
+    def _query_mapfile_store(self, mapfile):
+        """ Return the MapfileStore for mapfile, with any mappings added to
+            mapfile since we last looked merged in.  The store lives next to
+            mapfile (in .hg/, for a conversion's git-mapfile), so it goes
+            away when the conversion dir is clobbered.
+            """
+        store_dir = '%s-store' % mapfile
+        store = self._query_store(store_dir)
+        if os.path.exists(mapfile):
+            added = store.merge(mapfile)
+            if added:
+                self.info("Added %d new mappings from %s to %s." % (added, mapfile, store_dir))
+        return store
+
     def _query_mapped_revision(self, revision=None, mapfile=None):
-        """ Use the virtualenv mapper module to search a mapfile for a
-            revision.
+        """ Look up the git revision for hg revision (which can be
+            abbreviated) in mapfile.
             """
-        if not callable(self.mapfile_binary_search):
-            site_packages_path = self.query_python_site_packages_path()
-            sys.path.append(os.path.join(site_packages_path, 'mapper'))
-            try:
-                from bsearch import mapfile_binary_search
-                global log
-                log = self.log_obj
-                self.mapfile_binary_search = mapfile_binary_search
-            except ImportError, e:
-                self.fatal("Can't import mapfile_binary_search! %s\nDid you create-virtualenv?" % str(e))
-        # I wish mapper did this for me, but ...
-        fd = open(mapfile, 'rb')
-        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
-        return self.mapfile_binary_search(m, revision)
+        return self._query_mapfile_store(mapfile).query_git_revision(revision)
+
+    def _query_new_mappings(self, mapfile, consumer, old_file):
+        """ Return (store, lines, end): mapfile's store, an iterator over
+            the mappings consumer hasn't dealt with yet, and what to pass to
+            store.mark_consumed() once it has.
+
+            Before the mapfile store, what each consumer had dealt with was
+            a copy of the mapfile (old_file); if that's all we have, skip
+            whatever is in it this one time.
+            """
+        store = self._query_mapfile_store(mapfile)
+        lines, end = store.query_delta(consumer)
+        if store.query_consumed(consumer) is None and os.path.exists(old_file):
+            self.info("Skipping the mappings already in %s." % old_file)
+            with self.opened(old_file) as (old, err):
+                if err:
+                    old_set = frozenset()
+                else:
+                    old_set = frozenset(old)
+            lines = (line for line in lines if line not in old_set)
+        return store, lines, end
 
     def _post_fatal(self, message=None, exit_code=None):
         """ After we call fatal(), run this method before exiting.
@@ -626,12 +708,29 @@ intree=1
         """ The write portion of _read_repo_update_json().
             """
         dirs = self.query_abs_dirs()
+        path = os.path.join(dirs['abs_upload_dir'], 'repo_update.json')
         contents = json.dumps(repo_map, sort_keys=True, indent=4)
-        self.write_to_file(
-            os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
-            contents,
-            create_parent_dir=True
-        )
+        with self.repo_update_lock:
+            # Write a temp file and rename it, so nothing ever reads half a
+            # json file.
+            if self.write_to_file(
+                '%s.tmp' % path,
+                contents,
+                create_parent_dir=True,
+                verbose=False
+            ):
+                os.rename('%s.tmp' % path, path)
+
+    @contextmanager
+    def _updating_repo_update_json(self):
+        """ Read repo_update.json, yield it to be changed, and write it
+            back.  Other threads can't touch it in between, so they don't
+            lose each other's changes.
+            """
+        with self.repo_update_lock:
+            repo_map = self._read_repo_update_json()
+            yield repo_map
+            self._write_repo_update_json(repo_map)
 
     def _query_hg_exe(self):
         """Returns the hg executable command as a list
@@ -688,42 +787,386 @@ intree=1
         """ Adapted from repo-sync-tools/combine_mapfiles
 
             Consolidate multiple conversion processes' mapfiles into a
-            single mapfile.
+            single mapfile, sorted by hg revision.  The mappings are kept
+            in a MapfileStore in the work dir between runs, so while the
+            mapfiles are only appended to, only the lines added since the
+            last run are read.  If one has been dropped or rewritten, the
+            store is rebuilt from the current mapfiles, so its stale
+            mappings go too.
             """
         self.info("Determining whether we need to combine mapfiles...")
         if cwd is None:
             cwd = self.query_abs_dirs()['abs_upload_dir']
-        existing_mapfiles = []
+        store_dir = os.path.join(self.query_abs_dirs()['abs_work_dir'],
+                                 '%s-store' % combined_mapfile)
+        store = self._query_store(store_dir)
+        sources = []
         for f in mapfiles:
             f_path = os.path.join(cwd, f)
             if os.path.exists(f_path):
-                existing_mapfiles.append(f)
+                sources.append(os.path.abspath(f_path))
             else:
                 self.warning("%s doesn't exist!" % f_path)
+        dropped = set(store.query_sources()) - set(sources)
+        rewritten = [f_path for f_path in sources
+                     if store.query_merged_offset(f_path) is None]
+        rebuild = bool(dropped or rewritten)
+        if rebuild:
+            self.info("Rebuilding %s; dropped: %s, rewritten: %s." %
+                      (store_dir, sorted(dropped), rewritten))
+            store.clear()
+        added = 0
+        for f_path in sources:
+            added += store.merge(f_path)
         combined_mapfile_path = os.path.join(cwd, combined_mapfile)
         if os.path.exists(combined_mapfile_path):
-            combined_timestamp = os.path.getmtime(combined_mapfile_path)
-            for f in existing_mapfiles:
-                f_path = os.path.join(cwd, f)
-                if os.path.getmtime(f_path) > combined_timestamp:
-                    # Yes, we want to combine mapfiles
-                    break
-            else:
+            if not added and not rebuild:
                 self.info("No new mapfiles to combine.")
                 return
             self.move(combined_mapfile_path, "%s.old" % combined_mapfile_path)
-        output = self.get_output_from_command(
-            ['sort', '--unique', '-t', ' ',
-             '--key=2'] + existing_mapfiles,
-            silent=True, halt_on_failure=True,
-            cwd=cwd,
-        )
-        self.write_to_file(combined_mapfile_path, output, verbose=False,
-                           error_level=FATAL)
+        self.info("Writing %d mappings (%d new) to %s." % (len(store), added, combined_mapfile_path))
+        store.write_mapfile(combined_mapfile_path)
         self.run_command(['ln', '-sf', combined_mapfile,
                           '%s-latest' % combined_mapfile],
                          cwd=cwd)
 
+    def _record_pull_start(self):
+        with self._updating_repo_update_json() as repo_map:
+            repo_map['last_pull_timestamp'] = int(time.time())
+            repo_map['last_pull_datetime'] = time.strftime('%Y-%m-%d %H:%M %Z')
+
+    def _update_work_repo(self, repo_config):
+        """ update_work_mirror() for one repo.
+            """
+        hg = self._query_hg_exe()
+        git = self.query_exe("git", return_type="list")
+        dirs = self.query_abs_dirs()
+        repo_name = repo_config['repo_name']
+        source = os.path.join(dirs['abs_source_dir'], repo_name)
+        dest = self.query_abs_conversion_dir(repo_config)
+        if not dest:
+            self.fatal("No conversion_dir for %s!" % repo_name)
+        if not os.path.exists(dest):
+            self.mkdir_p(os.path.dirname(dest))
+            self.run_command(hg + ['clone', '--noupdate', source, dest],
+                             error_list=HgErrorList,
+                             halt_on_failure=False)
+            if os.path.exists(dest):
+                self.write_hggit_hgrc(dest)
+                self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
+                self.run_command(
+                git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
+                )
+            else:
+                self.add_failure(
+                    repo_name,
+                    message="Failed to clone %s!" % source,
+                    level=ERROR,
+                )
+                return
+        # Build branch map.
+        branch_map = self.query_branches(
+            repo_config.get('branch_config', {}),
+            source,
+        )
+        branches = {}
+        for (branch, target_branch) in branch_map.items():
+            output = self.get_output_from_command(
+                hg + ['id', '-r', branch],
+                cwd=source
+            )
+            if output:
+                rev = output.split(' ')[0]
+            else:
+                self.add_failure(
+                    repo_name,
+                    message="Branch %s doesn't exist in %s (%s cloned into staging directory %s)!" % (branch, repo_name, repo_config.get('repo'), source),
+                    level=ERROR,
+                )
+                continue
+            timestamp = int(time.time())
+            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+            if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
+                                error_list=HgErrorList):
+                # We shouldn't have an issue pulling!
+                self.add_failure(
+                    repo_name,
+                    message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
+                    level=ERROR,
+                )
+                self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
+                # don't leave a dirty checkout behind, and skip remaining branches
+                self.rmtree(source)
+                break
+            self.run_command(
+                hg + ['bookmark', '-f', '-r', rev, target_branch],
+                cwd=dest, error_list=HgErrorList,
+            )
+            # This might get a little large.
+            branches[branch] = {
+                'hg_branch': branch,
+                'hg_revision': rev,
+                'git_branch': target_branch,
+                'pull_timestamp': timestamp,
+                'pull_datetime': datetime,
+            }
+        if branches:
+            with self._updating_repo_update_json() as repo_map:
+                repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {}).update(branches)
+        if self.query_failure(repo_name):
+            # We hit an error in the for loop above
+            return
+        self.retry(
+            self.run_command,
+            args=(hg + ['-v', 'gexport'], ),
+            kwargs={
+                'output_timeout': 15 * 60,
+                'cwd': dest,
+                'error_list': HgErrorList,
+            },
+            error_level=FATAL,
+        )
+        generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+        self.copy_to_upload_dir(
+            generated_mapfile,
+            dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
+            log_level=INFO
+        )
+        git_revisions = {}
+        for branch in branches:
+            git_revisions[branch] = self._query_mapped_revision(
+                revision=branches[branch]['hg_revision'], mapfile=generated_mapfile)
+        with self._updating_repo_update_json() as repo_map:
+            for (branch, git_revision) in git_revisions.items():
+                repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
+
+    def _create_repo_git_notes(self, repo_config):
+        """ create_git_notes() for one repo.
+            """
+        git = self.query_exe("git", return_type="list")
+        repo = repo_config['repo']
+        if repo_config.get('generate_git_notes', False):
+            dest = self.query_abs_conversion_dir(repo_config)
+            # 'git-mapfile' is created by hggit plugin, containing all the mappings
+            complete_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+            # 'added-to-git-notes' was the set of mappings known to be recorded in the git
+            # notes of the project, before the mapfile store kept track of that
+            added_to_git_notes = os.path.join(dest, '.hg', 'added-to-git-notes')
+            # 'delta-git-notes' is the set of new mappings found on this iteration, that
+            # now need to be added to the git notes of the project
+            delta_git_notes = os.path.join(dest, '.hg', 'delta-git-notes')
+            git_dir = os.path.join(dest, '.git')
+            self.rmtree(delta_git_notes)
+            git_notes_adding_successful = True
+            with self.opened(delta_git_notes, open_mode='w') as (delta_out, err):
+                if err:
+                    git_notes_adding_successful = False
+                    self.warn("Could not write list of unprocessed git note mappings to file %s - not critical" % delta_git_notes)
+                else:
+                    store, new_mappings, end = self._query_new_mappings(
+                        complete_mapfile, 'git-notes', added_to_git_notes)
+                    for sha_lookup in new_mappings:
+                        (git_sha, hg_sha) = sha_lookup.split()
+                        # only add git note if not already there - note
+                        # devs may have added their own notes, so don't
+                        # replace any existing notes, just add to them
+                        output = self.get_output_from_command(
+                            git + ['notes', 'show', git_sha],
+                            cwd=git_dir,
+                            ignore_errors=True
+                        )
+                        git_note_text='Upstream source: %s/rev/%s' % (repo, hg_sha)
+                        git_notes_add_return_code = 1
+                        if not output or output.find(git_note_text) < 0:
+                            git_notes_add_return_code = self.run_command(
+                                git + ['notes', 'append', '-m', git_note_text, git_sha],
+                                cwd=git_dir
+                            )
+                        # if note was successfully added, or it was already there, we can
+                        # mark it as added, by putting it in the delta file...
+                        if git_notes_add_return_code == 0 or output.find(git_note_text) >= 0:
+                            print >>delta_out, sha_lookup,
+                        else:
+                            self.error("Was not able to append required git note for git commit %s ('%s')" % (git_sha, git_note_text))
+                            git_notes_adding_successful = False
+            if git_notes_adding_successful:
+                store.mark_consumed('git-notes', end)
+        else:
+            self.info("Not creating git notes for repo %s (generate_git_notes not set to True)" % repo)
+
+    def _publish_repo_to_mapper(self, repo_config):
+        """ publish_to_mapper() for one repo.
+            """
+        dest = self.query_abs_conversion_dir(repo_config)
+        # 'git-mapfile' is created by hggit plugin, containing all the mappings
+        complete_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+        # 'published-to-mapper' was all the mappings that are known to be published
+        # to mapper, for this project, before the mapfile store kept track of that
+        published_to_mapper = os.path.join(dest, '.hg', 'published-to-mapper')
+        # 'delta-for-mapper' is the set of mappings that need to be published to
+        # mapper on this iteration
+        delta_for_mapper = os.path.join(dest, '.hg', 'delta-for-mapper')
+        self.rmtree(delta_for_mapper)
+        store, new_mappings, end = self._query_new_mappings(
+            complete_mapfile, 'mapper', published_to_mapper)
+        # we only mark the mappings as published if we successfully
+        # pushed to mapper
+        mapper_config = repo_config.get('mapper', {})
+        if mapper_config:
+            site_packages_path = self.query_python_site_packages_path()
+            if site_packages_path not in sys.path:
+                sys.path.append(site_packages_path)
+            try:
+                import requests
+            except ImportError as e:
+                self.error("Can't import requests: %s\nDid you create-virtualenv?" % str(e))
+            mapper_url = mapper_config['url']
+            mapper_project = mapper_config['project']
+            insert_url = "%s/%s/insert/ignoredups" % (mapper_url, mapper_project)
+            headers = {
+                'Content-Type': 'text/plain',
+                'Authentication': 'Bearer %s' % os.environ["RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN"]
+            }
+            # due to timeouts on load balancer, we only push 200 lines at a time
+            # this means that we should get http response back within 30 seconds
+            # including the time it takes to insert the mappings in the database
+            publish_successful = True
+            delta_out = open(delta_for_mapper, 'w')
+            try:
+                i = 0
+                for chunk in iter(lambda: list(islice(new_mappings, 200)), []):
+                    delta_out.writelines(chunk)
+                    r = requests.post(insert_url, data="".join(chunk), headers=headers)
+                    if (r.status_code != 200):
+                        self.error("Could not publish mapfile ('%s') line range [%s, %s] to mapper (%s) - received http %s code" % (delta_for_mapper, i, i+200, insert_url, r.status_code))
+                        publish_successful = False
+                        # we won't break out, since we may be able to publish other mappings
+                        # and duplicates are allowed, so we will push the whole lot again next
+                        # time anyway
+                    else:
+                        self.info("Published mapfile ('%s') line range [%s, %s] to mapper (%s)" % (delta_for_mapper, i, i+200, insert_url))
+                    i += len(chunk)
+            finally:
+                delta_out.close()
+            if publish_successful:
+                # if we get this far, we know we could successfully post to mapper, so now
+                # we can mark these mappings as published, so that we don't push to mapper
+                # for these commits again
+                store.mark_consumed('mapper', end)
+        else:
+            store.mark_consumed('mapper', end)
+
+    def _record_push_start(self):
+        self.create_test_targets()
+        with self._updating_repo_update_json() as repo_map:
+            repo_map['last_push_timestamp'] = int(time.time())
+            repo_map['last_push_datetime'] = time.strftime('%Y-%m-%d %H:%M %Z')
+
+    def _push_repo_and_record_status(self, repo_config):
+        """ push() for one repo.  Returns an error message if the push
+            failed, or ''.
+            """
+        timestamp = int(time.time())
+        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+        status = self._push_repo(repo_config)
+        repo_name = repo_config['repo_name']
+        with self._updating_repo_update_json() as repo_map:
+            if not status:  # good
+                with self.state_lock:
+                    if repo_name not in self.successful_repos:
+                        self.successful_repos.append(repo_name)
+                repo_map.setdefault('repos', {}).setdefault(repo_name, {})['push_timestamp'] = timestamp
+                repo_map['repos'][repo_name]['push_datetime'] = datetime
+                previous_status = self._query_repo_previous_status(repo_name, repo_map=repo_map)
+                if previous_status is None:
+                    self.add_summary("Possibly the first successful push of %s." % repo_name)
+                elif previous_status is False:
+                    self.add_summary("Previously unsuccessful push of %s is now successful!" % repo_name)
+                self._update_repo_previous_status(repo_name, successful_flag=True, repo_map=repo_map)
+                return ""
+            self.add_failure(
+                repo_name,
+                message="Unable to push %s." % repo_name,
+                level=ERROR,
+            )
+            self._update_repo_previous_status(repo_name, successful_flag=False, repo_map=repo_map)
+        return status + "\n"
+
+    def _record_push_end(self, failure_msg):
+        if not failure_msg:
+            with self._updating_repo_update_json() as repo_map:
+                repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
+                repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
+        if failure_msg:
+            self.fatal("Unable to push these repos:\n%s" % failure_msg)
+
+    def _run_repo_pipeline(self):
+        """ With self.config['vcs_sync_workers'] > 1, the first per-repo
+            action to run (see repo_pipeline) takes each repo through all
+            of the per-repo actions we're running, that many repos at a
+            time; a slow |hg gexport| only holds up its own repo.  The
+            other per-repo actions then have nothing left to do.
+
+            Repos sharing a conversion dir take turns in it.  A repo that
+            fails an action skips the rest, as it would between actions.
+            After a fatal error, or any exception, no more repos are
+            started; it's re-raised here once the running ones are done.
+
+            Returns True if the calling action has nothing left to do.
+            """
+        workers = self.config.get('vcs_sync_workers', 1)
+        if workers <= 1:
+            return False
+        if self.repo_pipeline_done:
+            self.info("Already done in the repo pipeline.")
+            return True
+        self.repo_pipeline_done = True
+        stages = [(action, getattr(self, method_name))
+                  for (action, method_name) in self.repo_pipeline
+                  if action in self.actions]
+        actions = [action for (action, method) in stages]
+        repos = self.query_all_non_failed_repos()
+        conversion_locks = {}
+        for repo_config in repos:
+            conversion_locks.setdefault(self.query_abs_conversion_dir(repo_config),
+                                        threading.Lock())
+        if 'update-work-mirror' in actions:
+            self._record_pull_start()
+        if 'push' in actions:
+            self._record_push_start()
+        aborted = []
+
+        def run_pipeline(repo_config):
+            repo_name = repo_config['repo_name']
+            push_status = None
+            for (action, method) in stages:
+                if aborted or self.query_failure(repo_name):
+                    break
+                if action == 'update-stage-mirror':
+                    # Each repo has its own stage mirror.
+                    lock = threading.Lock()
+                else:
+                    lock = conversion_locks[self.query_abs_conversion_dir(repo_config)]
+                try:
+                    with lock:
+                        with self.log_obj.block():
+                            self.info("Running %s for %s." % (action, repo_name))
+                            status = method(repo_config)
+                except BaseException:
+                    aborted.append(repo_name)
+                    raise
+                if action == 'push':
+                    push_status = status
+            return push_status
+
+        self.info("Running %s for %d repos, %d at a time." %
+                  (', '.join(actions), len(repos), workers))
+        # Each action logs as its own block, so not run_pipeline as a whole.
+        push_statuses = run_concurrently(run_pipeline, repos, workers)
+        if 'push' in actions:
+            self._record_push_end(''.join([s for s in push_statuses if s]))
+        return True
+
     # Actions {{{1
 
     def list_repos(self):
@@ -759,252 +1202,38 @@ intree=1
             We pull the stage mirror into the work mirror, where the conversion
             is done.
             """
+        if self._run_repo_pipeline():
+            return
         for repo_config in self.query_all_non_failed_repos():
             self._update_stage_repo(repo_config)
 
-    def pull_out_new_sha_lookups(self, old_file, new_file):
-        """ This method will return an iterator which iterates through lines in file
-            new_file that do not exist in old_file. If old_file can't be read, all
-            lines in new_file are returned. It does not cause any problems if lines
-            exist in old_file that do not exist in new_file. Results are sorted by
-            the second field (text after first space in line).
-
-            This is somewhat equivalent to:
-               ( [ ! -f "${old_file}" ] && cat "${new_file}" || diff "${old_file}" "${new_file}" | sed -n 's/> //p' ) | sort -k2"""
-        with self.opened(old_file) as (old, err):
-            if err:
-                self.info('Map file %s not found - probably first time this has run.' % old_file)
-                old_set = frozenset()
-            else:
-                old_set = frozenset(old)
-        with self.opened(new_file, 'rt') as (new, err):
-            if err:
-                self.error('Could not read contents of map file %s:\n%s' % (new_file, err.message))
-                new_set = frozenset()
-            else:
-                new_set = frozenset(new)
-        for line in sorted(new_set.difference(old_set), key=lambda line: line.partition(' ')[2]):
-            yield line
-
     def update_work_mirror(self):
         """ Pull the latest changes into the work mirror, update the repo_map
             json, and run |hg gexport| to convert those latest changes into
             the git conversion repo.
             """
-        hg = self._query_hg_exe()
-        git = self.query_exe("git", return_type="list")
-        dirs = self.query_abs_dirs()
-        repo_map = self._read_repo_update_json()
-        timestamp = int(time.time())
-        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-        repo_map['last_pull_timestamp'] = timestamp
-        repo_map['last_pull_datetime'] = datetime
+        if self._run_repo_pipeline():
+            return
+        self._record_pull_start()
         for repo_config in self.query_all_non_failed_repos():
-            repo_name = repo_config['repo_name']
-            source = os.path.join(dirs['abs_source_dir'], repo_name)
-            dest = self.query_abs_conversion_dir(repo_config)
-            if not dest:
-                self.fatal("No conversion_dir for %s!" % repo_name)
-            if not os.path.exists(dest):
-                self.mkdir_p(os.path.dirname(dest))
-                self.run_command(hg + ['clone', '--noupdate', source, dest],
-                                 error_list=HgErrorList,
-                                 halt_on_failure=False)
-                if os.path.exists(dest):
-                    self.write_hggit_hgrc(dest)
-                    self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
-                    self.run_command(
-                    git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
-                    )
-                else:
-                    self.add_failure(
-                        repo_name,
-                        message="Failed to clone %s!" % source,
-                        level=ERROR,
-                    )
-                    continue
-            # Build branch map.
-            branch_map = self.query_branches(
-                repo_config.get('branch_config', {}),
-                source,
-            )
-            for (branch, target_branch) in branch_map.items():
-                output = self.get_output_from_command(
-                    hg + ['id', '-r', branch],
-                    cwd=source
-                )
-                if output:
-                    rev = output.split(' ')[0]
-                else:
-                    self.add_failure(
-                        repo_name,
-                        message="Branch %s doesn't exist in %s (%s cloned into staging directory %s)!" % (branch, repo_name, repo_config.get('repo'), source),
-                        level=ERROR,
-                    )
-                    continue
-                timestamp = int(time.time())
-                datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-                if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
-                                    error_list=HgErrorList):
-                    # We shouldn't have an issue pulling!
-                    self.add_failure(
-                        repo_name,
-                        message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
-                        level=ERROR,
-                    )
-                    self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
-                    # don't leave a dirty checkout behind, and skip remaining branches
-                    self.rmtree(source)
-                    break
-                self.run_command(
-                    hg + ['bookmark', '-f', '-r', rev, target_branch],
-                    cwd=dest, error_list=HgErrorList,
-                )
-                # This might get a little large.
-                repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {})[branch] = {
-                    'hg_branch': branch,
-                    'hg_revision': rev,
-                    'git_branch': target_branch,
-                    'pull_timestamp': timestamp,
-                    'pull_datetime': datetime,
-                }
-            if self.query_failure(repo_name):
-                # We hit an error in the for loop above
-                continue
-            self.retry(
-                self.run_command,
-                args=(hg + ['-v', 'gexport'], ),
-                kwargs={
-                    'output_timeout': 15 * 60,
-                    'cwd': dest,
-                    'error_list': HgErrorList,
-                },
-                error_level=FATAL,
-            )
-            generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            self.copy_to_upload_dir(
-                generated_mapfile,
-                dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
-                log_level=INFO
-            )
-            for (branch, target_branch) in branch_map.items():
-                git_revision = self._query_mapped_revision(
-                    revision=rev, mapfile=generated_mapfile)
-                repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
-        self._write_repo_update_json(repo_map)
-
+            self._update_work_repo(repo_config)
 
     def create_git_notes(self):
-        git = self.query_exe("git", return_type="list")
+        """ Add an "Upstream source" git note to each newly converted commit,
+            for repos with generate_git_notes set.
+            """
+        if self._run_repo_pipeline():
+            return
         for repo_config in self.query_all_non_failed_repos():
-            repo = repo_config['repo']
-            if repo_config.get('generate_git_notes', False):
-                dest = self.query_abs_conversion_dir(repo_config)
-                # 'git-mapfile' is created by hggit plugin, containing all the mappings
-                complete_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-                # 'added-to-git-notes' is the set of mappings known to be recorded in the git notes
-                # of the project (typically 'git-mapfile' from previous run)
-                added_to_git_notes = os.path.join(dest, '.hg', 'added-to-git-notes')
-                # 'delta-git-notes' is the set of new mappings found on this iteration, that
-                # now need to be added to the git notes of the project (the diff between the
-                # previous two files described)
-                delta_git_notes = os.path.join(dest, '.hg', 'delta-git-notes')
-                git_dir = os.path.join(dest, '.git')
-                self.rmtree(delta_git_notes)
-                git_notes_adding_successful = True
-                with self.opened(delta_git_notes, open_mode='w') as (delta_out, err):
-                    if err:
-                        git_notes_adding_successful = False
-                        self.warn("Could not write list of unprocessed git note mappings to file %s - not critical" % delta_git_notes)
-                    else:
-                        for sha_lookup in self.pull_out_new_sha_lookups(added_to_git_notes, complete_mapfile):
-                            print >>delta_out, sha_lookup,
-                            (git_sha, hg_sha) = sha_lookup.split()
-                            # only add git note if not already there - note
-                            # devs may have added their own notes, so don't
-                            # replace any existing notes, just add to them
-                            output = self.get_output_from_command(
-                                git + ['notes', 'show', git_sha],
-                                cwd=git_dir,
-                                ignore_errors=True
-                            )
-                            git_note_text='Upstream source: %s/rev/%s' % (repo, hg_sha)
-                            git_notes_add_return_code = 1
-                            if not output or output.find(git_note_text) < 0:
-                                git_notes_add_return_code = self.run_command(
-                                    git + ['notes', 'append', '-m', git_note_text, git_sha],
-                                    cwd=git_dir
-                                )
-                            # if note was successfully added, or it was already there, we can
-                            # mark it as added, by putting it in the delta file...
-                            if git_notes_add_return_code == 0 or output.find(git_note_text) >= 0:
-                                print >>delta_out, sha_lookup,
-                            else:
-                                self.error("Was not able to append required git note for git commit %s ('%s')" % (git_sha, git_note_text))
-                                git_notes_adding_successful = False
-                if git_notes_adding_successful:
-                    self.copyfile(complete_mapfile, added_to_git_notes)
-            else:
-                self.info("Not creating git notes for repo %s (generate_git_notes not set to True)" % repo)
+            self._create_repo_git_notes(repo_config)
 
     def publish_to_mapper(self):
         """ This method will attempt to create git notes for any new git<->hg mappings
             found in the generated_mapfile file and also push new mappings to mapper service."""
+        if self._run_repo_pipeline():
+            return
         for repo_config in self.query_all_non_failed_repos():
-            dest = self.query_abs_conversion_dir(repo_config)
-            # 'git-mapfile' is created by hggit plugin, containing all the mappings
-            complete_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            # 'published-to-mapper' is all the mappings that are known to be published
-            # to mapper, for this project (typically the 'git-mapfile' from the previous
-            # run)
-            published_to_mapper = os.path.join(dest, '.hg', 'published-to-mapper')
-            # 'delta-for-mapper' is the set of mappings that need to be published to
-            # mapper on this iteration, i.e. the diff between the previous two files
-            # described
-            delta_for_mapper = os.path.join(dest, '.hg', 'delta-for-mapper')
-            self.rmtree(delta_for_mapper)
-            # we only replace published_to_mapper if we successfully updated
-            # pushed to mapper
-            mapper_config = repo_config.get('mapper', {})
-            if mapper_config:
-                site_packages_path = self.query_python_site_packages_path()
-                if site_packages_path not in sys.path:
-                    sys.path.append(site_packages_path)
-                try:
-                    import requests
-                except ImportError as e:
-                    self.error("Can't import requests: %s\nDid you create-virtualenv?" % str(e))
-                mapper_url = mapper_config['url']
-                mapper_project = mapper_config['project']
-                insert_url = "%s/%s/insert/ignoredups" % (mapper_url, mapper_project)
-                headers = {
-                    'Content-Type': 'text/plain',
-                    'Authentication': 'Bearer %s' % os.environ["RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN"]
-                }
-                all_new_mappings = []
-                all_new_mappings.extend(self.pull_out_new_sha_lookups(published_to_mapper, complete_mapfile))
-                self.write_to_file(delta_for_mapper, "".join(all_new_mappings))
-                # due to timeouts on load balancer, we only push 200 lines at a time
-                # this means that we should get http response back within 30 seconds
-                # including the time it takes to insert the mappings in the database
-                publish_successful = True
-                for i in range(0, len(all_new_mappings), 200):
-                    r = requests.post(insert_url, data="".join(all_new_mappings[i:i+200]), headers=headers)
-                    if (r.status_code != 200):
-                        self.error("Could not publish mapfile ('%s') line range [%s, %s] to mapper (%s) - received http %s code" % (delta_for_mapper, i, i+200, insert_url, r.status_code))
-                        publish_successful = False
-                        # we won't break out, since we may be able to publish other mappings
-                        # and duplicates are allowed, so we will push the whole lot again next
-                        # time anyway
-                    else:
-                        self.info("Published mapfile ('%s') line range [%s, %s] to mapper (%s)" % (delta_for_mapper, i, i+200, insert_url))
-                if publish_successful:
-                    # if we get this far, we know we could successfully post to mapper, so now
-                    # we can copy the mapfile over "previously generated" version
-                    # so that we don't push to mapper for these commits again
-                    self.copyfile(complete_mapfile, published_to_mapper)
-            else:
-                self.copyfile(complete_mapfile, published_to_mapper)
+            self._publish_repo_to_mapper(repo_config)
 
     def combine_mapfiles(self):
         """ This method is for any job (l10n, project-branches) that needs to combine
@@ -1038,43 +1267,13 @@ intree=1
         """ Push to all targets.  test_targets are local directory test repos;
             the rest are remote.  Updates the repo_map json.
             """
-        self.create_test_targets()
-        repo_map = self._read_repo_update_json()
+        if self._run_repo_pipeline():
+            return
+        self._record_push_start()
         failure_msg = ""
-        timestamp = int(time.time())
-        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-        repo_map['last_push_timestamp'] = timestamp
-        repo_map['last_push_datetime'] = datetime
         for repo_config in self.query_all_non_failed_repos():
-            timestamp = int(time.time())
-            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-            status = self._push_repo(repo_config)
-            repo_name = repo_config['repo_name']
-            if not status:  # good
-                if repo_name not in self.successful_repos:
-                    self.successful_repos.append(repo_name)
-                repo_map.setdefault('repos', {}).setdefault(repo_name, {})['push_timestamp'] = timestamp
-                repo_map['repos'][repo_name]['push_datetime'] = datetime
-                previous_status = self._query_repo_previous_status(repo_name, repo_map=repo_map)
-                if previous_status is None:
-                    self.add_summary("Possibly the first successful push of %s." % repo_name)
-                elif previous_status is False:
-                    self.add_summary("Previously unsuccessful push of %s is now successful!" % repo_name)
-                self._update_repo_previous_status(repo_name, successful_flag=True, repo_map=repo_map, write_update=True)
-            else:
-                self.add_failure(
-                    repo_name,
-                    message="Unable to push %s." % repo_name,
-                    level=ERROR,
-                )
-                failure_msg += status + "\n"
-                self._update_repo_previous_status(repo_name, successful_flag=False, repo_map=repo_map, write_update=True)
-        if not failure_msg:
-            repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
-            repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
-        self._write_repo_update_json(repo_map)
-        if failure_msg:
-            self.fatal("Unable to push these repos:\n%s" % failure_msg)
+            failure_msg += self._push_repo_and_record_status(repo_config)
+        self._record_push_end(failure_msg)
 
     def preflight_upload(self):
         if not self.config.get("copy_logs_post_run", True):
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Benchmark ScriptMixin.download_file against a local HTTP server.
+
+Each server connection is throttled to --throttle MiB/s, which is roughly
+what a single stream from ftp.mozilla.org gets in the cloud, so this
+shows what segmented downloads buy us.
+
+    python test/benchmarks/bench_download.py [--size-mb N] [--throttle N]
+"""
+
+from optparse import OptionParser
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+sys.path.insert(0, os.path.dirname(here))
+
+from mozharness.base.log import LogMixin, ERROR
+from mozharness.base.script import ScriptMixin
+from range_http_server import RangeHTTPServer, make_file
+
+
+class Downloader(ScriptMixin, LogMixin):
+    def __init__(self, config):
+        self.config = config
+        self.log_obj = None
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--size-mb", type="int", default=64)
+    parser.add_option("--throttle", type="float", default=16,
+                      help="MiB/s per connection (default %default)")
+    options, args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        make_file(os.path.join(tmpdir, 'tests.zip'), options.size_mb * 1024 * 1024)
+        server = RangeHTTPServer(tmpdir, throttle=options.throttle * 1024 * 1024)
+        server.start()
+        url = server.url_for('tests.zip')
+        dest = os.path.join(tmpdir, 'dest.zip')
+        for name, accept_ranges, segments in (('single stream', False, 1),
+                                              ('1 segment', True, 1),
+                                              ('4 segments', True, 4),
+                                              ('8 segments', True, 8)):
+            server.accept_ranges = accept_ranges
+            d = Downloader({'log_level': ERROR,
+                            'download_segments': segments,
+                            'download_min_segment_size': 1024 * 1024})
+            start = time.time()
+            assert d.download_file(url, file_name=dest) == dest
+            elapsed = time.time() - start
+            print "%-14s %6.2fs  %6.1f MiB/s" % (name, elapsed,
+                                                 options.size_mb / elapsed)
+            os.remove(dest)
+        server.stop()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Benchmark error_list matching in OutputParser.
+
+Compares walking the error_list entry by entry (the pre-ErrorListMatcher
+behaviour) against mozharness.base.log.ErrorListMatcher.
+
+    python test/benchmarks/bench_output_parser.py [--repeat N] [log ...]
+
+With no log files, test/helper_files/build_log_excerpt.txt is used.
+Pass real build/test logs (e.g. a downloaded log_raw.log) for real numbers.
+"""
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import mozharness.base.errors as errors
+from mozharness.base.log import ErrorListMatcher
+
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'helper_files', 'build_log_excerpt.txt')
+ERROR_LISTS = ('MakefileErrorList', 'HgErrorList', 'PythonErrorList',
+               'SSHErrorList', 'VirtualenvErrorList')
+
+
+def walk_error_list(error_list, line):
+    for index, error_check in enumerate(error_list):
+        if 'substr' in error_check:
+            if error_check['substr'] in line:
+                return index
+        elif 'regex' in error_check:
+            if error_check['regex'].search(line):
+                return index
+
+
+def read_lines(paths):
+    lines = []
+    for path in paths:
+        fh = open(path)
+        for line in fh:
+            if not line or line.isspace():
+                continue
+            lines.append(line.decode('utf-8', 'replace').rstrip())
+        fh.close()
+    return lines
+
+
+def time_it(func, lines):
+    start = time.time()
+    for line in lines:
+        func(line)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser(usage="%prog [--repeat N] [log ...]")
+    parser.add_option("--repeat", type="int", default=2000,
+                      help="repeat the input lines N times (default %default)")
+    options, args = parser.parse_args()
+    lines = read_lines(args or [DEFAULT_LOG]) * options.repeat
+    print "%d lines" % len(lines)
+    for name in ERROR_LISTS:
+        error_list = getattr(errors, name)
+        matcher = ErrorListMatcher(error_list)
+        for line in lines[:1000]:
+            assert matcher.match(line) == walk_error_list(error_list, line), line
+        walked = time_it(lambda line: walk_error_list(error_list, line), lines)
+        compiled = time_it(matcher.match, lines)
+        print "%-20s %3d entries  walk %6.3fs  compiled %6.3fs  x%.1f" % (
+            name, len(error_list), walked, compiled, walked / compiled)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Benchmark StructuredOutputParser on line-delimited JSON test logs.
+
+Compares decoding every line with json.loads and formatting every message
+(the pre-fast-path behaviour) against StructuredOutputParser.add_lines().
+Needs mozlog.
+
+    python test/benchmarks/bench_structured_log.py [--repeat N] [--log-level LEVEL] [log ...]
+
+With no log files, the wpt and mochitest excerpts in test/helper_files are
+used.  Pass real structured logs (e.g. a downloaded wpt_raw.log or
+mochitest_raw.log) for real numbers.
+"""
+
+import json
+from optparse import OptionParser
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from mozharness.base import log
+from mozharness.base.log import INFO, SimpleFileLogger
+from mozharness.mozilla import structuredlog
+from mozharness.mozilla.buildbot import TBPL_SUCCESS
+from mozharness.mozilla.structuredlog import StructuredOutputParser
+
+HELPER_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'helper_files')
+DEFAULT_LOGS = [os.path.join(HELPER_FILES, 'structured_log_wpt.log'),
+                os.path.join(HELPER_FILES, 'structured_log_mochitest.log')]
+
+
+class OldStructuredOutputParser(StructuredOutputParser):
+    """parse_single_line() as it was before the fast path."""
+    def parse_single_line(self, line):
+        level = INFO
+        tbpl_level = TBPL_SUCCESS
+
+        data = None
+        try:
+            candidate_data = json.loads(line)
+            if (isinstance(candidate_data, dict) and
+                'action' in candidate_data and candidate_data['action'] in self.log_actions):
+                data = candidate_data
+        except ValueError:
+            pass
+
+        if data is None:
+            self._handle_unstructured_output(line)
+            return
+
+        self.handler(data)
+
+        action = data["action"]
+        if action == "log":
+            level = getattr(log, data["level"].upper())
+
+        self.log(self.formatter(data), level=level)
+        self.update_levels(tbpl_level, level)
+
+    def add_lines(self, output):
+        super(StructuredOutputParser, self).add_lines(output)
+
+
+def read_lines(paths):
+    lines = []
+    for path in paths:
+        fh = open(path)
+        lines.extend(fh.readlines())
+        fh.close()
+    return lines
+
+
+def time_it(parser_class, lines, log_obj, log_level, chunk=1000):
+    parser = parser_class(config={'log_level': log_level}, log_obj=log_obj,
+                          strict=False)
+    start = time.time()
+    # OutputPump hands the parser batches of lines
+    for i in xrange(0, len(lines), chunk):
+        parser.add_lines(lines[i:i + chunk])
+    log_obj.flush()
+    return time.time() - start, parser.handler.summarize()
+
+
+def main():
+    parser = OptionParser(usage="%prog [--repeat N] [--log-level LEVEL] [log ...]")
+    parser.add_option("--repeat", type="int", default=2000,
+                      help="repeat the input lines N times (default %default)")
+    parser.add_option("--log-level", default=INFO,
+                      help="log level of the logger (default %default)")
+    options, args = parser.parse_args()
+    try:
+        import mozlog.structured
+        assert mozlog.structured
+    except ImportError:
+        parser.error("mozlog is needed to run this benchmark")
+    lines = read_lines(args or DEFAULT_LOGS) * options.repeat
+    print "%d lines, decoding with %s.loads" % (len(lines),
+                                               structuredlog.json_loads.__module__)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, parser_class in (('old', OldStructuredOutputParser),
+                                   ('new', StructuredOutputParser)):
+            log_obj = SimpleFileLogger(log_dir=os.path.join(tmp_dir, name),
+                                       log_level=options.log_level,
+                                       logger_name='bench-%s' % name,
+                                       log_to_console=False)
+            results[name] = time_it(parser_class, lines, log_obj, options.log_level)
+        assert results['old'][1] == results['new'][1]
+        print "old %6.3fs  new %6.3fs  x%.1f" % (
+            results['old'][0], results['new'][0],
+            results['old'][0] / results['new'][0])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
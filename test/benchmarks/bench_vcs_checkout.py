@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Benchmark VCSMixin.vcs_checkout_repos against local bare git repos.
+
+Local clones are much quicker than clones from hg.mozilla.org, so each
+checkout also sleeps for --latency seconds, standing in for the network
+round trips of a real pull.
+
+    python test/benchmarks/bench_vcs_checkout.py [--repos N] [--latency S]
+"""
+
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+
+from mozharness.base.log import LogMixin, ERROR
+from mozharness.base.script import ScriptMixin
+from mozharness.base.vcs import vcsbase
+
+
+class GitCloneVCS(ScriptMixin, LogMixin):
+    latency = 0
+
+    def __init__(self, log_obj=None, config=None, vcs_config=None,
+                 script_obj=None):
+        self.log_obj = log_obj
+        self.config = config
+        self.vcs_config = vcs_config
+
+    def ensure_repo_and_revision(self):
+        time.sleep(self.latency)
+        dest = self.vcs_config['dest']
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        self.run_command(['git', 'clone', '-q', self.vcs_config['repo'], dest])
+        return self.get_output_from_command(['git', 'rev-parse', 'HEAD'], cwd=dest)
+
+
+def make_repos(tmpdir, count):
+    devnull = open(os.devnull, 'w')
+    src = os.path.join(tmpdir, 'src')
+    subprocess.check_call(['git', 'init', '-q', src])
+    for i in range(50):
+        open(os.path.join(src, 'file%d.properties' % i), 'w').write('key=%d\n' % i * 100)
+    subprocess.check_call(['git', 'add', '.'], cwd=src)
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                           'commit', '-q', '-m', 'initial'], cwd=src)
+    repos = []
+    for i in range(count):
+        bare = os.path.join(tmpdir, 'remote', 'locale%d.git' % i)
+        subprocess.check_call(['git', 'clone', '-q', '--bare', src, bare],
+                              stdout=devnull)
+        repos.append({'repo': bare, 'dest': 'l10n/locale%d' % i, 'vcs': 'gitclone'})
+    return repos
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--repos", type="int", default=40)
+    parser.add_option("--latency", type="float", default=0.5,
+                      help="seconds added to each checkout (default %default)")
+    options, args = parser.parse_args()
+    vcsbase.VCS_DICT['gitclone'] = GitCloneVCS
+    GitCloneVCS.latency = options.latency
+    tmpdir = tempfile.mkdtemp()
+    try:
+        repos = make_repos(tmpdir, options.repos)
+        for workers in (1, 4, 8, 16):
+            script = vcsbase.VCSScript(
+                config={'log_level': ERROR, 'log_to_console': False,
+                        'vcs_checkout_workers': workers,
+                        'vcs_checkout_per_host': workers},
+                option_args=['--base-work-dir', tmpdir, '--work-dir', 'work'],
+            )
+            start = time.time()
+            revisions = script.vcs_checkout_repos(repos)
+            elapsed = time.time() - start
+            assert len(revisions) == options.repos
+            print "%2d workers %6.2fs" % (workers, elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
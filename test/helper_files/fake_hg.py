@@ -0,0 +1,54 @@
+"""Stands in for hg in test_base_vcs_mercurial.py's command server tests.
+
+Appends each invocation to $HG_LOG.  `serve --cmdserver pipe` speaks the
+command server protocol, unless $FAKE_HG_NO_CMDSERVER is set.
+"""
+import os
+import struct
+import sys
+
+OUTPUT = {
+    'parent': 'abcdef123456',
+    'branch': 'default\n',
+    'branches': 'default 1:abcdef123456\nrelbranch 2:123456abcdef\n',
+}
+
+
+def log(args):
+    fh = open(os.environ['HG_LOG'], 'a')
+    fh.write(' '.join(args) + '\n')
+    fh.close()
+
+
+def write(channel, data):
+    sys.stdout.write(struct.pack('>cI', channel, len(data)) + data)
+    sys.stdout.flush()
+
+
+def cmdserver():
+    write('o', 'capabilities: getencoding runcommand\nencoding: UTF-8')
+    while True:
+        command = sys.stdin.readline()
+        if not command:
+            return
+        length = struct.unpack('>I', sys.stdin.read(4))[0]
+        args = sys.stdin.read(length).split('\0')
+        if args[0] in OUTPUT:
+            write('o', OUTPUT[args[0]])
+            write('r', struct.pack('>i', 0))
+        else:
+            write('e', 'abort: unknown command %s\n' % args[0])
+            write('r', struct.pack('>i', 255))
+
+
+args = [a for a in sys.argv[1:] if a != '--config' and '=' not in a]
+log(args)
+if args[:2] == ['serve', '--cmdserver']:
+    if os.environ.get('FAKE_HG_NO_CMDSERVER'):
+        sys.stderr.write("hg serve: option --cmdserver not recognized\n")
+        sys.exit(255)
+    cmdserver()
+elif args == ['-q', 'version']:
+    print 'Mercurial Distributed SCM (version 3.2.1)'
+elif args[0] in OUTPUT:
+    sys.stdout.write('subprocess ' + OUTPUT[args[0]])
@@ -0,0 +1,11 @@
+"""Stands in for mbsdiff in test_mozilla_mar.py.
+
+`fake_mbsdiff.py FROM TO PATCH` writes a tiny "patch" naming TO's size,
+and appends TO to $MBSDIFF_LOG.
+"""
+import os
+import sys
+
+from_path, to_path, patch_path = sys.argv[1:]
+open(os.environ['MBSDIFF_LOG'], 'a').write(to_path + '\n')
+open(patch_path, 'wb').write('PATCH %d' % os.path.getsize(to_path))
@@ -0,0 +1,24 @@
+"""Stands in for virtualenv in test_base_python.py.
+
+Creates VENV/bin/python and a VENV/bin/pip that appends its arguments to
+$PIP_LOG, and answers `pip freeze`.
+"""
+import os
+import sys
+
+PIP = """#!%(python)s
+import sys
+if sys.argv[1] == 'freeze':
+    print 'fakemodule==1.0'
+else:
+    open(%(log)r, 'a').write(' '.join(sys.argv[1:]) + '\\n')
+"""
+
+venv = sys.argv[-1]
+os.makedirs(os.path.join(venv, 'bin'))
+open(os.path.join(venv, 'bin', 'python'), 'w').close()
+pip = os.path.join(venv, 'bin', 'pip')
+fh = open(pip, 'w')
+fh.write(PIP % {'python': sys.executable, 'log': os.environ['PIP_LOG']})
+fh.close()
+os.chmod(pip, 0755)
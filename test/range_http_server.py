@@ -0,0 +1,140 @@
+"""A local HTTP server for download tests and benchmarks.
+
+Serves files from a directory, honouring single-range Range requests
+and If-None-Match (which SimpleHTTPRequestHandler doesn't), with knobs to throttle each
+connection and to drop connections part way through.
+
+    server = RangeHTTPServer(directory)
+    server.start()
+    url = server.url_for('tests.zip')
+    ...
+    server.stop()
+"""
+
+import BaseHTTPServer
+import os
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    range_regex = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # Clients hang up early on purpose (e.g. after reading headers).
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        server = self.server
+        path = os.path.join(server.directory, self.path.lstrip('/').split('?')[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        server.requests.append((self.command, self.path, self.headers.get('Range')))
+        size = os.path.getsize(path)
+        etag = '"%d-%d"' % (size, int(os.path.getmtime(path)))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        first, last = 0, size - 1
+        status = 200
+        m = self.range_regex.match(self.headers.get('Range', ''))
+        if m and server.accept_ranges:
+            first = int(m.group(1))
+            if first >= size:
+                self.send_error(416)
+                return
+            if m.group(2):
+                last = min(int(m.group(2)), size - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(last - first + 1))
+        self.send_header('ETag', etag)
+        if server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+        self.end_headers()
+        if not send_body:
+            return
+        fh = open(path, 'rb')
+        fh.seek(first)
+        remaining = last - first + 1
+        sent = 0
+        try:
+            while remaining > 0:
+                block = fh.read(min(64 * 1024, remaining))
+                if status == 206 and server.drop_after is not None and \
+                        sent + len(block) > server.drop_after:
+                    server.drop_after = None
+                    self.wfile.write(block[:1024])
+                    return
+                try:
+                    self.wfile.write(block)
+                except socket.error:
+                    return
+                sent += len(block)
+                remaining -= len(block)
+                if server.throttle:
+                    time.sleep(len(block) / float(server.throttle))
+        finally:
+            fh.close()
+
+
+class RangeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, accept_ranges=True, throttle=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RangeRequestHandler)
+        self.directory = directory
+        self.accept_ranges = accept_ranges
+        # bytes per second, per connection
+        self.throttle = throttle
+        # drop the next Range response after this many bytes of body
+        self.drop_after = None
+        self.requests = []
+        self.thread = None
+
+    def url_for(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_file(path, size):
+    """Write size bytes of non-repeating data to path."""
+    fh = open(path, 'wb')
+    block = os.urandom(1024 * 1024)
+    while size > 0:
+        fh.write(block[:size])
+        size -= len(block)
+        block = block[1:] + block[:1]
+    fh.close()
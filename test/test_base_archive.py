@@ -0,0 +1,267 @@
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from StringIO import StringIO
+
+from mozharness.base import archive
+from mozharness.base.errors import ExtractError
+import mozharness.base.script as script
+from range_http_server import RangeHTTPServer
+
+
+def cleanup():
+    for f in ('test_logs', 'test_dir'):
+        if os.path.exists(f):
+            shutil.rmtree(f)
+
+
+def add_member(bundle, name, data, mode=0644):
+    info = zipfile.ZipInfo(name)
+    info.external_attr = mode << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    bundle.writestr(info, data)
+
+
+def make_zip(path):
+    bundle = zipfile.ZipFile(path, 'w')
+    add_member(bundle, 'bin/', '', stat.S_IFDIR | 0755)
+    add_member(bundle, 'bin/xpcshell', 'x' * 100000, 0755)
+    add_member(bundle, 'bin/components/a.js', 'a')
+    add_member(bundle, 'bin/link', 'xpcshell', stat.S_IFLNK | 0777)
+    add_member(bundle, 'mochitest/b.html', 'b' * 5000)
+    add_member(bundle, 'reftest/c.html', 'c')
+    bundle.close()
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.tmpdir, 'tests.zip')
+        make_zip(self.zip_path)
+        self.dest = os.path.join(self.tmpdir, 'tests')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, name):
+        return open(os.path.join(self.dest, name)).read()
+
+    def _files(self):
+        found = []
+        for root, dirs, files in os.walk(self.dest):
+            for name in files:
+                found.append(os.path.relpath(os.path.join(root, name), self.dest))
+        return sorted(found)
+
+    def test_extract_zip(self):
+        names, written = archive.extract_zip(self.zip_path, self.dest)
+        self.assertEqual(written, 5)
+        self.assertEqual(self._read('bin/xpcshell'), 'x' * 100000)
+        self.assertTrue(os.stat(os.path.join(self.dest, 'bin/xpcshell')).st_mode & stat.S_IXUSR)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'bin/link')), 'xpcshell')
+
+    def test_patterns(self):
+        names, written = archive.extract_zip(self.zip_path, self.dest,
+                                             patterns=['bin/*', 'reftest/*'])
+        self.assertEqual(self._files(), ['bin/components/a.js', 'bin/link',
+                                         'bin/xpcshell', 'reftest/c.html'])
+        names, written = archive.extract_zip(self.zip_path, self.dest,
+                                             patterns=['nothing/*'])
+        self.assertEqual((names, written), ([], 0))
+
+    def test_skip_unchanged(self):
+        archive.extract_zip(self.zip_path, self.dest)
+        open(os.path.join(self.dest, 'reftest/c.html'), 'w').write('d')
+        names, written = archive.extract_zip(self.zip_path, self.dest)
+        self.assertEqual(written, 1)
+        self.assertEqual(self._read('reftest/c.html'), 'c')
+
+    def test_outside_dest(self):
+        bundle = zipfile.ZipFile(self.zip_path, 'w')
+        add_member(bundle, '../evil', 'x')
+        bundle.close()
+        self.assertRaises(ExtractError, archive.extract_zip, self.zip_path, self.dest)
+
+    def test_extract_zip_stream(self):
+        stream = StringIO(open(self.zip_path, 'rb').read())
+        names = archive.extract_zip_stream(stream, self.dest, patterns=['bin/*'])
+        self.assertEqual(sorted(names), ['bin/components/a.js', 'bin/link',
+                                         'bin/xpcshell'])
+        archive.apply_zip_modes(self.zip_path, self.dest, patterns=['bin/*'])
+        self.assertEqual(self._read('bin/xpcshell'), 'x' * 100000)
+        self.assertTrue(os.stat(os.path.join(self.dest, 'bin/xpcshell')).st_mode & stat.S_IXUSR)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'bin/link')), 'xpcshell')
+
+    def test_extract_zip_stream_data_descriptor(self):
+        # zip can only use data descriptors for input from a pipe.
+        try:
+            p = subprocess.Popen(['zip', '-q', self.zip_path + '2', '-'],
+                                 stdin=subprocess.PIPE)
+        except OSError:
+            raise unittest.SkipTest("zip isn't installed")
+        p.communicate('streamed ' * 10000)
+        stream = open(self.zip_path + '2', 'rb')
+        self.assertEqual(archive.extract_zip_stream(stream, self.dest), ['-'])
+        stream.close()
+        self.assertEqual(self._read('-'), 'streamed ' * 10000)
+
+    def test_extract_zip_stream_corrupt(self):
+        bundle = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_STORED)
+        bundle.writestr('data.bin', 'abcdefgh' * 100)
+        bundle.close()
+        data = open(self.zip_path, 'rb').read().replace('abcdefgh', 'abcdefgX', 1)
+        self.assertRaises(ExtractError, archive.extract_zip_stream,
+                          StringIO(data), self.dest)
+
+    def test_extract_tarball(self):
+        tar_path = os.path.join(self.tmpdir, 'jsshell.tar.bz2')
+        archive.extract_zip(self.zip_path, os.path.join(self.tmpdir, 'src'))
+        bundle = tarfile.open(tar_path, 'w:bz2')
+        bundle.add(os.path.join(self.tmpdir, 'src'), arcname='.')
+        bundle.close()
+        names = archive.extract_tarball(tar_path, self.dest, patterns=['./mochitest/*'])
+        self.assertEqual(self._files(), ['mochitest/b.html'])
+        names = archive.extract_tarball_stream(open(tar_path, 'rb'), self.dest)
+        self.assertEqual(self._read('reftest/c.html'), 'c')
+
+    def test_tarball_outside_dest(self):
+        outside = os.path.join(self.tmpdir, 'outside')
+        os.mkdir(outside)
+        for names in (['../evil'], ['link', 'link/evil']):
+            tar_path = os.path.join(self.tmpdir, 'evil.tar')
+            bundle = tarfile.open(tar_path, 'w')
+            for name in names:
+                info = tarfile.TarInfo(name)
+                if name == 'link':
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = outside
+                    bundle.addfile(info)
+                else:
+                    info.size = 1
+                    bundle.addfile(info, StringIO('x'))
+            bundle.close()
+            self.assertRaises(ExtractError, archive.extract_tarball, tar_path, self.dest)
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'evil')))
+            self.assertEqual(os.listdir(outside), [])
+
+    def test_rewrite_zip(self):
+        bundle = zipfile.ZipFile(self.zip_path, 'a')
+        bundle.writestr(zipfile.ZipInfo('stored.ja'), 'old')
+        add_member(bundle, 'META-INF/CERT.RSA', 'signature')
+        bundle.close()
+        rewritten = StringIO()
+        counts = archive.rewrite_zip(self.zip_path, rewritten,
+                                     add={'stored.ja': 'new', 'defaults/pref/partner.js': 'pref'},
+                                     remove=['META-INF/*'])
+        self.assertEqual(counts, {'copied': 6, 'added': 1, 'replaced': 1, 'removed': 1})
+        old = zipfile.ZipFile(self.zip_path)
+        new = zipfile.ZipFile(rewritten)
+        self.assertEqual(new.testzip(), None)
+        self.assertEqual(new.namelist(), [
+            'bin/', 'bin/xpcshell', 'bin/components/a.js', 'bin/link',
+            'mochitest/b.html', 'reftest/c.html', 'stored.ja', 'defaults/pref/partner.js'])
+        for name in new.namelist()[:6]:
+            self.assertEqual(new.read(name), old.read(name))
+            # copied as they were, not recompressed
+            self.assertEqual(new.getinfo(name).compress_size, old.getinfo(name).compress_size)
+            self.assertEqual(new.getinfo(name).external_attr, old.getinfo(name).external_attr)
+        self.assertEqual(new.read('stored.ja'), 'new')
+        self.assertEqual(new.getinfo('stored.ja').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(new.read('defaults/pref/partner.js'), 'pref')
+        self.assertEqual(new.getinfo('defaults/pref/partner.js').compress_type,
+                         zipfile.ZIP_DEFLATED)
+
+    def test_rewrite_zip_data_descriptor(self):
+        try:
+            p = subprocess.Popen(['zip', '-q', self.zip_path + '2', '-'],
+                                 stdin=subprocess.PIPE)
+        except OSError:
+            raise unittest.SkipTest("zip isn't installed")
+        p.communicate('streamed ' * 10000)
+        rewritten = StringIO()
+        archive.rewrite_zip(self.zip_path + '2', rewritten, add={'a': 'a'})
+        new = zipfile.ZipFile(rewritten)
+        self.assertEqual(new.testzip(), None)
+        self.assertEqual(new.read('-'), 'streamed ' * 10000)
+        archive.extract_zip_stream(StringIO(rewritten.getvalue()), self.dest)
+        self.assertEqual(self._read('-'), 'streamed ' * 10000)
+
+
+class TestUnpack(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.tmpdir = tempfile.mkdtemp()
+        self.serve_dir = os.path.join(self.tmpdir, 'serve')
+        os.mkdir(self.serve_dir)
+        make_zip(os.path.join(self.serve_dir, 'tests.zip'))
+        self.dest = os.path.join(self.tmpdir, 'tests')
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        del(self.s)
+        cleanup()
+
+    def test_unpack(self):
+        names = self.s.unpack(os.path.join(self.serve_dir, 'tests.zip'),
+                              self.dest, patterns=['mochitest/*'])
+        self.assertEqual(names, ['mochitest/b.html'])
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, 'mochitest/b.html')))
+
+    def test_unpack_unknown(self):
+        path = os.path.join(self.tmpdir, 'notes.txt')
+        open(path, 'w').write('not an archive')
+        self.assertRaises(SystemExit, self.s.unpack, path, self.dest)
+
+    def test_download_unpack(self):
+        server = RangeHTTPServer(self.serve_dir)
+        server.start()
+        try:
+            file_name = self.s.download_unpack(server.url_for('tests.zip'), self.dest,
+                                               parent_dir=self.tmpdir)
+        finally:
+            server.stop()
+        self.assertEqual(file_name, os.path.join(self.tmpdir, 'tests.zip'))
+        self.assertEqual(open(file_name, 'rb').read(),
+                         open(os.path.join(self.serve_dir, 'tests.zip'), 'rb').read())
+        self.assertEqual(open(os.path.join(self.dest, 'bin/xpcshell')).read(), 'x' * 100000)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'bin/link')), 'xpcshell')
+
+    def _download_unpack(self, **kwargs):
+        server = RangeHTTPServer(self.serve_dir)
+        server.start()
+        try:
+            return self.s.download_unpack(server.url_for('tests.zip'), self.dest,
+                                          parent_dir=self.tmpdir,
+                                          retry_config={'attempts': 2, 'sleeptime': 0},
+                                          **kwargs)
+        finally:
+            server.stop()
+
+    def test_download_unpack_truncated(self):
+        # cut off in the central directory, after the last member
+        length = os.path.getsize(os.path.join(self.serve_dir, 'tests.zip')) - 10
+        real_urlopen = self.s._urlopen
+        opened = []
+
+        def truncated_urlopen(url, **kwargs):
+            f = real_urlopen(url, **kwargs)
+            f.read = StringIO(f.read(length)).read
+            opened.append(url)
+            return f
+        self.s._urlopen = truncated_urlopen
+        self.assertEqual(self._download_unpack(), None)
+        self.assertEqual(len(opened), 2)
+
+    def test_download_unpack_bad_hash(self):
+        self.assertEqual(self._download_unpack(expected_hash='0' * 128), None)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'tests.zip')))
+
+
+if __name__ == '__main__':
+    unittest.main()
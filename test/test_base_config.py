@@ -1,4 +1,8 @@
 import os
+import re
+import shutil
+import tempfile
+import time
 import unittest
 
 JSON_TYPE = None
@@ -101,6 +105,49 @@ class TestParseConfigFile(unittest.TestCase):
         self.assertEqual(c._config['keep_string'], "don't change me")
 
 
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, 'cfg.py')
+        self._write_config("{'a': [1, 2], 'b': {'c': 'd'}}")
+
+    def tearDown(self):
+        os.environ.pop('MOZHARNESS_CONFIG_CACHE', None)
+        shutil.rmtree(self.tmpdir)
+
+    def _write_config(self, value, mtime=None):
+        fh = open(self.config_file, 'w')
+        fh.write("import os\nconfig = %s\n" % value)
+        fh.close()
+        if mtime:
+            os.utime(self.config_file, (mtime, mtime))
+
+    def test_fresh_copies(self):
+        c1 = config.parse_config_file(self.config_file)
+        c1['b']['c'] = 'changed'
+        c2 = config.parse_config_file(self.config_file)
+        self.assertEqual(c2, {'a': [1, 2], 'b': {'c': 'd'}})
+
+    def test_file_changed(self):
+        config.parse_config_file(self.config_file)
+        self._write_config("{'a': 'new'}", mtime=time.time() + 10)
+        self.assertEqual(config.parse_config_file(self.config_file), {'a': 'new'})
+
+    def test_disk_snapshot(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.environ['MOZHARNESS_CONFIG_CACHE'] = cache_dir
+        config.parse_config_file(self.config_file)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        config._config_snapshots.clear()
+        self.assertEqual(config.parse_config_file(self.config_file),
+                         {'a': [1, 2], 'b': {'c': 'd'}})
+
+    def test_unmarshallable(self):
+        self._write_config("{'regex': __import__('re').compile('x')}")
+        c = config.parse_config_file(self.config_file)
+        self.assertTrue(c['regex'].match('x'))
+
+
 class TestReadOnlyDict(unittest.TestCase):
     control_dict = {
         'b': '2',
@@ -241,6 +288,48 @@ class TestReadOnlyDict(unittest.TestCase):
         with self.assertRaises(AttributeError):
             r['e'][2]['turtles'].append('turtle2')
 
+    def test_lock_copies_source(self):
+        source = {'a': [1, 2], 'c': {'d': ['4']}}
+        r = config.ReadOnlyDict(source)
+        r.lock()
+        source['a'].append(3)
+        source['c']['d'].append('5')
+        source['c']['e'] = '6'
+        self.assertEqual(r['a'], (1, 2))
+        self.assertEqual(r['c'], {'d': ('4',)})
+
+    def test_lock_shares_equal_values(self):
+        def make_source():
+            return {'a': [1, 2], 'c': {'d': ['4']}, 'r': [re.compile('x')]}
+        source = make_source()
+        r1 = config.ReadOnlyDict(source)
+        r1.lock()
+        r2 = config.ReadOnlyDict(make_source())
+        r2.lock()
+        self.assertTrue(r1['a'] is r2['a'])
+        self.assertTrue(r1['c'] is r2['c'])
+        # not marshallable, so frozen separately
+        self.assertFalse(r1['r'] is r2['r'])
+        self.assertRaises(AssertionError, r2['c'].update, {})
+        source['c']['d'].append('5')
+        self.assertEqual(r1['c'], {'d': ('4',)})
+
+    def test_locked_raw_access_is_frozen(self):
+        r = self.get_locked_ROD()
+        with self.assertRaises(AttributeError):
+            dict(**r)['e'].append('h')
+        with self.assertRaises(AttributeError):
+            dict(r.viewitems())['d']['turtles'].append('turtle2')
+        self.assertRaises(AssertionError, dict(**r)['c'].update, {})
+
+    def test_locked_copy_is_frozen(self):
+        r = self.get_locked_ROD()
+        c = r.copy()
+        c['b'] = 'new'
+        self.assertRaises(AssertionError, c['c'].update, {})
+        with self.assertRaises(AttributeError):
+            dict(r.items())['e'].append('h')
+
     def test_locked_deepcopy_set(self):
         r = self.get_locked_ROD()
         c = deepcopy(r)
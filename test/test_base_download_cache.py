@@ -0,0 +1,124 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import mozharness.base.script as script
+from mozharness.base.download_cache import DownloadCache
+from range_http_server import RangeHTTPServer, make_file
+
+
+def cleanup():
+    for f in ('test_logs', 'test_dir'):
+        if os.path.exists(f):
+            shutil.rmtree(f)
+
+
+class TestDownloadCache(unittest.TestCase):
+    size = 256 * 1024
+
+    def setUp(self):
+        cleanup()
+        self.tmpdir = tempfile.mkdtemp()
+        self.serve_dir = os.path.join(self.tmpdir, 'serve')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.mkdir(self.serve_dir)
+        self.src = os.path.join(self.serve_dir, 'src.bin')
+        make_file(self.src, self.size)
+        self.dest = os.path.join(self.tmpdir, 'dest.bin')
+        self.server = RangeHTTPServer(self.serve_dir)
+        self.server.start()
+        self.url = self.server.url_for('src.bin')
+        self.s = script.BaseScript(initial_config_file='test/test.json',
+                                   config={'download_cache_dir': self.cache_dir})
+
+    def tearDown(self):
+        self.server.stop()
+        for root, dirs, files in os.walk(self.tmpdir):
+            os.chmod(root, 0755)
+        shutil.rmtree(self.tmpdir)
+        del(self.s)
+        cleanup()
+
+    def _download(self, **kwargs):
+        if os.path.exists(self.dest):
+            os.remove(self.dest)
+        return self.s.download_file(self.url, file_name=self.dest,
+                                    retry_config={'sleeptime': 0, 'attempts': 1},
+                                    **kwargs)
+
+    def _gets(self):
+        return [r for r in self.server.requests if r[0] == 'GET']
+
+    def _sha512(self, path):
+        return hashlib.sha512(open(path, 'rb').read()).hexdigest()
+
+    def test_hit(self):
+        self.assertEqual(self._download(), self.dest)
+        self.assertEqual(len(self._gets()), 1)
+        self.assertEqual(self._download(), self.dest)
+        # revalidated with a HEAD, not downloaded again
+        self.assertEqual(len(self._gets()), 1)
+        self.assertEqual(self.server.requests[-1][0], 'HEAD')
+        self.assertEqual(open(self.dest, 'rb').read(), open(self.src, 'rb').read())
+
+    def test_changed(self):
+        self._download()
+        make_file(self.src, self.size + 1)
+        os.utime(self.src, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self._download(), self.dest)
+        self.assertEqual(len(self._gets()), 2)
+        self.assertEqual(open(self.dest, 'rb').read(), open(self.src, 'rb').read())
+
+    def test_expected_hash_needs_no_server(self):
+        sha512 = self._sha512(self.src)
+        self._download(expected_hash=sha512)
+        self.url = 'http://127.0.0.1:1/src.bin'
+        self.assertEqual(self._download(expected_hash=sha512), self.dest)
+        self.assertEqual(self._sha512(self.dest), sha512)
+
+    def test_cached_file_is_a_copy(self):
+        self._download()
+        self._download()
+        blob = self.s.query_download_cache()._blob_path(self._sha512(self.src))
+        self.assertNotEqual(os.stat(self.dest).st_ino, os.stat(blob).st_ino)
+        self.assertTrue(os.stat(self.dest).st_mode & stat.S_IWUSR)
+        open(self.dest, 'ab').write('x')
+        self.assertEqual(self._sha512(blob), self._sha512(self.src))
+
+    def test_read_only_link(self):
+        self._download()
+        os.remove(self.dest)
+        cache = self.s.query_download_cache()
+        cache.fetch(self.url, self.dest, None, read_only=True)
+        blob = cache._blob_path(self._sha512(self.src))
+        self.assertEqual(os.stat(self.dest).st_ino, os.stat(blob).st_ino)
+        self.assertFalse(os.stat(self.dest).st_mode & stat.S_IWUSR)
+
+    def test_bypass(self):
+        self._download()
+        self._download(use_cache=False)
+        self.assertEqual(len(self._gets()), 2)
+
+    def test_evict(self):
+        cache = DownloadCache({'download_cache_dir': self.cache_dir,
+                               'download_cache_max_size': 2 * self.size},
+                              self.s.log_obj)
+        shas = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir, 'file%d' % i)
+            make_file(path, self.size)
+            shas.append(cache.add('http://example.com/%d' % i, path))
+            os.utime(cache._blob_path(shas[-1]), (i, i))
+        self.assertEqual(cache.query_entry('http://example.com/0'), None)
+        self.assertFalse(os.path.exists(cache._blob_path(shas[0])))
+        for i in (1, 2):
+            self.assertEqual(cache.query_entry('http://example.com/%d' % i)['sha512'],
+                             shas[i])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mozharness.base import hashing
+from mozharness.base.hashing import HashCache
+import mozharness.base.script as script
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.reads = []
+        self.real_hash_file = hashing.hash_file
+
+        def counting_hash_file(path, hash_types=hashing.DEFAULT_HASH_TYPES):
+            self.reads.append(path)
+            return self.real_hash_file(path, hash_types)
+        hashing.hash_file = counting_hash_file
+
+    def tearDown(self):
+        hashing.hash_file = self.real_hash_file
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        open(path, 'wb').write(data)
+        return path
+
+    def test_hash_file(self):
+        for data in ('', 'abc', 'x' * (hashing.BLOCK_SIZE * 2 + 1)):
+            result = self.real_hash_file(self._write('f', data))
+            self.assertEqual(result['size'], len(data))
+            for hash_type in hashing.DEFAULT_HASH_TYPES:
+                self.assertEqual(result[hash_type],
+                                 hashlib.new(hash_type, data).hexdigest())
+
+    def test_cache(self):
+        path = self._write('installer', 'one')
+        cache = HashCache(('sha1', 'sha512'))
+        self.assertEqual(cache.query(path)['sha1'], hashlib.sha1('one').hexdigest())
+        self.assertEqual(cache.query(path)['sha512'], hashlib.sha512('one').hexdigest())
+        self.assertEqual(len(self.reads), 1)
+        # not among cache.hash_types
+        self.assertEqual(cache.query(path, ('md5', ))['md5'], hashlib.md5('one').hexdigest())
+        self.assertEqual(len(self.reads), 2)
+        self.assertTrue('md5' in cache.query(path))
+        self.assertEqual(len(self.reads), 2)
+
+    def test_changed_file(self):
+        path = self._write('installer', 'one')
+        cache = HashCache()
+        cache.query(path)
+        os.utime(path, (0, 0))
+        self.assertEqual(cache.query(path)['sha1'], hashlib.sha1('one').hexdigest())
+        self._write('installer', 'two')
+        self.assertEqual(cache.query(path)['sha1'], hashlib.sha1('two').hexdigest())
+        self.assertEqual(len(self.reads), 3)
+
+    def test_hash_files(self):
+        paths = [self._write(str(i), str(i) * 1000) for i in range(6)]
+        cache = HashCache()
+        results = hashing.hash_files(paths, cache=cache, workers=3)
+        self.assertEqual(sorted(results), sorted(paths))
+        for path in paths:
+            self.assertEqual(results[path]['sha512'],
+                             hashlib.sha512(open(path).read()).hexdigest())
+        hashing.hash_files(paths, cache=cache, workers=3)
+        self.assertEqual(len(self.reads), 6)
+
+    def test_script(self):
+        s = script.ScriptMixin()
+        s.config = {'hash_types': ('sha512', )}
+        path = self._write('installer', 'one')
+        self.assertEqual(s.file_hash(path), hashlib.sha512('one').hexdigest())
+        self.assertEqual(s.query_file_hashes(path)['size'], 3)
+        self.assertEqual(s.file_hash(path, 'sha1'), hashlib.sha1('one').hexdigest())
+        self.assertEqual(len(self.reads), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
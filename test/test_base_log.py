@@ -1,8 +1,12 @@
 import os
+import re
 import shutil
+import logging
 import subprocess
+import threading
 import unittest
 
+import mozharness.base.errors as errors
 import mozharness.base.log as log
 
 tmp_dir = "test_log_dir"
@@ -38,5 +42,254 @@ class TestLog(unittest.TestCase):
         self.assertTrue(os.path.exists(get_log_file_path()))
         del(l)
 
+    def _read(self, level=None):
+        fh = open(get_log_file_path(level))
+        try:
+            return [line.split(' - ', 1)[-1].rstrip('\n') for line in fh]
+        finally:
+            fh.close()
+
+    def test_multi_file_logger_fan_out(self):
+        l = log.MultiFileLogger(log_dir=tmp_dir, log_name=log_name,
+                                logger_name='TestFanOut', log_to_console=False)
+        l.log_message('one\ntwo')
+        l.log_message('three', level=log.WARNING)
+        l.log_message(u'caf\xe9', level=log.ERROR)
+        l.flush()
+        self.assertEqual(self._read(log.INFO)[1:],
+                         ['one', 'two', 'three', 'caf\xc3\xa9'])
+        self.assertEqual(self._read(log.WARNING), ['three', 'caf\xc3\xa9'])
+        self.assertEqual(self._read(log.ERROR), ['caf\xc3\xa9'])
+        self.assertEqual(self._read('raw')[1:],
+                         ['one', 'two', 'three', 'caf\xc3\xa9'])
+        del(l)
+
+    def test_close(self):
+        for async_writer in (True, False):
+            l = log.MultiFileLogger(log_dir=tmp_dir, log_name=log_name,
+                                    logger_name='TestClose', log_to_console=False,
+                                    async_writer=async_writer)
+            l.log_message('bye')
+            paths = [os.path.join(l.abs_log_dir, f) for f in l.log_files.values()]
+            l.close()
+            self.assertEqual(logging.getLogger('TestClose').handlers, [])
+            self.assertEqual(self._read(log.INFO)[-1], 'bye')
+            if os.path.isdir('/proc/self/fd'):
+                open_files = set()
+                for fd in os.listdir('/proc/self/fd'):
+                    try:
+                        open_files.add(os.readlink(os.path.join('/proc/self/fd', fd)))
+                    except OSError:
+                        pass
+                self.assertEqual([p for p in paths if p in open_files], [])
+            del(l)
+
+    def test_fatal_flushes(self):
+        l = log.MultiFileLogger(log_dir=tmp_dir, log_name=log_name,
+                                logger_name='TestFanOutFatal', log_to_console=False)
+        self.assertRaises(SystemExit, l.log_message, 'bye', level=log.FATAL)
+        self.assertEqual(self._read(log.FATAL), ['bye', 'Exiting -1'])
+        del(l)
+
+    def test_held_block_spools(self):
+        l = log.SimpleFileLogger(log_dir=tmp_dir, log_name=log_name,
+                                 logger_name='TestBlockSpool', log_to_console=False)
+        first_started = threading.Event()
+        second_done = threading.Event()
+        held = []
+
+        def first():
+            with l.block():
+                l.log_message('first begins')
+                first_started.set()
+                second_done.wait(10)
+                l.log_message('first ends')
+
+        def second():
+            first_started.wait(10)
+            with l.block():
+                for i in range(25):
+                    l.log_message('second %d' % i)
+                held.append(l._local.block)
+                held.append(l._local.block.spool is not None)
+                held.append(len(l._local.block.records))
+            second_done.set()
+
+        old_max = log._LogBlock.max_records
+        log._LogBlock.max_records = 10
+        try:
+            threads = [threading.Thread(target=f) for f in (first, second)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(10)
+        finally:
+            log._LogBlock.max_records = old_max
+        self.assertEqual(held[1:], [True, 5])
+        self.assertEqual(held[0].spool, None)
+        self.assertEqual(self._read()[1:],
+                         ['first begins', 'first ends'] +
+                         ['second %d' % i for i in range(25)])
+
+
+class TestFanOutFileHandler(unittest.TestCase):
+    def setUp(self):
+        clean_log_dir()
+        os.mkdir(tmp_dir)
+        self.handler = log.FanOutFileHandler()
+        self.handler.add_file(get_log_file_path())
+
+    def tearDown(self):
+        self.handler.close_files()
+        clean_log_dir()
+
+    def _record(self, msg):
+        return logging.LogRecord('test', logging.INFO, __file__, 0, msg, None, None)
+
+    def _read(self):
+        return open(get_log_file_path()).read().splitlines()
+
+    def test_sync_drains_without_writer(self):
+        writer = self.handler.writer
+        self.handler.close()
+        writer.join(5)
+        self.assertEqual(self.handler.writer, None)
+        # as if queued just as the writer stopped
+        self.handler.pending.append(self._record('stranded'))
+        self.handler.sync()
+        self.assertEqual(self._read(), ['stranded'])
+
+    def test_records_queued_while_closing(self):
+        # logging.shutdown() closes the handler whenever a logger goes away
+        stop = threading.Event()
+
+        def closer():
+            while not stop.is_set():
+                self.handler.close()
+        t = threading.Thread(target=closer)
+        t.start()
+        try:
+            for i in range(2000):
+                self.handler.handle(self._record(str(i)))
+                if i % 100 == 0:
+                    self.handler.sync()
+                    self.assertEqual(len(self._read()), i + 1)
+        finally:
+            stop.set()
+            t.join()
+        self.handler.sync()
+        self.assertEqual(self._read(), [str(i) for i in range(2000)])
+
+    def test_close_from_garbage_collector(self):
+        """close() run by the garbage collector while this thread holds
+        wakeup's lock mustn't try to take it again."""
+        class Wakeup(object):
+            def __init__(self, handler):
+                self.handler = handler
+                self.event = threading.Event()
+                self.lock = threading.Lock()
+                self.deadlocked = False
+
+            def set(self):
+                if not self.lock.acquire(False):
+                    self.deadlocked = True
+                    return
+                try:
+                    self.event.set()
+                    # as BaseLogger.__del__ would
+                    self.handler.close()
+                finally:
+                    self.lock.release()
+
+            def wait(self, timeout=None):
+                return self.event.wait(timeout)
+
+            def clear(self):
+                self.event.clear()
+
+        handler = log.FanOutFileHandler()
+        handler.wakeup = wakeup = Wakeup(handler)
+        handler.add_file(get_log_file_path('gc'))
+        for i in range(100):
+            handler.handle(self._record(str(i)))
+        handler.close_files()
+        self.assertFalse(wakeup.deadlocked)
+        self.assertEqual(open(get_log_file_path('gc')).read().splitlines(),
+                         [str(i) for i in range(100)])
+
+
+class TestErrorListMatcher(unittest.TestCase):
+    def _walk(self, error_list, line):
+        """The uncompiled reference: first matching entry in list order."""
+        for index, error_check in enumerate(error_list):
+            if 'substr' in error_check:
+                if error_check['substr'] in line:
+                    return index
+            elif 'regex' in error_check:
+                if error_check['regex'].search(line):
+                    return index
+
+    def test_first_match_in_list_order(self):
+        error_list = [
+            {'substr': 'bar', 'level': log.WARNING},
+            {'regex': re.compile('fo+'), 'level': log.ERROR},
+            {'substr': 'foo', 'level': log.CRITICAL},
+        ]
+        matcher = log.ErrorListMatcher(error_list)
+        # The leftmost match in the line is 'foo', but 'bar' comes first
+        # in the list.
+        self.assertEqual(matcher.match('foo bar'), 0)
+        self.assertEqual(matcher.match('foo'), 1)
+        self.assertEqual(matcher.match('baz'), None)
+
+    def test_required_literal(self):
+        required_literal = log.ErrorListMatcher.required_literal
+        self.assertEqual(required_literal(re.compile(r':\d+: error:')), ': error:')
+        self.assertEqual(required_literal(re.compile(r'^abort:')), 'abort:')
+        self.assertEqual(required_literal(re.compile(r'foo|bar')), None)
+        self.assertEqual(required_literal(re.compile(r'abc', re.I)), None)
+
+    def test_invalid_entries(self):
+        error_list = [
+            {'regex': re.compile('(a)\\1'), 'level': log.ERROR},
+            {'level': log.ERROR},
+            {'regex': re.compile('ABC', re.I), 'level': log.ERROR},
+        ]
+        matcher = log.ErrorListMatcher(error_list)
+        self.assertEqual(matcher.invalid, [1])
+        self.assertEqual(matcher.match('xaax'), 0)
+        self.assertEqual(matcher.match('abc'), 2)
+        self.assertEqual(matcher.match('ab'), None)
+
+    def test_matches_errors_module(self):
+        lines = [
+            'make[2]: *** [libs] Error 2',
+            'foo.cpp:12: warning: unused variable',
+            'Traceback (most recent call last):',
+            'abort: repository not found',
+            'Warning: Identity file not found',
+            'raise ValueError: nope',
+            'TEST-PASS | nothing to see here',
+            'Makefile was not found.  Stop.',
+        ]
+        for name in dir(errors):
+            error_list = getattr(errors, name)
+            if not name.endswith('ErrorList') or not isinstance(error_list, list):
+                continue
+            matcher = log.get_error_list_matcher(error_list)
+            for line in lines:
+                self.assertEqual(matcher.match(line),
+                                 self._walk(error_list, line),
+                                 msg="%s: %s" % (name, line))
+
+    def test_output_parser(self):
+        parser = log.OutputParser(config={'log_to_console': False},
+                                  error_list=errors.MakefileErrorList)
+        parser.add_lines(['all good', 'make[1]: *** [foo] Error 1',
+                          'Warning: this is a test'])
+        self.assertEqual(parser.num_errors, 1)
+        self.assertEqual(parser.num_warnings, 1)
+        self.assertEqual(parser.worst_log_level, log.ERROR)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,22 @@
 import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 import mozharness.base.python as python
+from mozharness.base.script import BaseScript
 
 here = os.path.dirname(os.path.abspath(__file__))
 
 
+class VirtualenvScript(python.VirtualenvMixin, BaseScript):
+    def __init__(self, config):
+        super(VirtualenvScript, self).__init__(
+            config=config, all_actions=['create-virtualenv'],
+            initial_config_file='test/test.json')
+
+
 class TestVirtualenvMixin(unittest.TestCase):
     def test_package_versions(self):
         example = os.path.join(here, 'pip-freeze.example.txt')
@@ -33,5 +44,78 @@ class TestVirtualenvMixin(unittest.TestCase):
         self.assertEqual(packages, expected)
 
 
+class TestVirtualenvSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pip_log = os.path.join(self.tmpdir, 'pip.log')
+        os.environ['PIP_LOG'] = self.pip_log
+        self.config = {
+            'virtualenv': [sys.executable,
+                           os.path.join(here, 'helper_files', 'fake_virtualenv.py')],
+            'virtualenv_path': os.path.join(self.tmpdir, 'venv'),
+            'virtualenv_modules': ['mozinfo', 'mozfile'],
+            'virtualenv_snapshot_dir': os.path.join(self.tmpdir, 'snapshots'),
+            'virtualenv_cache_dir': None,
+        }
+        python.VirtualenvMixin.python_paths = {}
+
+    def tearDown(self):
+        del os.environ['PIP_LOG']
+        python.VirtualenvMixin.python_paths = {}
+        shutil.rmtree(self.tmpdir)
+        for d in ('test_logs', 'build'):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+    def _create(self, **config):
+        self.config.update(config)
+        s = VirtualenvScript(self.config)
+        s.register_virtualenv_module('mock')
+        s.create_virtualenv()
+        return s
+
+    def _pip_calls(self):
+        if not os.path.exists(self.pip_log):
+            return []
+        return open(self.pip_log).read().splitlines()
+
+    def test_batched_then_restored(self):
+        self._create()
+        calls = self._pip_calls()
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(calls[0].endswith('mozinfo mozfile mock'))
+        self.assertEqual(len(os.listdir(self.config['virtualenv_snapshot_dir'])), 2)
+
+        shutil.rmtree(self.config['virtualenv_path'])
+        self._create()
+        self.assertEqual(len(self._pip_calls()), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.config['virtualenv_path'],
+                                                    'bin', 'pip')))
+        # an existing, matching virtualenv is used as-is
+        self._create()
+        self.assertEqual(len(self._pip_calls()), 1)
+
+    def test_modules_changed(self):
+        self._create()
+        shutil.rmtree(self.config['virtualenv_path'])
+        self._create(virtualenv_modules=['mozinfo'])
+        self.assertEqual(len(self._pip_calls()), 2)
+        self.assertEqual(len(os.listdir(self.config['virtualenv_snapshot_dir'])), 4)
+
+    def test_local_module_contents_hashed(self):
+        module_dir = os.path.join(self.tmpdir, 'mozlocal')
+        os.mkdir(module_dir)
+        open(os.path.join(module_dir, 'setup.py'), 'w').write('# v1')
+        s = VirtualenvScript(self.config)
+        module_list = [dict(name='mozlocal', url=module_dir, method='pip',
+                            requirements=(), global_options=[], optional=False,
+                            two_pass=False, editable=False)]
+        first = s.query_virtualenv_hash(['virtualenv'], module_list)
+        open(os.path.join(module_dir, 'setup.pyc'), 'w').write('ignored')
+        self.assertEqual(s.query_virtualenv_hash(['virtualenv'], module_list), first)
+        open(os.path.join(module_dir, 'setup.py'), 'w').write('# v2')
+        self.assertNotEqual(s.query_virtualenv_hash(['virtualenv'], module_list), first)
+
+
 if __name__ == '__main__':
     unittest.main()
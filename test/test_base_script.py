@@ -1,7 +1,13 @@
 import gc
 import mock
 import os
+import hashlib
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import types
 import unittest
 PYWIN32 = False
@@ -18,6 +24,7 @@ import mozharness.base.log as log
 from mozharness.base.log import DEBUG, INFO, WARNING, ERROR, CRITICAL, FATAL, IGNORE
 import mozharness.base.script as script
 from mozharness.base.config import parse_config_file
+from range_http_server import RangeHTTPServer, make_file
 
 test_string = '''foo
 bar
@@ -209,6 +216,7 @@ class TestScript(unittest.TestCase):
         self.s.run_command(command="this_cmd_should_not_exist --help",
                            env={'GARBLE': 'FARG'},
                            error_list=errors.PythonErrorList)
+        self.s.log_obj.flush()
         error_logsize = os.path.getsize("test_logs/test_error.log")
         self.assertTrue(error_logsize > 0,
                         msg="command not found error not hit")
@@ -218,6 +226,7 @@ class TestScript(unittest.TestCase):
         self.s.run_command(command="ls",
                            cwd='/this_dir_should_not_exist',
                            error_list=errors.PythonErrorList)
+        self.s.log_obj.flush()
         error_logsize = os.path.getsize("test_logs/test_error.log")
         self.assertTrue(error_logsize > 0,
                         msg="bad dir error not hit")
@@ -225,6 +234,7 @@ class TestScript(unittest.TestCase):
     def test_get_output_from_command_in_bad_dir(self):
         self.s = get_debug_script_obj()
         self.s.get_output_from_command(command="ls", cwd='/this_dir_should_not_exist')
+        self.s.log_obj.flush()
         error_logsize = os.path.getsize("test_logs/test_error.log")
         self.assertTrue(error_logsize > 0,
                         msg="bad dir error not hit")
@@ -232,6 +242,7 @@ class TestScript(unittest.TestCase):
     def test_get_output_from_command_with_missing_file(self):
         self.s = get_debug_script_obj()
         self.s.get_output_from_command(command="ls /this_file_should_not_exist")
+        self.s.log_obj.flush()
         error_logsize = os.path.getsize("test_logs/test_error.log")
         self.assertTrue(error_logsize > 0,
                         msg="bad file error not hit")
@@ -247,6 +258,7 @@ class TestScript(unittest.TestCase):
             }, {
                 'substr': ']$', 'level': WARNING,
             }])
+        self.s.log_obj.flush()
         error_logsize = os.path.getsize("test_logs/test_error.log")
         self.assertTrue(error_logsize > 0,
                         msg="error list not working properly")
@@ -285,6 +297,61 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(test_string, contents,
                          msg="get_output_from_command('cat file') differs from fh.write")
 
+    def test_get_output_from_command_head_tail(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        command = [sys.executable, '-c', 'for i in range(10): print i']
+        self.assertEqual(self.s.get_output_from_command(command, head_lines=2),
+                         '0\n1')
+        self.assertEqual(self.s.get_output_from_command(command, tail_lines=2),
+                         '8\n9')
+        self.assertEqual(self.s.get_output_from_command(command, head_lines=1,
+                                                        tail_lines=1),
+                         '0\n9')
+
+    def test_get_output_from_command_spill(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        command = [sys.executable, '-c',
+                   'import sys; sys.stdout.write("x" * 100000); '
+                   'sys.stderr.write("y" * 100000)']
+        output = self.s.get_output_from_command(command, spill_size=1000,
+                                                silent=True, ignore_errors=True)
+        self.assertEqual(output, 'x' * 100000)
+        self.assertFalse(os.path.exists('tmpfile_stdout'))
+
+    def test_get_output_from_command_tmpfiles(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.get_output_from_command(
+            ["bash", "-c", "cat %s" % self.temp_file], return_type='files',
+            save_tmpfiles=True),
+            ('tmpfile_stdout', 'tmpfile_stderr'))
+        self.assertEqual(open('tmpfile_stdout').read().rstrip(), test_string)
+
+    def test_buffer_iter_lines(self):
+        buf = script.OutputBuffer(spill_size=4)
+        buf.write('a\nbb\n')
+        self.assertEqual(list(buf.iter_lines()), ['a', 'bb'])
+        buf.write('ccc\n')
+        self.assertTrue(buf.spill_file is not None)
+        self.assertEqual(list(buf.iter_lines()), ['a', 'bb', 'ccc'])
+        self.assertEqual(buf.getvalue(), 'a\nbb\nccc\n')
+        buf.close()
+
+    def test_buffer_iter_lines_split_alike(self):
+        data = 'a\r\nb\rc\n\nd\r\r\ne\r'
+        for spill_size in (None, 4):
+            buf = script.OutputBuffer(spill_size=spill_size)
+            buf.write(data)
+            self.assertEqual(list(buf.iter_lines()), data.splitlines())
+            buf.close()
+
+    def test_get_output_from_command_spill_logged(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        command = [sys.executable, '-c',
+                   'import sys; sys.stdout.write("x\\r\\n" * 1000 + "\\n\\n")']
+        self.assertEqual(self.s.get_output_from_command(command, spill_size=100),
+                         '\n'.join(['x'] * 1000))
+
     def test_run_command(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -293,6 +360,27 @@ class TestHelperFunctions(unittest.TestCase):
                                             cwd="test_dir"), 0,
                          msg="run_command('cat file') did not exit 0")
 
+    def test_run_command_output_order(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        parser = log.OutputParser(config=self.s.config, log_obj=None,
+                                  log_output=False)
+        lines = []
+        parser.parse_single_line = lines.append
+        # Enough output to span several reads, with no trailing newline.
+        command = [sys.executable, '-c',
+                   "import sys; sys.stdout.write('\\n'.join(str(i) for i in range(20000)))"]
+        self.assertEqual(self.s.run_command(command, output_parser=parser), 0)
+        self.assertEqual(lines, [str(i) for i in range(20000)])
+
+    def test_output_pump(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, 'a\r\nb\n\nc')
+        os.close(write_fd)
+        fh = os.fdopen(read_fd)
+        batches = list(script.OutputPump(fh, chunk_size=2).batches())
+        fh.close()
+        self.assertEqual(sum(batches, []), ['a\r', 'b', '', 'c'])
+
     def test_move1(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -438,6 +526,7 @@ class TestScriptLogging(unittest.TestCase):
     def test_info_logsize(self):
         self.s = script.BaseScript(config={'log_type': 'multi'},
                                    initial_config_file='test/test.json')
+        self.s.log_obj.flush()
         info_logsize = os.path.getsize("test_logs/test_info.log")
         self.assertTrue(info_logsize > 0,
                         msg="initial info logfile missing/size 0")
@@ -445,8 +534,10 @@ class TestScriptLogging(unittest.TestCase):
     def test_add_summary_info(self):
         self.s = script.BaseScript(config={'log_type': 'multi'},
                                    initial_config_file='test/test.json')
+        self.s.log_obj.flush()
         info_logsize = os.path.getsize("test_logs/test_info.log")
         self.s.add_summary('one')
+        self.s.log_obj.flush()
         info_logsize2 = os.path.getsize("test_logs/test_info.log")
         self.assertTrue(info_logsize < info_logsize2,
                         msg="add_summary() info not logged")
@@ -454,8 +545,10 @@ class TestScriptLogging(unittest.TestCase):
     def test_add_summary_warning(self):
         self.s = script.BaseScript(config={'log_type': 'multi'},
                                    initial_config_file='test/test.json')
+        self.s.log_obj.flush()
         warning_logsize = os.path.getsize("test_logs/test_warning.log")
         self.s.add_summary('two', level=WARNING)
+        self.s.log_obj.flush()
         warning_logsize2 = os.path.getsize("test_logs/test_warning.log")
         self.assertTrue(warning_logsize < warning_logsize2,
                         msg="add_summary(level=%s) not logged in warning log" % WARNING)
@@ -465,9 +558,11 @@ class TestScriptLogging(unittest.TestCase):
                                    initial_config_file='test/test.json')
         self.s.add_summary('one')
         self.s.add_summary('two', level=WARNING)
+        self.s.log_obj.flush()
         info_logsize = os.path.getsize("test_logs/test_info.log")
         warning_logsize = os.path.getsize("test_logs/test_warning.log")
         self.s.summary()
+        self.s.log_obj.flush()
         info_logsize2 = os.path.getsize("test_logs/test_info.log")
         warning_logsize2 = os.path.getsize("test_logs/test_warning.log")
         msg = ""
@@ -493,6 +588,7 @@ class TestScriptLogging(unittest.TestCase):
                     contents = fh.read()
                     fh.close()
                 self.assertEqual(contents.rstrip(), test_string, "_post_fatal failed!")
+        self.s.log_obj.flush()
         del(self.s)
         msg = ""
         for level in log_level_file_list:
@@ -809,6 +905,272 @@ class TestScriptDecorators(unittest.TestCase):
         self.assertEqual(len(self.s.post_run_2_args), 1)
 
 
+class BaseScriptWithCommand(BaseScriptWithDecorators):
+    def build(self):
+        self.run_command([sys.executable, '-c', 'print "hello"'])
+
+
+# TestProfile {{{1
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.s = None
+
+    def tearDown(self):
+        del self.s
+        cleanup()
+
+    def _read_profile(self):
+        dirs = self.s.query_abs_dirs()
+        return parse_config_file(os.path.join(dirs['abs_log_dir'], 'profile.json'))
+
+    def test_profile_written(self):
+        self.s = BaseScriptWithCommand(initial_config_file='test/test.json')
+        self.s.run()
+        events = self._read_profile()['traceEvents']
+        spans = [(e['cat'], e['name']) for e in events]
+        self.assertEqual(spans[0], ('script', '__init__'))
+        for span in (('action', 'clobber'), ('action', 'build'),
+                     ('method', 'build'), ('listener', 'pre_action_1'),
+                     ('listener', 'post_run_1')):
+            self.assertTrue(span in spans, span)
+        command = [e for e in events if e['cat'] == 'command'][0]
+        self.assertEqual(command['args']['return'], 0)
+        self.assertTrue('children_user' in command['args'])
+        build = [e for e in events if e['name'] == 'build' and e['cat'] == 'action'][0]
+        self.assertTrue(build['args']['success'])
+        self.assertTrue(build['ts'] <= command['ts'])
+        self.assertTrue(command['ts'] + command['dur'] <= build['ts'] + build['dur'])
+
+    def test_profile_written_on_failure(self):
+        self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
+        self.s.raise_during_build = 'Testing profile on failure.'
+        with self.assertRaises(SystemExit):
+            self.s.run()
+        events = self._read_profile()['traceEvents']
+        build = [e for e in events if e['name'] == 'build' and e['cat'] == 'action'][0]
+        self.assertFalse(build['args']['success'])
+
+    def test_concurrent_spans(self):
+        profiler = script.Profiler()
+        started = threading.Event()
+        done = threading.Event()
+
+        def other():
+            with profiler.span('other', 'command'):
+                started.set()
+                done.wait()
+        with profiler.span('outer', 'action'):
+            with profiler.span('nested', 'command'):
+                pass
+            thread = threading.Thread(target=other)
+            thread.start()
+            started.wait()
+            with profiler.span('overlapped', 'command'):
+                done.set()
+            thread.join()
+        with profiler.span('after', 'action'):
+            pass
+        concurrent = dict((e['name'], e['args'].get('concurrent', False))
+                          for e in profiler.events)
+        self.assertEqual(concurrent, {'nested': False, 'other': True,
+                                      'overlapped': True, 'outer': True,
+                                      'after': False})
+
+
+class ParallelScript(script.BaseScript):
+    action_dependencies = {
+        'fetch-a': ('setup', ),
+        'fetch-b': ('setup', ),
+    }
+
+    def __init__(self, **kwargs):
+        self.ran = []
+        self.b_started = threading.Event()
+        self.raise_during_fetch_a = False
+        super(ParallelScript, self).__init__(
+            initial_config_file='test/test.json',
+            all_actions=['setup', 'fetch-a', 'fetch-b', 'finish'],
+            **kwargs)
+
+    def setup(self):
+        self.ran.append('setup')
+
+    def fetch_a(self):
+        # only finishes if fetch-b runs at the same time
+        self.b_started.wait(10)
+        for i in range(3):
+            self.info("fetch-a %d" % i)
+        if self.raise_during_fetch_a:
+            raise Exception(self.raise_during_fetch_a)
+        self.ran.append('fetch-a')
+
+    def fetch_b(self):
+        self.info("fetch-b 0")
+        self.b_started.set()
+        self.ran.append('fetch-b')
+
+    def finish(self):
+        self.ran.append('finish')
+
+
+# TestParallelActions {{{1
+class TestParallelActions(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.s = None
+
+    def tearDown(self):
+        del self.s
+        cleanup()
+
+    def test_sequential_by_default(self):
+        self.s = ParallelScript()
+        self.s.b_started.set()
+        self.s.run()
+        self.assertEqual(self.s.ran, ['setup', 'fetch-a', 'fetch-b', 'finish'])
+
+    def test_dependencies(self):
+        self.s = ParallelScript(config={'parallel_actions': 2})
+        self.assertEqual(self.s.query_action_dependencies(), {
+            'setup': set(),
+            'fetch-a': set(['setup']),
+            'fetch-b': set(['setup']),
+            'finish': set(['setup', 'fetch-a', 'fetch-b']),
+        })
+
+    def test_parallel(self):
+        self.s = ParallelScript(config={'parallel_actions': 2})
+        self.s.run()
+        self.assertEqual(self.s.ran, ['setup', 'fetch-b', 'fetch-a', 'finish'])
+        # each action logs in one block
+        log_file = os.path.join(self.s.log_obj.abs_log_dir,
+                                self.s.log_obj.log_files['info'])
+        lines = [l.split(' - ')[-1].strip() for l in open(log_file)]
+        self.assertTrue([l for l in lines if re.match('fetch-. \d', l)] in
+                        (['fetch-a 0', 'fetch-a 1', 'fetch-a 2', 'fetch-b 0'],
+                         ['fetch-b 0', 'fetch-a 0', 'fetch-a 1', 'fetch-a 2']))
+
+    def test_parallel_fail_fast(self):
+        self.s = ParallelScript(config={'parallel_actions': 2})
+        self.s.raise_during_fetch_a = 'Testing fail fast.'
+        self.assertRaises(SystemExit, self.s.run)
+        self.assertEqual(self.s.ran, ['setup', 'fetch-b'])
+
+    def test_run_concurrently(self):
+        self.s = ParallelScript()
+        started = []
+
+        def square(n):
+            started.append(n)
+            if n == 0:
+                # only finishes if 1 runs at the same time
+                self.s.b_started.wait(10)
+            else:
+                self.s.b_started.set()
+            self.s.info("square %d" % n)
+            return n * n
+        self.assertEqual(self.s.run_concurrently(square, range(4), 2), [0, 1, 4, 9])
+        self.assertEqual(sorted(started), range(4))
+
+    def test_run_concurrently_fail_fast(self):
+        one_started = threading.Event()
+        failed = threading.Event()
+        started = []
+
+        def run(n):
+            started.append(n)
+            if n == 0:
+                one_started.wait(10)
+                failed.set()
+                raise ValueError("Testing fail fast.")
+            one_started.set()
+            failed.wait(10)
+            time.sleep(0.1)
+        self.assertRaises(ValueError, script.run_concurrently, run, range(6), 2)
+        self.assertEqual(sorted(started), [0, 1])
+
+
+# TestDownloadFile {{{1
+class TestDownloadFile(unittest.TestCase):
+    size = 3 * 1024 * 1024 + 17
+
+    def setUp(self):
+        cleanup()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src.bin')
+        make_file(self.src, self.size)
+        self.sha512 = hashlib.sha512(open(self.src, 'rb').read()).hexdigest()
+        self.dest = os.path.join(self.tmpdir, 'dest.bin')
+        self.server = RangeHTTPServer(self.tmpdir)
+        self.server.start()
+        self.s = script.BaseScript(initial_config_file='test/test.json',
+                                   config={'download_segments': 4,
+                                           'download_min_segment_size': 512 * 1024})
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+        del(self.s)
+        cleanup()
+
+    def _download(self, **kwargs):
+        return self.s.download_file(self.server.url_for('src.bin'),
+                                    file_name=self.dest,
+                                    retry_config={'sleeptime': 0, 'attempts': 2},
+                                    **kwargs)
+
+    def _range_requests(self):
+        return [r for command, path, r in self.server.requests if r]
+
+    def test_segmented(self):
+        self.assertEqual(self._download(expected_hash=self.sha512), self.dest)
+        self.assertEqual(open(self.dest, 'rb').read(), open(self.src, 'rb').read())
+        # the probe's answer is the first segment, and no GET of the whole
+        # file just for its headers
+        self.assertEqual(sorted(self._range_requests()),
+                         ['bytes=0-524287', 'bytes=1398107-2271925',
+                          'bytes=2271926-3145744', 'bytes=524288-1398106'])
+        self.assertFalse(os.path.exists(self.dest + '.download_state'))
+
+    def test_no_ranges(self):
+        self.server.accept_ranges = False
+        self.assertEqual(self._download(), self.dest)
+        self.assertEqual(open(self.dest, 'rb').read(), open(self.src, 'rb').read())
+        # the probe got the whole file
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_small_file(self):
+        make_file(self.src, 1000)
+        self.assertEqual(self._download(), self.dest)
+        self.assertEqual(open(self.dest, 'rb').read(), open(self.src, 'rb').read())
+        # the probe got the whole file
+        self.assertEqual([r for command, path, r in self.server.requests],
+                         ['bytes=0-524287'])
+
+    def test_empty_file(self):
+        make_file(self.src, 0)
+        self.assertEqual(self._download(), self.dest)
+        self.assertEqual(os.path.getsize(self.dest), 0)
+        # 416 Requested Range Not Satisfiable, then a plain GET
+        self.assertEqual([r for command, path, r in self.server.requests],
+                         ['bytes=0-524287', None])
+
+    def test_resume(self):
+        self.server.drop_after = 100 * 1024
+        self.assertEqual(self._download(expected_hash=self.sha512), self.dest)
+        self.assertEqual(open(self.dest, 'rb').read(), open(self.src, 'rb').read())
+        # the probe's segment and 3 more, then another probe and 1
+        # resumed segment that didn't start from its beginning.
+        ranges = self._range_requests()
+        self.assertEqual(len(ranges), 6)
+        self.assertTrue(ranges[-1] not in ranges[:4])
+
+    def test_bad_hash(self):
+        self.assertEqual(self._download(expected_hash='0' * 128), None)
+        self.assertFalse(os.path.exists(self.dest))
+
+
 # main {{{1
 if __name__ == '__main__':
     unittest.main()
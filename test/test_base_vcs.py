@@ -0,0 +1,116 @@
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mozharness.base.errors import VCSException
+from mozharness.base.vcs import vcsbase
+
+
+def cleanup():
+    for f in ('test_logs', 'test_dir'):
+        if os.path.exists(f):
+            shutil.rmtree(f)
+
+
+class FakeVCS(object):
+    """Checks out nothing; records what it was asked for."""
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+    checkouts = []
+    fail = ()
+
+    def __init__(self, log_obj=None, config=None, vcs_config=None,
+                 script_obj=None):
+        self.vcs_config = vcs_config
+
+    def ensure_repo_and_revision(self):
+        cls = FakeVCS
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+            cls.checkouts.append(self.vcs_config['dest'])
+        time.sleep(0.1)
+        with cls.lock:
+            cls.running -= 1
+        if self.vcs_config['repo'] in cls.fail:
+            raise VCSException("Unable to checkout")
+        return 'rev-%s' % os.path.basename(self.vcs_config['repo'])
+
+
+class TestVCSCheckoutRepos(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        FakeVCS.running = FakeVCS.max_running = 0
+        FakeVCS.checkouts = []
+        FakeVCS.fail = ()
+        self.tmpdir = tempfile.mkdtemp()
+        self.patcher = mock.patch.dict(vcsbase.VCS_DICT, {'fake': FakeVCS})
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+        cleanup()
+
+    def _script(self, **config):
+        config.update({'default_vcs': 'fake', 'global_retries': 1})
+        return vcsbase.VCSScript(initial_config_file='test/test.json',
+                                 config=config)
+
+    def _repos(self, count, host='hg.example.com'):
+        return [{'repo': 'https://%s/l10n/locale%d' % (host, i),
+                 'dest': 'l10n/locale%d' % i} for i in range(count)]
+
+    def test_revision_dict(self):
+        s = self._script()
+        cwd = os.getcwd()
+        revisions = s.vcs_checkout_repos(self._repos(3), parent_dir=self.tmpdir,
+                                         revision='default')
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(revisions['l10n/locale1'], {
+            'repo': 'https://hg.example.com/l10n/locale1',
+            'revision': 'rev-locale1',
+        })
+        self.assertEqual(sorted(FakeVCS.checkouts),
+                         [os.path.join(self.tmpdir, 'l10n', 'locale%d' % i)
+                          for i in range(3)])
+
+    def test_concurrency_limits(self):
+        s = self._script(vcs_checkout_workers=6, vcs_checkout_per_host=2)
+        s.vcs_checkout_repos(self._repos(6), parent_dir=self.tmpdir)
+        self.assertEqual(FakeVCS.max_running, 2)
+
+        FakeVCS.max_running = 0
+        s.vcs_checkout_repos(self._repos(3) + self._repos(3, host='git.example.com'),
+                             parent_dir=self.tmpdir)
+        self.assertEqual(FakeVCS.max_running, 4)
+
+    def test_sequential_by_default(self):
+        s = self._script()
+        s.vcs_checkout_repos(self._repos(3), parent_dir=self.tmpdir)
+        self.assertEqual(FakeVCS.max_running, 1)
+
+    def test_failure(self):
+        FakeVCS.fail = ('https://hg.example.com/l10n/locale0', )
+        s = self._script(vcs_checkout_workers=2, vcs_checkout_per_host=2)
+        self.assertRaises(SystemExit, s.vcs_checkout_repos, self._repos(6),
+                          parent_dir=self.tmpdir)
+        # fail fast: not every repo was attempted
+        self.assertTrue(len(set(FakeVCS.checkouts)) < 6)
+
+    def test_failure_error_level(self):
+        FakeVCS.fail = ('https://hg.example.com/l10n/locale0', )
+        s = self._script()
+        revisions = s.vcs_checkout_repos(self._repos(3), parent_dir=self.tmpdir,
+                                         error_level='error')
+        self.assertEqual(revisions['l10n/locale0']['revision'], -1)
+        self.assertEqual(revisions['l10n/locale2']['revision'], 'rev-locale2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.vcs import gitrefs
+from mozharness.base.vcs.gitrefs import GitRefCache, GitRefResolver
+
+
+def git(*args, **kwargs):
+    cmd = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    return subprocess.check_output(cmd + list(args), **kwargs).strip()
+
+
+class CountingResolver(GitRefResolver):
+    def __init__(self, **kwargs):
+        super(CountingResolver, self).__init__(sleeptime=0, **kwargs)
+        self.calls = []
+
+    def ls_remote(self, remote_url):
+        self.calls.append(remote_url)
+        return super(CountingResolver, self).ls_remote(remote_url)
+
+
+class TestParsing(unittest.TestCase):
+    def test_match_ref(self):
+        refs = gitrefs.parse_ls_remote(
+            "aaa\tHEAD\n"
+            "bbb\trefs/heads/master\n"
+            "ccc\trefs/remotes/origin/master\n"
+            "ddd\trefs/tags/v1\n"
+            "eee\trefs/tags/v1^{}\n")
+        self.assertEqual(gitrefs.match_ref(refs, 'refs/heads/master'), 'bbb')
+        self.assertEqual(gitrefs.match_ref(refs, 'master'), 'bbb')
+        self.assertEqual(gitrefs.match_ref(refs, 'origin/master'), 'ccc')
+        self.assertEqual(gitrefs.match_ref(refs, 'tags/v1'), 'ddd')
+        self.assertEqual(gitrefs.match_ref(refs, 'refs/heads/nope'), None)
+
+    def test_query_host(self):
+        self.assertEqual(gitrefs.query_host('https://git.mozilla.org/b2g/gaia.git'), 'git.mozilla.org')
+        self.assertEqual(gitrefs.query_host('git@github.com:mozilla-b2g/gaia.git'), 'github.com')
+        self.assertEqual(gitrefs.query_host('/builds/git/gaia.git'), 'localhost')
+
+
+class TestGitRefResolver(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.remotes = []
+        self.revisions = []
+        for i in range(2):
+            src = os.path.join(self.tmpdir, 'src%d' % i)
+            git('init', '-q', src)
+            git('symbolic-ref', 'HEAD', 'refs/heads/master', cwd=src)
+            open(os.path.join(src, 'file'), 'w').write('%d\n' % i)
+            git('add', 'file', cwd=src)
+            git('commit', '-q', '-m', 'initial', cwd=src)
+            git('branch', 'v2.0', cwd=src)
+            remote = os.path.join(self.tmpdir, 'remote%d.git' % i)
+            git('clone', '-q', '--bare', src, remote)
+            self.remotes.append(remote)
+            self.revisions.append(git('rev-parse', 'HEAD', cwd=src))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_one_ls_remote_per_remote(self):
+        resolver = CountingResolver()
+        wanted = []
+        for remote in self.remotes:
+            wanted += [(remote, 'refs/heads/master'), (remote, 'refs/heads/v2.0'),
+                       (remote, 'refs/heads/missing')]
+        results = resolver.resolve(wanted)
+        self.assertEqual(sorted(resolver.calls), sorted(self.remotes))
+        for remote, revision in zip(self.remotes, self.revisions):
+            self.assertEqual(results[(remote, 'refs/heads/master')], revision)
+            self.assertEqual(results[(remote, 'refs/heads/v2.0')], revision)
+            self.assertEqual(results[(remote, 'refs/heads/missing')], None)
+        # Later lookups come from the cache, or the refs already listed
+        results = resolver.resolve([(self.remotes[0], 'refs/heads/master'),
+                                    (self.remotes[1], 'missing')])
+        self.assertEqual(results[(self.remotes[0], 'refs/heads/master')], self.revisions[0])
+        self.assertEqual(len(resolver.calls), 2)
+
+    def test_unreachable_remote(self):
+        resolver = CountingResolver(attempts=2)
+        bogus = os.path.join(self.tmpdir, 'nope.git')
+        results = resolver.resolve([(bogus, 'refs/heads/master')])
+        self.assertEqual(results[(bogus, 'refs/heads/master')], None)
+        self.assertEqual(resolver.calls, [bogus])
+
+    def test_cache_ttl(self):
+        path = os.path.join(self.tmpdir, 'git_ref_cache.json')
+        cache = GitRefCache()
+        cache.set('url', 'refs/heads/old', 'a' * 40, timestamp=time.time() - 7200)
+        cache.set('url', 'refs/heads/new', 'b' * 40)
+        open(path, 'w').write(cache.dumps())
+        cache = GitRefCache(ttl=3600)
+        self.assertEqual(cache.load(path), 1)
+        self.assertEqual(cache.get('url', 'refs/heads/old'), None)
+        self.assertEqual(cache.get('url', 'refs/heads/new'), 'b' * 40)
+
+    def test_old_cache_format_expires(self):
+        path = os.path.join(self.tmpdir, 'git_ref_cache.json')
+        open(path, 'w').write(json.dumps({'url:refs/heads/master': 'a' * 40}))
+        cache = GitRefCache(ttl=3600)
+        self.assertEqual(cache.load(path), 1)
+        cache = GitRefCache()
+        cache.load(path)
+        self.assertEqual(cache.get('url', 'refs/heads/master'), 'a' * 40)
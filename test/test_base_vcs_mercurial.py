@@ -1,6 +1,7 @@
 import os
 import platform
 import shutil
+import sys
 import tempfile
 import unittest
 
@@ -543,5 +544,75 @@ class TestHg(unittest.TestCase):
             pass
         self.assertRaises(errors.VCSException, m.apply_and_push, self.wc, self.repodir, c)
 
+
+class TestHgCommandServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        os.makedirs(os.path.join(self.repo, '.hg'))
+        self.hg_log = os.path.join(self.tmpdir, 'hg.log')
+        os.environ['HG_LOG'] = self.hg_log
+        fake_hg = os.path.join(os.path.dirname(__file__), 'helper_files', 'fake_hg.py')
+        self.config = {
+            'exes': {'hg': [sys.executable, fake_hg]},
+            'hg_command_server': True,
+        }
+        self._reset()
+
+    def tearDown(self):
+        self._reset()
+        os.environ.pop('FAKE_HG_NO_CMDSERVER', None)
+        shutil.rmtree(self.tmpdir)
+
+    def _reset(self):
+        mercurial.command_servers.close()
+        mercurial.command_servers.unavailable.clear()
+        mercurial._hg_versions.clear()
+        mercurial._can_share.clear()
+
+    def _invocations(self):
+        if not os.path.exists(self.hg_log):
+            return []
+        return [l.split()[0] for l in open(self.hg_log)]
+
+    def _vcs(self):
+        return mercurial.MercurialVCS(config=self.config)
+
+    def test_command_server(self):
+        m = self._vcs()
+        self.assertEquals(m.get_revision_from_path(self.repo), 'abcdef123456')
+        self.assertEquals(m.get_branch_from_path(self.repo), 'default')
+        self.assertEquals(self._vcs().get_branches_from_path(self.repo),
+                          ['default', 'relbranch'])
+        self.assertEquals(self._invocations(), ['serve'])
+
+    def test_repo_recreated(self):
+        m = self._vcs()
+        m.get_revision_from_path(self.repo)
+        shutil.rmtree(self.repo)
+        os.makedirs(os.path.join(self.repo, '.hg'))
+        m.get_revision_from_path(self.repo)
+        self.assertEquals(self._invocations(), ['serve', 'serve'])
+
+    def test_fallback(self):
+        os.environ['FAKE_HG_NO_CMDSERVER'] = '1'
+        m = self._vcs()
+        self.assertEquals(m.get_revision_from_path(self.repo), 'subprocess abcdef123456')
+        self.assertEquals(m.get_revision_from_path(self.repo), 'subprocess abcdef123456')
+        # no point trying the command server again
+        self.assertEquals(self._invocations(), ['serve', 'parent', 'parent'])
+
+    def test_disabled(self):
+        self.config['hg_command_server'] = False
+        self.assertEquals(self._vcs().get_revision_from_path(self.repo),
+                          'subprocess abcdef123456')
+        self.assertEquals(self._invocations(), ['parent'])
+
+    def test_hg_ver_memoized(self):
+        self.assertEquals(self._vcs().hg_ver(), (3, 2, 1))
+        self.assertEquals(self._vcs().hg_ver(), (3, 2, 1))
+        self.assertEquals(self._invocations(), ['-q'])
+
+
 if __name__ == '__main__':
     unittest.main()
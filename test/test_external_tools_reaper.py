@@ -0,0 +1,133 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'external_tools'))
+import clobberer
+import purge_builds
+import reaper
+
+
+def make_tree(root, size=1000):
+    for name in ('a', 'b/c', 'b/d/e'):
+        path = os.path.join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('x' * size)
+    os.symlink('b', os.path.join(root, 'link'))
+
+
+class TestReaper(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for dirpath, dirnames, filenames in os.walk(self.tmpdir):
+            os.chmod(dirpath, 0700)
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+    def test_schedule_delete(self):
+        for name in ('obj', 'obj.deleteme', 'obj-1.deleteme'):
+            os.mkdir(self._path(name))
+        self.assertEqual(reaper.schedule_delete(self._path('obj')),
+                         self._path('obj-2.deleteme'))
+        self.assertEqual(reaper.schedule_delete(self._path('obj.deleteme')),
+                         self._path('obj.deleteme'))
+        self.assertEqual(reaper.find_pending([self.tmpdir, self._path('missing')]),
+                         [self._path('obj-1.deleteme'), self._path('obj-2.deleteme'),
+                          self._path('obj.deleteme')])
+
+    def test_delete_tree(self):
+        make_tree(self._path('obj'))
+        make_tree(self._path('obj', 'b', 'nested'))
+        os.chmod(self._path('obj', 'b', 'd'), 0500)
+        reaper.delete_tree(self._path('obj'), workers=4)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_reap_skips_locked_trees(self):
+        make_tree(self._path('a.deleteme'))
+        make_tree(self._path('b.deleteme'))
+        fd = reaper._lock_tree(self._path('a.deleteme'))
+        try:
+            self.assertEqual(reaper.reap(reaper.find_pending([self.tmpdir])), 0)
+            self.assertEqual(os.listdir(self.tmpdir), ['a.deleteme'])
+        finally:
+            os.close(fd)
+
+    def test_background_reaper(self):
+        make_tree(self._path('obj'))
+        make_tree(self._path('leftover.deleteme'))
+        tree = reaper.schedule_delete(self._path('obj'))
+        self.assertEqual(reaper.start_reaper([tree], [self.tmpdir], workers=2).wait(), 0)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_do_clobber(self):
+        make_tree(self._path('build'))
+        make_tree(self._path('build', 'old.deleteme'))
+        open(self._path('build', 'last-clobber'), 'w').write('1')
+        clobberer.do_clobber(self._path('build'), skip=['last-clobber'],
+                             background=False)
+        self.assertEqual(os.listdir(self._path('build')), ['last-clobber'])
+
+
+class TestPurgeAccounting(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.real_freespace = purge_builds.freespace
+        # nothing is deleted until the reaper runs
+        purge_builds.freespace = lambda p: 10 * 1024 ** 2
+
+    def tearDown(self):
+        purge_builds.freespace = self.real_freespace
+        shutil.rmtree(self.tmpdir)
+
+    def test_pending_deletes_count_as_free(self):
+        now = time.time()
+        for i, name in enumerate(['oldest', 'older', 'newer', 'newest']):
+            make_tree(os.path.join(self.tmpdir, name), size=300 * 1024)
+            os.utime(os.path.join(self.tmpdir, name), (now + i, now + i))
+        make_tree(os.path.join(self.tmpdir, 'leftover.deleteme'), size=300 * 1024)
+        pending = purge_builds.PendingDeletes(self.tmpdir)
+        # leftover.deleteme and two of the others free enough
+        gigs = (10 * 1024 ** 2 + 2.5 * 900 * 1024) / 1024.0 ** 3
+        purge_builds.purge([self.tmpdir], gigs, [], None, pending=pending)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['leftover.deleteme', 'newer', 'newest',
+                          'older.deleteme', 'oldest.deleteme'])
+        self.assertTrue(pending.freespace() >= gigs * 1024 ** 3)
+        pending.delete(background=False)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['newer', 'newest'])
+
+    def test_trees_measured_only_when_needed(self):
+        measured = []
+        real_tree_size = purge_builds.tree_size
+
+        def counting_tree_size(path):
+            measured.append(os.path.basename(path))
+            return real_tree_size(path)
+        purge_builds.tree_size = counting_tree_size
+        try:
+            now = time.time()
+            for name, mtime in (('old', now - 100), ('new', now + 100)):
+                make_tree(os.path.join(self.tmpdir, name), size=300 * 1024)
+                os.utime(os.path.join(self.tmpdir, name), (mtime, mtime))
+            # enough is free already; 'old' goes for its age alone
+            pending = purge_builds.purge([self.tmpdir], 0.001, [], now)
+            self.assertEqual(pending.trees, [os.path.join(self.tmpdir, 'old.deleteme')])
+            self.assertEqual(measured, [])
+            self.assertTrue(pending.freespace() > 10 * 1024 ** 2)
+            self.assertEqual(measured, ['old.deleteme'])
+            pending.delete(background=False)
+        finally:
+            purge_builds.tree_size = real_tree_size
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
 import gc
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 
@@ -57,6 +61,65 @@ class TestBuildbotStatus(unittest.TestCase):
         self.s.buildbot_status(TBPL_SUCCESS)
         self.assertEqual(self.s.return_code, EXIT_STATUS_DICT[TBPL_SUCCESS])
 
+class PropertyScript(BuildbotMixin, script.BaseScript):
+    def __init__(self, **kwargs):
+        self.seen = {}
+        super(PropertyScript, self).__init__(
+            initial_config_file='test/test.json',
+            all_actions=['set-props', 'set-more-props'],
+            **kwargs)
+        self.buildbot_properties = {}
+
+    def _props_dir(self):
+        return os.path.join(self.config['base_work_dir'], 'properties')
+
+    def set_props(self):
+        self.set_buildbot_property('appName', 'Firefox', write_to_file=True)
+        self.set_buildbot_property('packageSize', 1234, write_to_file=True)
+        self.set_buildbot_property('not_written', 'x')
+        self.seen['set-props'] = os.path.exists(self._props_dir())
+
+    def set_more_props(self):
+        self.set_buildbot_property('appName', 'Fennec', write_to_file=True)
+        self.seen['set-more-props'] = sorted(os.listdir(self._props_dir()))
+
+
+# TestBuildbotProperties {{{1
+class TestBuildbotProperties(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.tmpdir = tempfile.mkdtemp()
+        self.s = PropertyScript(config={'base_work_dir': self.tmpdir})
+
+    def tearDown(self):
+        del(self.s)
+        shutil.rmtree(self.tmpdir)
+        cleanup()
+
+    def _read(self, name):
+        return open(os.path.join(self.tmpdir, name)).read()
+
+    def test_written_once_per_action(self):
+        self.s.run()
+        # nothing is written while the action runs
+        self.assertEqual(self.s.seen['set-props'], False)
+        self.assertEqual(self.s.seen['set-more-props'], ['appName', 'packageSize'])
+        self.assertEqual(self._read('properties/appName'), 'appName:Fennec\n')
+        self.assertEqual(self._read('properties/packageSize'), 'packageSize:1234\n')
+        self.assertEqual(json.loads(self._read('buildbot_properties.json')),
+                         {'appName': 'Fennec', 'packageSize': 1234})
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     'buildbot_properties.json.tmp')))
+
+    def test_written_at_once_outside_actions(self):
+        self.assertEqual(self.s.set_buildbot_property('buildid', '20150101', write_to_file=True),
+                         '20150101')
+        self.assertEqual(self._read('properties/buildid'), 'buildid:20150101\n')
+        self.assertEqual(json.loads(self._read('buildbot_properties.json')),
+                         {'buildid': '20150101'})
+        self.assertEqual(self.s.flush_buildbot_properties(), [])
+
+
 # main {{{1
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mozharness.mozilla import mapfile
+from mozharness.mozilla.mapfile import MapfileStore
+
+
+def sha(*args):
+    return hashlib.sha1(repr(args)).hexdigest()
+
+
+def mapping(i, kind='git'):
+    return "%s %s\n" % (sha(kind, i), sha('hg', i))
+
+
+class TestMapfileStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mapfile = os.path.join(self.tmpdir, 'git-mapfile')
+        self.store_dir = os.path.join(self.tmpdir, 'store')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def open_store(self):
+        store = MapfileStore(self.store_dir)
+        self.stores.append(store)
+        return store
+
+    def append(self, lines, path=None):
+        fh = open(path or self.mapfile, 'a')
+        fh.writelines(lines)
+        fh.close()
+
+    def test_lookups(self):
+        self.append([mapping(i) for i in range(100)])
+        store = self.open_store()
+        self.assertEqual(store.merge(self.mapfile), 100)
+        for i in range(100):
+            self.assertEqual(store.query_git_revision(sha('hg', i)), sha('git', i))
+            self.assertEqual(store.query_hg_revision(sha('git', i)), sha('hg', i))
+        self.assertEqual(store.query_git_revision(sha('hg', 5)[:12]), sha('git', 5))
+        self.assertEqual(store.query_git_revision(sha('hg', 5).upper()), sha('git', 5))
+        self.assertEqual(store.query_git_revision(sha('nope')), None)
+        self.assertEqual(store.query_git_revision('not a sha'), None)
+
+    def test_incremental_merge(self):
+        self.append([mapping(i) for i in range(10)])
+        self.assertEqual(self.open_store().merge(self.mapfile), 10)
+        # half a line hasn't been written yet
+        self.append([mapping(i) for i in range(10, 20)] + [mapping(20)[:30]])
+        store = self.open_store()
+        self.assertEqual(store.merge(self.mapfile), 10)
+        self.assertEqual(store.merge(self.mapfile), 0)
+        self.append([mapping(20)[30:]])
+        self.assertEqual(store.merge(self.mapfile), 1)
+        self.assertEqual(len(store), 21)
+        self.assertEqual(store.query_git_revision(sha('hg', 20)), sha('git', 20))
+
+    def test_rewritten_mapfile(self):
+        self.append([mapping(i) for i in range(10)])
+        store = self.open_store()
+        store.merge(self.mapfile)
+        os.remove(self.mapfile)
+        # a different hg-git conversion; the first mapping for an hg sha wins
+        self.append([mapping(i, kind='other') for i in range(15)])
+        self.assertEqual(store.merge(self.mapfile), 5)
+        self.assertEqual(store.query_git_revision(sha('hg', 1)), sha('git', 1))
+        self.assertEqual(store.query_git_revision(sha('hg', 12)), sha('other', 12))
+
+    def test_clear(self):
+        other = os.path.join(self.tmpdir, 'l10n-mapfile')
+        self.append([mapping(i) for i in range(10)])
+        self.append([mapping(i, kind='other') for i in range(10, 20)], path=other)
+        store = self.open_store()
+        store.merge(self.mapfile)
+        store.merge(other)
+        self.assertEqual(store.query_sources(), sorted([self.mapfile, other]))
+        self.assertEqual(store.query_merged_offset(other), os.path.getsize(other))
+        os.remove(self.mapfile)
+        self.append([mapping(i, kind='other') for i in range(5)])
+        self.assertEqual(store.query_merged_offset(self.mapfile), None)
+        store.clear()
+        self.assertEqual(store.query_sources(), [])
+        self.assertEqual(store.merge(self.mapfile), 5)
+        self.assertEqual(len(self.open_store()), 5)
+        self.assertEqual(store.query_git_revision(sha('hg', 1)), sha('other', 1))
+        self.assertEqual(store.query_git_revision(sha('hg', 12)), None)
+
+    def test_compaction(self):
+        store = self.open_store()
+        for i in range(mapfile.MAX_SEGMENTS + 1):
+            self.append([mapping(i)])
+            store.merge(self.mapfile)
+        self.assertEqual(len(store.state['segments']), 1)
+        self.assertEqual(len(os.listdir(self.store_dir)), 4)
+        for i in range(mapfile.MAX_SEGMENTS + 1):
+            self.assertEqual(store.query_hg_revision(sha('git', i)), sha('hg', i))
+
+    def test_write_mapfile_matches_sort(self):
+        other = os.path.join(self.tmpdir, 'l10n-mapfile')
+        self.append([mapping(i) for i in range(50)])
+        self.append([mapping(i, kind='other') for i in range(40, 80)], path=other)
+        store = self.open_store()
+        store.merge(self.mapfile)
+        store.merge(other)
+        combined = os.path.join(self.tmpdir, 'combined')
+        store.write_mapfile(combined)
+        expected = subprocess.Popen(
+            ['sort', '--unique', '-t', ' ', '--key=2', self.mapfile, other],
+            stdout=subprocess.PIPE, env=dict(os.environ, LC_ALL='C'),
+        ).communicate()[0]
+        self.assertEqual(open(combined).read(), expected)
+
+    def test_delta(self):
+        self.append([mapping(i) for i in range(5)])
+        store = self.open_store()
+        store.merge(self.mapfile)
+        lines, end = store.query_delta('mapper')
+        self.assertEqual(list(lines), [mapping(i) for i in range(5)])
+        store.mark_consumed('mapper', end)
+        self.append([mapping(i) for i in range(5, 8)])
+        store.merge(self.mapfile)
+        # a consumer only sees what was there when it asked
+        lines, end = store.query_delta('mapper')
+        self.append([mapping(8)])
+        store.merge(self.mapfile)
+        self.assertEqual(list(lines), [mapping(i) for i in range(5, 8)])
+        store.mark_consumed('mapper', end)
+        lines, end = self.open_store().query_delta('mapper')
+        self.assertEqual(list(lines), [mapping(8)])
+        lines, end = store.query_delta('git-notes')
+        self.assertEqual(len(list(lines)), 9)
+
+    def test_unsaved_merge_is_dropped(self):
+        self.append([mapping(i) for i in range(5)])
+        store = self.open_store()
+        store.merge(self.mapfile)
+        # as though a merge died before saving the state
+        self.append([mapping(99)], path=store.log_path)
+        lines, end = self.open_store().query_delta('mapper')
+        self.assertEqual(len(list(lines)), 5)
+        self.assertEqual(os.path.getsize(store.log_path), end)
@@ -0,0 +1,259 @@
+import bz2
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+from mozharness.base.errors import MarError
+from mozharness.mozilla import mar
+from mozharness.mozilla.marfile import MarReader, MarWriter
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_file(path, data, mode=0644):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    open(path, 'wb').write(data)
+    os.chmod(path, mode)
+
+
+def make_tree(root, files):
+    for name, data in files.items():
+        write_file(os.path.join(root, name), data)
+
+
+def make_complete_mar(path, root):
+    """A complete mar of the tree root, bzip2ing every member."""
+    with MarWriter(path, product_info=('firefox-test', '37.0a1')) as m:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in sorted(filenames):
+                full = os.path.join(dirpath, filename)
+                m.add(os.path.relpath(full, root), full, compress=True)
+
+
+class TestMarFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mar_path = os.path.join(self.tmpdir, 'test.mar')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        src = os.path.join(self.tmpdir, 'firefox')
+        write_file(src, 'x' * 3000000, 0755)
+        with MarWriter(self.mar_path, product_info=('firefox-test', '37.0a1')) as m:
+            m.add('firefox', src, compress=True)
+            m.add_data('defaults/pref/channel-prefs.js', 'pref("a", 1);\n')
+        with MarReader(self.mar_path) as m:
+            self.assertEqual([(x.name, x.flags) for x in m.members],
+                             [('firefox', 0755),
+                              ('defaults/pref/channel-prefs.js', 0644)])
+            self.assertEqual(m.query_product_info(), ('firefox-test', '37.0a1'))
+            self.assertEqual(m.file_size, os.path.getsize(self.mar_path))
+            self.assertEqual(m.signatures, [])
+            self.assertEqual(bz2.decompress(m.read(m.members[0])), 'x' * 3000000)
+            dest = os.path.join(self.tmpdir, 'unpacked')
+            m.extract_all(dest, decompress=False)
+            self.assertEqual(open(os.path.join(dest, 'firefox')).read(),
+                             bz2.compress('x' * 3000000))
+            m.extract(m.members[0], dest, decompress=True)
+        self.assertEqual(open(os.path.join(dest, 'firefox')).read(), 'x' * 3000000)
+        self.assertEqual(os.stat(os.path.join(dest, 'firefox')).st_mode & 0777, 0755)
+
+    def test_old_style(self):
+        """No signature block: data starts right after the header."""
+        data = 'hello'
+        index = struct.pack('>III', 8, len(data), 0644) + 'a/b.txt\0'
+        fh = open(self.mar_path, 'wb')
+        fh.write('MAR1' + struct.pack('>I', 8 + len(data)) + data +
+                 struct.pack('>I', len(index)) + index)
+        fh.close()
+        with MarReader(self.mar_path) as m:
+            self.assertEqual(m.file_size, None)
+            self.assertEqual(m.query_product_info(), None)
+            self.assertEqual(m.read(m.members[0]), 'hello')
+
+    def test_errors(self):
+        open(self.mar_path, 'wb').write('PK\x03\x04 not a mar')
+        self.assertRaises(MarError, MarReader, self.mar_path)
+        with MarWriter(self.mar_path) as m:
+            m.add_data('../evil', bz2.compress('x'))
+        with MarReader(self.mar_path) as m:
+            self.assertRaises(Exception, m.extract_all,
+                              os.path.join(self.tmpdir, 'dest'), True)
+
+    def test_writer_removes_file_on_error(self):
+        try:
+            with MarWriter(self.mar_path) as m:
+                m.add_data('a', 'a')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(os.path.exists(self.mar_path))
+
+
+class TestUnpackedMarCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unpack_once(self):
+        src = os.path.join(self.tmpdir, 'src')
+        make_tree(src, {'application.ini': '[App]\nBuildID=20141201030201\n',
+                        'browser/omni.ja': 'omni' * 1000})
+        mar_path = os.path.join(self.tmpdir, 'en-US.mar')
+        make_complete_mar(mar_path, src)
+        copy = os.path.join(self.tmpdir, 'copy.mar')
+        shutil.copyfile(mar_path, copy)
+        cache = mar.UnpackedMarCache(os.path.join(self.tmpdir, 'cache'))
+        path = cache.unpack(mar_path)
+        self.assertEqual(mar.buildid_from_ini(os.path.join(path, 'application.ini')),
+                         '20141201030201')
+        self.assertEqual(open(os.path.join(path, 'browser', 'omni.ja')).read(),
+                         'omni' * 1000)
+        # same contents, same tree; nothing else left in the cache
+        self.assertEqual(cache.unpack(copy), path)
+        self.assertEqual(os.listdir(cache.cache_dir), [os.path.basename(path)])
+
+    def test_evict(self):
+        mars = []
+        for i in range(3):
+            src = os.path.join(self.tmpdir, 'src%d' % i)
+            make_tree(src, {'omni.ja': str(i) * 1000})
+            mars.append(os.path.join(self.tmpdir, '%d.mar' % i))
+            make_complete_mar(mars[-1], src)
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        old = mar.UnpackedMarCache(cache_dir)
+        paths = [old.unpack(m) for m in mars[:2]]
+        os.utime(paths[0], (0, 0))
+        # a later run: nothing of the old one's is in use
+        cache = mar.UnpackedMarCache(cache_dir, max_size=2500)
+        self.assertEqual(cache.unpack(mars[1]), paths[1])
+        path = cache.unpack(mars[2])
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         sorted(os.path.basename(p) for p in (paths[1], path)))
+        # both in use, so over the limit rather than removing either
+        cache.max_size = 1000
+        cache.unpack(mars[0])
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+
+class TestGeneratePartial(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'mbsdiff.log')
+        os.environ['MBSDIFF_LOG'] = self.log
+        self.mbsdiff = os.path.join(self.tmpdir, 'mbsdiff')
+        write_file(self.mbsdiff, '#!%s\n%s' % (
+            sys.executable,
+            open(os.path.join(here, 'helper_files', 'fake_mbsdiff.py')).read()),
+            0755)
+
+    def tearDown(self):
+        del os.environ['MBSDIFF_LOG']
+        shutil.rmtree(self.tmpdir)
+
+    def test_partial(self):
+        from_dir = os.path.join(self.tmpdir, 'from')
+        to_dir = os.path.join(self.tmpdir, 'to')
+        make_tree(from_dir, {
+            'same.txt': 'same',
+            'big.bin': 'a' * 100000,
+            'small.txt': 'a',
+            'gone.txt': 'gone',
+            'updatev2.manifest': 'old manifest',
+            'default.pgc': 'pgc',
+        })
+        make_tree(to_dir, {
+            'same.txt': 'same',
+            'big.bin': os.urandom(100000),
+            'small.txt': 'b',
+            'new/file.txt': 'new',
+            'removed-files': 'old/dir/*\nold/empty/\nold.txt\n',
+            'default.pgc': 'other pgc',
+        })
+        partial = os.path.join(self.tmpdir, 'partial.mar')
+        counts = mar.generate_partial(from_dir, to_dir, partial, self.mbsdiff,
+                                      product_info=('firefox-test', '37.0a1'),
+                                      ignore=('*.pgc', ), workers=2)
+        self.assertEqual(counts, {'patch': 1, 'add': 3, 'remove': 1,
+                                  'unchanged': 1})
+        # only files that changed were diffed
+        self.assertEqual(sorted(open(self.log).read().split()),
+                         [os.path.join(to_dir, 'big.bin'),
+                          os.path.join(to_dir, 'small.txt')])
+        with MarReader(partial) as m:
+            members = dict((x.name, x) for x in m.members)
+            self.assertEqual(sorted(members), [
+                'big.bin.patch', 'new/file.txt', 'removed-files',
+                'small.txt', 'update.manifest', 'updatev2.manifest'])
+            self.assertEqual(m.read(members['updatev2.manifest'], decompress=True), '\n'.join([
+                'type "partial"',
+                'patch "big.bin.patch" "big.bin"',
+                'add "new/file.txt"',
+                'add "removed-files"',
+                'add "small.txt"',
+                'remove "gone.txt"',
+                'rmrfdir "old/dir/"',
+                'rmdir "old/empty/"',
+                'remove "old.txt"',
+            ]) + '\n')
+            self.assertTrue('rmdir' not in m.read(members['update.manifest'],
+                                                  decompress=True))
+            self.assertEqual(m.read(members['big.bin.patch'], decompress=True),
+                             'PATCH 100000')
+            self.assertEqual(m.read(members['small.txt'], decompress=True), 'b')
+            self.assertEqual(m.query_product_info(), ('firefox-test', '37.0a1'))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['from', 'mbsdiff', 'mbsdiff.log', 'partial.mar', 'to'])
+
+    def test_manifest(self):
+        from_dir = os.path.join(self.tmpdir, 'from')
+        to_dir = os.path.join(self.tmpdir, 'to')
+        ext = 'distribution/extensions/langpack@firefox.mozilla.org'
+        make_tree(from_dir, {
+            'precomplete': 'remove "a"\n',
+            'firefox.chk': 'chk',
+            ext + '/chrome.manifest': 'x' * 100000,
+            ext + '/install.rdf': 'rdf',
+            'extensions/old@mozilla.org/a.js': 'a',
+        })
+        make_tree(to_dir, {
+            'precomplete': 'remove "a"\n',
+            'firefox.chk': 'chk',
+            ext + '/chrome.manifest': os.urandom(100000),
+            ext + '/install.rdf': 'rdf',
+            ext + '/new.js': 'new',
+            'extensions/old@mozilla.org/a.js': 'b',
+        })
+        partial = os.path.join(self.tmpdir, 'partial.mar')
+        counts = mar.generate_partial(from_dir, to_dir, partial, self.mbsdiff)
+        self.assertEqual(counts, {'patch': 1, 'add': 4, 'remove': 0,
+                                  'unchanged': 1})
+        manifest = [
+            'patch-if "%s" "%s/chrome.manifest.patch" "%s/chrome.manifest"' %
+            (ext, ext, ext),
+            'add-if "%s" "%s/new.js"' % (ext, ext),
+            'add-if "extensions/old@mozilla.org" "extensions/old@mozilla.org/a.js"',
+            'add "firefox.chk"',
+            'add "precomplete"',
+        ]
+        with MarReader(partial) as m:
+            members = dict((x.name, x) for x in m.members)
+            self.assertEqual(m.read(members['updatev2.manifest'], decompress=True),
+                             '\n'.join(['type "partial"'] + manifest) + '\n')
+            self.assertEqual(m.read(members['update.manifest'], decompress=True),
+                             '\n'.join(manifest) + '\n')
+            self.assertEqual(m.read(members['precomplete'], decompress=True),
+                             'remove "a"\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
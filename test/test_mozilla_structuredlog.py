@@ -0,0 +1,93 @@
+import os
+import unittest
+
+try:
+    import mozlog.structured
+    assert mozlog.structured
+    MOZLOG = True
+except ImportError:
+    MOZLOG = False
+
+from mozharness.base.log import CRITICAL, INFO, WARNING
+from mozharness.mozilla.buildbot import TBPL_FAILURE, TBPL_WARNING
+from mozharness.mozilla.structuredlog import StructuredOutputParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_log(name):
+    fh = open(os.path.join(here, 'helper_files', name))
+    try:
+        return fh.readlines()
+    finally:
+        fh.close()
+
+
+class RecordingParser(StructuredOutputParser):
+    def __init__(self, log_level=INFO, **kwargs):
+        super(RecordingParser, self).__init__(config={'log_level': log_level},
+                                              **kwargs)
+        self.messages = []
+        self.formatted = 0
+        formatter = self.formatter
+
+        def counting_formatter(data):
+            self.formatted += 1
+            return formatter(data)
+        self.formatter = counting_formatter
+
+    def log(self, message, level=INFO, exit_code=-1):
+        self.messages.append((level, message))
+
+
+@unittest.skipUnless(MOZLOG, "needs mozlog")
+class TestStructuredOutputParser(unittest.TestCase):
+    def test_add_lines_matches_single_lines(self):
+        for name in ('structured_log_wpt.log', 'structured_log_mochitest.log'):
+            lines = read_log(name)
+            batched = RecordingParser(strict=False)
+            batched.add_lines(lines)
+            single = RecordingParser(strict=False)
+            for line in lines:
+                single.parse_single_line(line.decode('utf-8').rstrip())
+            self.assertEqual(batched.messages, single.messages)
+            self.assertEqual(batched.handler.summarize(), single.handler.summarize())
+            self.assertEqual(batched.evaluate_parser(0), single.evaluate_parser(0))
+
+    def test_wpt_log(self):
+        parser = RecordingParser()
+        parser.add_lines(read_log('structured_log_wpt.log'))
+        summary = parser.handler.summarize()
+        self.assertEqual(summary.unexpected_statuses, {'FAIL': 1, 'TIMEOUT': 1})
+        self.assertEqual(summary.action_counts['test_status'], 30)
+        self.assertTrue((INFO, 'TEST-START | /dom/nodes/Node-cloneNode.html\n')
+                        in parser.messages)
+        self.assertEqual(parser.evaluate_parser(0), (TBPL_WARNING, WARNING))
+
+    def test_strict(self):
+        parser = RecordingParser()
+        parser.add_lines(['{"action": "no_such_action"}\n', '{not json\n', '\n'])
+        self.assertEqual([level for level, message in parser.messages],
+                         [CRITICAL, CRITICAL])
+        self.assertEqual(parser.tbpl_status, TBPL_FAILURE)
+        self.assertEqual(parser.handler.summarize().action_counts, {})
+
+    def test_invalid_utf8_is_unstructured(self):
+        parser = RecordingParser(strict=False)
+        parser.add_lines('{"action": "log", "level": "INFO", "message": "\xff"}\n')
+        self.assertEqual(parser.messages,
+                         [(INFO, u' {"action": "log", "level": "INFO", "message": "\ufffd"}')])
+
+    def test_skips_formatting_below_log_level(self):
+        lines = read_log('structured_log_wpt.log')
+        parser = RecordingParser(log_level=WARNING)
+        parser.add_lines(lines)
+        # only the WARNING log message is formatted
+        self.assertEqual(parser.formatted, 1)
+        self.assertEqual(parser.messages, [(WARNING, 'Got 1 unexpected results\n')])
+        self.assertEqual(parser.handler.summarize().action_counts['test_end'], 5)
+        self.assertEqual(parser.evaluate_parser(0), (TBPL_WARNING, WARNING))
+
+
+if __name__ == '__main__':
+    unittest.main()
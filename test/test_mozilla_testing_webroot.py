@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mozharness.mozilla.testing import webroot
+from mozharness.mozilla.testing.webroot import WebrootSync
+
+
+def make_tree(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(data)
+
+
+def read_tree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            files[os.path.relpath(path, root)] = open(path).read()
+    return files
+
+
+class TestSyncTree(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.addon = os.path.join(self.tmpdir, 'addon')
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        make_tree(self.src, {'talos.py': 'talos', 'startup_test/a.html': 'a',
+                             'base_profile/prefs.js': 'prefs'})
+        make_tree(self.addon, {'pageloader.xpi': 'xpi', 'talos.py': 'patched'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_layers(self):
+        layers = [('', self.src), ('', self.addon), ('base_profile/plugins', self.addon)]
+        self.assertEqual(webroot.sync_tree(layers, self.dest),
+                         {'copied': 6, 'removed': 0, 'unchanged': 0})
+        expected = {
+            'talos.py': 'patched',
+            'pageloader.xpi': 'xpi',
+            'startup_test/a.html': 'a',
+            'base_profile/prefs.js': 'prefs',
+            'base_profile/plugins/pageloader.xpi': 'xpi',
+            'base_profile/plugins/talos.py': 'patched',
+        }
+        self.assertEqual(read_tree(self.dest), expected)
+        self.assertEqual(webroot.sync_tree(layers, self.dest),
+                         {'copied': 0, 'removed': 0, 'unchanged': 6})
+
+    def test_only_changes_are_copied(self):
+        webroot.sync_tree([('', self.src)], self.dest)
+        make_tree(self.dest, {'stale/old.html': 'old', 'extra.txt': 'extra'})
+        shutil.rmtree(os.path.join(self.src, 'startup_test'))
+        # a file where there was a directory
+        make_tree(self.src, {'startup_test': 'now a file', 'talos.py': 'new'})
+        self.assertEqual(webroot.sync_tree([('', self.src)], self.dest),
+                         {'copied': 2, 'removed': 3, 'unchanged': 1})
+        self.assertEqual(read_tree(self.dest), read_tree(self.src))
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ['base_profile', 'startup_test', 'talos.py'])
+
+    def test_same_contents_new_mtime(self):
+        webroot.sync_tree([('', self.src)], self.dest)
+        os.utime(os.path.join(self.src, 'talos.py'), (0, 0))
+        self.assertEqual(webroot.sync_tree([('', self.src)], self.dest)['unchanged'], 3)
+
+
+class TestWebrootSync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.webroot = os.path.join(self.tmpdir, 'talos-data')
+        self.src = os.path.join(self.tmpdir, 'talos')
+        make_tree(self.src, {'talos.py': 'one'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync_and_swap(self):
+        sync = WebrootSync(self.webroot)
+        wanted = {'talos_revision': 'abc', 'archives': []}
+        self.assertFalse(sync.is_current(wanted))
+        sync.sync(wanted, [('', self.src)])
+        self.assertTrue(WebrootSync(self.webroot).is_current(wanted))
+        self.assertEqual(read_tree(sync.live), {'talos.py': 'one'})
+
+        sync = WebrootSync(self.webroot)
+        archive = sync.query_archive_path('f' * 128)
+        make_tree(archive, {'pageloader.xpi': 'xpi'})
+        make_tree(os.path.join(sync.archive_dir, 'unused'), {'a': 'a'})
+        make_tree(self.src, {'talos.py': 'two'})
+        wanted = {'talos_revision': 'def',
+                  'archives': [{'url': 'http://x/a.zip', 'sha512': 'f' * 128, 'dest': ''}]}
+        sync.sync(wanted, [('', self.src), ('', archive)])
+        self.assertEqual(read_tree(sync.live), {'talos.py': 'two', 'pageloader.xpi': 'xpi'})
+        # the previous copy is kept for next time
+        self.assertEqual(read_tree(sync.staging), {'talos.py': 'one'})
+        self.assertEqual(os.listdir(sync.archive_dir), [os.path.basename(archive)])
+        sync = WebrootSync(self.webroot)
+        self.assertTrue(sync.is_current(wanted))
+        self.assertEqual(sync.manifest['staging']['talos_revision'], 'abc')
+
+    def test_missing_live_copy_is_not_current(self):
+        wanted = {'talos_revision': 'abc', 'archives': []}
+        WebrootSync(self.webroot).sync(wanted, [('', self.src)])
+        shutil.rmtree(os.path.join(self.webroot, 'talos'))
+        self.assertFalse(WebrootSync(self.webroot).is_current(wanted))
+
+    def test_interrupted_swap(self):
+        sync = WebrootSync(self.webroot)
+        sync.sync({'talos_revision': 'abc'}, [('', self.src)])
+        os.rename(sync.live, sync.staging + '.swap')
+        sync = WebrootSync(self.webroot)
+        self.assertEqual(read_tree(sync.live), {'talos.py': 'one'})
+        self.assertFalse(os.path.exists(sync.staging + '.swap'))
+
+
+if __name__ == '__main__':
+    unittest.main()